@@ -0,0 +1,432 @@
+"""基准测试用例。每个用例的 setup 构建模型与输入，返回一个无参函数，计时只包含该函数的调用。
+
+benchmark cases. setup of every case builds models and inputs, returns a function without arguments,
+only calls of the function are timed.
+"""
+from collections import OrderedDict
+from types import SimpleNamespace
+from typing import Callable, Dict, Sequence
+import os
+import re
+import tempfile
+
+import numpy as np
+import torch
+from diffusers.models.attention_processor import (
+    Attention,
+    AttnProcessor,
+    AttnProcessor2_0,
+)
+
+from musev.data.data_util import (
+    batch_index_copy,
+    batch_index_fill,
+    batch_index_select,
+)
+from musev.models.attention_processor import (
+    IPAttention,
+    LocalTemporalAttnProcessor,
+    NonParamT2ISelfReferenceXFormersAttnProcessor,
+)
+from musev.models.quantization import WeightOnlyQuantLinear
+from musev.utils.model_util import unload_lora, update_pipeline_lora_model
+from musev.utils.tensor_util import hist_match_video_bcthw
+from musev.utils.util import make_video_grid, save_videos_grid_with_opencv
+
+from tiny_models import (
+    TINY_BLOCK_OUT_CHANNELS,
+    TINY_CROSS_ATTENTION_DIM,
+    TINY_TEXT_LENGTH,
+    build_tiny_controlnet,
+    build_tiny_pipeline,
+    build_tiny_prompt_embeds,
+    build_tiny_referencenet,
+    build_tiny_temporal_transformer,
+    build_tiny_unet,
+    build_tiny_vae,
+)
+
+
+# name: (setup, devices)
+BENCHMARK_CASES = OrderedDict()
+
+VIDEO_LENGTH = 16
+HEIGHT = 64
+WIDTH = 64
+LATENT_HEIGHT = HEIGHT // 8
+LATENT_WIDTH = WIDTH // 8
+
+
+def register_case(name: str, devices: Sequence[str] = ("cpu", "cuda")) -> Callable:
+    def decorator(setup: Callable) -> Callable:
+        BENCHMARK_CASES[name] = (setup, tuple(devices))
+        return setup
+
+    return decorator
+
+
+def _randn(*shape, device: str, dtype: torch.dtype, seed: int = 0) -> torch.Tensor:
+    generator = torch.Generator(device="cpu").manual_seed(seed)
+    return torch.randn(shape, generator=generator).to(device=device, dtype=dtype)
+
+
+def _random_index(
+    batch_size: int, length: int, n: int, device: str, seed: int = 0
+) -> torch.LongTensor:
+    generator = torch.Generator(device="cpu").manual_seed(seed)
+    index = torch.stack(
+        [torch.randperm(length, generator=generator)[:n] for _ in range(batch_size)]
+    )
+    return index.to(device)
+
+
+# ---------------- pipeline ----------------
+@register_case("pipeline_call_context_window")
+def setup_pipeline_call(device: str, dtype: torch.dtype) -> Callable:
+    pipeline = build_tiny_pipeline(device, dtype)
+    prompt_embeds = build_tiny_prompt_embeds(device=device, dtype=dtype)
+
+    def run():
+        return pipeline(
+            video_length=VIDEO_LENGTH,
+            height=HEIGHT,
+            width=WIDTH,
+            num_inference_steps=2,
+            guidance_scale=7.5,
+            generator=torch.Generator(device="cpu").manual_seed(0),
+            output_type="np",
+            context_schedule="uniform",
+            context_frames=8,
+            context_stride=1,
+            context_overlap=2,
+            context_batch_size=1,
+            **prompt_embeds,
+        )
+
+    return run
+
+
+# ---------------- models ----------------
+@register_case("unet3d_forward")
+def setup_unet3d_forward(device: str, dtype: torch.dtype) -> Callable:
+    unet = build_tiny_unet(device, dtype)
+    sample = _randn(
+        2, 4, VIDEO_LENGTH, LATENT_HEIGHT, LATENT_WIDTH, device=device, dtype=dtype
+    )
+    encoder_hidden_states = _randn(
+        2, TINY_TEXT_LENGTH, TINY_CROSS_ATTENTION_DIM, device=device, dtype=dtype
+    )
+    timestep = torch.tensor([500], device=device)
+
+    def run():
+        return unet(sample, timestep, encoder_hidden_states, return_dict=False)
+
+    return run
+
+
+@register_case("referencenet_forward")
+def setup_referencenet_forward(device: str, dtype: torch.dtype) -> Callable:
+    referencenet = build_tiny_referencenet(device, dtype)
+    sample = _randn(1, 4, LATENT_HEIGHT, LATENT_WIDTH, device=device, dtype=dtype)
+    encoder_hidden_states = _randn(
+        1, TINY_TEXT_LENGTH, TINY_CROSS_ATTENTION_DIM, device=device, dtype=dtype
+    )
+    timestep = torch.zeros(1, dtype=torch.long, device=device)
+
+    def run():
+        return referencenet(
+            sample=sample,
+            timestep=timestep,
+            encoder_hidden_states=encoder_hidden_states,
+            num_frames=1,
+            return_ndim=5,
+        )
+
+    return run
+
+
+@register_case("temporal_transformer_forward")
+def setup_temporal_transformer_forward(device: str, dtype: torch.dtype) -> Callable:
+    model = build_tiny_temporal_transformer(device, dtype)
+    channels = TINY_BLOCK_OUT_CHANNELS[0]
+    hidden_states = _randn(
+        VIDEO_LENGTH, channels, 16, 16, device=device, dtype=dtype
+    )
+    femb = _randn(1, VIDEO_LENGTH, channels * 4, device=device, dtype=dtype)
+
+    def run():
+        return model(hidden_states, femb, num_frames=VIDEO_LENGTH, return_dict=False)
+
+    return run
+
+
+@register_case("controlnet_forward")
+def setup_controlnet_forward(device: str, dtype: torch.dtype) -> Callable:
+    controlnet = build_tiny_controlnet(device, dtype)
+    sample = _randn(
+        VIDEO_LENGTH, 4, LATENT_HEIGHT, LATENT_WIDTH, device=device, dtype=dtype
+    )
+    controlnet_cond = _randn(VIDEO_LENGTH, 3, HEIGHT, WIDTH, device=device, dtype=dtype)
+    encoder_hidden_states = _randn(
+        VIDEO_LENGTH,
+        TINY_TEXT_LENGTH,
+        TINY_CROSS_ATTENTION_DIM,
+        device=device,
+        dtype=dtype,
+    )
+    timestep = torch.tensor([500], device=device)
+
+    def run():
+        return controlnet(
+            sample,
+            timestep,
+            encoder_hidden_states=encoder_hidden_states,
+            controlnet_cond=controlnet_cond,
+            return_dict=False,
+        )
+
+    return run
+
+
+@register_case("vae_decode")
+def setup_vae_decode(device: str, dtype: torch.dtype) -> Callable:
+    vae = build_tiny_vae(device, dtype)
+    latents = _randn(
+        VIDEO_LENGTH, 4, LATENT_HEIGHT, LATENT_WIDTH, device=device, dtype=dtype
+    )
+
+    def run():
+        return vae.decode(latents, return_dict=False)
+
+    return run
+
+
+# ---------------- attention processors ----------------
+def _build_attention(
+    processor, device: str, dtype: torch.dtype, attention_class=Attention
+) -> Attention:
+    torch.manual_seed(0)
+    channels = TINY_BLOCK_OUT_CHANNELS[-1]
+    attn = attention_class(
+        query_dim=channels, heads=8, dim_head=channels // 8, processor=processor
+    )
+    attn.requires_grad_(False)
+    return attn.to(device=device, dtype=dtype)
+
+
+def _register_spatial_attn_case(name: str, processor_class: Callable) -> None:
+    @register_case(name)
+    def setup(device: str, dtype: torch.dtype) -> Callable:
+        attn = _build_attention(processor_class(), device, dtype)
+        # (b t) (h w) c
+        hidden_states = _randn(
+            VIDEO_LENGTH, 16 * 16, attn.inner_dim, device=device, dtype=dtype
+        )
+
+        def run():
+            return attn(hidden_states)
+
+        return run
+
+
+def _register_temporal_attn_case(name: str, processor_class: Callable) -> None:
+    @register_case(name)
+    def setup(device: str, dtype: torch.dtype) -> Callable:
+        attn = _build_attention(processor_class(), device, dtype)
+        # (b h w) t c
+        hidden_states = _randn(
+            16 * 16, 4 * VIDEO_LENGTH, attn.inner_dim, device=device, dtype=dtype
+        )
+
+        def run():
+            return attn(hidden_states)
+
+        return run
+
+
+_register_spatial_attn_case("attn_spatial_AttnProcessor", AttnProcessor)
+_register_spatial_attn_case("attn_spatial_AttnProcessor2_0", AttnProcessor2_0)
+_register_temporal_attn_case("attn_temporal_AttnProcessor2_0", AttnProcessor2_0)
+_register_temporal_attn_case(
+    "attn_temporal_LocalTemporalAttnProcessor",
+    lambda: LocalTemporalAttnProcessor(window_size=4),
+)
+
+
+# xformers 的 memory_efficient_attention 需要 cuda. memory_efficient_attention of xformers needs cuda
+@register_case("attn_spatial_NonParamT2ISelfReference", devices=("cuda",))
+def setup_attn_referenceonly(device: str, dtype: torch.dtype) -> Callable:
+    attn = _build_attention(
+        NonParamT2ISelfReferenceXFormersAttnProcessor(),
+        device,
+        dtype,
+        attention_class=IPAttention,
+    )
+    hidden_states = _randn(
+        VIDEO_LENGTH, 16 * 16, attn.inner_dim, device=device, dtype=dtype
+    )
+    vision_conditon_frames_sample_index = torch.LongTensor([[0]]).to(device)
+
+    def run():
+        return attn(
+            hidden_states,
+            num_frames=VIDEO_LENGTH,
+            vision_conditon_frames_sample_index=vision_conditon_frames_sample_index,
+        )
+
+    return run
+
+
+# ---------------- tensor utils ----------------
+@register_case("batch_index_select")
+def setup_batch_index_select(device: str, dtype: torch.dtype) -> Callable:
+    tensor = _randn(2, 4, 4 * VIDEO_LENGTH, 32, 32, device=device, dtype=dtype)
+    index = _random_index(2, 4 * VIDEO_LENGTH, VIDEO_LENGTH, device)
+
+    def run():
+        return batch_index_select(tensor, index=index, dim=2)
+
+    return run
+
+
+@register_case("batch_index_copy")
+def setup_batch_index_copy(device: str, dtype: torch.dtype) -> Callable:
+    tensor = _randn(2, 4, 4 * VIDEO_LENGTH, 32, 32, device=device, dtype=dtype)
+    source = _randn(2, 4, VIDEO_LENGTH, 32, 32, device=device, dtype=dtype, seed=1)
+    index = _random_index(2, 4 * VIDEO_LENGTH, VIDEO_LENGTH, device)
+
+    def run():
+        return batch_index_copy(tensor, dim=2, index=index, source=source)
+
+    return run
+
+
+@register_case("batch_index_fill")
+def setup_batch_index_fill(device: str, dtype: torch.dtype) -> Callable:
+    tensor = _randn(2, 4, 4 * VIDEO_LENGTH, 32, 32, device=device, dtype=dtype)
+    index = _random_index(2, 4 * VIDEO_LENGTH, VIDEO_LENGTH, device)
+
+    def run():
+        return batch_index_fill(tensor, dim=2, index=index, value=0.0)
+
+    return run
+
+
+# ---------------- quantization ----------------
+def _register_linear_case(name: str, bits: int = None, lora_rank: int = None) -> None:
+    @register_case(name)
+    def setup(device: str, dtype: torch.dtype) -> Callable:
+        torch.manual_seed(0)
+        layer = torch.nn.Linear(1280, 1280).to(device=device, dtype=dtype)
+        if bits is not None:
+            layer = WeightOnlyQuantLinear.from_linear(layer, bits=bits)
+        if lora_rank is not None:
+            layer.add_lora(
+                _randn(1280, lora_rank, device=device, dtype=dtype),
+                _randn(lora_rank, 1280, device=device, dtype=dtype, seed=1),
+            )
+        hidden_states = _randn(
+            2 * VIDEO_LENGTH, 1024, 1280, device=device, dtype=dtype
+        )
+
+        def run():
+            return layer(hidden_states)
+
+        return run
+
+
+# 与全精度 nn.Linear 对比，int8 在 cpu 上走 int8 kernel，int4 与 gpu 上是反量化参考实现
+# compared with full precision nn.Linear, int8 on cpu uses int8 kernel, int4 and gpu use dequantize reference kernel
+_register_linear_case("linear_full_precision")
+_register_linear_case("linear_weight_only_int8", bits=8)
+_register_linear_case("linear_weight_only_int4", bits=4)
+# 低秩 lora 旁路的额外开销. extra cost of low-rank lora side-car
+_register_linear_case("linear_weight_only_int8_lora", bits=8, lora_rank=16)
+
+
+# ---------------- lora ----------------
+def build_tiny_lora_state_dict(
+    unet: torch.nn.Module, rank: int = 4, seed: int = 0
+) -> Dict[str, torch.Tensor]:
+    """按 kohya 格式为 spatial attn 的 to_q、to_k、to_v、to_out.0 构建随机 lora
+    build random lora in kohya format for to_q, to_k, to_v, to_out.0 of spatial attns.
+    """
+    generator = torch.Generator(device="cpu").manual_seed(seed)
+    pattern = re.compile(
+        r"^(down_blocks|mid_block|up_blocks).*\.attentions\.\d+\..*attn[12]\.(to_q|to_k|to_v|to_out\.0)$"
+    )
+    state_dict = {}
+    for name, module in unet.named_modules():
+        if not pattern.match(name):
+            continue
+        key = "lora_unet_" + name.replace(".", "_")
+        state_dict[f"{key}.lora_down.weight"] = torch.randn(
+            (rank, module.in_features), generator=generator
+        )
+        state_dict[f"{key}.lora_up.weight"] = torch.randn(
+            (module.out_features, rank), generator=generator
+        )
+        state_dict[f"{key}.alpha"] = torch.tensor(float(rank))
+    return state_dict
+
+
+@register_case("update_pipeline_lora_model")
+def setup_update_pipeline_lora_model(device: str, dtype: torch.dtype) -> Callable:
+    unet = build_tiny_unet(device, dtype)
+    pipeline = SimpleNamespace(unet=unet, text_encoder=None)
+    lora = build_tiny_lora_state_dict(unet)
+
+    def run():
+        # 加载后卸载，使每次调用的初始权重相同
+        # unload after load, so that initial weights are the same for every call
+        _, unload_dict = update_pipeline_lora_model(
+            pipeline, lora, alpha=0.75, device=device, need_unload=True
+        )
+        unload_lora(unload_dict)
+
+    return run
+
+
+# ---------------- post processing ----------------
+@register_case("hist_match_video_bcthw")
+def setup_hist_match(device: str, dtype: torch.dtype) -> Callable:
+    video = torch.rand((1, 3, 4 * VIDEO_LENGTH, 256, 256), device=device, dtype=dtype)
+
+    def run():
+        hist_match_video_bcthw(video[:, :, 1:], video[:, :, :1], value=255.0)
+
+    return run
+
+
+# ---------------- video writing ----------------
+@register_case("make_video_grid")
+def setup_make_video_grid(device: str, dtype: torch.dtype) -> Callable:
+    # 长批量对比视频. long batch comparison video
+    videos = torch.rand((2 * VIDEO_LENGTH, 8, 3, 128, 128), device=device, dtype=dtype)
+    texts = [f"case_{i}" for i in range(videos.shape[1])]
+
+    def run():
+        make_video_grid(videos, 2, texts=texts, font_size=0.6, write_info=True)
+
+    return run
+
+
+@register_case("save_videos_grid_with_opencv", devices=("cpu",))
+def setup_save_videos(device: str, dtype: torch.dtype) -> Callable:
+    rng = np.random.default_rng(0)
+    videos = rng.random((2, 3, VIDEO_LENGTH, 256, 256), dtype=np.float32)
+    output_dir = tempfile.mkdtemp(prefix="musev_benchmark_")
+    path = os.path.join(output_dir, "video.mp4")
+
+    def run():
+        save_videos_grid_with_opencv(
+            videos,
+            path,
+            n_cols=2,
+            texts=["a", "b"],
+            fps=8,
+            tensor_order="b c t h w",
+            save_filetype="mp4",
+        )
+
+    return run
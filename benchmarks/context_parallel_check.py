@@ -0,0 +1,103 @@
+"""在 cpu 上用 gloo 后端检查 context window 多进程并行：与单进程结果逐步比较 latents，并报告耗时。
+
+check context window parallelism on cpu with gloo backend: compare latents of every step with single process,
+and report time.
+
+usage:
+    python benchmarks/context_parallel_check.py --world_size 2
+"""
+from typing import Dict
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+from equivalence import DEFAULT_CALL_KWARGS, compare_runs, format_report
+from tiny_models import build_tiny_pipeline, build_tiny_prompt_embeds
+
+
+def run_tiny_pipeline(call_kwargs: Dict, seed: int, context_parallel: bool):
+    pipeline = build_tiny_pipeline(seed=seed)
+    if context_parallel:
+        pipeline.enable_context_parallel()
+    prompt_embeds = build_tiny_prompt_embeds(seed=seed)
+    step_latents = []
+
+    def callback(step, timestep, latents):
+        step_latents.append(latents.detach().float().cpu().clone())
+
+    torch.manual_seed(seed)
+    start = time.perf_counter()
+    with torch.no_grad():
+        pipeline(
+            generator=torch.Generator(device="cpu").manual_seed(seed),
+            callback=callback,
+            callback_steps=1,
+            **prompt_embeds,
+            **call_kwargs,
+        )
+    return step_latents, time.perf_counter() - start
+
+
+def worker(
+    rank: int, world_size: int, init_file: str, call_kwargs: Dict, seed: int, output: str
+):
+    dist.init_process_group(
+        backend="gloo",
+        init_method=f"file://{init_file}",
+        rank=rank,
+        world_size=world_size,
+    )
+    # 每个进程单线程，避免进程间抢占 cpu. one thread per process to avoid cpu contention
+    torch.set_num_threads(1)
+    step_latents, duration = run_tiny_pipeline(call_kwargs, seed, context_parallel=True)
+    if rank == 0:
+        torch.save({"steps": step_latents, "time": duration}, output)
+    dist.destroy_process_group()
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--world_size", type=int, default=2)
+    parser.add_argument("--video_length", type=int, default=32)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--atol", type=float, default=1e-5)
+    parser.add_argument("--rtol", type=float, default=1e-4)
+    args = parser.parse_args()
+
+    call_kwargs = dict(DEFAULT_CALL_KWARGS)
+    call_kwargs["video_length"] = args.video_length
+
+    torch.set_num_threads(1)
+    reference_steps, reference_time = run_tiny_pipeline(
+        call_kwargs, args.seed, context_parallel=False
+    )
+
+    tmp_dir = tempfile.mkdtemp(prefix="musev_context_parallel_")
+    init_file = os.path.join(tmp_dir, "init")
+    output = os.path.join(tmp_dir, "rank0.pt")
+    mp.spawn(
+        worker,
+        args=(args.world_size, init_file, call_kwargs, args.seed, output),
+        nprocs=args.world_size,
+        join=True,
+    )
+    parallel = torch.load(output)
+
+    result = compare_runs(
+        (reference_steps, {}), (parallel["steps"], {}), atol=args.atol, rtol=args.rtol
+    )
+    print(format_report(f"context_parallel world_size={args.world_size}", result))
+    print(
+        f"  time: single={reference_time:.3f}s, parallel={parallel['time']:.3f}s, speedup={reference_time / parallel['time']:.2f}x"
+    )
+    return 0 if result["passed"] else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,405 @@
+"""优化执行路径的数值等价性检查。
+使用相同随机种子的小模型，分别在优化关闭与开启时运行 MusevControlNetPipeline.__call__，
+按步比较 latents，并通过 forward hook 按执行顺序比较各层输出，报告第一个超出容差的层。
+
+numerical equivalence check of optimized execution paths.
+run MusevControlNetPipeline.__call__ on tiny models with the same seed, once with optimization off and once on,
+compare latents of every step, and compare outputs of layers in execution order via forward hooks,
+report the first layer beyond tolerance.
+
+usage:
+    python benchmarks/equivalence.py --presets sdpa context_batch_size
+    python benchmarks/equivalence.py --presets deep_cache --atol 1e-2 --output equivalence.json
+    # 自定义 pipeline 参数 custom pipeline kwargs
+    python benchmarks/equivalence.py --on '{"temporal_attn_window": 2}'
+"""
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Sequence, Tuple
+import argparse
+import json
+import os
+import sys
+
+import torch
+from torch import nn
+from diffusers.models.attention_processor import AttnProcessor, AttnProcessor2_0
+
+from tiny_models import build_tiny_pipeline, build_tiny_prompt_embeds
+
+
+DEFAULT_CALL_KWARGS = {
+    "video_length": 16,
+    "height": 64,
+    "width": 64,
+    "num_inference_steps": 3,
+    "guidance_scale": 7.5,
+    "output_type": "np",
+    "context_schedule": "uniform",
+    "context_frames": 8,
+    "context_stride": 1,
+    "context_overlap": 2,
+    "context_batch_size": 1,
+}
+
+
+def _set_unet_attn_processor(processor_class: Callable) -> Callable:
+    def setup(pipeline):
+        pipeline.unet.set_attn_processor(processor_class())
+
+    return setup
+
+
+# name: {off, on, off_setup, on_setup, exact}
+# exact 表示理论上只有浮点误差，否则为近似优化，结果差异仅作参考
+# exact means only float error is expected, otherwise it is an approximate optimization and differences are for reference
+EQUIVALENCE_PRESETS = OrderedDict(
+    {
+        "sdpa": {
+            "off": {},
+            "on": {},
+            "off_setup": _set_unet_attn_processor(AttnProcessor),
+            "on_setup": _set_unet_attn_processor(AttnProcessor2_0),
+            "exact": True,
+        },
+        "context_batch_size": {
+            "off": {"context_batch_size": 1},
+            "on": {"context_batch_size": 2},
+            "exact": True,
+        },
+        # 窗口需小于 context_frames // 2 才会真正屏蔽远处帧；chunk_size 不小于帧数时只有一个 dense mask 的 chunk，作为参考
+        # window should be smaller than context_frames // 2 to really mask far frames;
+        # chunk_size not smaller than num of frames gives one chunk with dense mask, used as reference
+        "temporal_attn_window": {
+            "off": {"temporal_attn_window": 2, "temporal_attn_chunk_size": 1024},
+            "on": {"temporal_attn_window": 2, "temporal_attn_chunk_size": 1},
+            "exact": True,
+        },
+        "deep_cache": {
+            "off": {},
+            "on": {"deep_cache_interval": 2},
+            "exact": False,
+        },
+        "reuse_uncond": {
+            "off": {},
+            "on": {
+                "guidance_execution_method": "reuse_uncond",
+                "guidance_uncond_reuse_steps": 1,
+            },
+            "exact": False,
+        },
+    }
+)
+
+
+def _first_tensor(output: Any) -> torch.Tensor:
+    if isinstance(output, torch.Tensor):
+        return output
+    if isinstance(output, (list, tuple)):
+        for x in output:
+            tensor = _first_tensor(x)
+            if tensor is not None:
+                return tensor
+        return None
+    if hasattr(output, "to_tuple"):
+        return _first_tensor(output.to_tuple())
+    return None
+
+
+class LayerOutputRecorder(object):
+    """按执行顺序记录模块输出，键为 (模块名, 第几次调用)
+    record outputs of modules in execution order, key is (module name, index of call).
+
+    Args:
+        model (nn.Module): model to hook, such as unet.
+        prefixes (Sequence[str], optional): only hook modules whose names start with prefixes, None means all. Defaults to None.
+        leaf_only (bool, optional): only hook modules without children. Defaults to True.
+    """
+
+    def __init__(
+        self,
+        model: nn.Module,
+        prefixes: Sequence[str] = None,
+        leaf_only: bool = True,
+    ) -> None:
+        self.records = OrderedDict()
+        self._counts = {}
+        self._hooks = []
+        for name, module in model.named_modules():
+            if name == "":
+                continue
+            if leaf_only and len(list(module.children())) > 0:
+                continue
+            if prefixes is not None and not any(name.startswith(x) for x in prefixes):
+                continue
+            self._hooks.append(module.register_forward_hook(self._make_hook(name)))
+
+    def _make_hook(self, name: str) -> Callable:
+        def hook(module, args, output):
+            tensor = _first_tensor(output)
+            if tensor is None:
+                return
+            index = self._counts.get(name, 0)
+            self._counts[name] = index + 1
+            self.records[(name, index)] = tensor.detach().float().cpu().clone()
+
+        return hook
+
+    def remove(self) -> None:
+        for hook in self._hooks:
+            hook.remove()
+        self._hooks = []
+
+
+def run_pipeline(
+    call_kwargs: Dict,
+    setup: Callable = None,
+    seed: int = 0,
+    device: str = "cpu",
+    dtype: torch.dtype = torch.float32,
+    hook_prefixes: Sequence[str] = None,
+) -> Tuple[List[torch.Tensor], "OrderedDict[Tuple[str, int], torch.Tensor]"]:
+    """每次运行重新构建相同种子的 pipeline，避免上一次运行的缓存等状态影响结果
+    rebuild pipeline with the same seed for every run, so that states such as caches of last run do not affect results.
+
+    Returns:
+        Tuple[List[torch.Tensor], OrderedDict]: latents of every step, outputs of hooked layers.
+    """
+    pipeline = build_tiny_pipeline(device, dtype, seed)
+    if setup is not None:
+        setup(pipeline)
+    prompt_embeds = build_tiny_prompt_embeds(device=device, dtype=dtype, seed=seed)
+    step_latents = []
+
+    def callback(step, timestep, latents):
+        step_latents.append(latents.detach().float().cpu().clone())
+
+    recorder = LayerOutputRecorder(pipeline.unet, prefixes=hook_prefixes)
+    torch.manual_seed(seed)
+    try:
+        with torch.no_grad():
+            pipeline(
+                generator=torch.Generator(device="cpu").manual_seed(seed),
+                callback=callback,
+                callback_steps=1,
+                **prompt_embeds,
+                **call_kwargs,
+            )
+    finally:
+        recorder.remove()
+    return step_latents, recorder.records
+
+
+def diff_stats(
+    reference: torch.Tensor, target: torch.Tensor, atol: float, rtol: float
+) -> Dict[str, Any]:
+    if reference.shape != target.shape:
+        return {
+            "allclose": False,
+            "shape_mismatch": [list(reference.shape), list(target.shape)],
+        }
+    diff = (reference - target).abs()
+    return {
+        "allclose": bool(torch.allclose(target, reference, atol=atol, rtol=rtol)),
+        "max_abs_diff": float(diff.max()),
+        "max_rel_diff": float((diff / reference.abs().clamp(min=1e-8)).max()),
+    }
+
+
+def compare_runs(
+    reference: Tuple[List[torch.Tensor], Dict],
+    target: Tuple[List[torch.Tensor], Dict],
+    atol: float,
+    rtol: float,
+) -> Dict[str, Any]:
+    ref_steps, ref_layers = reference
+    target_steps, target_layers = target
+    steps = []
+    for i, (ref_latents, target_latents) in enumerate(zip(ref_steps, target_steps)):
+        steps.append({"step": i, **diff_stats(ref_latents, target_latents, atol, rtol)})
+
+    # 按参考运行的执行顺序比较，只比较两次运行都存在且 shape 相同的记录
+    # compare in execution order of reference run, only records existing in both runs with same shape
+    first_diverging_layer = None
+    n_unmatched = 0
+    for key, ref_output in ref_layers.items():
+        if key not in target_layers or target_layers[key].shape != ref_output.shape:
+            n_unmatched += 1
+            continue
+        stats = diff_stats(ref_output, target_layers[key], atol, rtol)
+        if not stats["allclose"] and first_diverging_layer is None:
+            first_diverging_layer = {"name": key[0], "call_index": key[1], **stats}
+
+    return {
+        "passed": len(ref_steps) == len(target_steps)
+        and all(x["allclose"] for x in steps),
+        "n_steps": [len(ref_steps), len(target_steps)],
+        "steps": steps,
+        "first_diverging_layer": first_diverging_layer,
+        "n_layer_records": [len(ref_layers), len(target_layers)],
+        "n_unmatched_layer_records": n_unmatched,
+    }
+
+
+def check_equivalence(
+    off: Dict = None,
+    on: Dict = None,
+    off_setup: Callable = None,
+    on_setup: Callable = None,
+    atol: float = 1e-4,
+    rtol: float = 1e-3,
+    seed: int = 0,
+    device: str = "cpu",
+    dtype: torch.dtype = torch.float32,
+    base_call_kwargs: Dict = None,
+    hook_prefixes: Sequence[str] = None,
+) -> Dict[str, Any]:
+    """优化关闭（参考）与开启各运行一次并比较. run once with optimization off (reference) and once on, then compare.
+
+    Args:
+        off (Dict, optional): pipeline kwargs with optimization off. Defaults to None.
+        on (Dict, optional): pipeline kwargs with optimization on. Defaults to None.
+        off_setup (Callable, optional): called with pipeline before run with optimization off. Defaults to None.
+        on_setup (Callable, optional): called with pipeline before run with optimization on. Defaults to None.
+        atol (float, optional): absolute tolerance of torch.allclose. Defaults to 1e-4.
+        rtol (float, optional): relative tolerance of torch.allclose. Defaults to 1e-3.
+        base_call_kwargs (Dict, optional): shared pipeline kwargs. Defaults to DEFAULT_CALL_KWARGS.
+        hook_prefixes (Sequence[str], optional): only compare unet layers whose names start with prefixes. Defaults to None.
+    """
+    if base_call_kwargs is None:
+        base_call_kwargs = DEFAULT_CALL_KWARGS
+    runs = []
+    for kwargs, setup in [(off, off_setup), (on, on_setup)]:
+        call_kwargs = dict(base_call_kwargs)
+        call_kwargs.update(kwargs or {})
+        runs.append(
+            run_pipeline(
+                call_kwargs,
+                setup=setup,
+                seed=seed,
+                device=device,
+                dtype=dtype,
+                hook_prefixes=hook_prefixes,
+            )
+        )
+    return compare_runs(runs[0], runs[1], atol=atol, rtol=rtol)
+
+
+def format_report(name: str, result: Dict[str, Any], exact: bool = True) -> str:
+    lines = [
+        f"[{name}] {'PASS' if result['passed'] else 'DIVERGED'}"
+        + ("" if exact else " (approximate optimization)")
+    ]
+    for step in result["steps"]:
+        if "shape_mismatch" in step:
+            lines.append(f"  step {step['step']}: shape mismatch {step['shape_mismatch']}")
+        else:
+            lines.append(
+                f"  step {step['step']}: max_abs_diff={step['max_abs_diff']:.3e}, max_rel_diff={step['max_rel_diff']:.3e}, allclose={step['allclose']}"
+            )
+    layer = result["first_diverging_layer"]
+    if layer is None:
+        lines.append("  first diverging layer: None")
+    else:
+        lines.append(
+            f"  first diverging layer: {layer['name']} (call {layer['call_index']}), max_abs_diff={layer['max_abs_diff']:.3e}"
+        )
+    lines.append(
+        f"  layer records: {result['n_layer_records']}, unmatched: {result['n_unmatched_layer_records']}"
+    )
+    return "\n".join(lines)
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="numerical equivalence check of optimized execution paths."
+    )
+    parser.add_argument(
+        "--presets",
+        type=str,
+        nargs="*",
+        default=None,
+        help=f"presets to check, default all, support {list(EQUIVALENCE_PRESETS.keys())}",
+    )
+    parser.add_argument(
+        "--off", type=str, default=None, help="json of pipeline kwargs, optimization off"
+    )
+    parser.add_argument(
+        "--on", type=str, default=None, help="json of pipeline kwargs, optimization on"
+    )
+    parser.add_argument("--atol", type=float, default=1e-4)
+    parser.add_argument("--rtol", type=float, default=1e-3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--device", type=str, default="cpu", choices=["cpu", "cuda"])
+    parser.add_argument(
+        "--hook_prefixes",
+        type=str,
+        nargs="*",
+        default=None,
+        help="only compare unet layers whose names start with prefixes",
+    )
+    parser.add_argument("--output", type=str, default=None, help="save report as json")
+    parser.add_argument(
+        "--fail_on_diverge",
+        action="store_true",
+        help="exit with code 1 when any exact preset or custom check diverges",
+    )
+    return parser.parse_args()
+
+
+def main() -> int:
+    args = parse_args()
+    checks = OrderedDict()
+    if args.off is not None or args.on is not None:
+        checks["custom"] = {
+            "off": json.loads(args.off) if args.off is not None else {},
+            "on": json.loads(args.on) if args.on is not None else {},
+            "exact": True,
+        }
+    if args.presets is not None or len(checks) == 0:
+        names = (
+            args.presets
+            if args.presets is not None and len(args.presets) > 0
+            else list(EQUIVALENCE_PRESETS.keys())
+        )
+        for name in names:
+            if name not in EQUIVALENCE_PRESETS:
+                raise ValueError(
+                    f"unknown preset {name}, only support {list(EQUIVALENCE_PRESETS.keys())}"
+                )
+            checks[name] = EQUIVALENCE_PRESETS[name]
+
+    report = OrderedDict()
+    failed = []
+    for name, check in checks.items():
+        result = check_equivalence(
+            off=check.get("off"),
+            on=check.get("on"),
+            off_setup=check.get("off_setup"),
+            on_setup=check.get("on_setup"),
+            atol=args.atol,
+            rtol=args.rtol,
+            seed=args.seed,
+            device=args.device,
+            hook_prefixes=args.hook_prefixes,
+        )
+        result["exact"] = check.get("exact", True)
+        report[name] = result
+        print(format_report(name, result, exact=result["exact"]))
+        if result["exact"] and not result["passed"]:
+            failed.append(name)
+
+    if args.output is not None:
+        dirname = os.path.dirname(args.output)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=4)
+    if len(failed) > 0:
+        print(f"diverged: {failed}", file=sys.stderr)
+        if args.fail_on_diverge:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,260 @@
+"""MuseV 基准测试，使用随机初始化的小模型，不需要模型文件与网络。
+打印稳定排序的结果表，可保存 json 基线，并与基线比较，标记性能回退。
+
+MuseV benchmark with tiny randomly initialized models, no checkpoint or network is needed.
+print result table in stable order, save json baseline, and compare with baseline to flag regressions.
+
+usage:
+    # 保存基线 save baseline
+    python benchmarks/run_benchmark.py --output benchmarks/baseline_cpu.json
+    # 与基线比较 compare with baseline
+    python benchmarks/run_benchmark.py --baseline benchmarks/baseline_cpu.json --fail_on_regression
+"""
+from collections import OrderedDict
+from typing import Callable, Dict, List
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+import numpy as np
+import torch
+
+from cases import BENCHMARK_CASES
+
+
+DTYPE_MAP = {"fp32": torch.float32, "fp16": torch.float16, "bf16": torch.bfloat16}
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="MuseV benchmark with tiny models.")
+    parser.add_argument(
+        "--cases",
+        type=str,
+        nargs="+",
+        default=None,
+        help="names of cases to run, default all cases supported by device",
+    )
+    parser.add_argument("--list", action="store_true", help="list cases and exit")
+    parser.add_argument("--device", type=str, default="cpu", choices=["cpu", "cuda"])
+    parser.add_argument("--dtype", type=str, default="fp32", choices=DTYPE_MAP.keys())
+    parser.add_argument("--warmup", type=int, default=2, help="untimed calls")
+    parser.add_argument("--repeat", type=int, default=5, help="timed calls")
+    parser.add_argument(
+        "--num_threads",
+        type=int,
+        default=4,
+        help="torch threads on cpu, fixed to make results comparable",
+    )
+    parser.add_argument(
+        "--output", type=str, default=None, help="save results as json baseline"
+    )
+    parser.add_argument(
+        "--baseline", type=str, default=None, help="json baseline to compare with"
+    )
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.2,
+        help="flag regression when median is slower than baseline by this ratio",
+    )
+    parser.add_argument(
+        "--fail_on_regression",
+        action="store_true",
+        help="exit with code 1 when any regression is flagged",
+    )
+    return parser.parse_args()
+
+
+def get_git_commit() -> str:
+    try:
+        return (
+            subprocess.check_output(
+                ["git", "rev-parse", "--short", "HEAD"],
+                cwd=os.path.dirname(os.path.abspath(__file__)),
+                stderr=subprocess.DEVNULL,
+            )
+            .decode()
+            .strip()
+        )
+    except Exception:
+        return None
+
+
+def get_env(args: argparse.Namespace) -> Dict:
+    return {
+        "device": args.device,
+        "dtype": args.dtype,
+        "num_threads": torch.get_num_threads(),
+        "torch": torch.__version__,
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "gpu": torch.cuda.get_device_name() if args.device == "cuda" else None,
+        "git_commit": get_git_commit(),
+    }
+
+
+def time_case(
+    fn: Callable, warmup: int, repeat: int, device: str
+) -> Dict[str, float]:
+    def sync():
+        if device == "cuda":
+            torch.cuda.synchronize()
+
+    with torch.no_grad():
+        for _ in range(warmup):
+            fn()
+        sync()
+        times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            fn()
+            sync()
+            times.append((time.perf_counter() - start) * 1000)
+    times = np.array(times)
+    return {
+        "median_ms": float(np.median(times)),
+        "min_ms": float(times.min()),
+        "mean_ms": float(times.mean()),
+        "std_ms": float(times.std()),
+        "repeat": repeat,
+    }
+
+
+def compare_with_baseline(
+    results: Dict[str, Dict], baseline: Dict, threshold: float
+) -> Dict[str, Dict]:
+    """比较中位数，慢于基线 threshold 以上标记为 regression，快于基线 threshold 以上标记为 improved
+    compare medians, slower than baseline by threshold is regression, faster by threshold is improved.
+    """
+    baseline_results = baseline.get("results", {})
+    comparison = OrderedDict()
+    for name, result in results.items():
+        if name not in baseline_results:
+            comparison[name] = {"baseline_ms": None, "ratio": None, "status": "new"}
+            continue
+        baseline_ms = baseline_results[name]["median_ms"]
+        ratio = result["median_ms"] / max(baseline_ms, 1e-6)
+        if ratio > 1 + threshold:
+            status = "REGRESSION"
+        elif ratio < 1 - threshold:
+            status = "improved"
+        else:
+            status = "ok"
+        comparison[name] = {
+            "baseline_ms": baseline_ms,
+            "ratio": ratio,
+            "status": status,
+        }
+    return comparison
+
+
+def format_table(results: Dict[str, Dict], comparison: Dict[str, Dict] = None) -> str:
+    header = ["case", "median_ms", "min_ms", "std_ms"]
+    if comparison is not None:
+        header += ["baseline_ms", "ratio", "status"]
+    rows = []
+    for name, result in results.items():
+        row = [
+            name,
+            f"{result['median_ms']:.3f}",
+            f"{result['min_ms']:.3f}",
+            f"{result['std_ms']:.3f}",
+        ]
+        if comparison is not None:
+            item = comparison[name]
+            row += [
+                "-" if item["baseline_ms"] is None else f"{item['baseline_ms']:.3f}",
+                "-" if item["ratio"] is None else f"{item['ratio']:.3f}",
+                item["status"],
+            ]
+        rows.append(row)
+    widths = [max(len(str(x)) for x in column) for column in zip(header, *rows)]
+    lines = [
+        "  ".join(str(x).ljust(width) for x, width in zip(header, widths)),
+        "  ".join("-" * width for width in widths),
+    ]
+    for row in rows:
+        lines.append("  ".join(str(x).ljust(width) for x, width in zip(row, widths)))
+    return "\n".join(lines)
+
+
+def select_cases(names: List[str], device: str) -> List[str]:
+    if names is None:
+        return [
+            name for name, (_, devices) in BENCHMARK_CASES.items() if device in devices
+        ]
+    for name in names:
+        if name not in BENCHMARK_CASES:
+            raise ValueError(
+                f"unknown case {name}, only support {list(BENCHMARK_CASES.keys())}"
+            )
+    # 保持注册顺序，使结果表稳定. keep register order, so that table is stable
+    return [name for name in BENCHMARK_CASES if name in names]
+
+
+def main() -> int:
+    args = parse_args()
+    if args.list:
+        for name, (_, devices) in BENCHMARK_CASES.items():
+            print(f"{name}  {','.join(devices)}")
+        return 0
+    if args.device == "cuda" and not torch.cuda.is_available():
+        raise ValueError("device is cuda, but cuda is not available")
+    if args.device == "cpu":
+        torch.set_num_threads(args.num_threads)
+    dtype = DTYPE_MAP[args.dtype]
+
+    results = OrderedDict()
+    for name in select_cases(args.cases, args.device):
+        setup, _ = BENCHMARK_CASES[name]
+        print(f"run {name}", file=sys.stderr)
+        fn = setup(args.device, dtype)
+        results[name] = time_case(fn, args.warmup, args.repeat, args.device)
+        del fn
+        if args.device == "cuda":
+            torch.cuda.empty_cache()
+
+    env = get_env(args)
+    comparison = None
+    if args.baseline is not None:
+        with open(args.baseline, "r") as f:
+            baseline = json.load(f)
+        baseline_env = baseline.get("env", {})
+        for key in ["device", "dtype", "num_threads"]:
+            if baseline_env.get(key) != env[key]:
+                print(
+                    f"warning: {key} of baseline is {baseline_env.get(key)}, but current is {env[key]}",
+                    file=sys.stderr,
+                )
+        comparison = compare_with_baseline(results, baseline, args.threshold)
+
+    print(format_table(results, comparison))
+
+    if args.output is not None:
+        output = {"env": env, "results": results}
+        if comparison is not None:
+            output["comparison"] = comparison
+        dirname = os.path.dirname(args.output)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        with open(args.output, "w") as f:
+            json.dump(output, f, indent=4)
+        print(f"save results to {args.output}", file=sys.stderr)
+
+    if comparison is not None:
+        regressions = [
+            name for name, item in comparison.items() if item["status"] == "REGRESSION"
+        ]
+        if len(regressions) > 0:
+            print(f"regressions: {regressions}", file=sys.stderr)
+            if args.fail_on_regression:
+                return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
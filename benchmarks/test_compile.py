@@ -0,0 +1,104 @@
+"""在小模型上测试 UNet3DConditionModel.enable_compile：torch.compile(fullgraph=True) 无 graph break，
+经过 prepare_compile_inputs 后与 eager 输出一致，每个分辨率桶只编译一次，编译模式只作用于被编译的模型。
+
+tests of UNet3DConditionModel.enable_compile on tiny model: torch.compile(fullgraph=True) has no graph break,
+outputs match eager after prepare_compile_inputs, every resolution bucket is compiled once,
+and compile mode only applies to the compiled model.
+
+usage:
+    cd benchmarks && python -m pytest -q test_compile.py
+"""
+from typing import Tuple
+
+import pytest
+import torch
+
+from tiny_models import (
+    TINY_CROSS_ATTENTION_DIM,
+    TINY_TEXT_LENGTH,
+    build_tiny_unet,
+)
+
+
+VIDEO_LENGTH = 4
+ATOL = 1e-4
+RTOL = 1e-3
+
+
+def build_inputs(
+    latent_size: Tuple[int, int], seed: int = 0
+) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+    generator = torch.Generator(device="cpu").manual_seed(seed)
+    sample = torch.randn(2, 4, VIDEO_LENGTH, *latent_size, generator=generator)
+    encoder_hidden_states = torch.randn(
+        2, TINY_TEXT_LENGTH, TINY_CROSS_ATTENTION_DIM, generator=generator
+    )
+    timestep = torch.tensor([500])
+    return sample, timestep, encoder_hidden_states
+
+
+@pytest.fixture
+def unet():
+    unet = build_tiny_unet()
+    yield unet
+    unet.disable_compile()
+
+
+@pytest.mark.parametrize("backend", ["aot_eager", "inductor"])
+def test_compiled_forward_matches_eager(unet, backend):
+    # 两个分辨率桶，第一个调用两次，验证命中已编译的桶
+    # two resolution buckets, the first one is called twice to check hit of compiled bucket
+    latent_sizes = [(8, 8), (8, 12), (8, 8)]
+    inputs = [build_inputs(latent_size) for latent_size in latent_sizes]
+    with torch.no_grad():
+        references = [unet(*x, return_dict=False)[0] for x in inputs]
+
+    unet.enable_compile(fullgraph=True, backend=backend)
+    with torch.no_grad():
+        outputs = [unet(*x, return_dict=False)[0] for x in inputs]
+    for output, reference in zip(outputs, references):
+        torch.testing.assert_close(output, reference, atol=ATOL, rtol=RTOL)
+    assert unet.compiled_forward_cache.stats() == {
+        "n_compiled_buckets": 2,
+        "compiled_calls": 3,
+        "n_eager_buckets": 0,
+        "eager_calls": 0,
+    }
+
+
+def test_context_windows_share_bucket(unet):
+    # 只有 deep_cache_key 等不影响计算图的参数变化时，不产生新桶
+    # no new bucket when only arguments not changing graph, such as deep_cache_key, change
+    unet.enable_compile(fullgraph=True, backend="aot_eager", max_buckets=2)
+    x = build_inputs((8, 8))
+    with torch.no_grad():
+        for start in range(4):
+            unet(*x, return_dict=False, deep_cache_key=((start, start + 1),))
+    stats = unet.compiled_forward_cache.stats()
+    assert stats["n_compiled_buckets"] == 1
+    assert stats["compiled_calls"] == 4
+    assert stats["eager_calls"] == 0
+
+
+def test_deep_cache_is_rejected_in_compile_mode(unet):
+    unet.set_deep_cache()
+    unet.enable_compile(fullgraph=True, backend="aot_eager")
+    with pytest.raises(ValueError):
+        unet(*build_inputs((8, 8)), return_dict=False, deep_cache_mode="full")
+
+
+def test_compile_mode_is_per_model(unet):
+    other = build_tiny_unet()
+    unet.enable_compile(fullgraph=True, backend="aot_eager")
+    x = build_inputs((8, 8))
+    with torch.no_grad():
+        unet(*x, return_dict=False)
+        other(*x, return_dict=False)
+    # 未编译的模型照常自增 print_idx. model not compiled increases print_idx as usual
+    assert other.print_idx == 1
+    assert all(not getattr(m, "compile_mode", False) for m in other.modules())
+
+    unet.disable_compile()
+    # 关闭编译后恢复原 print_idx. print_idx is restored after compile is disabled
+    assert unet.print_idx == 0
+    assert all(not getattr(m, "compile_mode", False) for m in unet.modules())
@@ -0,0 +1,188 @@
+"""随机初始化的小模型配置，用于基准测试，不需要下载模型或联网。
+结构与 MuseV 推理时使用的模型一致，只缩小通道数与层数，每次构建使用固定随机种子，结果可复现。
+
+tiny randomly initialized model configs for benchmarks, no checkpoint or network is needed.
+structures are the same as models used by MuseV inference, only channels and layers are reduced,
+every build uses fixed random seed, so results are reproducible.
+"""
+from typing import Dict
+import logging
+
+import torch
+from torch import nn
+from transformers import CLIPTextConfig, CLIPTextModel
+from diffusers.models import AutoencoderKL, ControlNetModel
+
+from musev.models.unet_3d_condition import UNet3DConditionModel
+from musev.models.referencenet import ReferenceNet2D
+from musev.models.temporal_transformer import TransformerTemporalModel
+from musev.pipelines.pipeline_controlnet import MusevControlNetPipeline
+from musev.schedulers import EulerDiscreteScheduler
+
+
+logger = logging.getLogger(__name__)
+
+# TemporalConvLayer 中 GroupNorm 固定为 32 组，通道数需为 32 的整数倍
+# GroupNorm in TemporalConvLayer uses 32 groups, channels should be multiples of 32
+TINY_BLOCK_OUT_CHANNELS = (32, 64)
+TINY_CROSS_ATTENTION_DIM = 32
+TINY_ATTENTION_HEAD_DIM = 8
+TINY_TEXT_LENGTH = 77
+# 与 sd 一致，vae 下采样 8 倍. same as sd, vae downsamples 8 times
+TINY_VAE_BLOCK_OUT_CHANNELS = (32, 32, 64, 64)
+
+
+def _seed(seed: int) -> None:
+    torch.manual_seed(seed)
+
+
+def _prepare(model: nn.Module, device: str, dtype: torch.dtype) -> nn.Module:
+    model.requires_grad_(False)
+    model.eval()
+    return model.to(device=device, dtype=dtype)
+
+
+def build_tiny_unet(
+    device: str = "cpu", dtype: torch.dtype = torch.float32, seed: int = 0
+) -> UNet3DConditionModel:
+    _seed(seed)
+    unet = UNet3DConditionModel(
+        in_channels=4,
+        out_channels=4,
+        down_block_types=("CrossAttnDownBlock3D", "DownBlock3D"),
+        up_block_types=("UpBlock3D", "CrossAttnUpBlock3D"),
+        block_out_channels=TINY_BLOCK_OUT_CHANNELS,
+        layers_per_block=1,
+        cross_attention_dim=TINY_CROSS_ATTENTION_DIM,
+        attention_head_dim=TINY_ATTENTION_HEAD_DIM,
+        need_t2i_ip_adapter=False,
+        need_refer_emb=False,
+    )
+    return _prepare(unet, device, dtype)
+
+
+def build_tiny_referencenet(
+    device: str = "cpu", dtype: torch.dtype = torch.float32, seed: int = 0
+) -> ReferenceNet2D:
+    _seed(seed)
+    referencenet = ReferenceNet2D(
+        in_channels=4,
+        out_channels=4,
+        down_block_types=("CrossAttnDownBlock2D", "DownBlock2D"),
+        up_block_types=("UpBlock2D", "CrossAttnUpBlock2D"),
+        block_out_channels=TINY_BLOCK_OUT_CHANNELS,
+        layers_per_block=1,
+        cross_attention_dim=TINY_CROSS_ATTENTION_DIM,
+        attention_head_dim=TINY_ATTENTION_HEAD_DIM,
+        need_block_embs=True,
+        need_self_attn_block_embs=False,
+    )
+    return _prepare(referencenet, device, dtype)
+
+
+def build_tiny_temporal_transformer(
+    device: str = "cpu", dtype: torch.dtype = torch.float32, seed: int = 0
+) -> TransformerTemporalModel:
+    _seed(seed)
+    channels = TINY_BLOCK_OUT_CHANNELS[0]
+    model = TransformerTemporalModel(
+        num_attention_heads=TINY_ATTENTION_HEAD_DIM,
+        attention_head_dim=channels // TINY_ATTENTION_HEAD_DIM,
+        in_channels=channels,
+        num_layers=1,
+        femb_channels=channels * 4,
+        cross_attention_dim=TINY_CROSS_ATTENTION_DIM,
+    )
+    return _prepare(model, device, dtype)
+
+
+def build_tiny_vae(
+    device: str = "cpu", dtype: torch.dtype = torch.float32, seed: int = 0
+) -> AutoencoderKL:
+    _seed(seed)
+    n_blocks = len(TINY_VAE_BLOCK_OUT_CHANNELS)
+    vae = AutoencoderKL(
+        in_channels=3,
+        out_channels=3,
+        down_block_types=("DownEncoderBlock2D",) * n_blocks,
+        up_block_types=("UpDecoderBlock2D",) * n_blocks,
+        block_out_channels=TINY_VAE_BLOCK_OUT_CHANNELS,
+        layers_per_block=1,
+        latent_channels=4,
+        norm_num_groups=32,
+    )
+    return _prepare(vae, device, dtype)
+
+
+def build_tiny_controlnet(
+    device: str = "cpu", dtype: torch.dtype = torch.float32, seed: int = 0
+) -> ControlNetModel:
+    _seed(seed)
+    controlnet = ControlNetModel(
+        in_channels=4,
+        down_block_types=("CrossAttnDownBlock2D", "DownBlock2D"),
+        block_out_channels=TINY_BLOCK_OUT_CHANNELS,
+        layers_per_block=1,
+        cross_attention_dim=TINY_CROSS_ATTENTION_DIM,
+        attention_head_dim=TINY_ATTENTION_HEAD_DIM,
+        # 条件图下采样 8 倍到 latent 尺寸. downsample condition image 8 times to latent size
+        conditioning_embedding_out_channels=(8, 16, 32, 32),
+    )
+    return _prepare(controlnet, device, dtype)
+
+
+def build_tiny_text_encoder(
+    device: str = "cpu", dtype: torch.dtype = torch.float32, seed: int = 0
+) -> CLIPTextModel:
+    """基准测试直接传入 prompt_embeds，text_encoder 只用于满足 pipeline 的接口
+    benchmarks pass prompt_embeds directly, text_encoder is only used to satisfy interface of pipeline.
+    """
+    _seed(seed)
+    config = CLIPTextConfig(
+        vocab_size=1000,
+        hidden_size=TINY_CROSS_ATTENTION_DIM,
+        intermediate_size=TINY_CROSS_ATTENTION_DIM * 2,
+        num_hidden_layers=1,
+        num_attention_heads=2,
+        max_position_embeddings=TINY_TEXT_LENGTH,
+    )
+    return _prepare(CLIPTextModel(config), device, dtype)
+
+
+def build_tiny_pipeline(
+    device: str = "cpu",
+    dtype: torch.dtype = torch.float32,
+    seed: int = 0,
+    need_controlnet: bool = False,
+) -> MusevControlNetPipeline:
+    pipeline = MusevControlNetPipeline(
+        vae=build_tiny_vae(device, dtype, seed),
+        unet=build_tiny_unet(device, dtype, seed),
+        scheduler=EulerDiscreteScheduler(),
+        controlnet=build_tiny_controlnet(device, dtype, seed)
+        if need_controlnet
+        else None,
+        text_encoder=build_tiny_text_encoder(device, dtype, seed),
+        tokenizer=None,
+        safety_checker=None,
+        feature_extractor=None,
+        requires_safety_checker=False,
+    )
+    pipeline.set_progress_bar_config(disable=True)
+    return pipeline
+
+
+def build_tiny_prompt_embeds(
+    batch_size: int = 1,
+    device: str = "cpu",
+    dtype: torch.dtype = torch.float32,
+    seed: int = 0,
+) -> Dict[str, torch.Tensor]:
+    generator = torch.Generator(device="cpu").manual_seed(seed)
+    shape = (batch_size, TINY_TEXT_LENGTH, TINY_CROSS_ATTENTION_DIM)
+    return {
+        "prompt_embeds": torch.randn(shape, generator=generator).to(device, dtype),
+        "negative_prompt_embeds": torch.randn(shape, generator=generator).to(
+            device, dtype
+        ),
+    }
@@ -1,4 +1,4 @@
-from typing import List, Dict, Literal, Union, Tuple
+from typing import List, Dict, Literal, Optional, Sequence, Union, Tuple
 import os
 import string
 import logging
@@ -298,22 +298,22 @@ def interwine_two_tensor(
     dim: int,
     return_index: bool = False,
 ) -> torch.Tensor:
+    """data1 放在 dim 维的偶数位置，data2 依次放在剩余位置
+    data1 is placed at even positions of dim, data2 fills the remaining positions in order.
+    """
     shape1 = list(data1.shape)
     shape2 = list(data2.shape)
     target_shape = list(shape1)
     target_shape[dim] = shape1[dim] + shape2[dim]
     target = torch.zeros(target_shape, device=data1.device, dtype=data1.dtype)
-    data1_reshape = torch.swapaxes(data1, 0, dim)
-    data2_reshape = torch.swapaxes(data2, 0, dim)
-    target = torch.swapaxes(target, 0, dim)
-    total_index = set(range(target_shape[dim]))
-    data1_index = range(0, 2 * shape1[dim], 2)
-    data2_index = sorted(list(set(total_index) - set(data1_index)))
-    data1_index = torch.LongTensor(data1_index)
-    data2_index = torch.LongTensor(data2_index)
-    target[data1_index, ...] = data1_reshape
-    target[data2_index, ...] = data2_reshape
-    target = torch.swapaxes(target, 0, dim)
+    data1_index = torch.arange(
+        0, 2 * shape1[dim], 2, dtype=torch.long, device=data1.device
+    )
+    data2_mask = torch.ones(target_shape[dim], dtype=torch.bool, device=data1.device)
+    data2_mask[data1_index] = False
+    data2_index = torch.nonzero(data2_mask, as_tuple=True)[0]
+    target.index_copy_(dim, data1_index, data1)
+    target.index_copy_(dim, data2_index, data2)
     if return_index:
         return target, data1_index, data2_index
     else:
@@ -409,11 +409,47 @@ def split_tensor(
         return (first_tensor, last_tensor)
 
 
-# TODO: 待确定batch_index_select的优化
+def uniform_batch_index(index: torch.LongTensor) -> Optional[torch.LongTensor]:
+    """二维 index 每个 batch 都相同时返回一维 index，否则返回 None
+    return 1D index if every row of 2D index is the same, otherwise None.
+    """
+    if index.ndim == 1:
+        return index
+    if index.shape[0] == 1:
+        return index[0]
+    if bool((index == index[:1]).all()):
+        return index[0]
+    return None
+
+
+def expand_batch_index(
+    index: torch.LongTensor, shape: Sequence[int], dim: int
+) -> torch.LongTensor:
+    """将 b*n 的 index 扩展为与 shape 相同（dim 维为 n）的视图，用于 gather、scatter_
+    expand b*n index to a view of shape with n at dim, for gather and scatter_.
+
+    Args:
+        index (torch.LongTensor): b*n, b equals shape[0].
+        shape (Sequence[int]): target shape, such as b*c*t*h*w.
+        dim (int): dim to index, > 0.
+
+    Returns:
+        torch.LongTensor: D1*...*N*..., expanded without copying.
+    """
+    view_shape = [1] * len(shape)
+    view_shape[0] = index.shape[0]
+    view_shape[dim] = index.shape[1]
+    expand_shape = list(shape)
+    expand_shape[dim] = index.shape[1]
+    return index.view(view_shape).expand(expand_shape)
+
+
 def batch_index_select(
     tensor: torch.Tensor, index: torch.LongTensor, dim: int
 ) -> torch.Tensor:
-    """_summary_
+    """index 为二维时每个 batch 使用各自的 index，用 gather 一次完成；各 batch index 相同时退化为 index_select
+    with 2D index every batch uses its own index, done at once with gather;
+    falls back to index_select when index of every batch is the same.
 
     Args:
         tensor (torch.Tensor): D1*D2*D3*D4...
@@ -424,23 +460,21 @@ def batch_index_select(
         torch.Tensor: D1*...*N*...
     """
     # TODO: now only support N same for every d1
-    if len(index.shape) == 1:
-        return torch.index_select(tensor, dim=dim, index=index)
-    else:
-        index = repeat_index_to_target_size(index, tensor.shape[0])
-        out = []
-        for i in torch.arange(tensor.shape[0]):
-            sub_tensor = tensor[i]
-            sub_index = index[i]
-            d = torch.index_select(sub_tensor, dim=dim - 1, index=sub_index)
-            out.append(d)
-        return torch.stack(out).to(dtype=tensor.dtype)
+    dim = dim % tensor.ndim
+    uniform_index = uniform_batch_index(index)
+    if uniform_index is not None:
+        return torch.index_select(tensor, dim=dim, index=uniform_index)
+    index = repeat_index_to_target_size(index, tensor.shape[0])
+    return torch.gather(
+        tensor, dim=dim, index=expand_batch_index(index, tensor.shape, dim)
+    )
 
 
 def batch_index_copy(
     tensor: torch.Tensor, dim: int, index: torch.LongTensor, source: torch.Tensor
 ) -> torch.Tensor:
-    """_summary_
+    """原地将 source 按各 batch 的 index 拷贝到 tensor，用 scatter_ 一次完成
+    copy source into tensor in place by index of every batch, done at once with scatter_.
 
     Args:
         tensor (torch.Tensor): b*c*h
@@ -453,18 +487,13 @@ def batch_index_copy(
     Returns:
         torch.Tensor: b*c*d*...
     """
-    if len(index.shape) == 1:
-        tensor.index_copy_(dim=dim, index=index, source=source)
+    dim = dim % tensor.ndim
+    uniform_index = uniform_batch_index(index)
+    if uniform_index is not None:
+        tensor.index_copy_(dim=dim, index=uniform_index, source=source)
     else:
         index = repeat_index_to_target_size(index, tensor.shape[0])
-
-        batch_size = tensor.shape[0]
-        for b in torch.arange(batch_size):
-            sub_index = index[b]
-            sub_source = source[b]
-            sub_tensor = tensor[b]
-            sub_tensor.index_copy_(dim=dim - 1, index=sub_index, source=sub_source)
-            tensor[b] = sub_tensor
+        tensor.scatter_(dim, expand_batch_index(index, source.shape, dim), source)
     return tensor
 
 
@@ -474,7 +503,8 @@ def batch_index_fill(
     index: torch.LongTensor,
     value: Literal[torch.Tensor, torch.float],
 ) -> torch.Tensor:
-    """_summary_
+    """原地按各 batch 的 index 填充 value，用 scatter_ 一次完成
+    fill value into tensor in place by index of every batch, done at once with scatter_.
 
     Args:
         tensor (torch.Tensor): b*c*h
@@ -485,15 +515,20 @@ def batch_index_fill(
     Returns:
         torch.Tensor: b*c*d*...
     """
+    dim = dim % tensor.ndim
+    uniform_index = uniform_batch_index(index)
+    if uniform_index is not None and not isinstance(value, torch.Tensor):
+        return tensor.index_fill_(dim, uniform_index, value)
     index = repeat_index_to_target_size(index, tensor.shape[0])
-    batch_size = tensor.shape[0]
-    for b in torch.arange(batch_size):
-        sub_index = index[b]
-        sub_value = value[b] if isinstance(value, torch.Tensor) else value
-        sub_tensor = tensor[b]
-        sub_tensor.index_fill_(dim - 1, sub_index, sub_value)
-        tensor[b] = sub_tensor
-    return tensor
+    index = expand_batch_index(index, tensor.shape, dim)
+    if isinstance(value, torch.Tensor):
+        # 每个 batch 一个值. one value per batch
+        value = (
+            value.to(device=tensor.device, dtype=tensor.dtype)
+            .reshape(-1, *[1] * (tensor.ndim - 1))
+            .expand(index.shape)
+        )
+    return tensor.scatter_(dim, index, value)
 
 
 def adaptive_instance_normalization(
@@ -608,6 +643,7 @@ def align_repeat_tensor_single_dim(
     dim: int = 0,
     n_src_base_length: int = 1,
     src_base_index: List[int] = None,
+    return_view: bool = False,
 ) -> torch.Tensor:
     """沿着 dim 纬度， 补齐 src 的长度到目标 target_length。
     当 src 长度不如 target_length 时， 取其中 前 n_src_base_length 然后 repeat 到 target_length
@@ -620,11 +656,22 @@ def align_repeat_tensor_single_dim(
         target_length (int): 目标长度, target_length
         dim (int, optional): 处理纬度, target dim . Defaults to 0.
         n_src_base_length (int, optional): src 的基本单元长度, basic length of src. Defaults to 1.
+        return_view (bool, optional): 数据布局允许时返回与 src 共享内存的视图而不是拷贝，src 在 dim 上长度为 1 时用 expand，
+            截断时用 narrow，结果不应原地修改。
+            return view sharing memory with src instead of copy when layout allows, expand when length of src at dim is 1,
+            narrow when truncating, result should not be modified in place. Defaults to False.
 
     Returns:
         torch.Tensor: _description_
     """
     src_dim_length = src.shape[dim]
+    if return_view:
+        if target_length > src_dim_length and src_dim_length == 1:
+            expand_shape = [-1] * src.ndim
+            expand_shape[dim] = target_length
+            return src.expand(*expand_shape)
+        if target_length <= src_dim_length:
+            return src.narrow(dim, 0, target_length)
     if target_length > src_dim_length:
         if target_length % src_dim_length == 0:
             new = src.repeat_interleave(
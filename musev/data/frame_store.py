@@ -0,0 +1,277 @@
+"""视频帧的内存映射存储。
+DecordVideoDataset 按固定 time_size/step/overlap 顺序解码窗口，每次运行都要重新解码。
+这里将视频一次性解码、缩放到目标分辨率，存为 uint8 的内存映射数组 t h w c，旁边的 index.json 记录 fps、shape 与内容哈希。
+之后任意窗口切片都是内存映射上的视图，不发生拷贝，重复运行、重叠窗口、并行多个片段都不需要重新解码。
+
+memory-mapped store of video frames.
+DecordVideoDataset decodes windows strictly in order with fixed time_size/step/overlap, and decodes again on every run.
+here a video is decoded once, resized to target resolution and stored as memory-mapped uint8 array t h w c,
+with a sidecar index.json of fps, shape and content hash. arbitrary window slices are views of the memory map
+without copying, so that re-runs, overlapping windows and parallel shots do not need re-decoding.
+"""
+from dataclasses import dataclass
+from typing import Callable, Dict, Iterator, List
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import logging
+
+import numpy as np
+
+
+logger = logging.getLogger(__name__)
+
+INDEX_NAME = "index.json"
+FRAMES_NAME = "frames.u8"
+
+
+def hash_file(path: str, chunk_size: int = 2**22) -> str:
+    hasher = hashlib.sha256()
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+class FrameStore(object):
+    def __init__(self, path: str) -> None:
+        """打开已构建的帧存储，帧以写时复制方式映射，下游原地修改不会写回文件
+        open a built frame store, frames are mapped copy-on-write, in-place modification downstream is not written back.
+
+        Args:
+            path (str): dir of store, containing index.json and frames.u8.
+        """
+        self.path = path
+        with open(os.path.join(path, INDEX_NAME), "r") as f:
+            self.index: Dict = json.load(f)
+        self.frames = np.memmap(
+            os.path.join(path, FRAMES_NAME),
+            dtype=np.uint8,
+            mode="c",
+            shape=tuple(self.index["shape"]),
+        )
+
+    @property
+    def fps(self) -> float:
+        return self.index["fps"]
+
+    @property
+    def content_hash(self) -> str:
+        return self.index["content_hash"]
+
+    def __len__(self) -> int:
+        return self.frames.shape[0]
+
+    def get_frames(
+        self, start: int, end: int, sample_rate: int = 1, channels_order: str = "c t h w"
+    ) -> np.ndarray:
+        """返回 [start, end) 内每 sample_rate 帧一帧的视图，不拷贝
+        return view of one frame every sample_rate frames in [start, end), without copying.
+
+        Args:
+            start (int): start frame index of original video.
+            end (int): end frame index of original video, exclusive.
+            sample_rate (int, optional): Defaults to 1.
+            channels_order (str, optional): "c t h w" as DecordVideoDataset, or "t h w c". Defaults to "c t h w".
+
+        Returns:
+            np.ndarray: uint8 rgb frames.
+        """
+        frames = self.frames[start:end:sample_rate]
+        if channels_order == "c t h w":
+            return frames.transpose(3, 0, 1, 2)
+        elif channels_order == "t h w c":
+            return frames
+        else:
+            raise ValueError(
+                f"channels_order should be one of ['c t h w', 't h w c'], but given {channels_order}"
+            )
+
+    @classmethod
+    def store_path(
+        cls, store_dir: str, content_hash: str, height: int, width: int, tag: str = ""
+    ) -> str:
+        name = f"{content_hash[:32]}_{height}x{width}"
+        if tag:
+            name = f"{name}_{tag}"
+        return os.path.join(store_dir, name)
+
+    @classmethod
+    def open_or_build(
+        cls,
+        video_path: str,
+        store_dir: str,
+        height: int,
+        width: int,
+        transform: Callable[[np.ndarray], np.ndarray] = None,
+        tag: str = "",
+        chunk_size: int = 64,
+    ) -> "FrameStore":
+        """内容哈希相同、目标尺寸相同的存储已存在时直接打开，否则解码构建
+        open existing store of same content hash and target size, otherwise decode and build it.
+
+        Args:
+            video_path (str): video path.
+            store_dir (str): root dir of stores, could be shared between workers.
+            height (int): target height.
+            width (int): target width.
+            transform (Callable[[np.ndarray], np.ndarray], optional): c t h w -> c t h w at target size, such as
+                crop resize of predictor, None means resize with opencv. Defaults to None.
+            tag (str, optional): distinguishes different transforms of same target size. Defaults to "".
+            chunk_size (int, optional): num of frames decoded per chunk. Defaults to 64.
+
+        Returns:
+            FrameStore: opened store.
+        """
+        content_hash = hash_file(video_path)
+        path = cls.store_path(store_dir, content_hash, height, width, tag=tag)
+        if os.path.exists(os.path.join(path, INDEX_NAME)):
+            logger.debug(f"open frame store {path}")
+            return cls(path)
+        os.makedirs(store_dir, exist_ok=True)
+        tmp_path = tempfile.mkdtemp(prefix=".building_", dir=store_dir)
+        try:
+            cls.build(
+                video_path,
+                tmp_path,
+                height=height,
+                width=width,
+                content_hash=content_hash,
+                transform=transform,
+                chunk_size=chunk_size,
+            )
+            try:
+                os.rename(tmp_path, path)
+            except OSError:
+                # 其他 worker 已构建完成. another worker has built it
+                if not os.path.exists(os.path.join(path, INDEX_NAME)):
+                    raise
+        finally:
+            if os.path.exists(tmp_path):
+                shutil.rmtree(tmp_path)
+        return cls(path)
+
+    @staticmethod
+    def build(
+        video_path: str,
+        path: str,
+        height: int,
+        width: int,
+        content_hash: str,
+        transform: Callable[[np.ndarray], np.ndarray] = None,
+        chunk_size: int = 64,
+    ) -> None:
+        import cv2
+        from decord import VideoReader, cpu
+
+        reader = VideoReader(video_path, ctx=cpu(0))
+        num_frames = len(reader)
+        shape = (num_frames, height, width, 3)
+        logger.info(f"build frame store {path} from {video_path}, shape={shape}")
+        frames = np.memmap(
+            os.path.join(path, FRAMES_NAME), dtype=np.uint8, mode="w+", shape=shape
+        )
+        for start in range(0, num_frames, chunk_size):
+            end = min(start + chunk_size, num_frames)
+            # t h w c, rgb
+            chunk = reader.get_batch(list(range(start, end))).asnumpy()
+            if transform is not None:
+                chunk = transform(chunk.transpose(3, 0, 1, 2)).transpose(1, 2, 3, 0)
+            else:
+                chunk = np.stack(
+                    [
+                        cv2.resize(x, (width, height), interpolation=cv2.INTER_AREA)
+                        for x in chunk
+                    ]
+                )
+            frames[start:end] = np.clip(chunk, 0, 255).astype(np.uint8)
+        frames.flush()
+        del frames
+        index = {
+            "source": os.path.abspath(video_path),
+            "content_hash": content_hash,
+            "fps": float(reader.get_avg_fps()),
+            "shape": list(shape),
+            "dtype": "uint8",
+            "channels_order": "t h w c",
+        }
+        with open(os.path.join(path, INDEX_NAME), "w") as f:
+            json.dump(index, f, indent=4)
+
+
+@dataclass
+class FrameWindow:
+    data: np.ndarray
+    index: List[int]
+
+
+class FrameStoreDataset(object):
+    def __init__(
+        self,
+        store: FrameStore,
+        time_size: int,
+        step: int = None,
+        overlap: int = 0,
+        sample_rate: int = 1,
+        drop_last: bool = True,
+        channels_order: str = "c t h w",
+    ) -> None:
+        """按窗口迭代帧存储，接口与 run_pipe_video2video 使用的 DecordVideoDataset 一致，窗口数据是内存映射的视图
+        iterate frame store by window, same interface as DecordVideoDataset used by run_pipe_video2video,
+        window data are views of the memory map.
+
+        Args:
+            store (FrameStore): frame store.
+            time_size (int): num of sampled frames per window.
+            step (int, optional): stride of windows in sampled frames, None means time_size - overlap. Defaults to None.
+            overlap (int, optional): used when step is None. Defaults to 0.
+            sample_rate (int, optional): sample one frame every sample_rate frames. Defaults to 1.
+            drop_last (bool, optional): drop last window shorter than time_size. Defaults to True.
+            channels_order (str, optional): Defaults to "c t h w".
+        """
+        if step is None:
+            step = time_size - (overlap or 0)
+        if step < 1:
+            raise ValueError(f"step should be >= 1, but given {step}")
+        self.store = store
+        self.time_size = time_size
+        self.step = step
+        self.sample_rate = sample_rate
+        self.drop_last = drop_last
+        self.channels_order = channels_order
+
+    def window(self, start: int) -> FrameWindow:
+        """第 start 个采样帧开始的窗口, window starting from start-th sampled frame."""
+        frame_start = start * self.sample_rate
+        frame_end = min((start + self.time_size) * self.sample_rate, len(self.store))
+        data = self.store.get_frames(
+            frame_start,
+            frame_end,
+            sample_rate=self.sample_rate,
+            channels_order=self.channels_order,
+        )
+        index = list(range(frame_start, frame_end, self.sample_rate))
+        return FrameWindow(data=data, index=index)
+
+    def __len__(self) -> int:
+        n_sampled = (len(self.store) + self.sample_rate - 1) // self.sample_rate
+        if n_sampled < self.time_size:
+            return 0 if self.drop_last else int(n_sampled > 0)
+        n = (n_sampled - self.time_size) // self.step + 1
+        if not self.drop_last and (n - 1) * self.step + self.time_size < n_sampled:
+            n += 1
+        return n
+
+    def __getitem__(self, i: int) -> FrameWindow:
+        if i < 0 or i >= len(self):
+            raise IndexError(f"window index {i} out of range {len(self)}")
+        return self.window(i * self.step)
+
+    def __iter__(self) -> Iterator[FrameWindow]:
+        for i in range(len(self)):
+            yield self[i]
@@ -36,6 +36,8 @@ from diffusers.models.attention import (
 from diffusers.models.attention_processor import AttnProcessor
 
 from .attention_processor import IPAttention, BaseIPAttnProcessor
+from .token_merge import compute_token_merge, do_nothing
+from .compile_util import is_compile_mode
 
 
 logger = logging.getLogger(__name__)
@@ -51,6 +53,9 @@ def not_use_xformers_anyway(
 @maybe_allow_in_graph
 class BasicTransformerBlock(DiffusersBasicTransformerBlock):
     print_idx = 0
+    # token merging of spatial self-attn, set by musev.models.token_merge.set_token_merge
+    tome_ratio = 0.0
+    tome_info = None
 
     def __init__(
         self,
@@ -288,10 +293,25 @@ class BasicTransformerBlock(DiffusersBasicTransformerBlock):
                 # f"norm_hidden_states shape, {norm_hidden_states.shape}, {norm_hidden_states.mean()}",
                 # )
         if self.attn1 is None:
-            self.print_idx += 1
+            if not is_compile_mode(self):
+                self.print_idx += 1
             return norm_hidden_states
-        attn_output = self.attn1(
-            norm_hidden_states,
+
+        # 空间 self-attn 的 token merging，attn1 后 unmerge 还原每帧的 token 排布
+        # token merging of spatial self-attn, unmerge after attn1 to restore token layout of every frame
+        if self.tome_info is not None and self.tome_ratio > 0 and attention_mask is None:
+            tome_merge, tome_unmerge = compute_token_merge(
+                norm_hidden_states, self.tome_info, self.tome_ratio
+            )
+        else:
+            tome_merge, tome_unmerge = do_nothing, do_nothing
+        attn1_hidden_states = tome_merge(norm_hidden_states)
+        if self.print_idx == 0:
+            logger.debug(
+                f"token merge, tome_ratio={self.tome_ratio}, norm_hidden_states={norm_hidden_states.shape}, attn1_hidden_states={attn1_hidden_states.shape}"
+            )
+        attn1_output = self.attn1(
+            attn1_hidden_states,
             encoder_hidden_states=encoder_hidden_states
             if self.only_cross_attention
             else None,
@@ -302,6 +322,7 @@ class BasicTransformerBlock(DiffusersBasicTransformerBlock):
                 else original_cross_attention_kwargs
             ),
         )
+        attn_output = tome_unmerge(attn1_output)
 
         if self.use_ada_layer_norm_zero:
             attn_output = gate_msa.unsqueeze(1) * attn_output
@@ -317,7 +338,7 @@ class BasicTransformerBlock(DiffusersBasicTransformerBlock):
         if self.print_idx == 0:
             logger.debug(f"do_classifier_free_guidance={do_classifier_free_guidance},")
         if do_classifier_free_guidance:
-            hidden_states_c = attn_output.clone()
+            hidden_states_c = attn1_output.clone()
             _uc_mask = (
                 torch.Tensor(
                     [1] * (norm_hidden_states.shape[0] // 2)
@@ -327,11 +348,11 @@ class BasicTransformerBlock(DiffusersBasicTransformerBlock):
                 .bool()
             )
             hidden_states_c[_uc_mask] = self.attn1(
-                norm_hidden_states[_uc_mask],
-                encoder_hidden_states=norm_hidden_states[_uc_mask],
+                attn1_hidden_states[_uc_mask],
+                encoder_hidden_states=attn1_hidden_states[_uc_mask],
                 attention_mask=attention_mask,
             )
-            attn_output = hidden_states_c.clone()
+            attn_output = tome_unmerge(hidden_states_c)
 
         if "refer_emb" in cross_attention_kwargs:
             del cross_attention_kwargs["refer_emb"]
@@ -427,5 +448,6 @@ class BasicTransformerBlock(DiffusersBasicTransformerBlock):
                 ff_output = gate_mlp.unsqueeze(1) * ff_output
 
             hidden_states = ff_output + hidden_states
-        self.print_idx += 1
+        if not is_compile_mode(self):
+            self.print_idx += 1
         return hidden_states
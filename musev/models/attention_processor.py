@@ -45,7 +45,10 @@ from ..data.data_util import (
     batch_adain_conditioned_tensor,
 )
 
+from ..utils.attention_util import generate_local_attn_chunks
 from . import Model_Register
+from .token_merge import pool_reference_tokens
+from .compile_util import is_compile_mode
 
 logger = logging.getLogger(__name__)  # pylint: disable=invalid-name
 
@@ -277,10 +280,10 @@ class T2IReferencenetIPAdapterXFormersAttnProcessor(BaseIPAttnProcessor):
             ip_key = attn.to_k_ip(vision_clip_emb)
             ip_value = attn.to_v_ip(vision_clip_emb)
             ip_key = align_repeat_tensor_single_dim(
-                ip_key, target_length=batch_size, dim=0
+                ip_key, target_length=batch_size, dim=0, return_view=True
             )
             ip_value = align_repeat_tensor_single_dim(
-                ip_value, target_length=batch_size, dim=0
+                ip_value, target_length=batch_size, dim=0, return_view=True
             )
             ip_key = attn.head_to_batch_dim(ip_key).contiguous()
             ip_value = attn.head_to_batch_dim(ip_value).contiguous()
@@ -313,10 +316,10 @@ class T2IReferencenetIPAdapterXFormersAttnProcessor(BaseIPAttnProcessor):
             ip_key = attn.ip_adapter_face_to_k_ip(ip_adapter_face_emb)
             ip_value = attn.ip_adapter_face_to_v_ip(ip_adapter_face_emb)
             ip_key = align_repeat_tensor_single_dim(
-                ip_key, target_length=batch_size, dim=0
+                ip_key, target_length=batch_size, dim=0, return_view=True
             )
             ip_value = align_repeat_tensor_single_dim(
-                ip_value, target_length=batch_size, dim=0
+                ip_value, target_length=batch_size, dim=0, return_view=True
             )
             ip_key = attn.head_to_batch_dim(ip_key).contiguous()
             ip_value = attn.head_to_batch_dim(ip_value).contiguous()
@@ -355,7 +358,8 @@ class T2IReferencenetIPAdapterXFormersAttnProcessor(BaseIPAttnProcessor):
             hidden_states = hidden_states + residual
 
         hidden_states = hidden_states / attn.rescale_output_factor
-        self.print_idx += 1
+        if not is_compile_mode(self):
+            self.print_idx += 1
         return hidden_states
 
 
@@ -364,8 +368,15 @@ class NonParamT2ISelfReferenceXFormersAttnProcessor(BaseIPAttnProcessor):
     r"""
     面向首帧的 referenceonly attn,适用于 T2I的 self_attn
     referenceonly with vis_cond as key, value, in t2i self_attn.
+
+    refer_token_pool_method, refer_token_pool_ratio 用于缩减 vis_cond 帧作为 key value 的 token，
+    由 unet.set_refer_token_pool 按层设置; referencenet 的 refer_emb 在 pipeline 中每次推理只缩减一次。
+    refer_token_pool_method, refer_token_pool_ratio reduce tokens of vis_cond frames used as key value,
+    set per layer by unet.set_refer_token_pool; refer_emb of referencenet is reduced once per run in pipeline.
     """
     print_idx = 0
+    refer_token_pool_method = None
+    refer_token_pool_ratio = 1.0
 
     def __init__(
         self,
@@ -450,14 +461,36 @@ class NonParamT2ISelfReferenceXFormersAttnProcessor(BaseIPAttnProcessor):
                     logger.debug(
                         f"NonParamT2ISelfReferenceXFormersAttnProcessor 1, vis_cond referenceonly, encoder_hidden_states={encoder_hidden_states.shape}, ip_hidden_states={ip_hidden_states.shape}"
                     )
+                if (
+                    self.refer_token_pool_method is not None
+                    and self.refer_token_pool_ratio < 1
+                ):
+                    # 未缩减的 refer_emb 与当前层同分辨率，可提供 h w
+                    # unpooled refer_emb has same resolution as current layer, provides h w
+                    hw = None
+                    if (
+                        refer_emb is not None
+                        and refer_emb.shape[-2] * refer_emb.shape[-1]
+                        == ip_hidden_states.shape[2]
+                    ):
+                        hw = tuple(refer_emb.shape[-2:])
+                    ip_hidden_states = pool_reference_tokens(
+                        ip_hidden_states,
+                        method=self.refer_token_pool_method,
+                        ratio=self.refer_token_pool_ratio,
+                        hw=hw,
+                    )
                 #
                 ip_hidden_states = rearrange(
                     ip_hidden_states, "b t hw c -> b 1 (t hw) c"
                 )
+                # 视图直接参与 concat，不再额外复制 num_frames 份
+                # view goes into concat directly, without extra copy of num_frames times
                 ip_hidden_states = align_repeat_tensor_single_dim(
                     ip_hidden_states,
                     dim=1,
                     target_length=num_frames,
+                    return_view=True,
                 )
                 # b t hw c -> b t hw + hw c
                 if self.print_idx == 0:
@@ -475,7 +508,7 @@ class NonParamT2ISelfReferenceXFormersAttnProcessor(BaseIPAttnProcessor):
             if refer_emb is not None:  # and num_frames > 1:
                 refer_emb = rearrange(refer_emb, "b c t h w->b 1 (t h w) c")
                 refer_emb = align_repeat_tensor_single_dim(
-                    refer_emb, target_length=num_frames, dim=1
+                    refer_emb, target_length=num_frames, dim=1, return_view=True
                 )
                 if self.print_idx == 0:
                     logger.debug(
@@ -541,7 +574,8 @@ class NonParamT2ISelfReferenceXFormersAttnProcessor(BaseIPAttnProcessor):
             hidden_states = hidden_states + residual
 
         hidden_states = hidden_states / attn.rescale_output_factor
-        self.print_idx += 1
+        if not is_compile_mode(self):
+            self.print_idx += 1
 
         return hidden_states
 
@@ -554,6 +588,124 @@ class NonParamReferenceIPXFormersAttnProcessor(
         super().__init__(attention_op)
 
 
+@Model_Register.register
+class LocalTemporalAttnProcessor(nn.Module):
+    r"""
+    时序 self_attn 的局部窗口版本，每帧只与 ±window_size 内的帧及条件帧计算 attn，
+    按 chunk 计算，不生成 t*t 的 dense mask，使 context_frames 可以更长。
+    local window version of temporal self_attn, every frame only attends frames within ±window_size and condition frames.
+    computed chunk by chunk without dense t*t mask, so that context_frames could be longer.
+
+    local_attn_chunks 由 TransformerTemporalModel 在每次 forward 时根据条件帧生成并设置。
+    local_attn_chunks is generated by TransformerTemporalModel with condition frames and set in every forward.
+    """
+    print_idx = 0
+
+    def __init__(self, window_size: int = 4, chunk_size: int = None):
+        super().__init__()
+        self.window_size = window_size
+        self.chunk_size = chunk_size
+        self.local_attn_chunks = None
+
+    def __call__(
+        self,
+        attn: DiffusersAttention,
+        hidden_states: torch.FloatTensor,
+        encoder_hidden_states: Optional[torch.FloatTensor] = None,
+        attention_mask: Optional[torch.FloatTensor] = None,
+        temb: Optional[torch.FloatTensor] = None,
+        scale: float = 1.0,
+    ):
+        # 带 mask 或 cross attn 时退化为 full attn
+        # fall back to full attn with attention_mask or cross attn
+        if (
+            attention_mask is not None
+            or hidden_states.ndim != 3
+            or (
+                encoder_hidden_states is not None
+                and encoder_hidden_states.shape != hidden_states.shape
+            )
+        ):
+            return AttnProcessor2_0()(
+                attn,
+                hidden_states,
+                encoder_hidden_states=encoder_hidden_states,
+                attention_mask=attention_mask,
+                temb=temb,
+                scale=scale,
+            )
+        residual = hidden_states
+
+        if attn.spatial_norm is not None:
+            hidden_states = attn.spatial_norm(hidden_states, temb)
+        if attn.group_norm is not None:
+            hidden_states = attn.group_norm(hidden_states.transpose(1, 2)).transpose(
+                1, 2
+            )
+
+        query = attn.to_q(hidden_states, scale=scale)
+        if encoder_hidden_states is None:
+            encoder_hidden_states = hidden_states
+        elif attn.norm_cross:
+            encoder_hidden_states = attn.norm_encoder_hidden_states(
+                encoder_hidden_states
+            )
+        key = attn.to_k(encoder_hidden_states, scale=scale)
+        value = attn.to_v(encoder_hidden_states, scale=scale)
+
+        batch_size, n_frames, inner_dim = query.shape
+        head_dim = inner_dim // attn.heads
+        # b t (h d) -> b h t d
+        query = query.view(batch_size, n_frames, attn.heads, head_dim).transpose(1, 2)
+        key = key.view(batch_size, n_frames, attn.heads, head_dim).transpose(1, 2)
+        value = value.view(batch_size, n_frames, attn.heads, head_dim).transpose(1, 2)
+
+        local_attn_chunks = self.local_attn_chunks
+        if local_attn_chunks is None or local_attn_chunks[-1][1] != n_frames:
+            local_attn_chunks = generate_local_attn_chunks(
+                n_frames,
+                window_size=self.window_size,
+                chunk_size=self.chunk_size,
+                device=query.device,
+            )
+        if self.print_idx == 0:
+            logger.debug(
+                f"LocalTemporalAttnProcessor, query={query.shape}, window_size={self.window_size}, n_chunks={len(local_attn_chunks)}"
+            )
+
+        hidden_states = torch.empty_like(query)
+        for q_start, q_end, key_index, mask in local_attn_chunks:
+            scores = (
+                torch.matmul(
+                    query[:, :, q_start:q_end], key[:, :, key_index].transpose(-1, -2)
+                )
+                * attn.scale
+            )
+            if attn.upcast_softmax:
+                scores = scores.float()
+            scores = scores.masked_fill(~mask, torch.finfo(scores.dtype).min)
+            probs = scores.softmax(dim=-1).to(value.dtype)
+            hidden_states[:, :, q_start:q_end] = torch.matmul(
+                probs, value[:, :, key_index]
+            )
+        hidden_states = hidden_states.transpose(1, 2).reshape(
+            batch_size, n_frames, inner_dim
+        )
+
+        # linear proj
+        hidden_states = attn.to_out[0](hidden_states, scale=scale)
+        # dropout
+        hidden_states = attn.to_out[1](hidden_states)
+
+        if attn.residual_connection:
+            hidden_states = hidden_states + residual
+
+        hidden_states = hidden_states / attn.rescale_output_factor
+        if not is_compile_mode(self):
+            self.print_idx += 1
+        return hidden_states
+
+
 @maybe_allow_in_graph
 class ReferEmbFuseAttention(IPAttention):
     """使用 attention 融合 refernet 中的 emb 到 unet 对应的 latens 中
@@ -746,5 +898,6 @@ class ReferEmbFuseAttention(IPAttention):
             hidden_states = hidden_states + residual
 
         hidden_states = hidden_states / self.rescale_output_factor
-        self.print_idx += 1
+        if not is_compile_mode(self):
+            self.print_idx += 1
         return hidden_states
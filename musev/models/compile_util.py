@@ -0,0 +1,179 @@
+"""torch.compile 编译模式工具。
+编译模式按模型开启：被编译模型的各模块与其 attn processor 关闭 print_idx == 0 的调试日志与 print_idx 自增，
+避免 graph break 与每步重新编译，关闭编译后恢复；其他模型不受影响。
+每个分辨率桶使用静态 shape 编译一次，编译结果按桶缓存。
+
+utils of torch.compile mode.
+compile mode is enabled per model: in modules and attn processors of the compiled model, debug logs guarded by
+print_idx == 0 and increment of print_idx are disabled, to avoid graph breaks and recompiling every step, and they
+are restored when compile is disabled; other models are not affected.
+every resolution bucket is compiled once with static shapes, and compiled graphs are cached per bucket.
+"""
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Iterator, Sequence, Tuple
+import logging
+
+import torch
+from torch import nn
+
+
+logger = logging.getLogger(__name__)
+
+
+def is_compile_mode(obj: Any) -> bool:
+    """obj 所在模型是否处于编译模式, whether model of obj is in compile mode."""
+    return getattr(obj, "compile_mode", False)
+
+
+def _debug_log_objects(model: nn.Module) -> Iterator[Any]:
+    for module in model.modules():
+        for obj in [module, getattr(module, "processor", None)]:
+            if obj is not None and hasattr(obj, "print_idx"):
+                yield obj
+
+
+def set_compile_mode(model: nn.Module, valid: bool) -> None:
+    """开启时将模块与其 attn processor 的 print_idx 设为 1，使 print_idx == 0 的调试分支不进入编译图，关闭时恢复原值
+    when valid, set print_idx of modules and their attn processors to 1, so that debug branches of print_idx == 0
+    are not traced; restore original print_idx when not valid.
+    """
+    for obj in _debug_log_objects(model):
+        if valid and not is_compile_mode(obj):
+            obj.eager_print_idx = obj.print_idx
+            obj.print_idx = 1
+            obj.compile_mode = True
+        elif not valid and is_compile_mode(obj):
+            obj.print_idx = obj.eager_print_idx
+            obj.compile_mode = False
+
+
+def get_bucket_key(
+    args: Tuple, kwargs: Dict[str, Any], graph_kwargs: Sequence[str] = ()
+) -> Tuple:
+    """tensor 取 shape 与 dtype，其他参数只取类型，graph_kwargs 中的参数取值，作为编译缓存的桶。
+    逐次调用变化但不影响计算图的参数（如 context window 的帧序号）不能进入桶，否则每个 window 都是新桶。
+    shape and dtype of tensors, type of other arguments, and value of arguments in graph_kwargs,
+    used as bucket of compile cache. arguments changing every call without changing graph, such as frame index of
+    context window, should not be in bucket, otherwise every window is a new bucket.
+    """
+
+    def fn(x):
+        if isinstance(x, torch.Tensor):
+            return ("tensor", tuple(x.shape), x.dtype)
+        if isinstance(x, (list, tuple)):
+            return tuple(fn(y) for y in x)
+        if isinstance(x, dict):
+            return tuple((k, fn(v)) for k, v in sorted(x.items()))
+        if x is None:
+            return None
+        return type(x).__name__
+
+    return (
+        fn(args)
+        + tuple((k, fn(v)) for k, v in sorted(kwargs.items()))
+        + tuple((k, kwargs[k]) for k in graph_kwargs if k in kwargs)
+    )
+
+
+class CompiledForwardCache(object):
+    """替换 model.forward，每个桶静态 shape 编译一次，桶数超过 max_buckets 后新桶使用 eager 运行，避免反复编译
+    replace model.forward, compile once with static shapes for every bucket, new buckets run eagerly after max_buckets,
+    to avoid recompiling again and again.
+
+    Args:
+        model (nn.Module): model to compile.
+        mode (str, optional): mode of torch.compile, such as "reduce-overhead", "max-autotune". Defaults to None.
+        fullgraph (bool, optional): fullgraph of torch.compile. Defaults to True.
+        max_buckets (int, optional): max num of compiled buckets. Defaults to 8.
+        backend (str, optional): backend of torch.compile. Defaults to "inductor".
+        prepare_fn (Callable, optional): called with inputs out of compiled graph before every call, to prepare caches read in graph. Defaults to None.
+        graph_kwargs (Sequence[str], optional): non-tensor kwargs whose values change graph, see get_bucket_key. Defaults to ().
+    """
+
+    def __init__(
+        self,
+        model: nn.Module,
+        mode: str = None,
+        fullgraph: bool = True,
+        max_buckets: int = 8,
+        backend: str = "inductor",
+        prepare_fn: Callable = None,
+        graph_kwargs: Sequence[str] = (),
+    ) -> None:
+        self.model = model
+        self.prepare_fn = prepare_fn
+        self.graph_kwargs = tuple(graph_kwargs)
+        self.eager_forward = type(model).forward.__get__(model)
+        self.max_buckets = max_buckets
+        self.compiled_forward = torch.compile(
+            self.eager_forward,
+            mode=mode,
+            fullgraph=fullgraph,
+            dynamic=False,
+            backend=backend,
+        )
+        # 每个桶对应 dynamo 缓存中的一个条目
+        # every bucket is an entry of dynamo cache
+        torch._dynamo.config.cache_size_limit = max(
+            torch._dynamo.config.cache_size_limit, max_buckets
+        )
+        self.bucket_hits = OrderedDict()
+        self.eager_hits = OrderedDict()
+
+    def __call__(self, *args, **kwargs):
+        key = get_bucket_key(args, kwargs, self.graph_kwargs)
+        # attn processor 可能在编译后被替换，如 set_local_temporal_attn，新 processor 也需关闭调试日志
+        # attn processors may be replaced after compile, such as set_local_temporal_attn, new ones also need debug logs disabled
+        set_compile_mode(self.model, True)
+        if self.prepare_fn is not None:
+            self.prepare_fn(*args, **kwargs)
+        if key in self.bucket_hits:
+            self.bucket_hits[key] += 1
+            return self.compiled_forward(*args, **kwargs)
+        if len(self.bucket_hits) < self.max_buckets:
+            logger.info(f"compile new bucket {len(self.bucket_hits)}")
+            self.bucket_hits[key] = 1
+            return self.compiled_forward(*args, **kwargs)
+        if key not in self.eager_hits:
+            logger.warning(
+                f"num of compiled buckets reaches max_buckets={self.max_buckets}, run new bucket eagerly"
+            )
+        self.eager_hits[key] = self.eager_hits.get(key, 0) + 1
+        return self.eager_forward(*args, **kwargs)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "n_compiled_buckets": len(self.bucket_hits),
+            "compiled_calls": sum(self.bucket_hits.values()),
+            "n_eager_buckets": len(self.eager_hits),
+            "eager_calls": sum(self.eager_hits.values()),
+        }
+
+
+def enable_compile(
+    model: nn.Module,
+    mode: str = None,
+    fullgraph: bool = True,
+    max_buckets: int = 8,
+    backend: str = "inductor",
+    prepare_fn: Callable = None,
+    graph_kwargs: Sequence[str] = (),
+) -> CompiledForwardCache:
+    set_compile_mode(model, True)
+    compiled_cache = CompiledForwardCache(
+        model,
+        mode=mode,
+        fullgraph=fullgraph,
+        max_buckets=max_buckets,
+        backend=backend,
+        prepare_fn=prepare_fn,
+        graph_kwargs=graph_kwargs,
+    )
+    model.forward = compiled_cache
+    return compiled_cache
+
+
+def disable_compile(model: nn.Module) -> None:
+    if isinstance(model.__dict__.get("forward", None), CompiledForwardCache):
+        del model.forward
+    set_compile_mode(model, False)
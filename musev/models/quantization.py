@@ -0,0 +1,386 @@
+"""weight-only 量化，将 unet、referencenet、controlnet 中 attn、ff 的 nn.Linear 权重存为 int8 或 int4，每个输出通道一个 scale。
+激活仍为 fp16/fp32。只有 cpu 上的 int8 层更快：使用 torch._weight_int8pack_mm 直接以 int8 权重计算，不重建全精度权重。
+int4 以及 gpu 上的所有层在每次 forward 中反量化出临时的全精度权重再计算，只节省常驻显存/内存，比不量化更慢。
+
+weight-only quantization, store weights of nn.Linear in attn and ff of unet, referencenet and controlnet as int8 or int4,
+with one scale per output channel. activations keep fp16/fp32. only int8 layers on cpu are faster: they compute with
+int8 weights directly via torch._weight_int8pack_mm, without materializing full precision weights. int4 layers and
+all layers on gpu dequantize a temporary full precision weight in every forward, which only saves resident memory
+and is slower than no quantization.
+
+lora 支持两种方式 lora is supported in two modes:
+    1. delta: lora 以低秩因子 up、down 旁路保存，forward 中按 x @ down.T @ up.T 计算，卸载无损，额外内存只有 rank * (in + out)。
+        lora is kept as side-car low-rank factors up and down, computed as x @ down.T @ up.T in forward,
+        unload is lossless, extra memory is only rank * (in + out).
+    2. requant: 反量化、合并、再量化，不增加显存，卸载有量化误差。
+        dequant-merge-requant, no extra memory, unload has quantization error.
+    稠密的权重 delta 总是按 requant 合并。dense weight deltas are always merged by requant.
+"""
+from typing import Dict, List, Literal, Sequence, Tuple, Union
+import functools
+import logging
+
+import torch
+from torch import nn
+import torch.nn.functional as F
+
+
+logger = logging.getLogger(__name__)
+
+# attn、ff 以及 ip-adapter 的 to_k_ip、to_v_ip 都在这些子模块名下
+# linears of attn, ff and to_k_ip, to_v_ip of ip-adapter are under these sub module names
+DEFAULT_QUANT_INCLUDE = ("attn", "ff.", "processor.")
+
+
+def quantize_weight_per_channel(
+    weight: torch.Tensor, bits: int = 8
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """对称量化，每个输出通道一个 scale
+    symmetric quantization, one scale per output channel.
+
+    Args:
+        weight (torch.Tensor): out_features * in_features
+        bits (int, optional): 8 or 4. Defaults to 8.
+
+    Returns:
+        Tuple[torch.Tensor, torch.Tensor]: qweight int8, out * in; scale float32, out.
+    """
+    if bits not in [4, 8]:
+        raise ValueError(f"bits should be 4 or 8, but given {bits}")
+    qmax = 2 ** (bits - 1) - 1
+    weight = weight.float()
+    scale = weight.abs().amax(dim=1).clamp(min=1e-8) / qmax
+    qweight = torch.round(weight / scale[:, None]).clamp(-qmax - 1, qmax)
+    return qweight.to(torch.int8), scale
+
+
+@functools.lru_cache(maxsize=None)
+def is_int8pack_mm_supported(dtype: torch.dtype) -> bool:
+    """当前 torch 的 cpu 上是否支持该激活类型的 _weight_int8pack_mm
+    whether _weight_int8pack_mm on cpu of current torch supports activation of dtype.
+    """
+    if not hasattr(torch, "_weight_int8pack_mm"):
+        return False
+    try:
+        torch._weight_int8pack_mm(
+            torch.zeros(1, 32, dtype=dtype),
+            torch.zeros(8, 32, dtype=torch.int8),
+            torch.ones(8, dtype=dtype),
+        )
+    except RuntimeError:
+        return False
+    return True
+
+
+def pack_int4(qweight: torch.Tensor) -> torch.Tensor:
+    """两个 int4 存入一个 uint8，in_features 为奇数时补 0
+    pack two int4 into one uint8, pad zero when in_features is odd.
+    """
+    if qweight.shape[1] % 2 == 1:
+        qweight = F.pad(qweight, (0, 1))
+    qweight = (qweight.to(torch.int16) + 8).to(torch.uint8)
+    return qweight[:, 0::2] | (qweight[:, 1::2] << 4)
+
+
+def unpack_int4(packed: torch.Tensor, in_features: int) -> torch.Tensor:
+    low = (packed & 0x0F).to(torch.int8) - 8
+    high = (packed >> 4).to(torch.int8) - 8
+    qweight = torch.stack([low, high], dim=-1).reshape(packed.shape[0], -1)
+    return qweight[:, :in_features]
+
+
+class WeightOnlyQuantLinear(nn.Module):
+    """替换 nn.Linear 和 diffusers 的 LoRACompatibleLinear，forward 的 scale 参数仅用于接口兼容
+    replace nn.Linear and LoRACompatibleLinear of diffusers, scale of forward is only for interface compatibility.
+
+    Args:
+        in_features (int):
+        out_features (int):
+        bias (bool, optional): Defaults to True.
+        bits (int, optional): 8 or 4. Defaults to 8.
+        lora_mode (Literal["delta", "requant"], optional): how to merge lora weight. Defaults to "delta".
+    """
+
+    def __init__(
+        self,
+        in_features: int,
+        out_features: int,
+        bias: bool = True,
+        bits: int = 8,
+        lora_mode: Literal["delta", "requant"] = "delta",
+        device: torch.device = None,
+        dtype: torch.dtype = None,
+    ) -> None:
+        super().__init__()
+        if bits not in [4, 8]:
+            raise ValueError(f"bits should be 4 or 8, but given {bits}")
+        if lora_mode not in ["delta", "requant"]:
+            raise ValueError(
+                f"lora_mode should be delta or requant, but given {lora_mode}"
+            )
+        self.in_features = in_features
+        self.out_features = out_features
+        self.bits = bits
+        self.lora_mode = lora_mode
+        packed_in_features = in_features if bits == 8 else (in_features + 1) // 2
+        self.register_buffer(
+            "qweight",
+            torch.zeros(
+                out_features,
+                packed_in_features,
+                dtype=torch.int8 if bits == 8 else torch.uint8,
+                device=device,
+            ),
+        )
+        self.register_buffer(
+            "weight_scale", torch.ones(out_features, dtype=dtype, device=device)
+        )
+        # 已加载 lora 的 key，因子保存为 buffer {key}_up、{key}_down，随模块移动设备
+        # keys of loaded loras, factors are buffers {key}_up and {key}_down, moved with module
+        self.lora_keys = []
+        self.n_lora_added = 0
+        if bias:
+            self.bias = nn.Parameter(
+                torch.zeros(out_features, dtype=dtype, device=device),
+                requires_grad=False,
+            )
+        else:
+            self.register_parameter("bias", None)
+
+    @classmethod
+    def from_linear(
+        cls,
+        linear: nn.Linear,
+        bits: int = 8,
+        lora_mode: Literal["delta", "requant"] = "delta",
+    ) -> "WeightOnlyQuantLinear":
+        weight = linear.weight.data
+        layer = cls(
+            linear.in_features,
+            linear.out_features,
+            bias=linear.bias is not None,
+            bits=bits,
+            lora_mode=lora_mode,
+            device=weight.device,
+            dtype=weight.dtype,
+        )
+        layer.set_weight(weight)
+        if linear.bias is not None:
+            layer.bias.data.copy_(linear.bias.data)
+        return layer
+
+    def set_weight(self, weight: torch.Tensor) -> None:
+        qweight, scale = quantize_weight_per_channel(weight, bits=self.bits)
+        if self.bits == 4:
+            qweight = pack_int4(qweight)
+        self.qweight = qweight.to(self.qweight.device)
+        self.weight_scale = scale.to(
+            device=self.weight_scale.device, dtype=self.weight_scale.dtype
+        )
+
+    def dequantize(
+        self, dtype: torch.dtype = None, include_lora: bool = True
+    ) -> torch.Tensor:
+        """反量化的权重，include_lora 时包含低秩 lora。dequantized weight, low-rank loras included if include_lora."""
+        if dtype is None:
+            dtype = self.weight_scale.dtype
+        qweight = self.qweight
+        if self.bits == 4:
+            qweight = unpack_int4(qweight, self.in_features)
+        weight = qweight.to(dtype) * self.weight_scale.to(dtype)[:, None]
+        if include_lora:
+            for key in self.lora_keys:
+                up, down = self._lora_factors(key, dtype)
+                weight = weight + up @ down
+        return weight
+
+    def add_weight_delta(self, delta: torch.Tensor) -> None:
+        """按 requant 合并稠密的权重 delta，卸载时传入 -delta。merge dense weight delta by requant, pass -delta to unload."""
+        delta = delta.to(device=self.qweight.device)
+        weight = self.dequantize(torch.float32, include_lora=False) + delta.float()
+        self.set_weight(weight)
+
+    def add_lora(self, weight_up: torch.Tensor, weight_down: torch.Tensor) -> str:
+        """保存低秩 lora 因子，scale 需已乘入 weight_up，返回卸载用的 key
+        keep low-rank lora factors, scale should be multiplied into weight_up, return key for unload.
+
+        Args:
+            weight_up (torch.Tensor): out_features * rank.
+            weight_down (torch.Tensor): rank * in_features.
+
+        Returns:
+            str: key for remove_lora.
+        """
+        key = f"lora_{self.n_lora_added}"
+        self.n_lora_added += 1
+        for name, factor in [("up", weight_up), ("down", weight_down)]:
+            self.register_buffer(
+                f"{key}_{name}",
+                factor.to(device=self.qweight.device, dtype=self.weight_scale.dtype),
+            )
+        self.lora_keys.append(key)
+        return key
+
+    def remove_lora(self, key: str) -> None:
+        self.lora_keys.remove(key)
+        delattr(self, f"{key}_up")
+        delattr(self, f"{key}_down")
+
+    def _lora_factors(
+        self, key: str, dtype: torch.dtype
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        return (
+            getattr(self, f"{key}_up").to(dtype),
+            getattr(self, f"{key}_down").to(dtype),
+        )
+
+    def _lora_output(
+        self, hidden_states: torch.Tensor, output: torch.Tensor
+    ) -> torch.Tensor:
+        for key in self.lora_keys:
+            up, down = self._lora_factors(key, hidden_states.dtype)
+            output = output + F.linear(F.linear(hidden_states, down), up)
+        return output
+
+    def _int8_mm(self, hidden_states: torch.Tensor) -> torch.Tensor:
+        dtype = hidden_states.dtype
+        output = torch._weight_int8pack_mm(
+            hidden_states.reshape(-1, self.in_features).contiguous(),
+            self.qweight,
+            self.weight_scale.to(dtype),
+        )
+        return output.reshape(*hidden_states.shape[:-1], self.out_features)
+
+    def forward(self, hidden_states: torch.Tensor, scale: float = 1.0) -> torch.Tensor:
+        bias = self.bias.to(hidden_states.dtype) if self.bias is not None else None
+        if (
+            self.bits == 8
+            and hidden_states.device.type == "cpu"
+            and is_int8pack_mm_supported(hidden_states.dtype)
+        ):
+            output = self._int8_mm(hidden_states)
+            if bias is not None:
+                output = output + bias
+        else:
+            # 参考实现：每次反量化出临时的全精度权重，只节省常驻内存，比不量化更慢
+            # reference kernel: dequantize a temporary full precision weight every call,
+            # only saves resident memory and is slower than no quantization
+            weight = self.dequantize(hidden_states.dtype, include_lora=False)
+            output = F.linear(hidden_states, weight, bias)
+        return self._lora_output(hidden_states, output)
+
+    def extra_repr(self) -> str:
+        return f"in_features={self.in_features}, out_features={self.out_features}, bias={self.bias is not None}, bits={self.bits}, lora_mode={self.lora_mode}"
+
+
+def _match_name(
+    name: str, include: Sequence[str] = None, exclude: Sequence[str] = None
+) -> bool:
+    if exclude is not None and any(key in name for key in exclude):
+        return False
+    if include is None:
+        return True
+    return any(key in name for key in include)
+
+
+def quantize_linear_layers(
+    model: nn.Module,
+    bits: int = 8,
+    include: Sequence[str] = DEFAULT_QUANT_INCLUDE,
+    exclude: Sequence[str] = None,
+    min_features: int = 64,
+    lora_mode: Literal["delta", "requant"] = "delta",
+) -> List[str]:
+    """将 model 中名字匹配的 nn.Linear 替换为 WeightOnlyQuantLinear，包括 3d block 中的时序层和 attn processor 中的 to_k_ip、to_v_ip
+    replace matched nn.Linear of model with WeightOnlyQuantLinear, including temporal layers of 3d blocks and to_k_ip, to_v_ip of attn processor.
+
+    Args:
+        model (nn.Module): unet, referencenet or controlnet.
+        bits (int, optional): 8 or 4. Defaults to 8.
+        include (Sequence[str], optional): sub strings of module names to quantize, None means all. Defaults to DEFAULT_QUANT_INCLUDE.
+        exclude (Sequence[str], optional): sub strings of module names to skip. Defaults to None.
+        min_features (int, optional): skip small linears whose in_features or out_features is less than it. Defaults to 64.
+        lora_mode (Literal["delta", "requant"], optional): how to merge lora weight. Defaults to "delta".
+
+    Returns:
+        List[str]: names of quantized modules.
+    """
+    targets = []
+    for name, module in model.named_modules():
+        if type(module) not in [nn.Linear] and module.__class__.__name__ not in [
+            "LoRACompatibleLinear"
+        ]:
+            continue
+        if getattr(module, "lora_layer", None) is not None:
+            continue
+        if min(module.in_features, module.out_features) < min_features:
+            continue
+        if not _match_name(name, include=include, exclude=exclude):
+            continue
+        targets.append(name)
+    for name in targets:
+        parent_name, _, child_name = name.rpartition(".")
+        parent = model.get_submodule(parent_name) if parent_name else model
+        linear = getattr(parent, child_name)
+        setattr(
+            parent,
+            child_name,
+            WeightOnlyQuantLinear.from_linear(linear, bits=bits, lora_mode=lora_mode),
+        )
+    logger.debug(
+        f"quantize_linear_layers, model={model.__class__.__name__}, bits={bits}, n_layers={len(targets)}"
+    )
+    return targets
+
+
+def dequantize_linear_layers(model: nn.Module) -> List[str]:
+    """将 WeightOnlyQuantLinear 还原为 nn.Linear, restore WeightOnlyQuantLinear to nn.Linear."""
+    targets = [
+        name
+        for name, module in model.named_modules()
+        if isinstance(module, WeightOnlyQuantLinear)
+    ]
+    for name in targets:
+        parent_name, _, child_name = name.rpartition(".")
+        parent = model.get_submodule(parent_name) if parent_name else model
+        layer = getattr(parent, child_name)
+        weight = layer.dequantize()
+        linear = nn.Linear(
+            layer.in_features,
+            layer.out_features,
+            bias=layer.bias is not None,
+            device=weight.device,
+            dtype=weight.dtype,
+        )
+        linear.weight.data.copy_(weight)
+        if layer.bias is not None:
+            linear.bias.data.copy_(layer.bias.data)
+        linear.requires_grad_(False)
+        setattr(parent, child_name, linear)
+    return targets
+
+
+def add_layer_weight_delta(layer: nn.Module, delta: torch.Tensor) -> None:
+    """lora 加载与卸载使用，兼容普通层与量化层
+    used by lora load and unload, compatible with normal and quantized layers.
+    """
+    if isinstance(layer, WeightOnlyQuantLinear):
+        layer.add_weight_delta(delta)
+    else:
+        layer.weight.data += delta
+
+
+def is_lora_factor_layer(layer: nn.Module) -> bool:
+    """该层是否以低秩因子保存 lora, whether layer keeps lora as low-rank factors."""
+    return isinstance(layer, WeightOnlyQuantLinear) and layer.lora_mode == "delta"
+
+
+def remove_layer_lora(layer_data: Dict) -> None:
+    """卸载 update_pipeline_lora_model 返回的 unload_dict 中的一项
+    unload one item of unload_dict returned by update_pipeline_lora_model.
+    """
+    layer = layer_data["layer"]
+    if "lora_key" in layer_data:
+        layer.remove_lora(layer_data["lora_key"])
+    else:
+        add_layer_weight_delta(layer, -layer_data["added_weight"])
@@ -68,6 +68,8 @@ from diffusers.models.modeling_utils import ModelMixin
 from ..data.data_util import align_repeat_tensor_single_dim
 from .unet_3d_condition import UNet3DConditionModel
 from .attention import BasicTransformerBlock, IPAttention
+from .token_merge import set_token_merge, remove_token_merge
+from .compile_util import is_compile_mode
 from .unet_2d_blocks import (
     UNetMidBlock2D,
     UNetMidBlock2DCrossAttn,
@@ -636,6 +638,9 @@ class ReferenceNet2D(UNet2DConditionModel, nn.Module):
             self.up_blocks = None
 
         self.insert_spatial_self_attn_idx()
+        # 空间 self-attn 的 token merging 共享信息，由 set_token_merge 设置
+        # shared info of token merging in spatial self-attn, set by set_token_merge
+        self.tome_info = None
 
     def forward(
         self,
@@ -912,6 +917,8 @@ class ReferenceNet2D(UNet2DConditionModel, nn.Module):
         else:
             self_attn_block_embs = None
         # 2. pre-process
+        if self.tome_info is not None:
+            self.tome_info["size"] = tuple(sample.shape[-2:])
         sample = self.conv_in(sample)
         if self.print_idx == 0:
             logger.debug(f"after conv in sample={sample.mean()}")
@@ -1119,7 +1126,8 @@ class ReferenceNet2D(UNet2DConditionModel, nn.Module):
                     reshape_return_emb(tmp_emb=tmp_emb)
                     for tmp_emb in self_attn_block_embs
                 ]
-            self.print_idx += 1
+            if not is_compile_mode(self):
+                self.print_idx += 1
             return (
                 return_down_block_res_samples,
                 return_mid_block_res_samples,
@@ -1136,12 +1144,37 @@ class ReferenceNet2D(UNet2DConditionModel, nn.Module):
             if USE_PEFT_BACKEND:
                 # remove `lora_scale` from each PEFT layer
                 unscale_lora_layers(self, lora_scale)
-            self.print_idx += 1
+            if not is_compile_mode(self):
+                self.print_idx += 1
             if not return_dict:
                 return (sample,)
 
             return UNet2DConditionOutput(sample=sample)
 
+    def set_token_merge(
+        self,
+        ratio: Union[float, Dict[str, float]] = 0.5,
+        max_downsample: int = 1,
+        sx: int = 2,
+        sy: int = 2,
+        use_rand: bool = False,
+    ) -> None:
+        """空间 self-attn 使用 token merging，参数见 musev.models.token_merge.set_token_merge
+        use token merging in spatial self-attn, refer to musev.models.token_merge.set_token_merge for parameters.
+        """
+        self.tome_info = set_token_merge(
+            self,
+            ratio=ratio,
+            max_downsample=max_downsample,
+            sx=sx,
+            sy=sy,
+            use_rand=use_rand,
+        )
+
+    def remove_token_merge(self) -> None:
+        remove_token_merge(self)
+        self.tome_info = None
+
     def insert_spatial_self_attn_idx(self):
         attns, basic_transformers = self.spatial_self_attns
         self.self_attn_num = len(attns)
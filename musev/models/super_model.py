@@ -14,6 +14,7 @@ from ..data.data_util import align_repeat_tensor_single_dim
 
 from .unet_3d_condition import UNet3DConditionModel
 from .referencenet import ReferenceNet2D
+from .compile_util import is_compile_mode
 from ip_adapter.ip_adapter import ImageProjModel
 
 logger = logging.getLogger(__name__)
@@ -245,7 +246,8 @@ class SuperUNet3DConditionModel(nn.Module):
             encoder_hidden_states=encoder_hidden_states,
             vision_clip_emb=vision_clip_emb,
         )
-        self.print_idx += 1
+        if not is_compile_mode(self):
+            self.print_idx += 1
         return out
 
     def _set_gradient_checkpointing(self, module, value=False):
@@ -40,10 +40,14 @@ from ..data.data_util import (
     concat_two_tensor,
     align_repeat_tensor_single_dim,
 )
-from ..utils.attention_util import generate_sparse_causcal_attn_mask
+from ..utils.attention_util import (
+    generate_sparse_causcal_attn_mask,
+    generate_local_attn_chunks,
+)
 from .attention import BasicTransformerBlock
 from .attention_processor import (
     BaseIPAttnProcessor,
+    LocalTemporalAttnProcessor,
 )
 from . import Model_Register
 
@@ -182,10 +186,64 @@ class TransformerTemporalModel(ModelMixin, ConfigMixin):
         self.double_self_attention = double_self_attention
         self.cross_attention_dim = cross_attention_dim
         self.image_scale = image_scale
+        # 局部时序 attn 的窗口，由 set_local_temporal_attn 设置，None 表示 full attn
+        # window of local temporal attn, set by set_local_temporal_attn, None means full attn
+        self.local_temporal_attn_window = None
+        self.local_temporal_attn_chunk_size = None
+        self._full_temporal_attn_processors = None
         # zero out the last layer params,so the conv block is identity
         nn.init.zeros_(self.proj_out.weight)
         nn.init.zeros_(self.proj_out.bias)
 
+    def _local_temporal_attns(self) -> List[nn.Module]:
+        attns = []
+        for block in self.transformer_blocks:
+            attns.append(block.attn1)
+            # double_self_attention 时 attn2 也是时序 self_attn
+            # attn2 is also temporal self_attn when double_self_attention
+            if block.attn2 is not None and self.double_self_attention:
+                attns.append(block.attn2)
+        return attns
+
+    def set_local_temporal_attn(
+        self, window_size: int = None, chunk_size: int = None
+    ) -> None:
+        """时序 self_attn 使用局部窗口，每帧只与 ±window_size 内的帧及条件帧计算 attn
+        use local window in temporal self_attn, every frame only attends frames within ±window_size and condition frames.
+
+        Args:
+            window_size (int, optional): window size, None means full attn. Defaults to None.
+            chunk_size (int, optional): num of frames in one query chunk. Defaults to None, use window_size.
+        """
+        attns = self._local_temporal_attns()
+        if window_size is None:
+            if self._full_temporal_attn_processors is not None:
+                for attn, processor in zip(attns, self._full_temporal_attn_processors):
+                    attn.set_processor(processor)
+                self._full_temporal_attn_processors = None
+            self.local_temporal_attn_window = None
+            self.local_temporal_attn_chunk_size = None
+            return
+        if window_size < 0:
+            raise ValueError(f"window_size should be >= 0, but given {window_size}")
+        if self._full_temporal_attn_processors is None:
+            self._full_temporal_attn_processors = [attn.processor for attn in attns]
+        for attn, processor in zip(attns, self._full_temporal_attn_processors):
+            # ip_adapter 等特殊 AttnProcessor 保持不变
+            # special AttnProcessor like ip_adapter is kept
+            if isinstance(processor, BaseIPAttnProcessor):
+                logger.warning(
+                    f"{processor.__class__.__name__} not support local temporal attn, keep full attn"
+                )
+                continue
+            attn.set_processor(
+                LocalTemporalAttnProcessor(
+                    window_size=window_size, chunk_size=chunk_size
+                )
+            )
+        self.local_temporal_attn_window = window_size
+        self.local_temporal_attn_chunk_size = chunk_size
+
     def forward(
         self,
         hidden_states,
@@ -247,8 +305,16 @@ class TransformerTemporalModel(ModelMixin, ConfigMixin):
         if not self.remove_femb_non_linear:
             femb = self.nonlinearity(femb)
         femb = self.frame_emb_proj(femb)
-        femb = align_repeat_tensor_single_dim(femb, hidden_states.shape[0], dim=0)
-        hidden_states = hidden_states + femb
+        if femb.ndim == 3 and hidden_states.shape[0] % femb.shape[0] == 0:
+            # (b h w) t c 按 b 分组后与 b t c 广播相加，与 repeat_interleave 结果相同，不再复制 h*w 份 femb
+            # add (b h w) t c grouped by b with b t c by broadcasting, same as repeat_interleave,
+            # without copying femb h*w times
+            hidden_states = (
+                hidden_states.unflatten(0, (femb.shape[0], -1)) + femb.unsqueeze(1)
+            ).flatten(0, 1)
+        else:
+            femb = align_repeat_tensor_single_dim(femb, hidden_states.shape[0], dim=0)
+            hidden_states = hidden_states + femb
 
         # 3. Blocks
         if (
@@ -263,6 +329,20 @@ class TransformerTemporalModel(ModelMixin, ConfigMixin):
                 n_src_base_length=batch_size,
             )
 
+        # 局部时序 attn 的分块只与帧数、条件帧有关，所有 block 共享
+        # chunks of local temporal attn only depend on num_frames and condition frames, shared by all blocks
+        if self.local_temporal_attn_window is not None:
+            local_attn_chunks = generate_local_attn_chunks(
+                num_frames,
+                window_size=self.local_temporal_attn_window,
+                chunk_size=self.local_temporal_attn_chunk_size,
+                condition_index=vision_conditon_frames_sample_index,
+                device=hidden_states.device,
+            )
+            for attn in self._local_temporal_attns():
+                if isinstance(attn.processor, LocalTemporalAttnProcessor):
+                    attn.processor.local_attn_chunks = local_attn_chunks
+
         for i, block in enumerate(self.transformer_blocks):
             hidden_states = block(
                 hidden_states,
@@ -0,0 +1,397 @@
+"""token merging for spatial self-attn, refer to ToMe for SD https://arxiv.org/abs/2303.17604
+bipartite_soft_matching_2d is adapted from https://github.com/dbolya/tomesd (MIT License)
+
+空间 self-attn 前合并相似 token，attn 后再还原，保证后续时序层每帧的 token 排布不变。
+merge similar tokens before spatial self-attn, and unmerge after attn, to keep token layout of every frame for temporal layers.
+
+pool_reference_tokens 用于 referenceonly attn 中作为 key value 的参考 token 的缩减。
+pool_reference_tokens reduces reference tokens used as key value in referenceonly attn.
+"""
+from typing import Callable, Dict, List, Literal, Tuple, Union
+import math
+import logging
+
+import torch
+from torch import nn
+import torch.nn.functional as F
+
+
+logger = logging.getLogger(__name__)
+
+
+def do_nothing(x: torch.Tensor, mode: str = None) -> torch.Tensor:
+    return x
+
+
+def bipartite_soft_matching_2d(
+    metric: torch.Tensor,
+    w: int,
+    h: int,
+    sx: int,
+    sy: int,
+    r: int,
+    use_rand: bool = False,
+    generator: torch.Generator = None,
+) -> Tuple[Callable, Callable]:
+    """每个 sx*sy 窗口选一个 dst token，其余 src token 中与 dst 最相似的 r 个合并到 dst
+    select one dst token in every sx*sy window, merge r src tokens most similar to dst into dst.
+
+    Args:
+        metric (torch.Tensor): b n c, similarity metric of tokens.
+        w (int): token width.
+        h (int): token height.
+        sx (int): stride in width.
+        sy (int): stride in height.
+        r (int): num of tokens to remove.
+        use_rand (bool, optional): whether to select dst randomly in window, fixed top-left otherwise. Defaults to False.
+        generator (torch.Generator, optional): generator of random dst. Defaults to None.
+
+    Returns:
+        Tuple[Callable, Callable]: merge, unmerge
+    """
+    B, N, _ = metric.shape
+
+    if r <= 0:
+        return do_nothing, do_nothing
+
+    gather = torch.gather
+
+    with torch.no_grad():
+        hsy, wsx = h // sy, w // sx
+
+        # dst 在窗口中的位置, position of dst in every window
+        if use_rand:
+            rand_idx = torch.randint(
+                sy * sx,
+                size=(hsy, wsx, 1),
+                device=generator.device if generator is not None else metric.device,
+                generator=generator,
+            ).to(metric.device)
+        else:
+            rand_idx = torch.zeros(
+                hsy, wsx, 1, device=metric.device, dtype=torch.int64
+            )
+
+        # dst 标记为 -1, src 为 0，argsort 后 dst 在前
+        # dst is marked -1 and src is 0, dst is ahead after argsort
+        idx_buffer_view = torch.zeros(
+            hsy, wsx, sy * sx, device=metric.device, dtype=torch.int64
+        )
+        idx_buffer_view.scatter_(
+            dim=2,
+            index=rand_idx,
+            src=-torch.ones_like(rand_idx, dtype=rand_idx.dtype),
+        )
+        idx_buffer_view = (
+            idx_buffer_view.view(hsy, wsx, sy, sx)
+            .transpose(1, 2)
+            .reshape(hsy * sy, wsx * sx)
+        )
+        # h, w 不能被 sy, sx 整除时，剩余部分都是 src
+        # if h, w is not divisible by sy, sx, the rest tokens are src
+        if (hsy * sy) < h or (wsx * sx) < w:
+            idx_buffer = torch.zeros(h, w, device=metric.device, dtype=torch.int64)
+            idx_buffer[: (hsy * sy), : (wsx * sx)] = idx_buffer_view
+        else:
+            idx_buffer = idx_buffer_view
+
+        rand_idx = idx_buffer.reshape(1, -1, 1).argsort(dim=1)
+        del idx_buffer, idx_buffer_view
+
+        num_dst = hsy * wsx
+        a_idx = rand_idx[:, num_dst:, :]  # src
+        b_idx = rand_idx[:, :num_dst, :]  # dst
+
+        def split(x: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+            C = x.shape[-1]
+            src = gather(x, dim=1, index=a_idx.expand(B, N - num_dst, C))
+            dst = gather(x, dim=1, index=b_idx.expand(B, num_dst, C))
+            return src, dst
+
+        metric = metric / metric.norm(dim=-1, keepdim=True)
+        a, b = split(metric)
+        scores = a @ b.transpose(-1, -2)
+
+        r = min(a.shape[1], r)
+
+        node_max, node_idx = scores.max(dim=-1)
+        edge_idx = node_max.argsort(dim=-1, descending=True)[..., None]
+
+        unm_idx = edge_idx[..., r:, :]  # unmerged src
+        src_idx = edge_idx[..., :r, :]  # merged src
+        dst_idx = gather(node_idx[..., None], dim=-2, index=src_idx)
+
+    def merge(x: torch.Tensor, mode: str = "mean") -> torch.Tensor:
+        src, dst = split(x)
+        n, t1, c = src.shape
+
+        unm = gather(src, dim=-2, index=unm_idx.expand(n, t1 - r, c))
+        src = gather(src, dim=-2, index=src_idx.expand(n, r, c))
+        dst = dst.scatter_reduce(-2, dst_idx.expand(n, r, c), src, reduce=mode)
+
+        return torch.cat([unm, dst], dim=1)
+
+    def unmerge(x: torch.Tensor) -> torch.Tensor:
+        unm_len = unm_idx.shape[1]
+        unm, dst = x[..., :unm_len, :], x[..., unm_len:, :]
+        _, _, c = unm.shape
+
+        src = gather(dst, dim=-2, index=dst_idx.expand(B, r, c))
+
+        out = torch.zeros(B, N, c, device=x.device, dtype=x.dtype)
+        out.scatter_(dim=-2, index=b_idx.expand(B, num_dst, c), src=dst)
+        out.scatter_(
+            dim=-2,
+            index=gather(
+                a_idx.expand(B, a_idx.shape[1], 1), dim=1, index=unm_idx
+            ).expand(B, unm_len, c),
+            src=unm,
+        )
+        out.scatter_(
+            dim=-2,
+            index=gather(
+                a_idx.expand(B, a_idx.shape[1], 1), dim=1, index=src_idx
+            ).expand(B, r, c),
+            src=src,
+        )
+
+        return out
+
+    return merge, unmerge
+
+
+def compute_token_merge(
+    x: torch.Tensor, tome_info: Dict, ratio: float
+) -> Tuple[Callable, Callable]:
+    """根据 block 的 token 数 推断下采样倍数与 token 的 h w，生成 merge unmerge
+    infer downsample and token h w of block from num of tokens, and generate merge, unmerge.
+
+    Args:
+        x (torch.Tensor): (b t) hw c
+        tome_info (Dict): shared token merging info of model, `size` is latent h w of model input.
+        ratio (float): ratio of tokens to remove.
+
+    Returns:
+        Tuple[Callable, Callable]: merge, unmerge
+    """
+    if tome_info.get("size", None) is None or ratio <= 0:
+        return do_nothing, do_nothing
+    original_h, original_w = tome_info["size"]
+    original_tokens = original_h * original_w
+    downsample = int(math.ceil(math.sqrt(original_tokens // x.shape[1])))
+    if downsample > tome_info["max_downsample"]:
+        return do_nothing, do_nothing
+    w = int(math.ceil(original_w / downsample))
+    h = int(math.ceil(original_h / downsample))
+    if h * w != x.shape[1]:
+        return do_nothing, do_nothing
+    r = int(x.shape[1] * ratio)
+    return bipartite_soft_matching_2d(
+        x,
+        w=w,
+        h=h,
+        sx=tome_info["sx"],
+        sy=tome_info["sy"],
+        r=r,
+        use_rand=tome_info["use_rand"],
+        generator=tome_info.get("generator", None),
+    )
+
+
+def set_token_merge(
+    model: nn.Module,
+    ratio: Union[float, Dict[str, float]] = 0.5,
+    max_downsample: int = 1,
+    sx: int = 2,
+    sy: int = 2,
+    use_rand: bool = False,
+) -> Dict:
+    """给 model 的 空间self-attn BasicTransformerBlock 设置 token merging
+    set token merging for spatial self-attn BasicTransformerBlock of model.
+
+    Args:
+        model (nn.Module): UNet3DConditionModel or ReferenceNet2D, should have property spatial_self_attns.
+        ratio (Union[float, Dict[str, float]], optional): ratio of tokens to remove.
+            float: same ratio for all blocks;
+            dict: per-block ratio, key is prefix of block name, such as `down_blocks.0`, the longest matched prefix is used,
+                blocks without matched prefix are not merged.
+            Defaults to 0.5.
+        max_downsample (int, optional): only merge blocks whose downsample <= max_downsample, in [1, 2, 4, 8]. Defaults to 1.
+        sx (int, optional): stride in width. Defaults to 2.
+        sy (int, optional): stride in height. Defaults to 2.
+        use_rand (bool, optional): whether to select dst randomly. Defaults to False.
+
+    Returns:
+        Dict: shared token merging info of model.
+    """
+    tome_info = {
+        "size": None,
+        "max_downsample": max_downsample,
+        "sx": sx,
+        "sy": sy,
+        "use_rand": use_rand,
+    }
+    _, basic_transformers = model.spatial_self_attns
+    for name, block in basic_transformers:
+        # 时序 transformer 的 token 是帧，不做 merge
+        # tokens of temporal transformer are frames, not to merge
+        if block is None or "temp_attentions" in name or "transformer_in" in name:
+            continue
+        if isinstance(ratio, dict):
+            matched_keys = [k for k in ratio.keys() if name.startswith(k)]
+            block_ratio = (
+                ratio[max(matched_keys, key=len)] if len(matched_keys) > 0 else 0.0
+            )
+        else:
+            block_ratio = ratio
+        if not 0 <= block_ratio < 1:
+            raise ValueError(
+                f"token merge ratio should be in [0, 1), but given {block_ratio} of {name}"
+            )
+        block.tome_ratio = block_ratio
+        block.tome_info = tome_info
+        logger.debug(f"set_token_merge, {name}, ratio={block_ratio}")
+    return tome_info
+
+
+def remove_token_merge(model: nn.Module) -> None:
+    _, basic_transformers = model.spatial_self_attns
+    for name, block in basic_transformers:
+        if block is None:
+            continue
+        block.tome_ratio = 0.0
+        block.tome_info = None
+
+
+def get_layer_pool_ratio(
+    ratio: Union[float, List[float], Dict[int, float]], idx: int
+) -> float:
+    """per-layer ratio of reference token pooling, layers not in list or dict are not pooled.
+
+    Args:
+        ratio (Union[float, List[float], Dict[int, float]]): float for all layers, or list/dict indexed by spatial_self_attn_idx.
+        idx (int): spatial_self_attn_idx of layer.
+
+    Returns:
+        float: ratio of tokens to keep.
+    """
+    if isinstance(ratio, dict):
+        return ratio.get(idx, 1.0)
+    if isinstance(ratio, (list, tuple)):
+        return ratio[idx] if idx < len(ratio) else 1.0
+    return ratio
+
+
+def pool_reference_tokens(
+    x: torch.Tensor,
+    method: Literal["stride", "topk_norm", "cluster"],
+    ratio: float,
+    hw: Tuple[int, int] = None,
+    n_iter: int = 2,
+) -> torch.Tensor:
+    """缩减 referenceonly attn 中的参考 token，只影响 key value 的长度
+    reduce reference tokens of referenceonly attn, only length of key value changes.
+
+    Args:
+        x (torch.Tensor): b t n c, reference tokens.
+        method (Literal["stride", "topk_norm", "cluster"]):
+            stride: average pooling with stride round(1/sqrt(ratio)) in h w, 1d pooling in n if hw is None;
+            topk_norm: keep tokens with top-k l2 norm of all t n tokens;
+            cluster: k-means of all t n tokens with cosine similarity, use centroids as tokens, no learned param.
+        ratio (float): ratio of tokens to keep, in (0, 1].
+        hw (Tuple[int, int], optional): h w of tokens, n == h * w. Defaults to None.
+        n_iter (int, optional): iterations of cluster. Defaults to 2.
+
+    Returns:
+        torch.Tensor: b t' n' c
+    """
+    if method is None or ratio >= 1:
+        return x
+    if not 0 < ratio <= 1:
+        raise ValueError(f"reference token pool ratio should be in (0, 1], but given {ratio}")
+    b, t, n, c = x.shape
+    if method == "stride":
+        stride = max(1, int(round(1 / math.sqrt(ratio))))
+        if stride == 1:
+            return x
+        if hw is not None and hw[0] * hw[1] == n:
+            h, w = hw
+            x = x.reshape(b * t, h, w, c).permute(0, 3, 1, 2)
+            x = F.avg_pool2d(x, kernel_size=stride, stride=stride, ceil_mode=True)
+            x = x.flatten(2).transpose(1, 2)
+        else:
+            x = x.reshape(b * t, n, c).transpose(1, 2)
+            x = F.avg_pool1d(
+                x, kernel_size=stride**2, stride=stride**2, ceil_mode=True
+            )
+            x = x.transpose(1, 2)
+        return x.reshape(b, t, -1, c)
+    x = x.reshape(b, t * n, c)
+    k = max(1, int(math.ceil(t * n * ratio)))
+    if method == "topk_norm":
+        idx = x.norm(dim=-1).topk(k, dim=-1).indices
+        # 保持原始 token 顺序, keep original order of tokens
+        idx = idx.sort(dim=-1).values
+        x = torch.gather(x, dim=1, index=idx[..., None].expand(b, k, c))
+    elif method == "cluster":
+        dtype = x.dtype
+        x = x.float()
+        x_norm = F.normalize(x, dim=-1)
+        init_idx = torch.linspace(0, t * n - 1, k, device=x.device).long()
+        centroids = x[:, init_idx]
+        for _ in range(n_iter):
+            sim = x_norm @ F.normalize(centroids, dim=-1).transpose(1, 2)
+            assign = sim.argmax(dim=-1)
+            sums = torch.zeros_like(centroids).scatter_add_(
+                1, assign[..., None].expand(b, t * n, c), x
+            )
+            counts = torch.zeros(b, k, 1, device=x.device, dtype=x.dtype)
+            counts.scatter_add_(1, assign[..., None], torch.ones_like(x[..., :1]))
+            # 空簇保留上一轮中心, empty cluster keeps previous centroid
+            centroids = torch.where(
+                counts > 0, sums / counts.clamp(min=1), centroids
+            )
+        x = centroids.to(dtype)
+    else:
+        raise ValueError(
+            f"reference token pool method should be one of stride, topk_norm, cluster, but given {method}"
+        )
+    return x.reshape(b, 1, k, c)
+
+
+def pool_refer_self_attn_embs(
+    refer_self_attn_embs: List[torch.Tensor],
+    method: Literal["stride", "topk_norm", "cluster"],
+    ratio: Union[float, List[float], Dict[int, float]],
+) -> List[torch.Tensor]:
+    """referencenet 输出的每层 self_attn emb 只需在每次推理中缩减一次
+    self_attn emb of every layer from referencenet only needs to be reduced once per run.
+
+    Args:
+        refer_self_attn_embs (List[torch.Tensor]): b c t h w, indexed by spatial_self_attn_idx.
+        method (Literal["stride", "topk_norm", "cluster"]): refer to pool_reference_tokens.
+        ratio (Union[float, List[float], Dict[int, float]]): refer to get_layer_pool_ratio.
+
+    Returns:
+        List[torch.Tensor]: b c t' n' 1
+    """
+    if refer_self_attn_embs is None or method is None:
+        return refer_self_attn_embs
+    pooled_embs = []
+    for idx, emb in enumerate(refer_self_attn_embs):
+        layer_ratio = get_layer_pool_ratio(ratio, idx)
+        if emb is None or layer_ratio >= 1:
+            pooled_embs.append(emb)
+            continue
+        _, _, t, h, w = emb.shape
+        pooled_emb = pool_reference_tokens(
+            emb.flatten(3).permute(0, 2, 3, 1),
+            method=method,
+            ratio=layer_ratio,
+            hw=(h, w),
+        )
+        pooled_embs.append(pooled_emb.permute(0, 3, 1, 2)[..., None].contiguous())
+        logger.debug(
+            f"pool_refer_self_attn_embs, {idx}, {emb.shape} -> {pooled_embs[-1].shape}"
+        )
+    return pooled_embs
@@ -39,6 +39,7 @@ from diffusers.models.modeling_utils import ModelMixin
 from diffusers.utils.constants import USE_PEFT_BACKEND
 
 from .attention import BasicTransformerBlock
+from .compile_util import is_compile_mode
 
 logger = logging.getLogger(__name__)
 
@@ -438,7 +439,8 @@ class Transformer2DModel(DiffusersTransformer2DModel):
                     width * self.patch_size,
                 )
             )
-        self.print_idx += 1
+        if not is_compile_mode(self):
+            self.print_idx += 1
         if not return_dict:
             return (output,)
 
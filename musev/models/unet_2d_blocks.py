@@ -59,6 +59,7 @@ from diffusers.models.unet_2d_blocks import (
 )
 
 from .transformer_2d import Transformer2DModel
+from .compile_util import is_compile_mode
 
 
 logger = logging.get_logger(__name__)  # pylint: disable=invalid-name
@@ -1128,7 +1129,8 @@ class CrossAttnDownBlock2D(nn.Module):
 
             output_states = output_states + (hidden_states,)
 
-        self.print_idx += 1
+        if not is_compile_mode(self):
+            self.print_idx += 1
         return hidden_states, output_states
 
 
@@ -31,6 +31,7 @@ from .resnet import TemporalConvLayer
 from .temporal_transformer import TransformerTemporalModel
 from .transformer_2d import Transformer2DModel
 from .attention_processor import ReferEmbFuseAttention
+from .compile_util import is_compile_mode
 
 
 logger = logging.getLogger(__name__)
@@ -429,7 +430,8 @@ class UNetMidBlock3DCrossAttn(nn.Module):
                     src_index=sample_index,
                     dst_index=vision_conditon_frames_sample_index,
                 )
-        self.print_idx += 1
+        if not is_compile_mode(self):
+            self.print_idx += 1
         return hidden_states
 
 
@@ -768,7 +770,8 @@ class CrossAttnDownBlock3D(nn.Module):
                     hidden_states, refer_embs[i_downblock], num_frames=num_frames
                 )
             output_states += (hidden_states,)
-        self.print_idx += 1
+        if not is_compile_mode(self):
+            self.print_idx += 1
         return hidden_states, output_states
 
 
@@ -979,7 +982,8 @@ class DownBlock3D(nn.Module):
                     hidden_states, refer_embs[i_downblock], num_frames=num_frames
                 )
             output_states += (hidden_states,)
-        self.print_idx += 1
+        if not is_compile_mode(self):
+            self.print_idx += 1
         return hidden_states, output_states
 
 
@@ -1247,7 +1251,8 @@ class CrossAttnUpBlock3D(nn.Module):
                     src_index=sample_index,
                     dst_index=vision_conditon_frames_sample_index,
                 )
-        self.print_idx += 1
+        if not is_compile_mode(self):
+            self.print_idx += 1
         return hidden_states
 
 
@@ -1409,5 +1414,6 @@ class UpBlock3D(nn.Module):
                     src_index=sample_index,
                     dst_index=vision_conditon_frames_sample_index,
                 )
-        self.print_idx += 1
+        if not is_compile_mode(self):
+            self.print_idx += 1
         return hidden_states
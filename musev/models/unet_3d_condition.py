@@ -73,6 +73,12 @@ from .temporal_transformer import (
     TransformerTemporalModel,
 )
 from .embeddings import get_2d_sincos_pos_embed, resize_spatial_position_emb
+from .token_merge import (
+    set_token_merge,
+    remove_token_merge,
+    get_layer_pool_ratio,
+    pool_refer_self_attn_embs,
+)
 from .unet_3d_blocks import (
     CrossAttnDownBlock3D,
     CrossAttnUpBlock3D,
@@ -94,6 +100,7 @@ from .attention_processor import BaseIPAttnProcessor
 from .attention_processor import ReferEmbFuseAttention
 from .transformer_2d import Transformer2DModel
 from .attention import BasicTransformerBlock
+from .compile_util import disable_compile, enable_compile, is_compile_mode
 
 
 logger = logging.getLogger(__name__)  # pylint: disable=invalid-name
@@ -609,6 +616,28 @@ class UNet3DConditionModel(ModelMixin, ConfigMixin, UNet2DConditionLoadersMixin)
         # 当为 True 时，会跳过 referencenet_block_emb的影响，主要用于首帧生成
         self.skip_refer_downblock_emb = False
 
+        # 相邻timestep的深层特征相似，cheap step 复用 full step 缓存的深层特征，参考 DeepCache
+        # deep features of adjacent timesteps are similar, cheap step reuses deep features cached in full step
+        # refer to DeepCache https://arxiv.org/abs/2312.00858
+        self.deep_cache = {}
+        self.deep_cache_n_shallow_blocks = 1
+
+        # 空间 self-attn 的 token merging 共享信息，由 set_token_merge 设置
+        # shared info of token merging in spatial self-attn, set by set_token_merge
+        self.tome_info = None
+
+        # referenceonly attn 中参考 token 的缩减，由 set_refer_token_pool 设置
+        # reduction of reference tokens in referenceonly attn, set by set_refer_token_pool
+        self.refer_token_pool_method = None
+        self.refer_token_pool_ratio = 1.0
+
+        # 按 hw 缓存的 spatial position emb，避免每步在 numpy 中计算
+        # spatial position emb cached by hw, to avoid computing in numpy every step
+        self.spatial_position_emb_cache = {}
+        # 编译模式下替换 forward 的按桶编译缓存，由 enable_compile 设置
+        # per bucket compile cache which replaces forward in compile mode, set by enable_compile
+        self.compiled_forward_cache = None
+
     @property
     # Copied from diffusers.models.unet_2d_condition.UNet2DConditionModel.attn_processors
     def attn_processors(self) -> Dict[str, AttentionProcessor]:
@@ -800,6 +829,8 @@ class UNet3DConditionModel(ModelMixin, ConfigMixin, UNet2DConditionLoadersMixin)
         ip_adapter_face_scale: float = 1.0,
         do_classifier_free_guidance: bool = False,
         pose_guider_emb: torch.Tensor = None,
+        deep_cache_mode: Literal["full", "cheap"] = None,
+        deep_cache_key: Any = None,
     ) -> Union[UNet3DConditionOutput, Tuple]:
         """_summary_
 
@@ -825,6 +856,12 @@ class UNet3DConditionModel(ModelMixin, ConfigMixin, UNet2DConditionLoadersMixin)
             how_fuse_referencenet_emb (Literal, optional): 如何融合 参考 latent. Defaults to ["add", "attn"]="add".
                 add: 要求 additional_latent 和 latent hw 同尺寸. hw of addtional_latent should be same as of latent
                 attn:   concat bt*h1w1*c and bt*h2w2*c into bt*(h1w1+h2w2)*c, and then as key,value into attn
+            deep_cache_mode (Literal["full", "cheap"], optional): None 表示不使用 deep cache.
+                full: run all blocks, and cache input of up_blocks[-deep_cache_n_shallow_blocks];
+                cheap: only run shallow down_blocks/up_blocks, reuse cached deep feature, run full if no valid cache.
+                Defaults to None.
+            deep_cache_key (Any, optional): key of cached deep feature, such as context window of latents,
+                to keep cached feature corresponding to the same frames. Defaults to None.
         Raises:
             ValueError: _description_
 
@@ -883,6 +920,9 @@ class UNet3DConditionModel(ModelMixin, ConfigMixin, UNet2DConditionLoadersMixin)
 
         # broadcast to batch dimension in a way that's compatible with ONNX/Core ML
         batch_size, channel, num_frames, height, width = sample.shape
+        # 编译模式下由 prepare_compile_inputs 在编译图外设置, set out of compiled graph by prepare_compile_inputs in compile mode
+        if self.tome_info is not None and not is_compile_mode(self):
+            self.tome_info["size"] = (height, width)
 
         # 准备 timestep emb
         timesteps = timesteps.expand(sample.shape[0])
@@ -954,16 +994,8 @@ class UNet3DConditionModel(ModelMixin, ConfigMixin, UNet2DConditionLoadersMixin)
         # prepare spatial_position_emb
         if self.need_spatial_position_emb:
             # height * width, self.spatial_position_input_dim
-            spatial_position_emb = get_2d_sincos_pos_embed(
-                embed_dim=self.spatial_position_input_dim,
-                grid_size_w=width,
-                grid_size_h=height,
-                cls_token=False,
-                norm_length=self.norm_spatial_length,
-                max_length=self.spatial_max_length,
-            )
-            spatial_position_emb = torch.from_numpy(spatial_position_emb).to(
-                device=sample.device, dtype=self.dtype
+            spatial_position_emb = self.get_spatial_position_emb(
+                height, width, device=sample.device
             )
             # height * width, self.spatial_position_embed_dim
             spatial_position_emb = self.spatial_position_embedding(spatial_position_emb)
@@ -977,8 +1009,10 @@ class UNet3DConditionModel(ModelMixin, ConfigMixin, UNet2DConditionLoadersMixin)
             or self.need_t2i_facein
             or self.need_t2i_ip_adapter_face
         ):
-            if cross_attention_kwargs is None:
-                cross_attention_kwargs = {}
+            # 复制而不是修改调用方的字典, copy instead of mutating dict of caller
+            cross_attention_kwargs = (
+                {} if cross_attention_kwargs is None else dict(cross_attention_kwargs)
+            )
             cross_attention_kwargs["num_frames"] = num_frames
             cross_attention_kwargs[
                 "do_classifier_free_guidance"
@@ -1071,9 +1105,32 @@ class UNet3DConditionModel(ModelMixin, ConfigMixin, UNet2DConditionLoadersMixin)
         # 将 refer_self_attn_emb 转化成字典，增加一个当前index，表示block 的对应关系
         # convert refer_self_attn_emb to dict, add a current index to represent the corresponding relationship of the block
 
+        # deep cache: cheap step 只运行浅层 down_blocks/up_blocks，复用 full step 缓存的深层特征
+        # deep cache: cheap step only runs shallow down_blocks/up_blocks, reuse deep feature cached in full step
+        n_shallow_blocks = self.deep_cache_n_shallow_blocks
+        deep_cache_block_idx = len(self.up_blocks) - n_shallow_blocks
+        deep_cache_name = (deep_cache_key, f"up_blocks.{deep_cache_block_idx}")
+        deep_cache_item = None
+        if deep_cache_mode == "cheap":
+            deep_cache_item = self.deep_cache.get(deep_cache_name, None)
+            # cfg 策略等导致 batch 变化时，缓存失效
+            # cache is invalid when batch changes, such as by cfg execution policy
+            if (
+                deep_cache_item is not None
+                and deep_cache_item["sample"].shape[0] != sample.shape[0]
+            ):
+                deep_cache_item = None
+        run_deep_branch = deep_cache_item is None
+        if self.print_idx == 0:
+            logger.debug(
+                f"deep_cache_mode={deep_cache_mode}, deep_cache_name={deep_cache_name}, run_deep_branch={run_deep_branch}"
+            )
+
         # 3. down
         down_block_res_samples = (sample,)
         for i_down_block, downsample_block in enumerate(self.down_blocks):
+            if not run_deep_branch and i_down_block >= n_shallow_blocks:
+                break
             # 使用 attn 的方式 来融合 refer_emb，这里是准备 downblock 对应的 refer_emb
             # fuse refer_emb with attn, here is to prepare the refer_emb corresponding to downblock
             if (
@@ -1099,10 +1156,7 @@ class UNet3DConditionModel(ModelMixin, ConfigMixin, UNet2DConditionLoadersMixin)
                     )
             if self.print_idx == 0:
                 logger.debug(f"downsample_block {i_down_block}, sample={sample.mean()}")
-            if (
-                hasattr(downsample_block, "has_cross_attention")
-                and downsample_block.has_cross_attention
-            ):
+            if getattr(downsample_block, "has_cross_attention", False):
                 sample, res_samples = downsample_block(
                     hidden_states=sample,
                     temb=emb,
@@ -1156,7 +1210,7 @@ class UNet3DConditionModel(ModelMixin, ConfigMixin, UNet2DConditionLoadersMixin)
             down_block_res_samples = new_down_block_res_samples
 
         # 4. mid
-        if self.mid_block is not None:
+        if self.mid_block is not None and run_deep_branch:
             sample = self.mid_block(
                 hidden_states=sample,
                 temb=emb,
@@ -1177,6 +1231,7 @@ class UNet3DConditionModel(ModelMixin, ConfigMixin, UNet2DConditionLoadersMixin)
             self.mid_block_refer_emb_attns is not None
             and mid_block_refer_emb is not None
             and not self.skip_refer_downblock_emb
+            and run_deep_branch
         ):
             if self.print_idx == 0:
                 logger.debug(
@@ -1192,11 +1247,28 @@ class UNet3DConditionModel(ModelMixin, ConfigMixin, UNet2DConditionLoadersMixin)
         else:
             if self.print_idx == 0:
                 logger.debug(f"mid_block_refer_emb_attns, no this step")
-        if mid_block_additional_residual is not None:
+        if mid_block_additional_residual is not None and run_deep_branch:
             sample = sample + mid_block_additional_residual
 
         # 5. up
+        if not run_deep_branch:
+            # 浅层 up_blocks 只使用 conv_in 与浅层 down_blocks 的 res_samples
+            # shallow up_blocks only use res_samples of conv_in and shallow down_blocks
+            n_shallow_res_samples = sum(
+                len(upsample_block.resnets)
+                for upsample_block in self.up_blocks[deep_cache_block_idx:]
+            )
+            down_block_res_samples = down_block_res_samples[:n_shallow_res_samples]
+            sample = deep_cache_item["sample"]
+            spatial_position_emb = deep_cache_item["spatial_position_emb"]
         for i_up_block, upsample_block in enumerate(self.up_blocks):
+            if not run_deep_branch and i_up_block < deep_cache_block_idx:
+                continue
+            if deep_cache_mode is not None and i_up_block == deep_cache_block_idx:
+                self.deep_cache[deep_cache_name] = {
+                    "sample": sample,
+                    "spatial_position_emb": spatial_position_emb,
+                }
             is_final_block = i_up_block == len(self.up_blocks) - 1
 
             res_samples = down_block_res_samples[-len(upsample_block.resnets) :]
@@ -1209,10 +1281,7 @@ class UNet3DConditionModel(ModelMixin, ConfigMixin, UNet2DConditionLoadersMixin)
             if not is_final_block and forward_upsample_size:
                 upsample_size = down_block_res_samples[-1].shape[2:]
 
-            if (
-                hasattr(upsample_block, "has_cross_attention")
-                and upsample_block.has_cross_attention
-            ):
+            if getattr(upsample_block, "has_cross_attention", False):
                 sample = upsample_block(
                     hidden_states=sample,
                     temb=emb,
@@ -1270,7 +1339,8 @@ class UNet3DConditionModel(ModelMixin, ConfigMixin, UNet2DConditionLoadersMixin)
         #         src_index=sample_index,
         #         dst_index=vision_conditon_frames_sample_index,
         #     )
-        self.print_idx += 1
+        if not is_compile_mode(self):
+            self.print_idx += 1
 
         if skip_temporal_layers is not None:
             self.set_skip_temporal_layers(not skip_temporal_layers)
@@ -1660,6 +1730,190 @@ class UNet3DConditionModel(ModelMixin, ConfigMixin, UNet2DConditionLoadersMixin)
             if isinstance(module, torch.nn.Module):
                 fn_recursive_set_mem_eff(module)
 
+    def set_token_merge(
+        self,
+        ratio: Union[float, Dict[str, float]] = 0.5,
+        max_downsample: int = 1,
+        sx: int = 2,
+        sy: int = 2,
+        use_rand: bool = False,
+    ) -> None:
+        """空间 self-attn 使用 token merging，参数见 musev.models.token_merge.set_token_merge
+        use token merging in spatial self-attn, refer to musev.models.token_merge.set_token_merge for parameters.
+        """
+        self.tome_info = set_token_merge(
+            self,
+            ratio=ratio,
+            max_downsample=max_downsample,
+            sx=sx,
+            sy=sy,
+            use_rand=use_rand,
+        )
+
+    def remove_token_merge(self) -> None:
+        remove_token_merge(self)
+        self.tome_info = None
+
+    def set_refer_token_pool(
+        self,
+        method: Literal["stride", "topk_norm", "cluster"] = None,
+        ratio: Union[float, List[float], Dict[int, float]] = 1.0,
+    ) -> None:
+        """设置 referenceonly attn 中参考 token 的缩减方式，method=None 表示不缩减
+        set reduction of reference tokens in referenceonly attn, method=None means no reduction.
+
+        Args:
+            method (Literal["stride", "topk_norm", "cluster"], optional): refer to musev.models.token_merge.pool_reference_tokens. Defaults to None.
+            ratio (Union[float, List[float], Dict[int, float]], optional): ratio of tokens to keep,
+                float for all layers, or list/dict indexed by spatial_self_attn_idx. Defaults to 1.0.
+        """
+        self.refer_token_pool_method = method
+        self.refer_token_pool_ratio = ratio
+        _, basic_transformers = self.spatial_self_attns
+        for name, block in basic_transformers:
+            if block is None or block.attn1 is None:
+                continue
+            processor = block.attn1.processor
+            if not hasattr(processor, "refer_token_pool_method"):
+                continue
+            processor.refer_token_pool_method = method
+            processor.refer_token_pool_ratio = (
+                get_layer_pool_ratio(ratio, block.spatial_self_attn_idx)
+                if method is not None
+                else 1.0
+            )
+
+    def pool_refer_self_attn_emb(
+        self, refer_self_attn_emb: List[torch.Tensor]
+    ) -> List[torch.Tensor]:
+        """按 set_refer_token_pool 的设置缩减 referencenet 输出的 self_attn emb
+        reduce self_attn emb of referencenet with setting of set_refer_token_pool.
+        """
+        return pool_refer_self_attn_embs(
+            refer_self_attn_emb,
+            method=self.refer_token_pool_method,
+            ratio=self.refer_token_pool_ratio,
+        )
+
+    def set_local_temporal_attn(
+        self, window_size: int = None, chunk_size: int = None
+    ) -> None:
+        """所有时序 transformer 使用局部窗口 attn，window_size=None 时恢复 full attn
+        use local window attn in all temporal transformers, restore full attn when window_size=None.
+
+        Args:
+            window_size (int, optional): every frame attends frames within ±window_size and condition frames. Defaults to None.
+            chunk_size (int, optional): num of frames in one query chunk. Defaults to None.
+        """
+        for module in self.modules():
+            if module is not self and hasattr(module, "set_local_temporal_attn"):
+                module.set_local_temporal_attn(
+                    window_size=window_size, chunk_size=chunk_size
+                )
+
+    def get_spatial_position_emb(
+        self, height: int, width: int, device: torch.device
+    ) -> torch.Tensor:
+        """(height * width) * spatial_position_input_dim, 按 hw 缓存，
+        编译模式下首次调用在编译图外完成，图内只读缓存
+        cached by hw, in compile mode the first call of every bucket is out of compiled graph, graph only reads cache.
+        """
+        key = (height, width, str(device), self.dtype)
+        if key not in self.spatial_position_emb_cache:
+            spatial_position_emb = get_2d_sincos_pos_embed(
+                embed_dim=self.spatial_position_input_dim,
+                grid_size_w=width,
+                grid_size_h=height,
+                cls_token=False,
+                norm_length=self.norm_spatial_length,
+                max_length=self.spatial_max_length,
+            )
+            self.spatial_position_emb_cache[key] = torch.from_numpy(
+                spatial_position_emb
+            ).to(device=device, dtype=self.dtype)
+        return self.spatial_position_emb_cache[key]
+
+    # 取值会改变编译图的非 tensor 参数，其余非 tensor 参数（如 deep_cache_key）不进入编译缓存的桶
+    # non-tensor kwargs whose values change compiled graph, other non-tensor kwargs such as deep_cache_key
+    # are not part of bucket of compile cache
+    compile_graph_kwargs = (
+        "return_dict",
+        "skip_temporal_layers",
+        "refer_self_attn_emb_mode",
+        "do_classifier_free_guidance",
+        "sample_frame_rate",
+        "ip_adapter_scale",
+        "facein_scale",
+        "ip_adapter_face_scale",
+        "deep_cache_mode",
+    )
+
+    def enable_compile(
+        self,
+        mode: str = None,
+        fullgraph: bool = True,
+        max_buckets: int = 8,
+        backend: str = "inductor",
+    ) -> None:
+        """使用 torch.compile 编译 forward，每个分辨率桶静态 shape 编译一次，参考 musev.models.compile_util
+        compile forward with torch.compile, once with static shapes for every resolution bucket, refer to musev.models.compile_util.
+        编译图内不修改模块状态：token merging 的尺寸在图外设置，deep cache 会写缓存，编译模式下不支持。
+        module state is not mutated in compiled graph: size of token merging is set out of graph,
+        deep cache writes its cache and is not supported in compile mode.
+
+        Args:
+            mode (str, optional): mode of torch.compile, such as "reduce-overhead", "max-autotune". Defaults to None.
+            fullgraph (bool, optional): fullgraph of torch.compile. Defaults to True.
+            max_buckets (int, optional): max num of compiled buckets, new buckets run eagerly after that. Defaults to 8.
+            backend (str, optional): backend of torch.compile. Defaults to "inductor".
+        """
+        self.compiled_forward_cache = enable_compile(
+            self,
+            mode=mode,
+            fullgraph=fullgraph,
+            max_buckets=max_buckets,
+            backend=backend,
+            prepare_fn=self.prepare_compile_inputs,
+            graph_kwargs=self.compile_graph_kwargs,
+        )
+
+    def disable_compile(self) -> None:
+        disable_compile(self)
+        self.compiled_forward_cache = None
+
+    def prepare_compile_inputs(self, *args, **kwargs) -> None:
+        """编译图外按 sample 的 hw 准备 spatial position emb 缓存与 token merging 尺寸
+        prepare cache of spatial position emb and size of token merging with hw of sample out of compiled graph.
+        """
+        if kwargs.get("deep_cache_mode", None) is not None:
+            raise ValueError(
+                "deep cache mutates module state, not supported in compile mode"
+            )
+        sample = args[0] if len(args) > 0 else kwargs["sample"]
+        if self.tome_info is not None:
+            self.tome_info["size"] = tuple(sample.shape[-2:])
+        if self.need_spatial_position_emb:
+            self.get_spatial_position_emb(
+                sample.shape[-2], sample.shape[-1], device=sample.device
+            )
+
+    def set_deep_cache(self, n_shallow_blocks: int = 1) -> None:
+        """设置 deep cache 中 cheap step 运行的浅层 down_blocks/up_blocks 数量，并清空缓存
+        set num of shallow down_blocks/up_blocks run in cheap step of deep cache, and clear cache.
+
+        Args:
+            n_shallow_blocks (int, optional): num of shallow blocks. Defaults to 1.
+        """
+        if not 1 <= n_shallow_blocks < len(self.up_blocks):
+            raise ValueError(
+                f"n_shallow_blocks should be in [1, {len(self.up_blocks) - 1}], but given {n_shallow_blocks}"
+            )
+        self.deep_cache_n_shallow_blocks = n_shallow_blocks
+        self.clear_deep_cache()
+
+    def clear_deep_cache(self) -> None:
+        self.deep_cache = {}
+
     def insert_spatial_self_attn_idx(self):
         attns, basic_transformers = self.spatial_self_attns
         self.self_attn_num = len(attns)
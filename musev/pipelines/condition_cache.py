@@ -0,0 +1,150 @@
+"""controlnet condition 的磁盘缓存。
+同一个驱动视频搭配不同参考图、prompt、随机种子反复推理时，每次都会对每帧重新运行 controlnet_aux 的检测器（DWPose、depth 等）。
+这里以 processor 输入帧内容的哈希、processor 名字、processor 参数、加载参数与目标尺寸为键，将逐帧 condition 压缩存为 hdf5，
+每帧一个 chunk，可随机读取单帧。写入先写临时文件再原子重命名，多个 worker 可共享同一个缓存目录。
+
+on-disk cache of controlnet condition.
+when the same driving video is reused with different reference image, prompt or seed, detectors of controlnet_aux
+(DWPose, depth and so on) run again on every frame. condition maps are keyed by content hash of processor input frames,
+processor name, processor params, load params and target size, stored compressed in hdf5 with one chunk per frame,
+so that single frame can be read randomly. files are written to temp file and renamed atomically,
+so that multiple workers could share one cache dir.
+"""
+from typing import Dict, List, Optional, Union
+import hashlib
+import json
+import os
+import threading
+import logging
+
+import h5py
+import numpy as np
+
+
+logger = logging.getLogger(__name__)
+
+ConditionType = Union[np.ndarray, List[np.ndarray]]
+
+
+class ControlnetConditionCache(object):
+    def __init__(
+        self,
+        cache_dir: str,
+        compression: str = "gzip",
+        compression_opts: int = 4,
+    ) -> None:
+        """
+        Args:
+            cache_dir (str): cache dir, could be shared between workers.
+            compression (str, optional): hdf5 compression filter. Defaults to "gzip".
+            compression_opts (int, optional): compression level of gzip. Defaults to 4.
+        """
+        self.cache_dir = cache_dir
+        self.compression = compression
+        self.compression_opts = compression_opts
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def make_key(
+        self,
+        data: np.ndarray,
+        processor_name: Union[str, List[str]],
+        processor_params: Union[Dict, List[Dict]],
+        height: int,
+        width: int,
+        load_params: Dict = None,
+    ) -> str:
+        """由 processor 输入帧内容与 processor 配置生成缓存键
+        make cache key from content of processor input frames and processor config.
+
+        Args:
+            data (np.ndarray): processor input frames, such as (b t) h w c.
+            processor_name (Union[str, List[str]]): controlnet name, list for multi controlnet.
+            processor_params (Union[Dict, List[Dict]]): output of update_controlnet_processor_params.
+            height (int): target height.
+            width (int): target width.
+            load_params (Dict, optional): load-time settings of processor, kwargs of load_controlnet_model such as
+                detect_resolution, image_resolution, include_body, include_hand, include_face. Defaults to None.
+
+        Returns:
+            str: sha256 hex digest.
+        """
+        data = np.ascontiguousarray(data)
+        meta = json.dumps(
+            {
+                "processor_name": processor_name,
+                "processor_params": processor_params,
+                "load_params": load_params,
+                "height": height,
+                "width": width,
+                "shape": list(data.shape),
+                "dtype": str(data.dtype),
+            },
+            sort_keys=True,
+            default=str,
+        )
+        hasher = hashlib.sha256(meta.encode("utf-8"))
+        hasher.update(memoryview(data).cast("B"))
+        return hasher.hexdigest()
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key[:2], f"{key}.h5")
+
+    def get(self, key: str, frame_index: List[int] = None) -> Optional[ConditionType]:
+        """读取缓存的 condition，未命中返回 None
+        read cached condition, return None if missed.
+
+        Args:
+            key (str): cache key.
+            frame_index (List[int], optional): only read these frames, None means all frames. Defaults to None.
+
+        Returns:
+            Optional[ConditionType]: (b t) c h w, or list of it for multi controlnet.
+        """
+        path = self.path(key)
+        if not os.path.exists(path):
+            return None
+        try:
+            with h5py.File(path, "r") as f:
+                n_condition = int(f.attrs["n_condition"])
+                condition = []
+                for i in range(n_condition):
+                    dataset = f[f"condition_{i}"]
+                    if frame_index is None:
+                        condition.append(dataset[...])
+                    else:
+                        condition.append(dataset[sorted(frame_index)])
+                is_list = bool(f.attrs["is_list"])
+        except (OSError, KeyError) as e:
+            # 损坏或未写完的文件视为未命中. broken or partial file is treated as missed
+            logger.warning(f"failed to read controlnet condition cache {path}, {e}")
+            return None
+        return condition if is_list else condition[0]
+
+    def put(self, key: str, condition: ConditionType) -> None:
+        """以每帧一个 chunk 压缩写入，先写临时文件再原子重命名
+        write compressed with one chunk per frame, to temp file and then rename atomically.
+        """
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        is_list = isinstance(condition, (list, tuple))
+        conditions = list(condition) if is_list else [condition]
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with h5py.File(tmp_path, "w") as f:
+                f.attrs["n_condition"] = len(conditions)
+                f.attrs["is_list"] = is_list
+                for i, x in enumerate(conditions):
+                    x = np.asarray(x)
+                    f.create_dataset(
+                        f"condition_{i}",
+                        data=x,
+                        chunks=(1, *x.shape[1:]),
+                        compression=self.compression,
+                        compression_opts=self.compression_opts,
+                        shuffle=True,
+                    )
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning(f"failed to write controlnet condition cache {path}, {e}")
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
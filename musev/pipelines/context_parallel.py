@@ -0,0 +1,96 @@
+"""context window 多进程并行。
+每个 step 内的各 context window 在 noise_pred / counter 归约前相互独立，将它们按轮转方式分配到多个进程，
+每个进程持有一份完整模型，只计算自己的 window，之后用 torch.distributed 对 noise_pred 与 counter 做 all_reduce。
+cpu 上使用 gloo 后端测试，gpu 上使用 nccl。所有进程需使用相同的随机种子，使初始 latents 与 scheduler 噪声一致。
+
+context window parallelism across processes.
+context windows of one step are independent before the noise_pred / counter reduction, they are assigned to
+processes round-robin, every process holds a full model replica and only computes its own windows,
+then noise_pred and counter are all-reduced with torch.distributed.
+gloo backend is used for testing on cpu, nccl on gpu. all processes should use the same random seed,
+so that initial latents and scheduler noise are the same.
+
+usage:
+    torchrun --nproc_per_node 2 scripts/inference/text2video.py --context_parallel ...
+"""
+from typing import List, Tuple
+import os
+import logging
+
+import torch
+import torch.distributed as dist
+
+
+logger = logging.getLogger(__name__)
+
+
+def init_context_parallel(backend: str = None) -> Tuple[int, int, str]:
+    """从 torchrun 设置的环境变量初始化默认进程组，已初始化时直接返回
+    init default process group from env variables set by torchrun, return directly if initialized.
+
+    Args:
+        backend (str, optional): nccl or gloo, None means nccl when cuda is available else gloo. Defaults to None.
+
+    Returns:
+        Tuple[int, int, str]: rank, world_size, device of current process.
+    """
+    if backend is None:
+        backend = "nccl" if torch.cuda.is_available() else "gloo"
+    if not dist.is_initialized():
+        dist.init_process_group(backend=backend)
+    rank = dist.get_rank()
+    world_size = dist.get_world_size()
+    if dist.get_backend() == "nccl":
+        local_rank = int(os.environ.get("LOCAL_RANK", rank))
+        torch.cuda.set_device(local_rank)
+        device = f"cuda:{local_rank}"
+    else:
+        device = "cpu"
+    logger.info(
+        f"init_context_parallel, backend={dist.get_backend()}, rank={rank}, world_size={world_size}, device={device}"
+    )
+    return rank, world_size, device
+
+
+def is_main_process() -> bool:
+    return not dist.is_initialized() or dist.get_rank() == 0
+
+
+def split_global_context(
+    global_context: List[List[List[int]]], rank: int, world_size: int
+) -> List[List[List[int]]]:
+    """按轮转方式将 context batch 分配给各进程，相邻 window 分到不同进程，负载更均衡
+    assign context batches to processes round-robin, adjacent windows go to different processes for better balance.
+    """
+    return global_context[rank::world_size]
+
+
+def all_reduce_noise_pred(
+    noise_pred: torch.Tensor,
+    counter: torch.Tensor,
+    group: dist.ProcessGroup = None,
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """将各进程部分 window 的 noise_pred 与 counter 拼成一个张量，一次 all_reduce 求和
+    concat partial noise_pred and counter of every process into one tensor, sum with a single all_reduce.
+
+    Args:
+        noise_pred (torch.Tensor): b c t h w, partial sum of local windows.
+        counter (torch.Tensor): 1 1 t 1 1, partial count of local windows.
+        group (dist.ProcessGroup, optional): Defaults to None, the default group.
+
+    Returns:
+        Tuple[torch.Tensor, torch.Tensor]: summed noise_pred and counter of all windows.
+    """
+    buffer = torch.cat([noise_pred.flatten(), counter.flatten().to(noise_pred.dtype)])
+    # gloo 只支持 cpu 张量. gloo only supports cpu tensors
+    need_cpu = buffer.is_cuda and dist.get_backend(group) == "gloo"
+    if need_cpu:
+        device = buffer.device
+        buffer = buffer.cpu()
+    dist.all_reduce(buffer, op=dist.ReduceOp.SUM, group=group)
+    if need_cpu:
+        buffer = buffer.to(device)
+    noise_pred_numel = noise_pred.numel()
+    noise_pred = buffer[:noise_pred_numel].view_as(noise_pred)
+    counter = buffer[noise_pred_numel:].view_as(counter).to(counter.dtype)
+    return noise_pred, counter
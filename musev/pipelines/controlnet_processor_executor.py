@@ -0,0 +1,146 @@
+"""controlnet_aux processor 的多进程执行器。
+DWPose、OpenPose 等检测器逐帧串行运行，且大量占用 cpu 与 GIL。这里将一个窗口的帧沿帧维切分到进程池中，
+每个 worker 进程各自加载一份 processor，结果按原帧顺序拼接，调用接口与 controlnet_processor 相同，
+可直接替换 DiffusersPipelinePredictor.controlnet_processor，预处理吞吐随 cpu 核数扩展。
+
+multi-process executor of controlnet_aux processors.
+detectors such as DWPose and OpenPose run frame by frame serially and are cpu and GIL heavy. frames of one window
+are sharded along frame dim into a process pool, every worker process loads its own processor, results are
+concatenated in original frame order. the call interface is the same as controlnet_processor, so that it could
+replace DiffusersPipelinePredictor.controlnet_processor directly, preprocessing throughput scales with cpu cores.
+"""
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, List, Union
+import atexit
+import math
+import multiprocessing
+import logging
+
+import cv2
+import numpy as np
+import torch
+
+from mmcm.vision.feature_extractor.controlnet import load_controlnet_model
+
+
+logger = logging.getLogger(__name__)
+
+# worker 进程内的 processor. processor in worker process
+_WORKER_PROCESSOR = None
+
+
+def _init_worker(
+    controlnet_name: Union[str, List[str]], load_kwargs: Dict[str, Any], num_threads: int
+) -> None:
+    global _WORKER_PROCESSOR
+    # 每个 worker 限制线程数，避免进程间抢占 cpu. limit threads per worker to avoid cpu contention
+    torch.set_num_threads(num_threads)
+    cv2.setNumThreads(num_threads)
+    _, _WORKER_PROCESSOR, _ = load_controlnet_model(
+        controlnet_name,
+        need_controlnet_processor=True,
+        need_controlnet=False,
+        **load_kwargs,
+    )
+
+
+def _run_worker(data: np.ndarray, kwargs: Dict[str, Any]):
+    return _WORKER_PROCESSOR(data=data, **kwargs)
+
+
+def _frame_dim_first(channel_order: str) -> bool:
+    return channel_order.replace("(", "").split()[0] == "b"
+
+
+class ControlnetProcessorExecutor(object):
+    def __init__(
+        self,
+        controlnet_name: Union[str, List[str]],
+        load_kwargs: Dict[str, Any] = None,
+        num_workers: int = 2,
+        min_frames_per_worker: int = 1,
+        num_threads_per_worker: int = 1,
+    ) -> None:
+        """
+        Args:
+            controlnet_name (Union[str, List[str]]): controlnet name, list for multi controlnet.
+            load_kwargs (Dict[str, Any], optional): other kwargs of load_controlnet_model in worker, such as device,
+                detect_resolution, include_body. Defaults to None.
+            num_workers (int, optional): num of worker processes. Defaults to 2.
+            min_frames_per_worker (int, optional): do not shard smaller than this, to amortize ipc. Defaults to 1.
+            num_threads_per_worker (int, optional): torch and opencv threads of every worker. Defaults to 1.
+        """
+        if num_workers < 1:
+            raise ValueError(f"num_workers should be >= 1, but given {num_workers}")
+        self.num_workers = num_workers
+        self.min_frames_per_worker = min_frames_per_worker
+        # spawn 避免 fork 已初始化 cuda 的主进程. spawn avoids forking main process with initialized cuda
+        self.executor = ProcessPoolExecutor(
+            max_workers=num_workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+            initargs=(controlnet_name, load_kwargs or {}, num_threads_per_worker),
+        )
+        # 调用方未显式 shutdown 时，退出前回收 worker 进程. reap worker processes at exit if caller does not shutdown
+        atexit.register(self.shutdown)
+        logger.info(
+            f"ControlnetProcessorExecutor, controlnet_name={controlnet_name}, num_workers={num_workers}, load_kwargs={load_kwargs}"
+        )
+
+    def __call__(
+        self,
+        data: np.ndarray,
+        data_channel_order: str = "b h w c",
+        return_type: str = "np",
+        return_data_channel_order: str = "b c h w",
+        **kwargs,
+    ) -> Union[np.ndarray, List[np.ndarray]]:
+        """与 controlnet_processor 接口相同，其余参数如 target_height、input_rgb_order、processor_params 原样传给 worker
+        same interface as controlnet_processor, other kwargs such as target_height, input_rgb_order, processor_params
+        are passed to workers as is.
+
+        Args:
+            data (np.ndarray): frames, frame dim should be first, such as b h w c.
+            data_channel_order (str, optional): Defaults to "b h w c".
+            return_type (str, optional): only np is supported. Defaults to "np".
+            return_data_channel_order (str, optional): frame dim should be first. Defaults to "b c h w".
+
+        Returns:
+            Union[np.ndarray, List[np.ndarray]]: condition in original frame order, list for multi controlnet.
+        """
+        if return_type != "np":
+            raise ValueError(
+                f"ControlnetProcessorExecutor only supports return_type np, but given {return_type}"
+            )
+        if not _frame_dim_first(data_channel_order) or not _frame_dim_first(
+            return_data_channel_order
+        ):
+            raise ValueError(
+                f"frame dim should be first, but given data_channel_order={data_channel_order}, return_data_channel_order={return_data_channel_order}"
+            )
+        kwargs.update(
+            data_channel_order=data_channel_order,
+            return_type=return_type,
+            return_data_channel_order=return_data_channel_order,
+        )
+        n_frames = data.shape[0]
+        n_shards = max(
+            1,
+            min(self.num_workers, math.ceil(n_frames / self.min_frames_per_worker)),
+        )
+        futures = [
+            self.executor.submit(_run_worker, shard, kwargs)
+            for shard in np.array_split(data, n_shards, axis=0)
+        ]
+        # 按提交顺序取结果，保持帧顺序. get results in submit order to keep frame order
+        results = [future.result() for future in futures]
+        if isinstance(results[0], list):
+            return [
+                np.concatenate([result[i] for result in results], axis=0)
+                for i in range(len(results[0]))
+            ]
+        return np.concatenate(results, axis=0)
+
+    def shutdown(self) -> None:
+        atexit.unregister(self.shutdown)
+        self.executor.shutdown(wait=True)
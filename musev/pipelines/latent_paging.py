@@ -0,0 +1,191 @@
+"""长视频单次推理的 latents 分页。
+time_size 达到数百帧时，完整的 latents、cfg 下 2 倍大小的 noise_pred、每帧的 control_image 与 controlnet_latents
+会在整个推理过程中常驻 device。这里将这些完整长度的张量放在 host 内存（pinned memory）或内存映射文件中，
+每个 context window batch 只把用到的帧搬到 device，scheduler.step 也按帧分页执行，
+device 显存只与 window 大小相关，与视频长度无关。
+
+latent paging for single-call long video inference.
+when time_size reaches hundreds of frames, full latents, noise_pred of 2x size under cfg, control_image and
+controlnet_latents of every frame stay on device during the whole inference.
+these full-length tensors are kept in pinned host memory or memory-mapped files, only frames of current
+context window batch are moved to device, scheduler.step also runs page by page along frames,
+so that device memory only depends on window size, not video length.
+
+usage:
+    pipeline.enable_latent_paging(storage="pinned", page_size=16)
+    # or
+    pipeline.enable_latent_paging(storage="memmap", memmap_dir="/data/tmp")
+"""
+from typing import Dict, List, Literal, Union
+import os
+import logging
+import tempfile
+
+import torch
+
+
+logger = logging.getLogger(__name__)
+
+TensorOrList = Union[torch.Tensor, List[torch.Tensor], None]
+
+
+class LatentPagingStore(object):
+    def __init__(
+        self,
+        device: str,
+        storage: Literal["pinned", "memmap"] = "pinned",
+        memmap_dir: str = None,
+        page_size: int = 16,
+    ) -> None:
+        """完整长度张量的 host 存储，按帧分页搬运到 device
+        host storage of full-length tensors, page frames to device.
+
+        Args:
+            device (str): device where unet runs.
+            storage (Literal["pinned", "memmap"], optional): pinned host memory, or memory-mapped file. Defaults to "pinned".
+            memmap_dir (str, optional): dir of memory-mapped files, None means system temp dir. Defaults to None.
+            page_size (int, optional): number of frames per page of scheduler step. Defaults to 16.
+        """
+        if storage not in ["pinned", "memmap"]:
+            raise ValueError(
+                f"storage should be one of ['pinned', 'memmap'], but given {storage}"
+            )
+        if page_size < 1:
+            raise ValueError(f"page_size should be >= 1, but given {page_size}")
+        self.device = torch.device(device)
+        self.storage = storage
+        self.memmap_dir = memmap_dir
+        self.page_size = page_size
+        # 在步间复用的 buffer, 如 noise_pred. buffers reused across steps, such as noise_pred
+        self.buffers: Dict[str, torch.Tensor] = {}
+
+    def empty(self, shape: List[int], dtype: torch.dtype) -> torch.Tensor:
+        if self.storage == "memmap":
+            numel = 1
+            for s in shape:
+                numel *= s
+            fd, path = tempfile.mkstemp(
+                prefix="musev_latent_", suffix=".bin", dir=self.memmap_dir
+            )
+            try:
+                element_size = torch.empty((), dtype=dtype).element_size()
+                os.ftruncate(fd, numel * element_size)
+                tensor = torch.from_file(path, shared=True, size=numel, dtype=dtype)
+            finally:
+                # 映射建立后即可删除文件，张量释放时磁盘空间随之回收
+                # file can be removed once mapped, disk space is reclaimed when tensor is released
+                os.close(fd)
+                os.remove(path)
+            return tensor.view(*shape)
+        return torch.empty(
+            shape, dtype=dtype, pin_memory=torch.cuda.is_available()
+        )
+
+    def offload(self, data: TensorOrList) -> TensorOrList:
+        """将 device 上的完整长度张量拷贝到 host 存储
+        copy full-length tensor on device into host storage.
+        """
+        if data is None:
+            return None
+        if isinstance(data, (list, tuple)):
+            return [self.offload(x) for x in data]
+        host = self.empty(list(data.shape), dtype=data.dtype)
+        host.copy_(data)
+        return host
+
+    def zeros(self, name: str, shape: List[int], dtype: torch.dtype) -> torch.Tensor:
+        """返回置零的 host buffer，步间复用。batch 维较小时复用已有 buffer 的前部，如 cfg 仅计算 cond 的 step
+        return zeroed host buffer reused across steps. reuse front part of existing buffer when batch dim is smaller,
+        such as cond-only step of cfg.
+        """
+        buffer = self.buffers.get(name, None)
+        if (
+            buffer is None
+            or buffer.dtype != dtype
+            or list(buffer.shape[1:]) != list(shape[1:])
+            or buffer.shape[0] < shape[0]
+        ):
+            buffer = self.empty(list(shape), dtype=dtype)
+            self.buffers[name] = buffer
+        buffer = buffer[: shape[0]]
+        buffer.zero_()
+        return buffer
+
+    def to_device(self, data: TensorOrList) -> TensorOrList:
+        if data is None:
+            return None
+        if isinstance(data, (list, tuple)):
+            return [self.to_device(x) for x in data]
+        return data.to(self.device, non_blocking=True)
+
+    def load(self, data: torch.Tensor, context: List[List[int]]) -> torch.Tensor:
+        """将 context batch 的帧从 host 拼接后搬到 device
+        gather frames of context batch on host and move them to device.
+        """
+        return self.to_device(torch.cat([data[:, :, c] for c in context]))
+
+    def pages(self, time_size: int) -> List[slice]:
+        return [
+            slice(start, min(start + self.page_size, time_size))
+            for start in range(0, time_size, self.page_size)
+        ]
+
+    def step(
+        self,
+        scheduler,
+        noise_pred: torch.Tensor,
+        t: torch.Tensor,
+        latents: torch.Tensor,
+        guidance_scale: float = None,
+        extra_step_kwargs: Dict = None,
+    ) -> torch.Tensor:
+        """按帧分页执行 guidance 与 scheduler.step，结果原地写回 host 上的 latents
+        run guidance and scheduler.step page by page along frames, write result back into latents on host in place.
+
+        Args:
+            scheduler: scheduler of pipeline, should be stateless in frame dim, such as Euler, DDIM, LCM.
+            noise_pred (torch.Tensor): b c t h w on host, 2b when guidance_scale is not None.
+            t (torch.Tensor): timestep.
+            latents (torch.Tensor): b c t h w on host.
+            guidance_scale (float, optional): None means no guidance. Defaults to None.
+            extra_step_kwargs (Dict, optional): Defaults to None.
+
+        Returns:
+            torch.Tensor: latents updated in place.
+        """
+        check_scheduler_pageable(scheduler)
+        if extra_step_kwargs is None:
+            extra_step_kwargs = {}
+        has_step_index = hasattr(scheduler, "_step_index")
+        step_index = getattr(scheduler, "_step_index", None)
+        for k, page in enumerate(self.pages(latents.shape[2])):
+            # 每页都从同一个 step_index 开始，全部页结束后只前进一步
+            # every page starts from the same step_index, which is advanced only once after all pages
+            if has_step_index and k > 0:
+                scheduler._step_index = step_index
+            noise_pred_page = self.to_device(noise_pred[:, :, page])
+            if guidance_scale is not None:
+                noise_pred_uncond, noise_pred_text = noise_pred_page.chunk(2)
+                noise_pred_page = noise_pred_uncond + guidance_scale * (
+                    noise_pred_text - noise_pred_uncond
+                )
+            latents_page = scheduler.step(
+                noise_pred_page,
+                t,
+                self.to_device(latents[:, :, page]),
+                **extra_step_kwargs,
+            ).prev_sample
+            latents[:, :, page].copy_(latents_page)
+            if has_step_index and k == 0:
+                step_index = scheduler._step_index - 1
+        return latents
+
+
+def check_scheduler_pageable(scheduler) -> None:
+    """多步 scheduler 缓存了完整 shape 的历史 model_output，无法按帧分页
+    multistep schedulers cache history model_output of full shape, can not be paged along frames.
+    """
+    if getattr(scheduler, "order", 1) != 1 or hasattr(scheduler, "model_outputs"):
+        raise ValueError(
+            f"latent paging only supports single step schedulers, such as Euler, DDIM, LCM, but given {scheduler.__class__.__name__}"
+        )
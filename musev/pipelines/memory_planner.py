@@ -0,0 +1,407 @@
+"""根据显存预算与请求形状自动选择 context_batch_size、decoder_t_segment、vae_slicing 与时序 attn 分块。
+显存模型按组件拆分，每项是与 batch、帧数、latent token 数成正比的系数，可在小尺寸配置上实测标定后外推。
+
+choose context_batch_size, decoder_t_segment, vae_slicing and temporal attn chunking automatically
+according to memory budget and request shape.
+memory model is split by component, every item is a coefficient proportional to batch, frames and latent tokens,
+which could be calibrated on tiny configs and extrapolated.
+"""
+from dataclasses import dataclass, asdict
+from typing import Dict, Sequence, Tuple, Union
+
+import numpy as np
+import torch
+from torch import nn
+
+from diffusers.utils import logging
+
+from .context import prepare_global_context
+
+logger = logging.get_logger(__name__)  # pylint: disable=invalid-name
+
+
+@dataclass
+class MemoryModel:
+    """每个组件的显存系数，单位 byte，默认值为 fp16 + xformers 下 SD1.5 规模模型的保守估计
+    memory coefficients of every component in bytes, default values are conservative estimation
+    of SD1.5-size model with fp16 and xformers.
+
+    unet_bytes_per_token_frame: unet 每个 latent token 每帧的激活, activation of unet per latent token per frame.
+    temporal_attn_bytes_per_token_frame_key: 时序 attn 分数矩阵，正比于 token * 帧数 * key 帧数,
+        scores of temporal attn, proportional to tokens * frames * key frames.
+    controlnet_bytes_per_token_frame: controlnet 激活与残差, activation and residuals of controlnet.
+    referencenet_bytes_per_token: referencenet 激活, 只在首步运行, activation of referencenet, only in the first step.
+    refer_emb_bytes_per_token: 常驻的 referencenet self_attn emb, resident self_attn emb of referencenet.
+    vae_bytes_per_pixel: vae decoder 单帧激活, activation of vae decoder for one frame.
+    vae_out_bytes_per_pixel_frame: 解码输出在 gpu 上的拼接, concat of decoded output on gpu.
+    safety_ratio: 估计值的放大系数, scale of estimation.
+    """
+
+    unet_bytes_per_token_frame: float = 1.2e5
+    temporal_attn_bytes_per_token_frame_key: float = 48.0
+    controlnet_bytes_per_token_frame: float = 6e4
+    referencenet_bytes_per_token: float = 1e5
+    refer_emb_bytes_per_token: float = 6e3
+    vae_bytes_per_pixel: float = 1.5e3
+    vae_out_bytes_per_pixel_frame: float = 12.0
+    safety_ratio: float = 1.2
+
+    def estimate_denoise(
+        self,
+        batch_size: int,
+        n_frames: int,
+        n_tokens: int,
+        n_key_frames: int = None,
+        use_controlnet: bool = False,
+        use_referencenet: bool = False,
+        n_refer_frames: int = 1,
+    ) -> float:
+        """一个 context batch 的 denoise step 的峰值显存
+        peak memory of denoise step of one context batch.
+
+        Args:
+            batch_size (int): batch of unet input, includes cfg and context_batch_size.
+            n_frames (int): frames of one context window.
+            n_tokens (int): latent tokens of one frame, (h // 8) * (w // 8).
+            n_key_frames (int, optional): key frames of temporal attn, n_frames with full attn. Defaults to None.
+            use_controlnet (bool, optional): Defaults to False.
+            use_referencenet (bool, optional): Defaults to False.
+            n_refer_frames (int, optional): frames of refer_image. Defaults to 1.
+
+        Returns:
+            float: bytes
+        """
+        if n_key_frames is None:
+            n_key_frames = n_frames
+        token_frames = batch_size * n_frames * n_tokens
+        memory = token_frames * self.unet_bytes_per_token_frame
+        memory += (
+            token_frames * n_key_frames * self.temporal_attn_bytes_per_token_frame_key
+        )
+        if use_controlnet:
+            memory += token_frames * self.controlnet_bytes_per_token_frame
+        if use_referencenet:
+            refer_tokens = batch_size * n_refer_frames * n_tokens
+            memory += refer_tokens * self.refer_emb_bytes_per_token
+            memory = max(memory, refer_tokens * self.referencenet_bytes_per_token)
+        return memory * self.safety_ratio
+
+    def estimate_decode(
+        self,
+        batch_size: int,
+        n_frames: int,
+        height: int,
+        width: int,
+        vae_slicing: bool = True,
+    ) -> float:
+        """解码 n_frames 帧的峰值显存, peak memory of decoding n_frames frames.
+
+        Returns:
+            float: bytes
+        """
+        n_pixels = height * width
+        n_decode = 1 if vae_slicing else batch_size * n_frames
+        memory = n_decode * n_pixels * self.vae_bytes_per_pixel
+        memory += batch_size * n_frames * n_pixels * self.vae_out_bytes_per_pixel_frame
+        return memory * self.safety_ratio
+
+
+@dataclass
+class MemoryPlan:
+    context_batch_size: int
+    decoder_t_segment: int
+    vae_slicing: bool
+    temporal_attn_window: int = None
+    estimated_denoise_bytes: float = 0
+    estimated_decode_bytes: float = 0
+    budget_bytes: float = 0
+
+    def to_dict(self) -> Dict:
+        return asdict(self)
+
+
+def get_gpu_memory_budget(
+    device: torch.device = None, ratio: float = 0.9
+) -> float:
+    """当前空闲显存的 ratio 倍，模型权重已加载时即为可用于激活的预算
+    ratio of current free gpu memory, which is the budget of activation when model weights are loaded.
+    """
+    if not torch.cuda.is_available():
+        raise ValueError("memory budget planner needs cuda, please set memory_budget")
+    free_bytes, _ = torch.cuda.mem_get_info(device)
+    return free_bytes * ratio
+
+
+def plan_memory(
+    budget_bytes: float,
+    batch_size: int,
+    video_length: int,
+    height: int,
+    width: int,
+    context_frames: int,
+    context_overlap: int,
+    context_stride: int = 1,
+    context_schedule: str = "uniform",
+    do_classifier_free_guidance: bool = True,
+    use_controlnet: bool = False,
+    use_referencenet: bool = False,
+    n_refer_frames: int = 1,
+    n_vision_condition: int = 1,
+    vae_scale_factor: int = 8,
+    memory_model: MemoryModel = None,
+) -> MemoryPlan:
+    """在显存预算内选择最大的 context_batch_size 与 decoder_t_segment，
+    context_batch_size=1 仍超预算时使用局部时序 attn 缩小时序 attn 的 key 帧数。
+    choose the largest context_batch_size and decoder_t_segment within memory budget,
+    use local temporal attn to reduce key frames of temporal attn when context_batch_size=1 still exceeds budget.
+
+    Args:
+        budget_bytes (float): memory budget in bytes.
+        batch_size (int): batch of request, num_videos_per_prompt included.
+        video_length (int): frames of one denoise run.
+        height (int): pixel height.
+        width (int): pixel width.
+        context_frames (int): frames of one context window.
+        context_overlap (int): overlap of context windows.
+        context_stride (int, optional): Defaults to 1.
+        context_schedule (str, optional): Defaults to "uniform".
+        do_classifier_free_guidance (bool, optional): Defaults to True.
+        use_controlnet (bool, optional): Defaults to False.
+        use_referencenet (bool, optional): Defaults to False.
+        n_refer_frames (int, optional): Defaults to 1.
+        n_vision_condition (int, optional): condition frames always attended in local temporal attn. Defaults to 1.
+        vae_scale_factor (int, optional): Defaults to 8.
+        memory_model (MemoryModel, optional): Defaults to None, use default MemoryModel.
+
+    Returns:
+        MemoryPlan: plan
+    """
+    if memory_model is None:
+        memory_model = MemoryModel()
+    n_tokens = (height // vae_scale_factor) * (width // vae_scale_factor)
+    n_frames = min(context_frames, video_length)
+    unet_batch_size = batch_size * (2 if do_classifier_free_guidance else 1)
+    n_windows = len(
+        prepare_global_context(
+            context_schedule=context_schedule,
+            num_inference_steps=1,
+            time_size=video_length,
+            context_frames=context_frames,
+            context_stride=context_stride,
+            context_overlap=context_overlap,
+            context_batch_size=1,
+        )
+    )
+
+    def estimate_denoise(context_batch_size: int, n_key_frames: int = None) -> float:
+        return memory_model.estimate_denoise(
+            batch_size=unet_batch_size * context_batch_size,
+            n_frames=n_frames,
+            n_tokens=n_tokens,
+            n_key_frames=n_key_frames,
+            use_controlnet=use_controlnet,
+            use_referencenet=use_referencenet,
+            n_refer_frames=n_refer_frames,
+        )
+
+    # 1. context_batch_size, 超过窗口数没有收益, no gain when larger than num of windows
+    context_batch_size = 1
+    for candidate in range(n_windows, 0, -1):
+        if estimate_denoise(candidate) <= budget_bytes:
+            context_batch_size = candidate
+            break
+    estimated_denoise_bytes = estimate_denoise(context_batch_size)
+
+    # 2. 时序 attn 分块，key 帧数约为 3 * window + n_vision_condition
+    # temporal attn chunking, key frames are about 3 * window + n_vision_condition
+    temporal_attn_window = None
+    if estimated_denoise_bytes > budget_bytes:
+        for window in range(n_frames // 2, 0, -1):
+            n_key_frames = min(n_frames, 3 * window + n_vision_condition)
+            if estimate_denoise(1, n_key_frames) <= budget_bytes:
+                temporal_attn_window = window
+                break
+        if temporal_attn_window is None:
+            temporal_attn_window = 1
+            logger.warning(
+                f"denoise of {n_frames} frames at {height}x{width} exceeds memory budget {budget_bytes / 2**30:.2f}GB "
+                "even with context_batch_size=1 and temporal_attn_window=1, may run out of memory"
+            )
+        estimated_denoise_bytes = estimate_denoise(
+            1, min(n_frames, 3 * temporal_attn_window + n_vision_condition)
+        )
+
+    # 3. decoder_t_segment, 优先不切片整段解码, prefer decoding whole segment without slicing
+    vae_slicing = False
+    decoder_t_segment = video_length
+    if (
+        memory_model.estimate_decode(
+            batch_size, video_length, height, width, vae_slicing=False
+        )
+        > budget_bytes
+    ):
+        vae_slicing = True
+        fixed_bytes = memory_model.estimate_decode(1, 0, height, width, True)
+        bytes_per_frame = memory_model.estimate_decode(
+            batch_size, 1, height, width, True
+        ) - fixed_bytes
+        decoder_t_segment = int((budget_bytes - fixed_bytes) // bytes_per_frame)
+        decoder_t_segment = max(1, min(video_length, decoder_t_segment))
+    estimated_decode_bytes = memory_model.estimate_decode(
+        batch_size, decoder_t_segment, height, width, vae_slicing
+    )
+
+    plan = MemoryPlan(
+        context_batch_size=context_batch_size,
+        decoder_t_segment=decoder_t_segment,
+        vae_slicing=vae_slicing,
+        temporal_attn_window=temporal_attn_window,
+        estimated_denoise_bytes=estimated_denoise_bytes,
+        estimated_decode_bytes=estimated_decode_bytes,
+        budget_bytes=budget_bytes,
+    )
+    logger.debug(f"plan_memory, n_windows={n_windows}, {plan}")
+    return plan
+
+
+class PeakMemoryRecorder(object):
+    """用 forward hook 记录模块每次 forward 相对入口的峰值显存增量
+    record peak memory increment of every forward of module relative to entrance with forward hooks.
+    """
+
+    def __init__(self, module: nn.Module) -> None:
+        self.records = []
+        self._start = 0
+        self._handles = [
+            module.register_forward_pre_hook(self._pre_hook),
+            module.register_forward_hook(self._hook),
+        ]
+
+    def _pre_hook(self, module, args):
+        torch.cuda.synchronize()
+        self._start = torch.cuda.memory_allocated()
+        torch.cuda.reset_peak_memory_stats()
+
+    def _hook(self, module, args, output):
+        torch.cuda.synchronize()
+        self.records.append(torch.cuda.max_memory_allocated() - self._start)
+
+    @property
+    def peak(self) -> float:
+        return max(self.records) if len(self.records) > 0 else 0
+
+    def remove(self) -> None:
+        for handle in self._handles:
+            handle.remove()
+
+
+def _fit_non_negative(features: np.ndarray, targets: np.ndarray) -> np.ndarray:
+    coef, _, _, _ = np.linalg.lstsq(features, targets, rcond=None)
+    return np.clip(coef, 0, None)
+
+
+@torch.no_grad()
+def calibrate_memory_model(
+    pipeline: nn.Module,
+    shapes: Sequence[Tuple[int, int, int]] = (
+        (2, 256, 256),
+        (4, 256, 256),
+        (2, 384, 384),
+    ),
+    do_classifier_free_guidance: bool = True,
+    memory_model: MemoryModel = None,
+    **pipeline_kwargs,
+) -> MemoryModel:
+    """在小尺寸配置上实测 unet、controlnet、referencenet、vae decoder 的峰值显存，拟合 MemoryModel 系数
+    measure peak memory of unet, controlnet, referencenet, vae decoder on tiny configs, and fit coefficients of MemoryModel.
+
+    Args:
+        pipeline (nn.Module): MusevControlNetPipeline.
+        shapes (Sequence[Tuple[int, int, int]], optional): frames, height, width of tiny configs,
+            at least 2 different frames and 2 different sizes to separate linear and temporal attn items.
+        do_classifier_free_guidance (bool, optional): Defaults to True.
+        memory_model (MemoryModel, optional): base model, uncalibrated items are kept. Defaults to None.
+        pipeline_kwargs: other parameters of pipeline, such as refer_image, controlnet_condition_images.
+
+    Returns:
+        MemoryModel: calibrated memory model
+    """
+    if memory_model is None:
+        memory_model = MemoryModel()
+    vae_scale_factor = pipeline.vae_scale_factor
+    recorders = {
+        "unet": PeakMemoryRecorder(pipeline.unet),
+        "vae": PeakMemoryRecorder(pipeline.vae.decoder),
+    }
+    if getattr(pipeline, "controlnet", None) is not None:
+        recorders["controlnet"] = PeakMemoryRecorder(pipeline.controlnet)
+    if getattr(pipeline, "referencenet", None) is not None:
+        recorders["referencenet"] = PeakMemoryRecorder(pipeline.referencenet)
+    unet_features, unet_targets = [], []
+    vae_features, vae_targets = [], []
+    controlnet_targets, referencenet_targets = [], []
+    unet_batch_size = 2 if do_classifier_free_guidance else 1
+    # 标定时开启 vae slicing，使 decoder 每次只解码一帧，结束后恢复
+    # enable vae slicing during calibration so that decoder decodes one frame per call, restore it afterwards
+    use_vae_slicing = getattr(pipeline.vae, "use_slicing", False)
+    pipeline.enable_vae_slicing()
+    try:
+        for n_frames, height, width in shapes:
+            for recorder in recorders.values():
+                recorder.records = []
+            pipeline(
+                prompt="",
+                video_length=n_frames,
+                height=height,
+                width=width,
+                num_inference_steps=1,
+                guidance_scale=7.5 if do_classifier_free_guidance else 1.0,
+                context_frames=n_frames,
+                context_batch_size=1,
+                decoder_t_segment=n_frames,
+                output_type="np",
+                **pipeline_kwargs,
+            )
+            n_tokens = (height // vae_scale_factor) * (width // vae_scale_factor)
+            token_frames = unet_batch_size * n_frames * n_tokens
+            unet_features.append([token_frames, token_frames * n_frames])
+            unet_targets.append(recorders["unet"].peak)
+            # vae slicing 下 decoder 每次只解码一帧, decoder decodes one frame with vae slicing
+            vae_features.append([height * width])
+            vae_targets.append(recorders["vae"].peak)
+            if "controlnet" in recorders:
+                controlnet_targets.append(recorders["controlnet"].peak / token_frames)
+            if "referencenet" in recorders:
+                referencenet_targets.append(
+                    recorders["referencenet"].peak / (unet_batch_size * n_tokens)
+                )
+            logger.debug(
+                f"calibrate_memory_model, frames={n_frames}, {height}x{width}, "
+                + ", ".join(f"{k}={v.peak / 2**20:.1f}MB" for k, v in recorders.items())
+            )
+    finally:
+        for recorder in recorders.values():
+            recorder.remove()
+        if not use_vae_slicing:
+            pipeline.disable_vae_slicing()
+
+    unet_coef = _fit_non_negative(np.array(unet_features), np.array(unet_targets))
+    memory_model.unet_bytes_per_token_frame = float(unet_coef[0])
+    memory_model.temporal_attn_bytes_per_token_frame_key = float(unet_coef[1])
+    vae_coef = _fit_non_negative(np.array(vae_features), np.array(vae_targets))
+    memory_model.vae_bytes_per_pixel = float(vae_coef[0])
+    if len(controlnet_targets) > 0:
+        memory_model.controlnet_bytes_per_token_frame = float(max(controlnet_targets))
+    if len(referencenet_targets) > 0:
+        memory_model.referencenet_bytes_per_token = float(max(referencenet_targets))
+    logger.debug(f"calibrate_memory_model, {memory_model}")
+    return memory_model
+
+
+def int_or_auto(value: str) -> Union[int, str]:
+    """argparse type of parameters which could be "auto" and planned by plan_memory."""
+    if value == "auto":
+        return value
+    if value == "None":
+        return None
+    return int(value)
@@ -0,0 +1,233 @@
+"""按推理阶段卸载模块，只在需要的阶段把模块放在 device 上，其余时间放在 cpu（可选 pinned memory），
+并在当前阶段运行时异步预取下一阶段的模块。
+
+offload modules by inference phase, modules are on device only in phases which need them and on cpu (optionally pinned) otherwise,
+and modules of next phase are prefetched asynchronously while current phase is running.
+"""
+from collections import OrderedDict
+from typing import Dict, List, Sequence, Union
+
+import torch
+from torch import nn
+
+from diffusers.utils import logging
+
+logger = logging.get_logger(__name__)  # pylint: disable=invalid-name
+
+# 阶段按 pipeline 运行顺序排列，每个阶段需要的 pipeline 组件
+# phases in running order of pipeline, and pipeline components needed by every phase
+DEFAULT_PHASE_MODULES = OrderedDict(
+    [
+        ("encode_prompt", ["text_encoder"]),
+        (
+            "encode_image",
+            [
+                "vae",
+                "vision_clip_extractor",
+                "ip_adapter_image_proj",
+                "face_emb_extractor",
+                "facein_image_proj",
+                "ip_adapter_face_emb_extractor",
+                "ip_adapter_face_image_proj",
+                "pose_guider",
+            ],
+        ),
+        # referencenet 只在第一步运行, referencenet only runs in the first step
+        ("referencenet", ["referencenet", "unet", "controlnet"]),
+        ("denoise", ["unet", "controlnet"]),
+        ("decode", ["vae"]),
+    ]
+)
+
+
+# 入口方法不经过 forward 的组件，需要在实际运行 forward 的子模块上挂加载 hook
+# vae.encode/vae.decode 不调用 vae.forward，而是直接调用这些子模块
+# components whose entry methods bypass forward, load hooks are registered on submodules whose forward actually runs,
+# vae.encode/vae.decode do not call vae.forward but call these submodules directly
+ENTRY_SUBMODULES = {
+    "vae": ["quant_conv", "encoder", "post_quant_conv", "decoder"],
+}
+
+
+def get_offload_module(component) -> nn.Module:
+    """extractor 等非 nn.Module 组件使用其 model 属性, use model attribute of non nn.Module component like extractor."""
+    if isinstance(component, nn.Module):
+        return component
+    model = getattr(component, "model", None)
+    if isinstance(model, nn.Module):
+        return model
+    return None
+
+
+class PhaseOffloadManager(object):
+    """
+    pipeline 在每个阶段开始时调用 enter_phase，不在当前阶段与预取阶段的模块被卸载到 cpu。
+    模块在阶段外被调用时，forward_pre_hook 会同步加载，保证结果正确。
+    pipeline calls enter_phase at the beginning of every phase, modules not in current phase and prefetch phase are offloaded to cpu.
+    when module is called out of its phases, forward_pre_hook loads it synchronously to keep result correct.
+
+    Args:
+        pipeline (nn.Module): MusevControlNetPipeline.
+        device (Union[str, torch.device], optional): execution device. Defaults to "cuda".
+        pin_memory (bool, optional): whether to keep offloaded weights in pinned memory for async copy. Defaults to True.
+        prefetch (bool, optional): whether to prefetch modules of next phase on a side stream. Defaults to True.
+        phase_modules (Dict[str, List[str]], optional): phases and components, in running order. Defaults to DEFAULT_PHASE_MODULES.
+    """
+
+    def __init__(
+        self,
+        pipeline: nn.Module,
+        device: Union[str, torch.device] = "cuda",
+        pin_memory: bool = True,
+        prefetch: bool = True,
+        phase_modules: Dict[str, List[str]] = None,
+    ) -> None:
+        self.device = torch.device(device)
+        self.pin_memory = pin_memory and torch.cuda.is_available()
+        self.prefetch = prefetch and self.device.type == "cuda"
+        self.phase_modules = OrderedDict(
+            phase_modules if phase_modules is not None else DEFAULT_PHASE_MODULES
+        )
+        self.phases = list(self.phase_modules.keys())
+        self.modules = OrderedDict()
+        for names in self.phase_modules.values():
+            for name in names:
+                if name in self.modules:
+                    continue
+                module = get_offload_module(getattr(pipeline, name, None))
+                if module is not None:
+                    self.modules[name] = module
+        # name: "device" | "cpu" | "prefetching"
+        self.states = {name: "device" for name in self.modules}
+        self._cpu_tensors = {name: {} for name in self.modules}
+        self._hooks = []
+        for name, module in self.modules.items():
+            hook_modules = [module] + [
+                getattr(module, key)
+                for key in ENTRY_SUBMODULES.get(name, [])
+                if isinstance(getattr(module, key, None), nn.Module)
+            ]
+            for hook_module in hook_modules:
+                self._hooks.append(
+                    hook_module.register_forward_pre_hook(self._make_load_hook(name))
+                )
+        self._stream = torch.cuda.Stream(self.device) if self.prefetch else None
+        self.current_phase = None
+        logger.debug(
+            f"PhaseOffloadManager, modules={list(self.modules.keys())}, pin_memory={self.pin_memory}, prefetch={self.prefetch}"
+        )
+
+    def _make_load_hook(self, name: str):
+        def hook(module, args):
+            if self.states[name] != "device":
+                logger.debug(f"PhaseOffloadManager, load {name} on demand")
+                self.load(name)
+
+        return hook
+
+    def _tensors(self, module: nn.Module):
+        for key, param in module.named_parameters():
+            yield f"param.{key}", param
+        for key, buffer in module.named_buffers():
+            yield f"buffer.{key}", buffer
+
+    def offload(self, name: str) -> None:
+        if self.states[name] == "cpu":
+            return
+        if self.states[name] == "prefetching":
+            self._wait_prefetch()
+        cpu_tensors = self._cpu_tensors[name]
+        for key, tensor in self._tensors(self.modules[name]):
+            if tensor.device.type == "cpu":
+                continue
+            # 权重可能被 lora 修改，每次卸载都从 device 拷贝
+            # weights may be changed by lora, copy from device every offload
+            if key not in cpu_tensors or cpu_tensors[key].shape != tensor.shape:
+                cpu_tensors[key] = torch.empty(
+                    tensor.shape,
+                    dtype=tensor.dtype,
+                    device="cpu",
+                    pin_memory=self.pin_memory,
+                )
+            cpu_tensors[key].copy_(tensor.data)
+            tensor.data = cpu_tensors[key]
+        self.states[name] = "cpu"
+
+    def _copy_to_device(self, name: str, non_blocking: bool) -> None:
+        for key, tensor in self._tensors(self.modules[name]):
+            if tensor.device == self.device:
+                continue
+            tensor.data = tensor.data.to(self.device, non_blocking=non_blocking)
+
+    def load(self, name: str) -> None:
+        if self.states[name] == "prefetching":
+            self._wait_prefetch()
+        if self.states[name] == "device":
+            return
+        self._copy_to_device(name, non_blocking=False)
+        self.states[name] = "device"
+
+    def start_prefetch(self, names: Sequence[str]) -> None:
+        names = [name for name in names if self.states.get(name) == "cpu"]
+        if len(names) == 0:
+            return
+        if not self.prefetch:
+            return
+        # 预取流需等待当前流上已排队的计算，避免与正在使用的显存冲突
+        # prefetch stream waits for queued work of current stream
+        self._stream.wait_stream(torch.cuda.current_stream(self.device))
+        with torch.cuda.stream(self._stream):
+            for name in names:
+                self._copy_to_device(name, non_blocking=self.pin_memory)
+                self.states[name] = "prefetching"
+
+    def _wait_prefetch(self) -> None:
+        current_stream = torch.cuda.current_stream(self.device)
+        current_stream.wait_stream(self._stream)
+        for name, state in self.states.items():
+            if state == "prefetching":
+                for _, tensor in self._tensors(self.modules[name]):
+                    if tensor.device.type == "cuda":
+                        tensor.data.record_stream(current_stream)
+                self.states[name] = "device"
+
+    def enter_phase(self, phase: str) -> None:
+        """进入阶段：加载当前阶段模块，卸载其他模块，并预取下一阶段模块
+        enter phase: load modules of current phase, offload other modules, and prefetch modules of next phase.
+        """
+        if phase not in self.phase_modules:
+            raise ValueError(f"phase should be one of {self.phases}, but given {phase}")
+        if phase == self.current_phase:
+            return
+        phase_idx = self.phases.index(phase)
+        current_names = [n for n in self.phase_modules[phase] if n in self.modules]
+        next_names = []
+        if phase_idx + 1 < len(self.phases):
+            next_names = [
+                n
+                for n in self.phase_modules[self.phases[phase_idx + 1]]
+                if n in self.modules
+            ]
+        for name in self.modules:
+            if name not in current_names and name not in next_names:
+                self.offload(name)
+        for name in current_names:
+            self.load(name)
+        self.start_prefetch(next_names)
+        self.current_phase = phase
+        logger.debug(
+            f"PhaseOffloadManager, enter_phase={phase}, states={self.states}"
+        )
+
+    def offload_all(self) -> None:
+        for name in self.modules:
+            self.offload(name)
+        self.current_phase = None
+
+    def remove(self) -> None:
+        """移除 hook 并把所有模块加载回 device, remove hooks and load all modules back to device."""
+        for hook in self._hooks:
+            hook.remove()
+        for name in self.modules:
+            self.load(name)
+        self._cpu_tensors = {name: {} for name in self.modules}
@@ -4,13 +4,14 @@ import inspect
 import math
 import time
 import warnings
-from typing import Any, Callable, Dict, List, Optional, Tuple, Union
+from typing import Any, Callable, Dict, List, Literal, Optional, Tuple, Union
 from dataclasses import dataclass
 
 from einops import rearrange, repeat
 import PIL.Image
 import numpy as np
 import torch
+import torch.distributed as dist
 from torch import nn
 import torch.nn.functional as F
 
@@ -41,10 +42,7 @@ from diffusers.loaders import TextualInversionLoaderMixin
 from diffusers.models.attention import (
     BasicTransformerBlock as DiffusersBasicTransformerBlock,
 )
-from mmcm.vision.process.correct_color import (
-    hist_match_color_video_batch,
-    hist_match_video_bcthw,
-)
+from mmcm.vision.process.correct_color import hist_match_color_video_batch
 
 from ..models.attention import BasicTransformerBlock
 from ..models.unet_3d_condition import UNet3DConditionModel
@@ -58,9 +56,16 @@ from ..data.data_util import (
     fuse_part_tensor,
 )
 from ..utils.text_emb_util import encode_weighted_prompt
-from ..utils.tensor_util import his_match
-from ..utils.timesteps_util import generate_parameters_with_timesteps
+from ..utils.tensor_util import his_match, hist_match_video_bcthw
+from ..utils.timesteps_util import (
+    generate_guidance_execution_with_timesteps,
+    generate_parameters_with_timesteps,
+)
 from .context import get_context_scheduler, prepare_global_context
+from .offload_manager import PhaseOffloadManager
+from .context_parallel import all_reduce_noise_pred, split_global_context
+from .latent_paging import LatentPagingStore, check_scheduler_pageable
+from ..utils.profiler import NULL_PROFILER, PipelineProfiler
 
 logger = logging.get_logger(__name__)  # pylint: disable=invalid-name
 
@@ -84,6 +89,25 @@ def torch_dfs(model: torch.nn.Module):
     return result
 
 
+def select_cfg_cond_part(
+    data: Union[torch.Tensor, List[torch.Tensor], Tuple[torch.Tensor], None]
+) -> Union[torch.Tensor, List[torch.Tensor], None]:
+    """classifier-free guidance 时的输入在batch维按 [uncond, cond] 拼接，这里只取 cond 部分，用于仅计算 cond 的step
+    input of classifier-free guidance is concatenated in batch dim as [uncond, cond], select cond part only for cond-only step.
+
+    Args:
+        data (Union[torch.Tensor, List[torch.Tensor], Tuple[torch.Tensor], None]): tensor or list of tensor, batch dim is 0.
+
+    Returns:
+        Union[torch.Tensor, List[torch.Tensor], None]: cond part.
+    """
+    if data is None:
+        return None
+    if isinstance(data, (list, tuple)):
+        return [select_cfg_cond_part(x) for x in data]
+    return data.chunk(2)[1]
+
+
 def prepare_image(
     image,  # b c t h w
     batch_size,
@@ -229,6 +253,91 @@ class MusevControlNetPipeline(
         if isinstance(pose_guider, nn.Module):
             pose_guider.to(dtype=self.unet.dtype, device=self.unet.device)
         self.pose_guider = pose_guider
+        # 按推理阶段卸载模块，由 enable_phase_offload 设置
+        # offload modules by inference phase, set by enable_phase_offload
+        self.offload_manager = None
+        # context window 多进程并行，由 enable_context_parallel 设置
+        # context window parallelism across processes, set by enable_context_parallel
+        self.context_parallel = False
+        self.context_parallel_group = None
+        # 长视频 latents 分页存储参数，由 enable_latent_paging 设置
+        # kwargs of latent paging store for long video, set by enable_latent_paging
+        self.latent_paging_kwargs = None
+
+    def enable_latent_paging(
+        self,
+        storage: Literal["pinned", "memmap"] = "pinned",
+        memmap_dir: str = None,
+        page_size: int = 16,
+    ) -> None:
+        """完整长度的 latents、noise_pred、control_image 放在 host 内存或内存映射文件中，只把当前 window 的帧搬到 device，
+        参考 musev.pipelines.latent_paging
+        keep full-length latents, noise_pred, control_image in host memory or memory-mapped file, only move frames of
+        current window to device, refer to musev.pipelines.latent_paging.
+        """
+        check_scheduler_pageable(self.scheduler)
+        self.latent_paging_kwargs = {
+            "storage": storage,
+            "memmap_dir": memmap_dir,
+            "page_size": page_size,
+        }
+
+    def disable_latent_paging(self) -> None:
+        self.latent_paging_kwargs = None
+
+    def enable_context_parallel(self, group: dist.ProcessGroup = None) -> None:
+        """每个 step 的 context window 分配到进程组内的各进程，需先初始化 torch.distributed，参考 musev.pipelines.context_parallel
+        spread context windows of every step across processes of group, torch.distributed should be initialized first,
+        refer to musev.pipelines.context_parallel.
+        """
+        if not dist.is_initialized():
+            raise ValueError(
+                "torch.distributed should be initialized before enable_context_parallel"
+            )
+        self.context_parallel = True
+        self.context_parallel_group = group
+
+    def disable_context_parallel(self) -> None:
+        self.context_parallel = False
+        self.context_parallel_group = None
+
+    def enable_phase_offload(
+        self,
+        device: Union[str, torch.device] = "cuda",
+        pin_memory: bool = True,
+        prefetch: bool = True,
+        phase_modules: Dict[str, List[str]] = None,
+    ) -> None:
+        """只在需要的推理阶段把模块放在 device 上，参数见 musev.pipelines.offload_manager.PhaseOffloadManager
+        keep modules on device only in inference phases which need them, refer to musev.pipelines.offload_manager.PhaseOffloadManager.
+        """
+        if self.offload_manager is not None:
+            self.disable_phase_offload()
+        self.offload_manager = PhaseOffloadManager(
+            self,
+            device=device,
+            pin_memory=pin_memory,
+            prefetch=prefetch,
+            phase_modules=phase_modules,
+        )
+        self.offload_manager.offload_all()
+
+    def disable_phase_offload(self) -> None:
+        if self.offload_manager is not None:
+            self.offload_manager.remove()
+            self.offload_manager = None
+
+    def _enter_offload_phase(self, phase: str) -> None:
+        if self.offload_manager is not None:
+            self.offload_manager.enter_phase(phase)
+
+    def _exit_offload_phase(self) -> None:
+        """调用结束（包括出错）时卸载所有模块并清空当前阶段，下一次调用从头按阶段加载
+        offload all modules and reset current phase at the end of call (including on error),
+        next call loads modules by phase from the start.
+        """
+        if self.offload_manager is not None:
+            self.offload_manager.offload_all()
 
     def decode_latents(self, latents):
         batch_size = latents.shape[0]
@@ -504,10 +613,12 @@ class MusevControlNetPipeline(
             )
 
     def hist_match_with_vis_cond(
-        self, video: np.ndarray, target: np.ndarray
-    ) -> np.ndarray:
+        self,
+        video: Union[torch.Tensor, np.ndarray],
+        target: Union[torch.Tensor, np.ndarray],
+    ) -> Union[torch.Tensor, np.ndarray]:
         """
-        video: b c t1 h w
+        video: b c t1 h w, matched on its own device
         target: b c t2(=1) h w
         """
         video = hist_match_video_bcthw(video, target, value=255.0)
@@ -1325,6 +1436,11 @@ class MusevControlNetPipeline(
         guidance_scale: float = 7.5,
         guidance_scale_end: float = None,
         guidance_scale_method: str = "linear",
+        guidance_execution_method: Literal[
+            "always", "truncate", "reuse_uncond"
+        ] = "always",
+        guidance_truncate_ratio: float = 1.0,
+        guidance_uncond_reuse_steps: int = 0,
         negative_prompt: Optional[Union[str, List[str]]] = None,
         num_videos_per_prompt: Optional[int] = 1,
         eta: float = 0.0,
@@ -1382,6 +1498,13 @@ class MusevControlNetPipeline(
         interpolation_factor=1,
         # parallel_denoise parameter end
         decoder_t_segment: int = 200,
+        deep_cache_interval: int = 1,
+        deep_cache_n_shallow_blocks: int = 1,
+        refer_token_pool_method: Literal["stride", "topk_norm", "cluster"] = None,
+        refer_token_pool_ratio: Union[float, List[float], Dict[int, float]] = 1.0,
+        temporal_attn_window: int = None,
+        temporal_attn_chunk_size: int = None,
+        profiler: PipelineProfiler = None,
     ):
         r"""
         旨在兼容text2video、text2image、img2img、video2video、是否有controlnet等的通用pipeline。目前仅不支持img2img、video2video。
@@ -1434,6 +1557,18 @@ class MusevControlNetPipeline(
                 Paper](https://arxiv.org/pdf/2205.11487.pdf). Guidance scale is enabled by setting `guidance_scale >
                 1`. Higher guidance scale encourages to generate images that are closely linked to the text `prompt`,
                 usually at the expense of lower image quality.
+            guidance_execution_method (`str`, *optional*, defaults to `"always"`):
+                classifier-free guidance 中 uncond 分支的计算方式，用于减少unet计算量。
+                how to run uncond branch of classifier-free guidance, to reduce unet compute.
+                `always`: 每步都计算 uncond, run uncond at every step;
+                `truncate`: 前 `guidance_truncate_ratio` 比例的step计算 uncond，之后仅使用 cond 预测,
+                    run uncond in the first `guidance_truncate_ratio` steps, then use cond prediction only;
+                `reuse_uncond`: 每个 context window 的 uncond 预测会被后续 `guidance_uncond_reuse_steps` 步复用,
+                    uncond prediction of every context window is reused by the next `guidance_uncond_reuse_steps` steps.
+            guidance_truncate_ratio (`float`, *optional*, defaults to 1.0):
+                ratio of steps that run uncond branch when `guidance_execution_method="truncate"`.
+            guidance_uncond_reuse_steps (`int`, *optional*, defaults to 0):
+                num of steps reusing the last uncond prediction when `guidance_execution_method="reuse_uncond"`.
             negative_prompt (`str` or `List[str]`, *optional*):
                 The prompt or prompts not to guide the image generation. If not defined, one has to pass
                 `negative_prompt_embeds` instead. Ignored when not using guidance (i.e., ignored if `guidance_scale` is
@@ -1493,6 +1628,18 @@ class MusevControlNetPipeline(
             skip_temporal_layer (`bool`: default to False) 为False时，unet起video生成作用,会运行时序生成的block；skip_temporal_layer为True时，unet起原image作用，跳过时序生成的block。
             need_img_based_video_noise: bool = False, 当只有首帧latents时，是否需要扩展为video noise;
             num_videos_per_prompt: now only support 1.
+            deep_cache_interval (`int`, defaults to 1): 每 `deep_cache_interval` 步中第一步为 full step，其余为复用深层特征的 cheap step，1 表示不使用 deep cache。
+                the first step of every `deep_cache_interval` steps is full step, the others are cheap steps reusing deep features. 1 means no deep cache.
+            deep_cache_n_shallow_blocks (`int`, defaults to 1): num of shallow down_blocks/up_blocks run in cheap step.
+            refer_token_pool_method (`str`, defaults to None): 缩减 referenceonly attn 中参考 token 的方式，stride、topk_norm、cluster，None 表示不缩减。
+                method to reduce reference tokens in referenceonly attn, one of stride, topk_norm, cluster. None means no reduction.
+            refer_token_pool_ratio (`float`, `List[float]` or `Dict[int, float]`, defaults to 1.0): 保留的参考 token 比例，list/dict 按 spatial_self_attn_idx 逐层设置。
+                ratio of reference tokens to keep, list/dict sets per layer by spatial_self_attn_idx.
+            temporal_attn_window (`int`, defaults to None): 时序 attn 中每帧只与 ±temporal_attn_window 内的帧及条件帧计算，None 表示 full attn。
+                every frame only attends frames within ±temporal_attn_window and condition frames in temporal attn. None means full attn.
+            temporal_attn_chunk_size (`int`, defaults to None): num of frames in one query chunk of local temporal attn, None means temporal_attn_window.
+            profiler (`PipelineProfiler`, defaults to None): 记录各阶段耗时与显存，None 表示不记录。
+                record time and memory of stages, None means no profiling.
 
         Examples:
 
@@ -1536,7 +1683,12 @@ class MusevControlNetPipeline(
         else:
             batch_size = prompt_embeds.shape[0]
 
-        device = self._execution_device
+        # 模块卸载时 pipeline.device 可能是 cpu，使用 offload_manager 的 device
+        # pipeline.device may be cpu when modules are offloaded, use device of offload_manager
+        if self.offload_manager is not None:
+            device = self.offload_manager.device
+        else:
+            device = self._execution_device
         dtype = self.unet.dtype
         # print("pipeline unet dtype", dtype)
         # here `guidance_scale` is defined analog to the guidance weight `w` of equation (2)
@@ -1556,24 +1708,29 @@ class MusevControlNetPipeline(
                 guess_mode=guess_mode,
             )
 
+        if profiler is None:
+            profiler = NULL_PROFILER
+
         # 3. Encode input prompt
+        self._enter_offload_phase("encode_prompt")
         text_encoder_lora_scale = (
             cross_attention_kwargs.get("scale", None)
             if cross_attention_kwargs is not None
             else None
         )
         if self.text_encoder is not None:
-            prompt_embeds = encode_weighted_prompt(
-                self,
-                prompt,
-                device,
-                num_videos_per_prompt,
-                do_classifier_free_guidance,
-                negative_prompt,
-                prompt_embeds=prompt_embeds,
-                negative_prompt_embeds=negative_prompt_embeds,
-                #             lora_scale=text_encoder_lora_scale,
-            )
+            with profiler.record("encode_prompt"):
+                prompt_embeds = encode_weighted_prompt(
+                    self,
+                    prompt,
+                    device,
+                    num_videos_per_prompt,
+                    do_classifier_free_guidance,
+                    negative_prompt,
+                    prompt_embeds=prompt_embeds,
+                    negative_prompt_embeds=negative_prompt_embeds,
+                    #             lora_scale=text_encoder_lora_scale,
+                )
             logger.debug(f"use text_encoder prepare prompt_emb={prompt_embeds.shape}")
         else:
             prompt_embeds = None
@@ -1640,20 +1797,22 @@ class MusevControlNetPipeline(
             batch_size * num_videos_per_prompt
         )  # 6. Prepare latent variables
 
-        (
-            condition_latents,
-            latent_index,
-            vision_condition_latent_index,
-        ) = self.prepare_condition_latents_and_index(
-            condition_images=condition_images,
-            condition_latents=condition_latents,
-            video_length=video_length,
-            batch_size=batch_size,
-            dtype=dtype,
-            device=device,
-            latent_index=latent_index,
-            vision_condition_latent_index=vision_condition_latent_index,
-        )
+        self._enter_offload_phase("encode_image")
+        with profiler.record("prepare_condition_latents"):
+            (
+                condition_latents,
+                latent_index,
+                vision_condition_latent_index,
+            ) = self.prepare_condition_latents_and_index(
+                condition_images=condition_images,
+                condition_latents=condition_latents,
+                video_length=video_length,
+                batch_size=batch_size,
+                dtype=dtype,
+                device=device,
+                latent_index=latent_index,
+                vision_condition_latent_index=vision_condition_latent_index,
+            )
         if vision_condition_latent_index is None:
             n_vision_cond = 0
         else:
@@ -1663,26 +1822,27 @@ class MusevControlNetPipeline(
         if self.print_idx == 0:
             logger.debug(f"pipeline controlnet, start prepare latents")
 
-        latents = self.prepare_latents(
-            batch_size=batch_size * num_videos_per_prompt,
-            num_channels_latents=num_channels_latents,
-            video_length=video_length,
-            height=height,
-            width=width,
-            dtype=dtype,
-            device=device,
-            generator=generator,
-            latents=latents,
-            image=image,
-            timestep=latent_timestep,
-            w_ind_noise=w_ind_noise,
-            initial_common_latent=initial_common_latent,
-            noise_type=noise_type,
-            add_latents_noise=add_latents_noise,
-            need_img_based_video_noise=need_img_based_video_noise,
-            condition_latents=condition_latents,
-            img_weight=img_weight,
-        )
+        with profiler.record("prepare_latents"):
+            latents = self.prepare_latents(
+                batch_size=batch_size * num_videos_per_prompt,
+                num_channels_latents=num_channels_latents,
+                video_length=video_length,
+                height=height,
+                width=width,
+                dtype=dtype,
+                device=device,
+                generator=generator,
+                latents=latents,
+                image=image,
+                timestep=latent_timestep,
+                w_ind_noise=w_ind_noise,
+                initial_common_latent=initial_common_latent,
+                noise_type=noise_type,
+                add_latents_noise=add_latents_noise,
+                need_img_based_video_noise=need_img_based_video_noise,
+                condition_latents=condition_latents,
+                img_weight=img_weight,
+            )
         if self.print_idx == 0:
             logger.debug(f"pipeline controlnet, finish prepare latents={latents.shape}")
 
@@ -1710,473 +1870,689 @@ class MusevControlNetPipeline(
         else:
             controlnet_keep = None
         # 8. Denoising loop
-        num_warmup_steps = len(timesteps) - num_inference_steps * self.scheduler.order
-        if skip_temporal_layer:
-            self.unet.set_skip_temporal_layers(True)
-
-        n_timesteps = len(timesteps)
-        guidance_scale_lst = generate_parameters_with_timesteps(
-            start=guidance_scale,
-            stop=guidance_scale_end,
-            num=n_timesteps,
-            method=guidance_scale_method,
-        )
-        if self.print_idx == 0:
-            logger.debug(
-                f"guidance_scale_lst, {guidance_scale_method}, {guidance_scale}, {guidance_scale_end}, {guidance_scale_lst}"
+        try:
+            if profiler.unet_block_hooks:
+                profiler.register_module_hooks(self.unet)
+            num_warmup_steps = len(timesteps) - num_inference_steps * self.scheduler.order
+            if skip_temporal_layer:
+                self.unet.set_skip_temporal_layers(True)
+
+            n_timesteps = len(timesteps)
+            guidance_scale_lst = generate_parameters_with_timesteps(
+                start=guidance_scale,
+                stop=guidance_scale_end,
+                num=n_timesteps,
+                method=guidance_scale_method,
             )
+            if self.print_idx == 0:
+                logger.debug(
+                    f"guidance_scale_lst, {guidance_scale_method}, {guidance_scale}, {guidance_scale_end}, {guidance_scale_lst}"
+                )
+            # full: 计算 uncond 与 cond; cond: 仅计算 cond，不做guidance; reuse: 仅计算 cond，复用缓存的 uncond
+            # full: run uncond and cond; cond: run cond only without guidance; reuse: run cond only, reuse cached uncond
+            guidance_execution_lst = generate_guidance_execution_with_timesteps(
+                num=n_timesteps,
+                method=guidance_execution_method if do_classifier_free_guidance else "always",
+                truncate_ratio=guidance_truncate_ratio,
+                uncond_reuse_steps=guidance_uncond_reuse_steps,
+            )
+            # 按 context window 缓存的 uncond 预测, uncond noise_pred cached by context window
+            uncond_noise_pred_cache = {}
+            if deep_cache_interval > 1:
+                self.unet.set_deep_cache(n_shallow_blocks=deep_cache_n_shallow_blocks)
+            if refer_token_pool_method is not None:
+                self.unet.set_refer_token_pool(
+                    method=refer_token_pool_method, ratio=refer_token_pool_ratio
+                )
+            if temporal_attn_window is not None:
+                self.unet.set_local_temporal_attn(
+                    window_size=temporal_attn_window, chunk_size=temporal_attn_chunk_size
+                )
+            if self.print_idx == 0:
+                logger.debug(
+                    f"guidance_execution_lst, {guidance_execution_method}, {guidance_truncate_ratio}, {guidance_uncond_reuse_steps}, {guidance_execution_lst}"
+                )
 
-        ip_adapter_image_emb = self.get_ip_adapter_image_emb(
-            ip_adapter_image=ip_adapter_image,
-            batch_size=batch_size,
-            device=device,
-            dtype=dtype,
-            do_classifier_free_guidance=do_classifier_free_guidance,
-            height=height,
-            width=width,
-        )
-
-        # 当前仅当没有ip_adapter时，按照参数 prompt_only_use_image_prompt 要求是否完全替换 image_prompt_emb
-        # only if ip_adapter is None and prompt_only_use_image_prompt is True, use image_prompt_emb replace text_prompt
-        if (
-            ip_adapter_image_emb is not None
-            and prompt_only_use_image_prompt
-            and not self.unet.ip_adapter_cross_attn
-        ):
-            prompt_embeds = ip_adapter_image_emb
-            logger.debug(f"use ip_adapter_image_emb replace prompt_embeds")
-        refer_face_image_emb = self.get_facein_image_emb(
-            refer_face_image=refer_face_image,
-            batch_size=batch_size,
-            device=device,
-            dtype=dtype,
-            do_classifier_free_guidance=do_classifier_free_guidance,
-        )
+            with profiler.record("encode_ip_adapter_image"):
+                ip_adapter_image_emb = self.get_ip_adapter_image_emb(
+                    ip_adapter_image=ip_adapter_image,
+                    batch_size=batch_size,
+                    device=device,
+                    dtype=dtype,
+                    do_classifier_free_guidance=do_classifier_free_guidance,
+                    height=height,
+                    width=width,
+                )
 
-        ip_adapter_face_emb = self.get_ip_adapter_face_emb(
-            refer_face_image=ip_adapter_face_image,
-            batch_size=batch_size,
-            device=device,
-            dtype=dtype,
-            do_classifier_free_guidance=do_classifier_free_guidance,
-        )
-        refer_image_vae_emb = self.get_referencenet_image_vae_emb(
-            refer_image=refer_image,
-            device=device,
-            dtype=dtype,
-            do_classifier_free_guidance=do_classifier_free_guidance,
-            num_videos_per_prompt=num_videos_per_prompt,
-            batch_size=batch_size,
-            width=width,
-            height=height,
-        )
+            # 当前仅当没有ip_adapter时，按照参数 prompt_only_use_image_prompt 要求是否完全替换 image_prompt_emb
+            # only if ip_adapter is None and prompt_only_use_image_prompt is True, use image_prompt_emb replace text_prompt
+            if (
+                ip_adapter_image_emb is not None
+                and prompt_only_use_image_prompt
+                and not self.unet.ip_adapter_cross_attn
+            ):
+                prompt_embeds = ip_adapter_image_emb
+                logger.debug(f"use ip_adapter_image_emb replace prompt_embeds")
+            with profiler.record("encode_facein_image"):
+                refer_face_image_emb = self.get_facein_image_emb(
+                    refer_face_image=refer_face_image,
+                    batch_size=batch_size,
+                    device=device,
+                    dtype=dtype,
+                    do_classifier_free_guidance=do_classifier_free_guidance,
+                )
 
-        if self.pose_guider is not None and control_image is not None:
-            if self.print_idx == 0:
-                logger.debug(f"pose_guider, controlnet_image={control_image.shape}")
-            control_image = rearrange(
-                control_image, " (b t) c h w->b c t h w", t=video_length
-            )
-            pose_guider_emb = self.pose_guider(control_image)
-            pose_guider_emb = rearrange(pose_guider_emb, "b c t h w-> (b t) c h w")
-        else:
-            pose_guider_emb = None
-        logger.debug(f"prompt_embeds={prompt_embeds.shape}")
+            with profiler.record("encode_ip_adapter_face_image"):
+                ip_adapter_face_emb = self.get_ip_adapter_face_emb(
+                    refer_face_image=ip_adapter_face_image,
+                    batch_size=batch_size,
+                    device=device,
+                    dtype=dtype,
+                    do_classifier_free_guidance=do_classifier_free_guidance,
+                )
+            with profiler.record("encode_refer_image_vae"):
+                refer_image_vae_emb = self.get_referencenet_image_vae_emb(
+                    refer_image=refer_image,
+                    device=device,
+                    dtype=dtype,
+                    do_classifier_free_guidance=do_classifier_free_guidance,
+                    num_videos_per_prompt=num_videos_per_prompt,
+                    batch_size=batch_size,
+                    width=width,
+                    height=height,
+                )
 
-        if control_image is not None:
-            if isinstance(control_image, list):
-                logger.debug(f"control_imageis list, num={len(control_image)}")
-                control_image = [
-                    rearrange(
-                        control_image_tmp,
+            if self.pose_guider is not None and control_image is not None:
+                if self.print_idx == 0:
+                    logger.debug(f"pose_guider, controlnet_image={control_image.shape}")
+                control_image = rearrange(
+                    control_image, " (b t) c h w->b c t h w", t=video_length
+                )
+                with profiler.record("pose_guider"):
+                    pose_guider_emb = self.pose_guider(control_image)
+                pose_guider_emb = rearrange(pose_guider_emb, "b c t h w-> (b t) c h w")
+            else:
+                pose_guider_emb = None
+            logger.debug(f"prompt_embeds={prompt_embeds.shape}")
+
+            if control_image is not None:
+                if isinstance(control_image, list):
+                    logger.debug(f"control_imageis list, num={len(control_image)}")
+                    control_image = [
+                        rearrange(
+                            control_image_tmp,
+                            " (b t) c h w->b c t h w",
+                            b=(int(do_classifier_free_guidance) * 1 + 1) * batch_size,
+                        )
+                        for control_image_tmp in control_image
+                    ]
+                else:
+                    logger.debug(f"control_image={control_image.shape}, before")
+                    control_image = rearrange(
+                        control_image,
                         " (b t) c h w->b c t h w",
                         b=(int(do_classifier_free_guidance) * 1 + 1) * batch_size,
                     )
-                    for control_image_tmp in control_image
-                ]
-            else:
-                logger.debug(f"control_image={control_image.shape}, before")
-                control_image = rearrange(
-                    control_image,
-                    " (b t) c h w->b c t h w",
-                    b=(int(do_classifier_free_guidance) * 1 + 1) * batch_size,
-                )
-                logger.debug(f"control_image={control_image.shape}, after")
+                    logger.debug(f"control_image={control_image.shape}, after")
 
-        if controlnet_latents is not None:
-            if isinstance(controlnet_latents, list):
-                logger.debug(
-                    f"controlnet_latents is list, num={len(controlnet_latents)}"
-                )
-                controlnet_latents = [
-                    rearrange(
-                        controlnet_latents_tmp,
+            if controlnet_latents is not None:
+                if isinstance(controlnet_latents, list):
+                    logger.debug(
+                        f"controlnet_latents is list, num={len(controlnet_latents)}"
+                    )
+                    controlnet_latents = [
+                        rearrange(
+                            controlnet_latents_tmp,
+                            " (b t) c h w->b c t h w",
+                            b=(int(do_classifier_free_guidance) * 1 + 1) * batch_size,
+                        )
+                        for controlnet_latents_tmp in controlnet_latents
+                    ]
+                else:
+                    logger.debug(f"controlnet_latents={controlnet_latents.shape}, before")
+                    controlnet_latents = rearrange(
+                        controlnet_latents,
                         " (b t) c h w->b c t h w",
                         b=(int(do_classifier_free_guidance) * 1 + 1) * batch_size,
                     )
-                    for controlnet_latents_tmp in controlnet_latents
-                ]
+                    logger.debug(f"controlnet_latents={controlnet_latents.shape}, after")
+
+            videos_mid = []
+            mid_video_noises = [] if record_mid_video_noises else None
+            mid_video_latents = [] if record_mid_video_latents else None
+
+            global_context = prepare_global_context(
+                context_schedule=context_schedule,
+                num_inference_steps=num_inference_steps,
+                time_size=latents.shape[2],
+                context_frames=context_frames,
+                context_stride=context_stride,
+                context_overlap=context_overlap,
+                context_batch_size=context_batch_size,
+            )
+            logger.debug(
+                f"context_schedule={context_schedule}, time_size={latents.shape[2]}, context_frames={context_frames}, context_stride={context_stride}, context_overlap={context_overlap}, context_batch_size={context_batch_size}"
+            )
+            logger.debug(f"global_context={global_context}")
+            if self.context_parallel:
+                local_context = split_global_context(
+                    global_context,
+                    rank=dist.get_rank(self.context_parallel_group),
+                    world_size=dist.get_world_size(self.context_parallel_group),
+                )
+                logger.debug(f"context_parallel, local_context={local_context}")
             else:
-                logger.debug(f"controlnet_latents={controlnet_latents.shape}, before")
-                controlnet_latents = rearrange(
-                    controlnet_latents,
-                    " (b t) c h w->b c t h w",
-                    b=(int(do_classifier_free_guidance) * 1 + 1) * batch_size,
+                local_context = global_context
+            if self.latent_paging_kwargs is not None:
+                if (last_mid_video_latents is not None and len(last_mid_video_latents) > 0) or (
+                    last_mid_video_noises is not None and len(last_mid_video_noises) > 0
+                ):
+                    raise ValueError(
+                        "latent paging does not support last_mid_video_latents or last_mid_video_noises"
+                    )
+                if (
+                    self.context_parallel
+                    and dist.get_backend(self.context_parallel_group) == "nccl"
+                ):
+                    raise ValueError(
+                        "latent paging keeps noise_pred on host, which can not be all-reduced with nccl backend"
+                    )
+                # 完整长度的张量放到 host，之后只按 window 搬运到 device
+                # keep full-length tensors on host, only move window frames to device later
+                latent_store = LatentPagingStore(device=device, **self.latent_paging_kwargs)
+                latents = latent_store.offload(latents)
+                control_image = latent_store.offload(control_image)
+                controlnet_latents = latent_store.offload(controlnet_latents)
+                logger.debug(
+                    f"latent paging, storage={latent_store.storage}, page_size={latent_store.page_size}"
                 )
-                logger.debug(f"controlnet_latents={controlnet_latents.shape}, after")
-
-        videos_mid = []
-        mid_video_noises = [] if record_mid_video_noises else None
-        mid_video_latents = [] if record_mid_video_latents else None
-
-        global_context = prepare_global_context(
-            context_schedule=context_schedule,
-            num_inference_steps=num_inference_steps,
-            time_size=latents.shape[2],
-            context_frames=context_frames,
-            context_stride=context_stride,
-            context_overlap=context_overlap,
-            context_batch_size=context_batch_size,
-        )
-        logger.debug(
-            f"context_schedule={context_schedule}, time_size={latents.shape[2]}, context_frames={context_frames}, context_stride={context_stride}, context_overlap={context_overlap}, context_batch_size={context_batch_size}"
-        )
-        logger.debug(f"global_context={global_context}")
-        # iterative denoise
-        with self.progress_bar(total=num_inference_steps) as progress_bar:
-            for i, t in enumerate(timesteps):
-                # 使用 last_mid_video_latents 来影响初始化latent，该部分效果较差，暂留代码
-                # use last_mide_video_latents to affect initial latent. works bad, Temporarily reserved
-                if i == 0:
-                    if record_mid_video_latents:
-                        mid_video_latents.append(latents[:, :, -video_overlap:])
-                    if record_mid_video_noises:
-                        mid_video_noises.append(None)
-                    if (
-                        last_mid_video_latents is not None
-                        and len(last_mid_video_latents) > 0
-                    ):
-                        if self.print_idx == 1:
-                            logger.debug(
-                                f"{i}, last_mid_video_latents={last_mid_video_latents[i].shape}"
+            else:
+                latent_store = None
+            # iterative denoise
+            self._enter_offload_phase("referencenet")
+            with self.progress_bar(total=num_inference_steps) as progress_bar:
+                for i, t in enumerate(timesteps):
+                    # referencenet 只在第一步运行，之后卸载
+                    # referencenet only runs in the first step, offload it after that
+                    if i == 1:
+                        self._enter_offload_phase("denoise")
+                    # 使用 last_mid_video_latents 来影响初始化latent，该部分效果较差，暂留代码
+                    # use last_mide_video_latents to affect initial latent. works bad, Temporarily reserved
+                    if i == 0:
+                        if record_mid_video_latents:
+                            mid_video_latents.append(
+                                latents[:, :, -video_overlap:].clone()
                             )
-                        latents = fuse_part_tensor(
-                            last_mid_video_latents[0],
-                            latents,
-                            video_overlap,
-                            weight=0.1,
-                            skip_step=0,
-                        )
-                noise_pred = torch.zeros(
-                    (
-                        latents.shape[0] * (2 if do_classifier_free_guidance else 1),
+                        if record_mid_video_noises:
+                            mid_video_noises.append(None)
+                        if (
+                            last_mid_video_latents is not None
+                            and len(last_mid_video_latents) > 0
+                        ):
+                            if self.print_idx == 1:
+                                logger.debug(
+                                    f"{i}, last_mid_video_latents={last_mid_video_latents[i].shape}"
+                                )
+                            latents = fuse_part_tensor(
+                                last_mid_video_latents[0],
+                                latents,
+                                video_overlap,
+                                weight=0.1,
+                                skip_step=0,
+                            )
+                    # run_uncond: 当前step unet是否计算 uncond 部分, whether unet runs uncond part in this step
+                    # do_guidance: 当前step是否做guidance, whether to perform guidance in this step
+                    guidance_execution = guidance_execution_lst[i]
+                    run_uncond = do_classifier_free_guidance and guidance_execution == "full"
+                    do_guidance = do_classifier_free_guidance and guidance_execution != "cond"
+                    if deep_cache_interval > 1:
+                        deep_cache_mode = "full" if i % deep_cache_interval == 0 else "cheap"
+                    else:
+                        deep_cache_mode = None
+                    noise_pred_shape = (
+                        latents.shape[0] * (2 if do_guidance else 1),
                         *latents.shape[1:],
-                    ),
-                    device=latents.device,
-                    dtype=latents.dtype,
-                )
-                counter = torch.zeros(
-                    (1, 1, latents.shape[2], 1, 1),
-                    device=latents.device,
-                    dtype=latents.dtype,
-                )
-                if i == 0:
-                    (
-                        down_block_refer_embs,
-                        mid_block_refer_emb,
-                        refer_self_attn_emb,
-                    ) = self.get_referencenet_emb(
-                        refer_image_vae_emb=refer_image_vae_emb,
-                        refer_image=refer_image,
-                        device=device,
-                        dtype=dtype,
-                        do_classifier_free_guidance=do_classifier_free_guidance,
-                        num_videos_per_prompt=num_videos_per_prompt,
-                        prompt_embeds=prompt_embeds,
-                        ip_adapter_image_emb=ip_adapter_image_emb,
-                        batch_size=batch_size,
-                        ref_timestep_int=t,
-                    )
-                for context in global_context:
-                    # expand the latents if we are doing classifier free guidance
-                    latents_c = torch.cat([latents[:, :, c] for c in context])
-                    latent_index_c = (
-                        torch.cat([latent_index[c] for c in context])
-                        if latent_index is not None
-                        else None
                     )
-                    latent_model_input = latents_c.to(device).repeat(
-                        2 if do_classifier_free_guidance else 1, 1, 1, 1, 1
-                    )
-                    latent_model_input = self.scheduler.scale_model_input(
-                        latent_model_input, t
-                    )
-                    sub_latent_index_c = (
-                        torch.LongTensor(
-                            torch.arange(latent_index_c.shape[-1]) + n_vision_cond
-                        ).to(device=latents_c.device)
-                        if latent_index is not None
-                        else None
-                    )
-                    if condition_latents is not None:
-                        latent_model_condition = (
-                            torch.cat([condition_latents] * 2)
-                            if do_classifier_free_guidance
-                            else latents
+                    if latent_store is not None:
+                        noise_pred = latent_store.zeros(
+                            "noise_pred", noise_pred_shape, dtype=latents.dtype
                         )
-
-                        if self.print_idx == 0:
-                            logger.debug(
-                                f"vision_condition_latent_index, {vision_condition_latent_index.shape}, vision_condition_latent_index"
-                            )
-                            logger.debug(
-                                f"latent_model_condition, {latent_model_condition.shape}"
+                    else:
+                        noise_pred = torch.zeros(
+                            noise_pred_shape,
+                            device=latents.device,
+                            dtype=latents.dtype,
+                        )
+                    counter = torch.zeros(
+                        (1, 1, latents.shape[2], 1, 1),
+                        device=latents.device,
+                        dtype=latents.dtype,
+                    )
+                    if i == 0:
+                        with profiler.record("referencenet"):
+                            (
+                                down_block_refer_embs,
+                                mid_block_refer_emb,
+                                refer_self_attn_emb,
+                            ) = self.get_referencenet_emb(
+                                refer_image_vae_emb=refer_image_vae_emb,
+                                refer_image=refer_image,
+                                device=device,
+                                dtype=dtype,
+                                do_classifier_free_guidance=do_classifier_free_guidance,
+                                num_videos_per_prompt=num_videos_per_prompt,
+                                prompt_embeds=prompt_embeds,
+                                ip_adapter_image_emb=ip_adapter_image_emb,
+                                batch_size=batch_size,
+                                ref_timestep_int=t,
                             )
-                            logger.debug(f"latent_index, {latent_index_c.shape}")
-                            logger.debug(
-                                f"latent_model_input, {latent_model_input.shape}"
+                        # referencenet 的参考 token 每次推理只缩减一次
+                        # reference tokens of referencenet are reduced once per run
+                        if refer_token_pool_method is not None:
+                            refer_self_attn_emb = self.unet.pool_refer_self_attn_emb(
+                                refer_self_attn_emb
                             )
-                            logger.debug(f"sub_latent_index_c, {sub_latent_index_c}")
-                        latent_model_input = batch_concat_two_tensor_with_index(
-                            data1=latent_model_condition,
-                            data1_index=vision_condition_latent_index,
-                            data2=latent_model_input,
-                            data2_index=sub_latent_index_c,
-                            dim=2,
+                    # 仅计算 cond 的step，所有 cfg 输入只保留 cond 部分
+                    # in cond-only step, keep cond part of all cfg inputs
+                    if do_classifier_free_guidance and not run_uncond:
+                        prompt_embeds_step = select_cfg_cond_part(prompt_embeds)
+                        ip_adapter_image_emb_step = select_cfg_cond_part(
+                            ip_adapter_image_emb
                         )
-                    if control_image is not None:
-                        if vision_condition_latent_index is not None:
-                            # 获取 vision_condition 对应的 control_imgae/control_latent 部分
-                            # generate control_image/control_latent corresponding to vision_condition
-                            controlnet_condtion_latent_index = (
-                                vision_condition_latent_index.clone().cpu().tolist()
-                            )
+                        refer_face_image_emb_step = select_cfg_cond_part(
+                            refer_face_image_emb
+                        )
+                        ip_adapter_face_emb_step = select_cfg_cond_part(ip_adapter_face_emb)
+                        down_block_refer_embs_step = select_cfg_cond_part(
+                            down_block_refer_embs
+                        )
+                        mid_block_refer_emb_step = select_cfg_cond_part(mid_block_refer_emb)
+                        refer_self_attn_emb_step = select_cfg_cond_part(refer_self_attn_emb)
+                        pose_guider_emb_step = select_cfg_cond_part(pose_guider_emb)
+                        # guess_mode 时 controlnet 输入本就只有 cond 部分
+                        # controlnet input only has cond part in guess_mode
+                        control_image_step = (
+                            select_cfg_cond_part(control_image)
+                            if not guess_mode
+                            else control_image
+                        )
+                        controlnet_latents_step = (
+                            select_cfg_cond_part(controlnet_latents)
+                            if not guess_mode
+                            else controlnet_latents
+                        )
+                    else:
+                        prompt_embeds_step = prompt_embeds
+                        ip_adapter_image_emb_step = ip_adapter_image_emb
+                        refer_face_image_emb_step = refer_face_image_emb
+                        ip_adapter_face_emb_step = ip_adapter_face_emb
+                        down_block_refer_embs_step = down_block_refer_embs
+                        mid_block_refer_emb_step = mid_block_refer_emb
+                        refer_self_attn_emb_step = refer_self_attn_emb
+                        pose_guider_emb_step = pose_guider_emb
+                        control_image_step = control_image
+                        controlnet_latents_step = controlnet_latents
+                    for context in local_context:
+                        # expand the latents if we are doing classifier free guidance
+                        if latent_store is not None:
+                            latents_c = latent_store.load(latents, context)
+                        else:
+                            latents_c = torch.cat([latents[:, :, c] for c in context])
+                        latent_index_c = (
+                            torch.cat([latent_index[c] for c in context])
+                            if latent_index is not None
+                            else None
+                        )
+                        latent_model_input = latents_c.to(device).repeat(
+                            2 if run_uncond else 1, 1, 1, 1, 1
+                        )
+                        latent_model_input = self.scheduler.scale_model_input(
+                            latent_model_input, t
+                        )
+                        sub_latent_index_c = (
+                            torch.LongTensor(
+                                torch.arange(latent_index_c.shape[-1]) + n_vision_cond
+                            ).to(device=latents_c.device)
+                            if latent_index is not None
+                            else None
+                        )
+                        if condition_latents is not None:
+                            # 只拼接视觉条件帧，它们常驻 device，分页时不会把 host 上的整段 latents 搬到 device
+                            # only vision condition frames are concatenated, they stay on device,
+                            # so full-length host latents are not moved to device when paging
+                            if run_uncond:
+                                latent_model_condition = torch.cat([condition_latents] * 2)
+                            else:
+                                latent_model_condition = condition_latents
+
                             if self.print_idx == 0:
                                 logger.debug(
-                                    f"context={context}, controlnet_condtion_latent_index={controlnet_condtion_latent_index}"
+                                    f"vision_condition_latent_index, {vision_condition_latent_index.shape}, vision_condition_latent_index"
                                 )
-                            controlnet_context = [
-                                controlnet_condtion_latent_index
-                                + [c_i + n_vision_cond for c_i in c]
-                                for c in context
-                            ]
-                        else:
-                            controlnet_context = context
-                        if self.print_idx == 0:
-                            logger.debug(
-                                f"controlnet_context={controlnet_context}, latent_model_input={latent_model_input.shape}"
+                                logger.debug(
+                                    f"latent_model_condition, {latent_model_condition.shape}"
+                                )
+                                logger.debug(f"latent_index, {latent_index_c.shape}")
+                                logger.debug(
+                                    f"latent_model_input, {latent_model_input.shape}"
+                                )
+                                logger.debug(f"sub_latent_index_c, {sub_latent_index_c}")
+                            latent_model_input = batch_concat_two_tensor_with_index(
+                                data1=latent_model_condition,
+                                data1_index=vision_condition_latent_index,
+                                data2=latent_model_input,
+                                data2_index=sub_latent_index_c,
+                                dim=2,
                             )
-                        if isinstance(control_image, list):
-                            control_image_c = [
-                                torch.cat(
+                        if control_image_step is not None:
+                            if vision_condition_latent_index is not None:
+                                # 获取 vision_condition 对应的 control_imgae/control_latent 部分
+                                # generate control_image/control_latent corresponding to vision_condition
+                                controlnet_condtion_latent_index = (
+                                    vision_condition_latent_index.clone().cpu().tolist()
+                                )
+                                if self.print_idx == 0:
+                                    logger.debug(
+                                        f"context={context}, controlnet_condtion_latent_index={controlnet_condtion_latent_index}"
+                                    )
+                                controlnet_context = [
+                                    controlnet_condtion_latent_index
+                                    + [c_i + n_vision_cond for c_i in c]
+                                    for c in context
+                                ]
+                            else:
+                                controlnet_context = context
+                            if self.print_idx == 0:
+                                logger.debug(
+                                    f"controlnet_context={controlnet_context}, latent_model_input={latent_model_input.shape}"
+                                )
+                            if isinstance(control_image_step, list):
+                                control_image_c = [
+                                    torch.cat(
+                                        [
+                                            control_image_tmp[:, :, c]
+                                            for c in controlnet_context
+                                        ]
+                                    )
+                                    for control_image_tmp in control_image_step
+                                ]
+                                control_image_c = [
+                                    rearrange(control_image_tmp, " b c t h w-> (b t) c h w")
+                                    for control_image_tmp in control_image_c
+                                ]
+                            else:
+                                control_image_c = torch.cat(
                                     [
-                                        control_image_tmp[:, :, c]
+                                        control_image_step[:, :, c]
                                         for c in controlnet_context
                                     ]
                                 )
-                                for control_image_tmp in control_image
-                            ]
-                            control_image_c = [
-                                rearrange(control_image_tmp, " b c t h w-> (b t) c h w")
-                                for control_image_tmp in control_image_c
-                            ]
+                                control_image_c = rearrange(
+                                    control_image_c, " b c t h w-> (b t) c h w"
+                                )
+                            if latent_store is not None:
+                                control_image_c = latent_store.to_device(control_image_c)
                         else:
-                            control_image_c = torch.cat(
-                                [control_image[:, :, c] for c in controlnet_context]
-                            )
-                            control_image_c = rearrange(
-                                control_image_c, " b c t h w-> (b t) c h w"
-                            )
-                    else:
-                        control_image_c = None
-                    if controlnet_latents is not None:
-                        if vision_condition_latent_index is not None:
-                            # 获取 vision_condition 对应的 control_imgae/control_latent 部分
-                            # generate control_image/control_latent corresponding to vision_condition
-                            controlnet_condtion_latent_index = (
-                                vision_condition_latent_index.clone().cpu().tolist()
-                            )
+                            control_image_c = None
+                        if controlnet_latents_step is not None:
+                            if vision_condition_latent_index is not None:
+                                # 获取 vision_condition 对应的 control_imgae/control_latent 部分
+                                # generate control_image/control_latent corresponding to vision_condition
+                                controlnet_condtion_latent_index = (
+                                    vision_condition_latent_index.clone().cpu().tolist()
+                                )
+                                if self.print_idx == 0:
+                                    logger.debug(
+                                        f"context={context}, controlnet_condtion_latent_index={controlnet_condtion_latent_index}"
+                                    )
+                                controlnet_context = [
+                                    controlnet_condtion_latent_index
+                                    + [c_i + n_vision_cond for c_i in c]
+                                    for c in context
+                                ]
+                            else:
+                                controlnet_context = context
                             if self.print_idx == 0:
                                 logger.debug(
-                                    f"context={context}, controlnet_condtion_latent_index={controlnet_condtion_latent_index}"
+                                    f"controlnet_context={controlnet_context}, controlnet_latents={controlnet_latents_step.shape}, latent_model_input={latent_model_input.shape},"
+                                )
+                            controlnet_latents_c = torch.cat(
+                                [
+                                    controlnet_latents_step[:, :, c]
+                                    for c in controlnet_context
+                                ]
+                            )
+                            controlnet_latents_c = rearrange(
+                                controlnet_latents_c, " b c t h w-> (b t) c h w"
+                            )
+                            if latent_store is not None:
+                                controlnet_latents_c = latent_store.to_device(
+                                    controlnet_latents_c
                                 )
-                            controlnet_context = [
-                                controlnet_condtion_latent_index
-                                + [c_i + n_vision_cond for c_i in c]
-                                for c in context
-                            ]
                         else:
-                            controlnet_context = context
+                            controlnet_latents_c = None
+                        with profiler.record("controlnet", step=i):
+                            (
+                                down_block_res_samples,
+                                mid_block_res_sample,
+                            ) = self.get_controlnet_emb(
+                                run_controlnet=run_controlnet,
+                                guess_mode=guess_mode,
+                                do_classifier_free_guidance=run_uncond,
+                                latents=latents_c,
+                                prompt_embeds=prompt_embeds_step,
+                                latent_model_input=latent_model_input,
+                                control_image=control_image_c,
+                                controlnet_latents=controlnet_latents_c,
+                                controlnet_keep=controlnet_keep,
+                                t=t,
+                                i=i,
+                                controlnet_conditioning_scale=controlnet_conditioning_scale,
+                            )
                         if self.print_idx == 0:
                             logger.debug(
-                                f"controlnet_context={controlnet_context}, controlnet_latents={controlnet_latents.shape}, latent_model_input={latent_model_input.shape},"
+                                f"{i}, latent_model_input={latent_model_input.shape}, sub_latent_index_c={sub_latent_index_c}"
+                                f"{vision_condition_latent_index}"
                             )
-                        controlnet_latents_c = torch.cat(
-                            [controlnet_latents[:, :, c] for c in controlnet_context]
-                        )
-                        controlnet_latents_c = rearrange(
-                            controlnet_latents_c, " b c t h w-> (b t) c h w"
-                        )
+                        # time.sleep(10)
+                        with profiler.record("unet", step=i):
+                            noise_pred_c = self.unet(
+                                latent_model_input,
+                                t,
+                                encoder_hidden_states=prompt_embeds_step,
+                                cross_attention_kwargs=cross_attention_kwargs,
+                                down_block_additional_residuals=down_block_res_samples,
+                                mid_block_additional_residual=mid_block_res_sample,
+                                return_dict=False,
+                                sample_index=sub_latent_index_c,
+                                vision_conditon_frames_sample_index=vision_condition_latent_index,
+                                sample_frame_rate=motion_speed,
+                                down_block_refer_embs=down_block_refer_embs_step,
+                                mid_block_refer_emb=mid_block_refer_emb_step,
+                                refer_self_attn_emb=refer_self_attn_emb_step,
+                                vision_clip_emb=ip_adapter_image_emb_step,
+                                face_emb=refer_face_image_emb_step,
+                                ip_adapter_scale=ip_adapter_scale,
+                                facein_scale=facein_scale,
+                                ip_adapter_face_emb=ip_adapter_face_emb_step,
+                                ip_adapter_face_scale=ip_adapter_face_scale,
+                                do_classifier_free_guidance=run_uncond,
+                                pose_guider_emb=pose_guider_emb_step,
+                                deep_cache_mode=deep_cache_mode,
+                                deep_cache_key=(
+                                    tuple(tuple(c) for c in context)
+                                    if deep_cache_mode is not None
+                                    else None
+                                ),
+                            )[0]
+                        if condition_latents is not None:
+                            noise_pred_c = batch_index_select(
+                                noise_pred_c, dim=2, index=sub_latent_index_c
+                            ).contiguous()
+                        if guidance_execution_method == "reuse_uncond" and do_guidance:
+                            context_key = tuple(tuple(c) for c in context)
+                            if run_uncond:
+                                uncond_noise_pred_cache[context_key] = noise_pred_c.chunk(
+                                    2
+                                )[0]
+                            else:
+                                noise_pred_c = torch.cat(
+                                    [uncond_noise_pred_cache[context_key], noise_pred_c]
+                                )
+                        if self.print_idx == 0:
+                            logger.debug(
+                                f"{i}, latent_model_input={latent_model_input.shape}, noise_pred_c={noise_pred_c.shape}, {len(context)}, {len(context[0])}"
+                            )
+                        if latent_store is not None:
+                            noise_pred_c = noise_pred_c.to(noise_pred.device)
+                        for j, c in enumerate(context):
+                            noise_pred[:, :, c] = noise_pred[:, :, c] + noise_pred_c
+                            counter[:, :, c] = counter[:, :, c] + 1
+                    if self.context_parallel:
+                        with profiler.record("context_parallel_all_reduce", step=i):
+                            noise_pred, counter = all_reduce_noise_pred(
+                                noise_pred, counter, group=self.context_parallel_group
+                            )
+                    if latent_store is not None:
+                        # 原地相除，避免在 host 上再分配一份完整长度的 noise_pred
+                        # divide in place to avoid another full-length noise_pred on host
+                        noise_pred.div_(counter)
                     else:
-                        controlnet_latents_c = None
-                    (
-                        down_block_res_samples,
-                        mid_block_res_sample,
-                    ) = self.get_controlnet_emb(
-                        run_controlnet=run_controlnet,
-                        guess_mode=guess_mode,
-                        do_classifier_free_guidance=do_classifier_free_guidance,
-                        latents=latents_c,
-                        prompt_embeds=prompt_embeds,
-                        latent_model_input=latent_model_input,
-                        control_image=control_image_c,
-                        controlnet_latents=controlnet_latents_c,
-                        controlnet_keep=controlnet_keep,
-                        t=t,
-                        i=i,
-                        controlnet_conditioning_scale=controlnet_conditioning_scale,
-                    )
-                    if self.print_idx == 0:
-                        logger.debug(
-                            f"{i}, latent_model_input={latent_model_input.shape}, sub_latent_index_c={sub_latent_index_c}"
-                            f"{vision_condition_latent_index}"
-                        )
-                    # time.sleep(10)
-                    noise_pred_c = self.unet(
-                        latent_model_input,
-                        t,
-                        encoder_hidden_states=prompt_embeds,
-                        cross_attention_kwargs=cross_attention_kwargs,
-                        down_block_additional_residuals=down_block_res_samples,
-                        mid_block_additional_residual=mid_block_res_sample,
-                        return_dict=False,
-                        sample_index=sub_latent_index_c,
-                        vision_conditon_frames_sample_index=vision_condition_latent_index,
-                        sample_frame_rate=motion_speed,
-                        down_block_refer_embs=down_block_refer_embs,
-                        mid_block_refer_emb=mid_block_refer_emb,
-                        refer_self_attn_emb=refer_self_attn_emb,
-                        vision_clip_emb=ip_adapter_image_emb,
-                        face_emb=refer_face_image_emb,
-                        ip_adapter_scale=ip_adapter_scale,
-                        facein_scale=facein_scale,
-                        ip_adapter_face_emb=ip_adapter_face_emb,
-                        ip_adapter_face_scale=ip_adapter_face_scale,
-                        do_classifier_free_guidance=do_classifier_free_guidance,
-                        pose_guider_emb=pose_guider_emb,
-                    )[0]
-                    if condition_latents is not None:
-                        noise_pred_c = batch_index_select(
-                            noise_pred_c, dim=2, index=sub_latent_index_c
-                        ).contiguous()
-                    if self.print_idx == 0:
-                        logger.debug(
-                            f"{i}, latent_model_input={latent_model_input.shape}, noise_pred_c={noise_pred_c.shape}, {len(context)}, {len(context[0])}"
-                        )
-                    for j, c in enumerate(context):
-                        noise_pred[:, :, c] = noise_pred[:, :, c] + noise_pred_c
-                        counter[:, :, c] = counter[:, :, c] + 1
-                noise_pred = noise_pred / counter
+                        noise_pred = noise_pred / counter
 
-                if (
-                    last_mid_video_noises is not None
-                    and len(last_mid_video_noises) > 0
-                    and i <= num_inference_steps // 2  # 是个超参数 super paramter
-                ):
-                    if self.print_idx == 1:
-                        logger.debug(
-                            f"{i}, last_mid_video_noises={last_mid_video_noises[i].shape}"
+                    if (
+                        last_mid_video_noises is not None
+                        and len(last_mid_video_noises) > 0
+                        and i <= num_inference_steps // 2  # 是个超参数 super paramter
+                    ):
+                        if self.print_idx == 1:
+                            logger.debug(
+                                f"{i}, last_mid_video_noises={last_mid_video_noises[i].shape}"
+                            )
+                        noise_pred = fuse_part_tensor(
+                            last_mid_video_noises[i + 1],
+                            noise_pred,
+                            video_overlap,
+                            weight=0.01,
+                            skip_step=1,
                         )
-                    noise_pred = fuse_part_tensor(
-                        last_mid_video_noises[i + 1],
-                        noise_pred,
-                        video_overlap,
-                        weight=0.01,
-                        skip_step=1,
-                    )
-                if record_mid_video_noises:
-                    mid_video_noises.append(noise_pred[:, :, -video_overlap:])
-
-                # perform guidance
-                if do_classifier_free_guidance:
-                    noise_pred_uncond, noise_pred_text = noise_pred.chunk(2)
-                    noise_pred = noise_pred_uncond + guidance_scale_lst[i] * (
-                        noise_pred_text - noise_pred_uncond
-                    )
+                    if record_mid_video_noises:
+                        mid_video_noises.append(noise_pred[:, :, -video_overlap:].clone())
+
+                    if latent_store is not None:
+                        # guidance 与 scheduler.step 按帧分页在 device 上执行
+                        # guidance and scheduler.step run on device page by page along frames
+                        with profiler.record("scheduler_step", step=i):
+                            latents = latent_store.step(
+                                self.scheduler,
+                                noise_pred,
+                                t,
+                                latents,
+                                guidance_scale=guidance_scale_lst[i]
+                                if do_guidance
+                                else None,
+                                extra_step_kwargs=extra_step_kwargs,
+                            )
+                    else:
+                        # perform guidance
+                        if do_guidance:
+                            noise_pred_uncond, noise_pred_text = noise_pred.chunk(2)
+                            noise_pred = noise_pred_uncond + guidance_scale_lst[i] * (
+                                noise_pred_text - noise_pred_uncond
+                            )
 
-                if self.print_idx == 0:
-                    logger.debug(
-                        f"before step, noise_pred={noise_pred.shape}, {noise_pred.device}, latents={latents.shape}, {latents.device}, t={t}"
-                    )
-                # compute the previous noisy sample x_t -> x_t-1
-                latents = self.scheduler.step(
-                    noise_pred,
-                    t,
-                    latents,
-                    **extra_step_kwargs,
-                ).prev_sample
+                        if self.print_idx == 0:
+                            logger.debug(
+                                f"before step, noise_pred={noise_pred.shape}, {noise_pred.device}, latents={latents.shape}, {latents.device}, t={t}"
+                            )
+                        # compute the previous noisy sample x_t -> x_t-1
+                        with profiler.record("scheduler_step", step=i):
+                            latents = self.scheduler.step(
+                                noise_pred,
+                                t,
+                                latents,
+                                **extra_step_kwargs,
+                            ).prev_sample
 
-                if (
-                    last_mid_video_latents is not None
-                    and len(last_mid_video_latents) > 0
-                    and i <= 1  # 超参数, super parameter
-                ):
-                    if self.print_idx == 1:
-                        logger.debug(
-                            f"{i}, last_mid_video_latents={last_mid_video_latents[i].shape}"
+                    if (
+                        last_mid_video_latents is not None
+                        and len(last_mid_video_latents) > 0
+                        and i <= 1  # 超参数, super parameter
+                    ):
+                        if self.print_idx == 1:
+                            logger.debug(
+                                f"{i}, last_mid_video_latents={last_mid_video_latents[i].shape}"
+                            )
+                        latents = fuse_part_tensor(
+                            last_mid_video_latents[i + 1],
+                            latents,
+                            video_overlap,
+                            weight=0.1,
+                            skip_step=0,
                         )
-                    latents = fuse_part_tensor(
-                        last_mid_video_latents[i + 1],
-                        latents,
-                        video_overlap,
-                        weight=0.1,
-                        skip_step=0,
-                    )
-                if record_mid_video_latents:
-                    mid_video_latents.append(latents[:, :, -video_overlap:])
-
-                if need_middle_latents is True:
-                    videos_mid.append(self.decode_latents(latents))
-                # call the callback, if provided
-                if i == len(timesteps) - 1 or (
-                    (i + 1) > num_warmup_steps and (i + 1) % self.scheduler.order == 0
-                ):
-                    progress_bar.update()
-                    if callback is not None and i % callback_steps == 0:
-                        callback(i, t, latents)
-                self.print_idx += 1
+                    if record_mid_video_latents:
+                        mid_video_latents.append(latents[:, :, -video_overlap:].clone())
 
-        if condition_latents is not None:
-            latents = batch_concat_two_tensor_with_index(
-                data1=condition_latents,
-                data1_index=vision_condition_latent_index,
-                data2=latents,
-                data2_index=latent_index,
-                dim=2,
-            )
-        b, c, t, h, w = latents.shape
-        num_segments = (t + decoder_t_segment - 1) // decoder_t_segment
-
-        video_segments = []
-        # to avoid t chanel too large causing gpu memory error
-        # split video latents in slices along t channel, decode each slice, and then concatenate them
-        for i in range(num_segments):
-            logger.debug(f"Decoding {i} th segment")
-            start_t = i * decoder_t_segment
-            end_t = min((i + 1) * decoder_t_segment, t)
-            latents_segment = latents[:, :, start_t:end_t, :, :]
-            video_segment = self.decode_latents(latents_segment)
-            video_segments.append(video_segment)
-        video_segments_np = np.concatenate(video_segments, axis=2)
-        video = torch.from_numpy(video_segments_np)
-
-        if skip_temporal_layer:
-            self.unet.set_skip_temporal_layers(False)
-        if need_hist_match:
-            video[:, :, latent_index, :, :] = self.hist_match_with_vis_cond(
-                batch_index_select(video, index=latent_index, dim=2),
-                batch_index_select(video, index=vision_condition_latent_index, dim=2),
-            )
+                    if need_middle_latents is True:
+                        videos_mid.append(self.decode_latents(latents.to(device)))
+                    # call the callback, if provided
+                    if i == len(timesteps) - 1 or (
+                        (i + 1) > num_warmup_steps and (i + 1) % self.scheduler.order == 0
+                    ):
+                        progress_bar.update()
+                        if callback is not None and i % callback_steps == 0:
+                            callback(i, t, latents)
+                    self.print_idx += 1
+
+            if deep_cache_interval > 1:
+                self.unet.clear_deep_cache()
+            if condition_latents is not None:
+                latents = batch_concat_two_tensor_with_index(
+                    data1=condition_latents.to(latents.device),
+                    data1_index=vision_condition_latent_index,
+                    data2=latents,
+                    data2_index=latent_index,
+                    dim=2,
+                )
+            self._enter_offload_phase("decode")
+            b, c, t, h, w = latents.shape
+            num_segments = (t + decoder_t_segment - 1) // decoder_t_segment
+
+            video_segments = []
+            # to avoid t chanel too large causing gpu memory error
+            # split video latents in slices along t channel, decode each slice, and then concatenate them
+            for i in range(num_segments):
+                logger.debug(f"Decoding {i} th segment")
+                start_t = i * decoder_t_segment
+                end_t = min((i + 1) * decoder_t_segment, t)
+                latents_segment = latents[:, :, start_t:end_t, :, :].to(device)
+                with profiler.record("vae_decode", segment=i):
+                    video_segment = self.decode_latents(latents_segment)
+                video_segments.append(video_segment)
+            video_segments_np = np.concatenate(video_segments, axis=2)
+            video = torch.from_numpy(video_segments_np)
+
+            if need_hist_match:
+                with profiler.record("hist_match"):
+                    video[:, :, latent_index, :, :] = self.hist_match_with_vis_cond(
+                        batch_index_select(video, index=latent_index, dim=2),
+                        batch_index_select(
+                            video, index=vision_condition_latent_index, dim=2
+                        ),
+                    )
+        finally:
+            # 出错时也恢复 unet 状态，避免残留到常驻 predictor 的下一次请求
+            # restore unet state on error too, so that it does not leak into next request of long-lived predictor
+            if skip_temporal_layer:
+                self.unet.set_skip_temporal_layers(False)
+            if deep_cache_interval > 1:
+                self.unet.clear_deep_cache()
+            if refer_token_pool_method is not None:
+                self.unet.set_refer_token_pool(method=None)
+            if temporal_attn_window is not None:
+                self.unet.set_local_temporal_attn(window_size=None)
+            profiler.remove_hooks()
+            self._exit_offload_phase()
         # Convert to tensor
         if output_type == "tensor":
             videos_mid = [torch.from_numpy(x) for x in videos_mid]
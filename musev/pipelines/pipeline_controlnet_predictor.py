@@ -1,5 +1,6 @@
 import copy
-from typing import Any, Callable, Dict, Iterable, Union
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterable, Literal, Union
 import PIL
 import cv2
 import torch
@@ -15,6 +16,7 @@ from pprint import pformat, pprint
 from collections import OrderedDict
 from dataclasses import dataclass
 import gc
+import itertools
 import time
 
 import numpy as np
@@ -40,7 +42,6 @@ from diffusers.utils.import_utils import is_xformers_available
 
 from mmcm.utils.seed_util import set_all_seed
 from mmcm.vision.data.video_dataset import DecordVideoDataset
-from mmcm.vision.process.correct_color import hist_match_video_bcthw
 from mmcm.vision.process.image_process import (
     batch_dynamic_crop_resize_images,
     batch_dynamic_crop_resize_images_v2,
@@ -59,6 +60,25 @@ from .pipeline_controlnet import (
     MusevControlNetPipeline,
     VideoPipelineOutput as PipelineVideoPipelineOutput,
 )
+from .memory_planner import (
+    MemoryModel,
+    MemoryPlan,
+    calibrate_memory_model,
+    get_gpu_memory_budget,
+    plan_memory,
+)
+from .resolution_bucket import ResolutionBucketer
+from ..utils.profiler import NULL_PROFILER, PipelineProfiler
+from ..utils.prefetch import BackgroundPrefetcher
+from .condition_cache import ControlnetConditionCache
+from .controlnet_processor_executor import ControlnetProcessorExecutor
+from ..data.frame_store import FrameStore, FrameStoreDataset
+from ..models.quantization import (
+    dequantize_linear_layers,
+    quantize_linear_layers,
+    remove_layer_lora,
+)
+from ..utils.tensor_util import hist_match_video_bcthw
 from ..utils.util import save_videos_grid_with_opencv
 from ..utils.model_util import (
     update_pipeline_basemodel,
@@ -140,8 +160,73 @@ class DiffusersPipelinePredictor(object):
         vae_model: Optional[Tuple[nn.Module, str]] = None,
         pose_guider: Optional[nn.Module] = None,
         enable_zero_snr: bool = False,
+        token_merge_ratio: Union[float, Dict[str, float]] = 0.0,
+        token_merge_max_downsample: int = 1,
+        memory_budget: float = None,
+        memory_model: MemoryModel = None,
+        enable_phase_offload: bool = False,
+        offload_pin_memory: bool = True,
+        offload_prefetch: bool = True,
+        weight_quant_bits: int = None,
+        weight_quant_lora_mode: Literal["delta", "requant"] = "delta",
+        compile_unet: bool = False,
+        compile_max_buckets: int = 8,
+        resolution_bucket_mode: Literal["crop", "pad"] = None,
+        resolution_bucket_aspect_ratios: List[float] = None,
+        resolution_bucket_areas: List[int] = None,
+        context_parallel: bool = False,
+        latent_paging: Literal["pinned", "memmap"] = None,
+        latent_paging_dir: str = None,
+        latent_paging_page_size: int = 16,
+        controlnet_condition_cache_dir: str = None,
+        controlnet_processor_num_workers: int = 0,
+        controlnet_processor_worker_device: str = "cpu",
+        frame_store_dir: str = None,
     ) -> None:
+        """
+        memory_budget (float, optional): 显存预算，单位 GB，参数为 "auto" 时使用，None 表示当前空闲显存的 90%。
+            memory budget in GB used by "auto" parameters, None means 90% of current free gpu memory.
+        memory_model (MemoryModel, optional): 显存模型，可由 calibrate_memory_model 标定，None 使用默认值。
+            memory model, could be calibrated by calibrate_memory_model, None means default.
+        enable_phase_offload (bool, optional): 只在需要的推理阶段把模块放在 device 上，用于低显存部署。
+            keep modules on device only in inference phases which need them, for low-vram deployments.
+        offload_pin_memory (bool, optional): 卸载的权重使用 pinned memory. offloaded weights use pinned memory.
+        offload_prefetch (bool, optional): 异步预取下一阶段的模块. prefetch modules of next phase asynchronously.
+        weight_quant_bits (int, optional): unet、referencenet、controlnet 中 attn、ff 线性层的 weight-only 量化位数，8 或 4，None 表示不量化。
+            bits of weight-only quantization of attn and ff linears in unet, referencenet and controlnet, 8 or 4, None means no quantization.
+            只节省权重内存，只有 cpu 上的 8 位更快；4 位以及 gpu 上每次 forward 反量化权重，比不量化更慢。
+            only saves weight memory, only 8 bits on cpu is faster; 4 bits and gpu dequantize weights every forward and are slower.
+        weight_quant_lora_mode (Literal["delta", "requant"], optional): 量化层合并 lora 的方式，参考 musev.models.quantization。
+            how quantized layers merge lora, refer to musev.models.quantization.
+            delta 以低秩因子保存 lora，卸载无损；requant 不增加内存，卸载有误差。
+            delta keeps lora as low-rank factors, unload is lossless; requant adds no memory, unload has error.
+        compile_unet (bool, optional): 使用 torch.compile 编译 unet，每个分辨率桶编译一次。
+            compile unet with torch.compile, once for every resolution bucket.
+        compile_max_buckets (int, optional): 最多编译的桶数，之后的新桶使用 eager 运行。
+            max num of compiled buckets, new buckets run eagerly after that.
+        resolution_bucket_mode (Literal["crop", "pad"], optional): 将请求宽高吸附到分辨率桶，输入中心裁剪或填充，None 表示不分桶。
+            snap requested size to resolution buckets, center crop or pad inputs, None means no bucketing.
+        resolution_bucket_aspect_ratios (List[float], optional): 桶的宽高比 width / height，None 使用默认值。
+            aspect ratios width / height of buckets, None means default.
+        resolution_bucket_areas (List[int], optional): 桶的面积 height * width，None 使用默认值。
+            areas height * width of buckets, None means default.
+        context_parallel (bool, optional): 每个 step 的 context window 分配到 torch.distributed 默认进程组的各进程，需先初始化进程组，参考 musev.pipelines.context_parallel。
+            spread context windows of every step across processes of default torch.distributed group, process group should be initialized first, refer to musev.pipelines.context_parallel.
+        latent_paging (Literal["pinned", "memmap"], optional): 完整长度的 latents 等张量放在 pinned host 内存或内存映射文件中，只把当前 window 的帧搬到 device，用于单次推理超长视频，None 表示不分页。
+            keep full-length latents and so on in pinned host memory or memory-mapped file, only move frames of current window to device, for single-call very long video, None means no paging.
+        latent_paging_dir (str, optional): 内存映射文件目录，None 表示系统临时目录. dir of memory-mapped files, None means system temp dir.
+        latent_paging_page_size (int, optional): scheduler.step 每页的帧数. number of frames per page of scheduler.step.
+        controlnet_condition_cache_dir (str, optional): controlnet condition 磁盘缓存目录，可在多个 worker 间共享，None 表示不缓存，参考 musev.pipelines.condition_cache。
+            dir of on-disk controlnet condition cache, could be shared between workers, None means no cache, refer to musev.pipelines.condition_cache.
+        controlnet_processor_num_workers (int, optional): controlnet processor 的 worker 进程数，窗口的帧切分到各进程并行检测，0 表示在当前进程串行运行。
+            num of worker processes of controlnet processor, frames of window are sharded across processes, 0 means run serially in current process.
+        controlnet_processor_worker_device (str, optional): worker 进程中 processor 的 device. device of processor in worker processes.
+        frame_store_dir (str, optional): video2video 输入视频解码一次后以目标分辨率存为内存映射帧，重复运行不再解码，None 表示每次用 decord 解码，参考 musev.data.frame_store。
+            video2video input video is decoded once and stored as memory-mapped frames at target resolution, re-runs do not decode again, None means decode with decord every run, refer to musev.data.frame_store.
+        """
         self.sd_model_path = sd_model_path
+        self.memory_budget = memory_budget
+        self.memory_model = memory_model
         self.unet = unet
         self.controlnet_name = controlnet_name
         self.controlnet = controlnet
@@ -157,27 +242,68 @@ class DiffusersPipelinePredictor(object):
         self.hand_and_face = hand_and_face
         self.include_face = include_face
         self.include_hand = include_hand
+        # load_controlnet_model 中决定 processor 检测结果的参数，也是 condition_cache 键的一部分
+        # kwargs of load_controlnet_model which decide detection results of processor, also part of condition_cache key
+        self.controlnet_processor_load_kwargs = dict(
+            image_resolution=image_resolution,
+            detect_resolution=detect_resolution,
+            include_body=include_body,
+            include_face=include_face,
+            hand_and_face=hand_and_face,
+            include_hand=include_hand,
+        )
         self.negative_embedding = negative_embedding
         self.device = device
         self.dtype = dtype
         self.lcm_lora_dct = lcm_lora_dct
+        self.weight_quant_bits = weight_quant_bits
+        self.weight_quant_lora_mode = weight_quant_lora_mode
+        self.compile_unet = compile_unet
+        self.compile_max_buckets = compile_max_buckets
+        self.frame_store_dir = frame_store_dir
+        self.condition_cache = (
+            ControlnetConditionCache(controlnet_condition_cache_dir)
+            if controlnet_condition_cache_dir is not None
+            else None
+        )
+        self.resolution_bucketer = (
+            ResolutionBucketer(
+                aspect_ratios=resolution_bucket_aspect_ratios,
+                areas=resolution_bucket_areas,
+                mode=resolution_bucket_mode,
+            )
+            if resolution_bucket_mode is not None
+            else None
+        )
         if controlnet is None and controlnet_name is not None:
+            # 使用多进程执行器时，processor 只在 worker 进程中加载
+            # processor is only loaded in worker processes when multi-process executor is used
+            use_processor_executor = (
+                need_controlnet_processor and controlnet_processor_num_workers > 0
+            )
             controlnet, controlnet_processor, processor_params = load_controlnet_model(
                 controlnet_name,
                 device=device,
                 dtype=dtype,
-                need_controlnet_processor=need_controlnet_processor,
+                need_controlnet_processor=need_controlnet_processor
+                and not use_processor_executor,
                 need_controlnet=need_controlnet,
-                image_resolution=image_resolution,
-                detect_resolution=detect_resolution,
-                include_body=include_body,
-                include_face=include_face,
-                hand_and_face=hand_and_face,
-                include_hand=include_hand,
+                **self.controlnet_processor_load_kwargs,
             )
             self.controlnet_processor = controlnet_processor
             self.controlnet_processor_params = processor_params
             logger.debug(f"init controlnet controlnet_name={controlnet_name}")
+            if use_processor_executor:
+                # 接口相同，替换为多进程执行器. same interface, replace with multi-process executor
+                self.controlnet_processor = ControlnetProcessorExecutor(
+                    controlnet_name,
+                    load_kwargs=dict(
+                        device=controlnet_processor_worker_device,
+                        dtype=torch.float32,
+                        **self.controlnet_processor_load_kwargs,
+                    ),
+                    num_workers=controlnet_processor_num_workers,
+                )
 
         if controlnet is not None:
             controlnet = controlnet.to(device=device, dtype=dtype)
@@ -190,6 +316,23 @@ class DiffusersPipelinePredictor(object):
         if referencenet is not None:
             referencenet.to(device=device, dtype=dtype)
             referencenet.eval()
+        # token merging of spatial self-attn, ratio could be float or per-block dict
+        if token_merge_ratio:
+            unet.set_token_merge(
+                ratio=token_merge_ratio, max_downsample=token_merge_max_downsample
+            )
+            if referencenet is not None and hasattr(referencenet, "set_token_merge"):
+                referencenet.set_token_merge(
+                    ratio=token_merge_ratio, max_downsample=token_merge_max_downsample
+                )
+            logger.debug(
+                f"set token merge, ratio={token_merge_ratio}, max_downsample={token_merge_max_downsample}"
+            )
+        if weight_quant_bits is not None:
+            for model in [unet, referencenet, controlnet]:
+                self.quantize_model(model)
+        if compile_unet:
+            unet.enable_compile(max_buckets=compile_max_buckets)
         if ip_adapter_image_proj is not None:
             ip_adapter_image_proj.to(device=device, dtype=dtype)
             ip_adapter_image_proj.eval()
@@ -305,53 +448,243 @@ class DiffusersPipelinePredictor(object):
             self.load_lora(lora_dict=lcm_lora_dct)
             logger.debug("load lcm lora {}".format(" ".join(list(lcm_lora_dct.keys()))))
 
+        self.enable_phase_offload = enable_phase_offload
+        self.offload_pin_memory = offload_pin_memory
+        self.offload_prefetch = offload_prefetch
+        if enable_phase_offload:
+            self.pipeline.enable_phase_offload(
+                device=device, pin_memory=offload_pin_memory, prefetch=offload_prefetch
+            )
+        self.context_parallel = context_parallel
+        if context_parallel:
+            self.pipeline.enable_context_parallel()
+        self.latent_paging = latent_paging
+        if latent_paging is not None:
+            self.pipeline.enable_latent_paging(
+                storage=latent_paging,
+                memmap_dir=latent_paging_dir,
+                page_size=latent_paging_page_size,
+            )
+
         # logger.debug("Unet3Model Parameters")
         # logger.debug(pformat(self.__dict__))
 
+    @contextmanager
+    def without_phase_offload(self):
+        """修改 lora、替换模块时需要所有模块在 device 上，结束后重新按阶段卸载
+        lora and module update need all modules on device, offload by phase again after that.
+        """
+        offload_manager = getattr(self.pipeline, "offload_manager", None)
+        if offload_manager is not None:
+            self.pipeline.disable_phase_offload()
+        try:
+            yield
+        finally:
+            if offload_manager is not None:
+                self.pipeline.enable_phase_offload(
+                    device=self.device,
+                    pin_memory=self.offload_pin_memory,
+                    prefetch=self.offload_prefetch,
+                )
+
+    def quantize_model(self, model: nn.Module) -> nn.Module:
+        """weight_quant_bits 不为 None 时对模型做 weight-only 量化, weight-only quantize model when weight_quant_bits is not None."""
+        if self.weight_quant_bits is None or model is None:
+            return model
+        models = model.nets if hasattr(model, "nets") else [model]
+        for net in models:
+            quantize_linear_layers(
+                net,
+                bits=self.weight_quant_bits,
+                lora_mode=self.weight_quant_lora_mode,
+            )
+        return model
+
+    def close(self) -> None:
+        """回收 controlnet processor 的 worker 进程, shutdown worker processes of controlnet processor."""
+        controlnet_processor = getattr(self, "controlnet_processor", None)
+        if isinstance(controlnet_processor, ControlnetProcessorExecutor):
+            controlnet_processor.shutdown()
+
+    def __enter__(self) -> "DiffusersPipelinePredictor":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> bool:
+        self.close()
+        return False
+
+    def snap_resolution(self, height: int, width: int) -> Tuple[int, int]:
+        """使用分辨率桶时返回吸附后的宽高，否则原样返回
+        return snapped height and width when resolution bucketing is used, otherwise return as is.
+        """
+        if self.resolution_bucketer is None or height is None or width is None:
+            return height, width
+        bucket_height, bucket_width = self.resolution_bucketer.snap(height, width)
+        logger.info(
+            f"resolution bucket, {height}x{width} -> {bucket_height}x{bucket_width}, report={self.resolution_bucketer.report()}"
+        )
+        return bucket_height, bucket_width
+
+    def resolution_bucket_report(self) -> Dict:
+        if self.resolution_bucketer is None:
+            return {}
+        return self.resolution_bucketer.report()
+
+    def restore_resolution(
+        self,
+        videos: Union[np.ndarray, List[np.ndarray]],
+        height: int,
+        width: int,
+    ) -> Union[np.ndarray, List[np.ndarray]]:
+        """将桶尺寸的输出还原到原始宽高, restore outputs of bucket size to original height and width."""
+        if self.resolution_bucketer is None or videos is None:
+            return videos
+        if isinstance(videos, list):
+            return [self.restore_resolution(x, height, width) for x in videos]
+        return self.resolution_bucketer.restore_outputs(videos, height, width)
+
+    def calibrate_memory_model(self, **kwargs) -> MemoryModel:
+        """在小尺寸配置上标定显存模型，参数见 musev.pipelines.memory_planner.calibrate_memory_model
+        calibrate memory model on tiny configs, refer to musev.pipelines.memory_planner.calibrate_memory_model.
+        """
+        self.memory_model = calibrate_memory_model(
+            self.pipeline, memory_model=self.memory_model, **kwargs
+        )
+        return self.memory_model
+
+    def plan_memory(
+        self,
+        video_length: int,
+        height: int = None,
+        width: int = None,
+        batch_size: int = 1,
+        context_frames: int = 12,
+        context_overlap: int = 4,
+        context_stride: int = 1,
+        context_schedule: str = "uniform",
+        do_classifier_free_guidance: bool = True,
+        n_refer_frames: int = 1,
+        n_vision_condition: int = 1,
+    ) -> MemoryPlan:
+        if height is None:
+            height = (
+                self.pipeline.unet.config.sample_size * self.pipeline.vae_scale_factor
+            )
+        if width is None:
+            width = (
+                self.pipeline.unet.config.sample_size * self.pipeline.vae_scale_factor
+            )
+        if self.memory_budget is not None:
+            budget_bytes = self.memory_budget * 2**30
+        else:
+            budget_bytes = get_gpu_memory_budget(self.device)
+        return plan_memory(
+            budget_bytes=budget_bytes,
+            batch_size=batch_size,
+            video_length=video_length,
+            height=height,
+            width=width,
+            context_frames=context_frames,
+            context_overlap=context_overlap,
+            context_stride=context_stride,
+            context_schedule=context_schedule,
+            do_classifier_free_guidance=do_classifier_free_guidance,
+            use_controlnet=self.pipeline.controlnet is not None,
+            use_referencenet=self.pipeline.referencenet is not None,
+            n_refer_frames=n_refer_frames,
+            n_vision_condition=n_vision_condition,
+            vae_scale_factor=self.pipeline.vae_scale_factor,
+            memory_model=self.memory_model,
+        )
+
+    def resolve_auto_memory_params(
+        self,
+        context_batch_size: Union[int, Literal["auto"]],
+        decoder_t_segment: Union[int, Literal["auto"]],
+        temporal_attn_window: Union[int, Literal["auto"]],
+        **plan_kwargs,
+    ) -> Tuple[int, int, int]:
+        """将 "auto" 参数替换为显存规划的结果，vae_slicing 也随 decoder_t_segment 一起设置
+        replace "auto" parameters with result of memory plan, vae_slicing is set with decoder_t_segment.
+        """
+        if "auto" not in [context_batch_size, decoder_t_segment, temporal_attn_window]:
+            return context_batch_size, decoder_t_segment, temporal_attn_window
+        memory_plan = self.plan_memory(**plan_kwargs)
+        logger.info(f"memory plan: {memory_plan.to_dict()}")
+        if context_batch_size == "auto":
+            context_batch_size = memory_plan.context_batch_size
+        if decoder_t_segment == "auto":
+            decoder_t_segment = memory_plan.decoder_t_segment
+            if memory_plan.vae_slicing:
+                self.pipeline.enable_vae_slicing()
+            else:
+                self.pipeline.disable_vae_slicing()
+        if temporal_attn_window == "auto":
+            temporal_attn_window = memory_plan.temporal_attn_window
+        return context_batch_size, decoder_t_segment, temporal_attn_window
+
     def load_lora(
         self,
         lora_dict: Dict[str, Dict],
     ):
-        self.pipeline, unload_dict = update_pipeline_lora_models(
-            self.pipeline, lora_dict, device=self.device
-        )
+        with self.without_phase_offload():
+            self.pipeline, unload_dict = update_pipeline_lora_models(
+                self.pipeline, lora_dict, device=self.device
+            )
         self.unload_dict += unload_dict
 
     def unload_lora(self):
-        for layer_data in self.unload_dict:
-            layer = layer_data["layer"]
-            added_weight = layer_data["added_weight"]
-            layer.weight.data -= added_weight
+        with self.without_phase_offload():
+            for layer_data in self.unload_dict:
+                remove_layer_lora(layer_data)
         self.unload_dict = []
         gc.collect()
         torch.cuda.empty_cache()
 
     def update_unet(self, unet: nn.Module):
-        self.pipeline.unet = unet.to(device=self.device, dtype=self.dtype)
+        with self.without_phase_offload():
+            self.pipeline.unet = self.quantize_model(
+                unet.to(device=self.device, dtype=self.dtype)
+            )
+            if self.compile_unet:
+                self.pipeline.unet.enable_compile(max_buckets=self.compile_max_buckets)
 
     def update_sd_model(self, model_path: str, text_model_path: str):
-        self.pipeline = update_pipeline_basemodel(
-            self.pipeline,
-            model_path,
-            text_sd_model_path=text_model_path,
-            device=self.device,
-        )
+        with self.without_phase_offload():
+            # 基模型按 nn.Linear 的 state_dict 加载，先还原量化层
+            # base model is loaded as state_dict of nn.Linear, restore quantized layers first
+            if self.weight_quant_bits is not None:
+                dequantize_linear_layers(self.pipeline.unet)
+            self.pipeline = update_pipeline_basemodel(
+                self.pipeline,
+                model_path,
+                text_sd_model_path=text_model_path,
+                device=self.device,
+            )
+            self.quantize_model(self.pipeline.unet)
 
     def update_sd_model_and_unet(
         self, lora_sd_path: str, lora_path: str, sd_model_path: str = None
     ):
-        self.pipeline = update_pipeline_model_parameters(
-            self.pipeline,
-            model_path=lora_sd_path,
-            lora_path=lora_path,
-            text_model_path=sd_model_path,
-            device=self.device,
-        )
+        with self.without_phase_offload():
+            if self.weight_quant_bits is not None:
+                dequantize_linear_layers(self.pipeline.unet)
+            self.pipeline = update_pipeline_model_parameters(
+                self.pipeline,
+                model_path=lora_sd_path,
+                lora_path=lora_path,
+                text_model_path=sd_model_path,
+                device=self.device,
+            )
+            self.quantize_model(self.pipeline.unet)
 
     def update_controlnet(self, controlnet_name=Union[str, List[str]]):
-        self.pipeline.controlnet = load_controlnet_model(controlnet_name).to(
-            device=self.device, dtype=self.dtype
-        )
+        with self.without_phase_offload():
+            self.pipeline.controlnet = self.quantize_model(
+                load_controlnet_model(controlnet_name).to(
+                    device=self.device, dtype=self.dtype
+                )
+            )
 
     def run_pipe_text2video(
         self,
@@ -364,6 +697,9 @@ class DiffusersPipelinePredictor(object):
         video_guidance_scale: float = 7.5,
         video_guidance_scale_end: float = 3.5,
         video_guidance_scale_method: str = "linear",
+        video_guidance_execution_method: str = "always",
+        video_guidance_truncate_ratio: float = 1.0,
+        video_guidance_uncond_reuse_steps: int = 0,
         strength: float = 0.8,
         video_negative_prompt: Optional[Union[str, List[str]]] = None,
         negative_prompt: Optional[Union[str, List[str]]] = None,
@@ -424,9 +760,18 @@ class DiffusersPipelinePredictor(object):
         context_frames=12,
         context_stride=1,
         context_overlap=4,
-        context_batch_size=1,
+        context_batch_size: Union[int, Literal["auto"]] = 1,
         interpolation_factor=1,
         # parallel_denoise parameter end
+        decoder_t_segment: Union[int, Literal["auto"]] = 200,
+        deep_cache_interval: int = 1,
+        deep_cache_n_shallow_blocks: int = 1,
+        refer_token_pool_method: Literal["stride", "topk_norm", "cluster"] = None,
+        refer_token_pool_ratio: Union[float, List[float], Dict[int, float]] = 1.0,
+        temporal_attn_window: Union[int, Literal["auto"]] = None,
+        temporal_attn_chunk_size: int = None,
+        restore_original_size: bool = False,
+        profiler: PipelineProfiler = None,
     ):
         """
         generate long video with end2end mode
@@ -452,8 +797,31 @@ class DiffusersPipelinePredictor(object):
         2. when input paramter is None, use text2video to generate vis cond image, and use as refer_image and ip_adapter_image too.
         3. given from input paramter, but still redraw, update with redrawn vis cond image.
         """
+        if profiler is None:
+            profiler = NULL_PROFILER
+        # 分辨率分桶，输入裁剪或填充到桶尺寸
+        # resolution bucketing, crop or pad inputs to bucket size
+        original_height, original_width = height, width
+        height, width = self.snap_resolution(height, width)
+        # 分桶已裁剪或填充到目标尺寸的输入不再重复裁剪缩放
+        # inputs already fitted by bucketing skip the crop resize below
+        inputs_fitted = self.resolution_bucketer is not None and (height, width) != (
+            original_height,
+            original_width,
+        )
+        if inputs_fitted:
+            condition_images = self.resolution_bucketer.fit_inputs(
+                condition_images, height, width
+            )
+            refer_image = self.resolution_bucketer.fit_inputs(refer_image, height, width)
+            ip_adapter_image = self.resolution_bucketer.fit_inputs(
+                ip_adapter_image, height, width
+            )
+            refer_face_image = self.resolution_bucketer.fit_inputs(
+                refer_face_image, height, width
+            )
         # crop resize images
-        if condition_images is not None:
+        if condition_images is not None and not inputs_fitted:
             logger.debug(
                 f"center crop resize condition_images={condition_images.shape}, to height={height}, width={width}"
             )
@@ -462,7 +830,7 @@ class DiffusersPipelinePredictor(object):
                 target_height=height,
                 target_width=width,
             )
-        if refer_image is not None:
+        if refer_image is not None and not inputs_fitted:
             logger.debug(
                 f"center crop resize refer_image to height={height}, width={width}"
             )
@@ -471,7 +839,7 @@ class DiffusersPipelinePredictor(object):
                 target_height=height,
                 target_width=width,
             )
-        if ip_adapter_image is not None:
+        if ip_adapter_image is not None and not inputs_fitted:
             logger.debug(
                 f"center crop resize ip_adapter_image to height={height}, width={width}"
             )
@@ -480,7 +848,7 @@ class DiffusersPipelinePredictor(object):
                 target_height=height,
                 target_width=width,
             )
-        if refer_face_image is not None:
+        if refer_face_image is not None and not inputs_fitted:
             logger.debug(
                 f"center crop resize refer_face_image to height={height}, width={width}"
             )
@@ -489,6 +857,26 @@ class DiffusersPipelinePredictor(object):
                 target_height=height,
                 target_width=width,
             )
+        (
+            context_batch_size,
+            decoder_t_segment,
+            temporal_attn_window,
+        ) = self.resolve_auto_memory_params(
+            context_batch_size=context_batch_size,
+            decoder_t_segment=decoder_t_segment,
+            temporal_attn_window=temporal_attn_window,
+            video_length=video_length,
+            height=height,
+            width=width,
+            batch_size=(len(prompt) if isinstance(prompt, list) else 1)
+            * num_videos_per_prompt,
+            context_frames=context_frames,
+            context_overlap=context_overlap,
+            context_stride=context_stride,
+            context_schedule=context_schedule,
+            do_classifier_free_guidance=video_guidance_scale > 1,
+            n_vision_condition=n_vision_condition,
+        )
         run_video_length = video_length
         # generate vision condition frame start
         # if condition_images is None, generate with refer_image, ip_adapter_image
@@ -532,6 +920,7 @@ class DiffusersPipelinePredictor(object):
                     if redraw_condition_image_with_ip_adapter_face
                     else None,
                     prompt_only_use_image_prompt=prompt_only_use_image_prompt,
+                    profiler=profiler,
                 )
                 run_video_length = video_length - 1
             elif (
@@ -579,6 +968,7 @@ class DiffusersPipelinePredictor(object):
                     if redraw_condition_image_with_ip_adapter_face
                     else None,
                     prompt_only_use_image_prompt=prompt_only_use_image_prompt,
+                    profiler=profiler,
                 )
         else:
             condition_images = None
@@ -705,6 +1095,9 @@ class DiffusersPipelinePredictor(object):
                 guidance_scale=video_guidance_scale,
                 guidance_scale_end=video_guidance_scale_end,
                 guidance_scale_method=video_guidance_scale_method,
+                guidance_execution_method=video_guidance_execution_method,
+                guidance_truncate_ratio=video_guidance_truncate_ratio,
+                guidance_uncond_reuse_steps=video_guidance_uncond_reuse_steps,
                 w_ind_noise=w_ind_noise,
                 need_img_based_video_noise=need_img_based_video_noise,
                 img_weight=img_weight,
@@ -734,6 +1127,14 @@ class DiffusersPipelinePredictor(object):
                 context_batch_size=context_batch_size,
                 interpolation_factor=interpolation_factor,
                 # parallel_denoise parameter end
+                decoder_t_segment=decoder_t_segment,
+                deep_cache_interval=deep_cache_interval,
+                deep_cache_n_shallow_blocks=deep_cache_n_shallow_blocks,
+                refer_token_pool_method=refer_token_pool_method,
+                refer_token_pool_ratio=refer_token_pool_ratio,
+                temporal_attn_window=temporal_attn_window,
+                temporal_attn_chunk_size=temporal_attn_chunk_size,
+                profiler=profiler,
             )
             logger.debug(
                 f"run_pipe_text2video, out.videos.shape, i_batch={i_batch}, videos={out.videos.shape}, result_overlap={result_overlap}"
@@ -744,8 +1145,13 @@ class DiffusersPipelinePredictor(object):
 
         out_videos = np.concatenate(out_videos, axis=2)
         if need_hist_match:
-            out_videos[:, :, 1:, :, :] = hist_match_video_bcthw(
-                out_videos[:, :, 1:, :, :], out_videos[:, :, :1, :, :], value=255.0
+            with profiler.record("hist_match"):
+                out_videos[:, :, 1:, :, :] = hist_match_video_bcthw(
+                    out_videos[:, :, 1:, :, :], out_videos[:, :, :1, :, :], value=255.0
+                )
+        if restore_original_size:
+            out_videos = self.restore_resolution(
+                out_videos, original_height, original_width
             )
         return out_videos
 
@@ -757,6 +1163,197 @@ class DiffusersPipelinePredictor(object):
     def run_pipe_middle2video_with_middle(self, middle: Tuple[str, Iterable]):
         pass
 
+    def open_frame_store(self, video_path: str, height: int, width: int) -> FrameStore:
+        """打开或构建视频的帧存储，帧经过与 prepare_video2video_batch 相同的填充与裁剪缩放
+        open or build frame store of video, frames go through the same pad and crop resize as prepare_video2video_batch.
+        """
+        bucket_pad = (
+            self.resolution_bucketer is not None
+            and self.resolution_bucketer.mode == "pad"
+        )
+
+        def transform(frames: np.ndarray) -> np.ndarray:
+            if bucket_pad:
+                frames = self.resolution_bucketer.fit_inputs(frames, height, width)
+            return batch_dynamic_crop_resize_images(
+                frames,
+                target_height=height,
+                target_width=width,
+            )
+
+        return FrameStore.open_or_build(
+            video_path,
+            self.frame_store_dir,
+            height=height,
+            width=width,
+            transform=transform,
+            tag="pad" if bucket_pad else "crop",
+        )
+
+    def run_controlnet_processor(
+        self,
+        data: np.ndarray,
+        height: int,
+        width: int,
+        processor_params: Union[Dict, List[Dict]],
+    ) -> Union[np.ndarray, List[np.ndarray]]:
+        """运行 controlnet processor，启用 condition_cache 时命中则跳过检测
+        run controlnet processor, skip detection if hit when condition_cache is enabled.
+
+        Args:
+            data (np.ndarray): (b t) h w c, rgb.
+            height (int): target height.
+            width (int): target width.
+            processor_params (Union[Dict, List[Dict]]): output of update_controlnet_processor_params.
+
+        Returns:
+            Union[np.ndarray, List[np.ndarray]]: (b t) c h w, or list of it for multi controlnet.
+        """
+        if self.condition_cache is not None:
+            cache_key = self.condition_cache.make_key(
+                data,
+                processor_name=self.controlnet_name,
+                processor_params=processor_params,
+                height=height,
+                width=width,
+                load_params=self.controlnet_processor_load_kwargs,
+            )
+            condition = self.condition_cache.get(cache_key)
+            if condition is not None:
+                logger.debug(f"controlnet condition cache hit, key={cache_key}")
+                return condition
+        condition = self.controlnet_processor(
+            data=data,
+            data_channel_order="b h w c",
+            target_height=height,
+            target_width=width,
+            return_type="np",
+            return_data_channel_order="b c h w",
+            input_rgb_order="rgb",
+            processor_params=processor_params,
+        )
+        if self.condition_cache is not None:
+            self.condition_cache.put(cache_key, condition)
+        return condition
+
+    def prepare_video2video_batch(
+        self,
+        i_batch: int,
+        item,
+        height: int,
+        width: int,
+        controlnet_processor_params: Dict = None,
+        condition_images: np.ndarray = None,
+        video_is_middle: bool = False,
+        video_has_condition: bool = True,
+        profiler: PipelineProfiler = None,
+    ) -> Tuple[np.ndarray, Union[np.ndarray, List[np.ndarray], None], int]:
+        """读取视频窗口，裁剪缩放并提取 controlnet condition，可在后台预取线程中运行
+        read video window, crop resize and extract controlnet condition, could run in background prefetch thread.
+
+        Returns:
+            Tuple[np.ndarray, Union[np.ndarray, List[np.ndarray], None], int]: batch b c t h w, batch_condition b c t h w
+                or list of it, video_length of window.
+        """
+        if profiler is None:
+            profiler = NULL_PROFILER
+        # read and prepare video batch
+        batch = item.data
+        if (
+            self.resolution_bucketer is not None
+            and self.resolution_bucketer.mode == "pad"
+        ):
+            batch = self.resolution_bucketer.fit_inputs(batch, height, width)
+        with profiler.record("prepare_video_batch", batch=i_batch):
+            batch = batch_dynamic_crop_resize_images(
+                batch,
+                target_height=height,
+                target_width=width,
+            )
+
+        batch = batch[np.newaxis, ...]
+        batch_size, channel, video_length, video_height, video_width = batch.shape
+        # extract controlnet middle
+        if self.pipeline.controlnet is not None:
+            batch = rearrange(batch, "b c t h w-> (b t) h w c")
+            controlnet_processor_params = update_controlnet_processor_params(
+                src=self.controlnet_processor_params,
+                dst=controlnet_processor_params,
+            )
+            if not video_is_middle:
+                with profiler.record("controlnet_processor", batch=i_batch):
+                    batch_condition = self.run_controlnet_processor(
+                        batch,
+                        height=height,
+                        width=width,
+                        processor_params=controlnet_processor_params,
+                    )
+            else:
+                # TODO: 临时用于可视化输入的 controlnet middle 序列，后续待拆到 middl2video中，也可以增加参数支持
+                # TODO: only use video_path is controlnet middle output, to improved
+                batch_condition = rearrange(
+                    copy.deepcopy(batch), " b h w c-> b c h w"
+                )
+
+            # 当前仅当 输入是 middle、condition_image的pose在middle首帧之前，需要重新生成condition_images的pose并绑定到middle_batch上
+            # when video_path is middle seq and condition_image is not aligned with middle seq,
+            # regenerate codntion_images pose, and then concat into middle_batch,
+            if (
+                i_batch == 0
+                and not video_has_condition
+                and video_is_middle
+                and condition_images is not None
+            ):
+                condition_images_reshape = rearrange(
+                    condition_images, "b c t h w-> (b t) h w c"
+                )
+                condition_images_condition = self.run_controlnet_processor(
+                    condition_images_reshape,
+                    height=height,
+                    width=width,
+                    processor_params=controlnet_processor_params,
+                )
+                condition_images_condition = rearrange(
+                    condition_images_condition,
+                    "(b t) c h w-> b c t h w",
+                    b=batch_size,
+                )
+            else:
+                condition_images_condition = None
+            if not isinstance(batch_condition, list):
+                batch_condition = rearrange(
+                    batch_condition, "(b t) c h w-> b c t h w", b=batch_size
+                )
+                if condition_images_condition is not None:
+                    batch_condition = np.concatenate(
+                        [
+                            condition_images_condition,
+                            batch_condition,
+                        ],
+                        axis=2,
+                    )
+                    # 此时 batch_condition 比 batch 多了一帧，为了最终视频能 concat 存储，替换下
+                    # 当前仅适用于  condition_images_condition 不为None
+                    # when condition_images_condition is not None,  batch_condition has more frames than batch
+                    batch = rearrange(batch_condition, "b c t h w ->(b t) h w c")
+            else:
+                batch_condition = [
+                    rearrange(x, "(b t) c h w-> b c t h w", b=batch_size)
+                    for x in batch_condition
+                ]
+                if condition_images_condition is not None:
+                    batch_condition = [
+                        np.concatenate(
+                            [condition_images_condition, batch_condition_tmp],
+                            axis=2,
+                        )
+                        for batch_condition_tmp in batch_condition
+                    ]
+            batch = rearrange(batch, "(b t) h w c -> b c t h w", b=batch_size)
+        else:
+            batch_condition = None
+        return batch, batch_condition, video_length
+
     def run_pipe_video2video(
         self,
         video: Tuple[str, Iterable],
@@ -774,6 +1371,9 @@ class DiffusersPipelinePredictor(object):
         video_guidance_scale: float = 7.5,
         video_guidance_scale_end: float = 3.5,
         video_guidance_scale_method: str = "linear",
+        video_guidance_execution_method: str = "always",
+        video_guidance_truncate_ratio: float = 1.0,
+        video_guidance_uncond_reuse_steps: int = 0,
         video_negative_prompt: Optional[Union[str, List[str]]] = None,
         negative_prompt: Optional[Union[str, List[str]]] = None,
         num_videos_per_prompt: Optional[int] = 1,
@@ -846,24 +1446,81 @@ class DiffusersPipelinePredictor(object):
         context_frames=12,
         context_stride=1,
         context_overlap=4,
-        context_batch_size=1,
+        context_batch_size: Union[int, Literal["auto"]] = 1,
         interpolation_factor=1,
         # parallel_denoise parameter end
+        decoder_t_segment: Union[int, Literal["auto"]] = 200,
+        deep_cache_interval: int = 1,
+        deep_cache_n_shallow_blocks: int = 1,
+        refer_token_pool_method: Literal["stride", "topk_norm", "cluster"] = None,
+        refer_token_pool_ratio: Union[float, List[float], Dict[int, float]] = 1.0,
+        temporal_attn_window: Union[int, Literal["auto"]] = None,
+        temporal_attn_chunk_size: int = None,
+        restore_original_size: bool = False,
+        profiler: PipelineProfiler = None,
         # 支持 video_path 时多种输入
         # TODO:// video_has_condition =False，当且仅支持 video_is_middle=True, 待后续重构
         # TODO:// when video_has_condition =False, video_is_middle should be True.
         video_is_middle: bool = False,
         video_has_condition: bool = True,
+        prefetch_batches: int = 1,
     ):
         """
         类似controlnet text2img pipeline。 输入视频，用视频得到controlnet condition。
         目前仅支持time_size == step，overlap=0
         输出视频长度=输入视频长度
+        prefetch_batches: 后台预取的窗口数，窗口的解码、缩放、controlnet condition 提取与前一个窗口的去噪重叠，0 表示不预取。
 
         similar to controlnet text2image pipeline, generate video with controlnet condition from given video.
         By now, sliding window only support time_size == step, overlap = 0.
+        prefetch_batches: num of windows prefetched in background, decoding, resizing and controlnet condition
+            extraction of a window overlap with denoising of previous window, 0 means no prefetching.
         """
-        if isinstance(video, str):
+        videos = [] if need_return_videos else None
+        out_videos = []
+        out_condition = (
+            []
+            if need_return_condition and self.pipeline.controlnet is not None
+            else None
+        )
+        if profiler is None:
+            profiler = NULL_PROFILER
+        # 分辨率分桶，输入裁剪或填充到桶尺寸
+        # resolution bucketing, crop or pad inputs to bucket size
+        original_height, original_width = height, width
+        height, width = self.snap_resolution(height, width)
+        # 分桶已裁剪或填充到目标尺寸的输入不再重复裁剪缩放
+        # inputs already fitted by bucketing skip the crop resize below
+        inputs_fitted = self.resolution_bucketer is not None and (height, width) != (
+            original_height,
+            original_width,
+        )
+        if inputs_fitted:
+            condition_images = self.resolution_bucketer.fit_inputs(
+                condition_images, height, width
+            )
+            refer_image = self.resolution_bucketer.fit_inputs(refer_image, height, width)
+            ip_adapter_image = self.resolution_bucketer.fit_inputs(
+                ip_adapter_image, height, width
+            )
+            refer_face_image = self.resolution_bucketer.fit_inputs(
+                refer_face_image, height, width
+            )
+        if isinstance(video, str) and self.frame_store_dir is not None:
+            # 解码一次并缓存到目标分辨率的内存映射，之后窗口按视图读取
+            # decode once into memory map at target resolution, windows are read as views after that
+            with profiler.record("frame_store"):
+                frame_store = self.open_frame_store(video, height, width)
+            video_reader = FrameStoreDataset(
+                frame_store,
+                time_size=time_size,
+                step=step,
+                overlap=overlap,
+                sample_rate=sample_rate,
+                drop_last=True,
+                channels_order="c t h w",
+            )
+        elif isinstance(video, str):
             video_reader = DecordVideoDataset(
                 video,
                 time_size=time_size,
@@ -877,15 +1534,8 @@ class DiffusersPipelinePredictor(object):
             )
         else:
             video_reader = video
-        videos = [] if need_return_videos else None
-        out_videos = []
-        out_condition = (
-            []
-            if need_return_condition and self.pipeline.controlnet is not None
-            else None
-        )
         # crop resize images
-        if condition_images is not None:
+        if condition_images is not None and not inputs_fitted:
             logger.debug(
                 f"center crop resize condition_images={condition_images.shape}, to height={height}, width={width}"
             )
@@ -894,7 +1544,7 @@ class DiffusersPipelinePredictor(object):
                 target_height=height,
                 target_width=width,
             )
-        if refer_image is not None:
+        if refer_image is not None and not inputs_fitted:
             logger.debug(
                 f"center crop resize refer_image to height={height}, width={width}"
             )
@@ -903,7 +1553,7 @@ class DiffusersPipelinePredictor(object):
                 target_height=height,
                 target_width=width,
             )
-        if ip_adapter_image is not None:
+        if ip_adapter_image is not None and not inputs_fitted:
             logger.debug(
                 f"center crop resize ip_adapter_image to height={height}, width={width}"
             )
@@ -912,7 +1562,7 @@ class DiffusersPipelinePredictor(object):
                 target_height=height,
                 target_width=width,
             )
-        if refer_face_image is not None:
+        if refer_face_image is not None and not inputs_fitted:
             logger.debug(
                 f"center crop resize refer_face_image to height={height}, width={width}"
             )
@@ -921,6 +1571,25 @@ class DiffusersPipelinePredictor(object):
                 target_height=height,
                 target_width=width,
             )
+        (
+            context_batch_size,
+            decoder_t_segment,
+            temporal_attn_window,
+        ) = self.resolve_auto_memory_params(
+            context_batch_size=context_batch_size,
+            decoder_t_segment=decoder_t_segment,
+            temporal_attn_window=temporal_attn_window,
+            video_length=time_size if time_size is not None else context_frames,
+            height=height,
+            width=width,
+            batch_size=num_videos_per_prompt,
+            context_frames=context_frames,
+            context_overlap=context_overlap,
+            context_stride=context_stride,
+            context_schedule=context_schedule,
+            do_classifier_free_guidance=video_guidance_scale > 1,
+            n_vision_condition=n_vision_condition,
+        )
         first_image = None
         last_mid_video_noises = None
         last_mid_video_latents = None
@@ -929,106 +1598,33 @@ class DiffusersPipelinePredictor(object):
         #     device=self.device, dtype=self.dtype
         # )
 
-        for i_batch, item in enumerate(video_reader):
-            logger.debug(f"\n sd_pipeline_predictor, run_pipe_video2video: {i_batch}")
-            if max_batch_num is not None and i_batch == max_batch_num:
-                break
-            # read and prepare video batch
-            batch = item.data
-            batch = batch_dynamic_crop_resize_images(
-                batch,
-                target_height=height,
-                target_width=width,
+        def prepare_batch(i_batch, item):
+            return self.prepare_video2video_batch(
+                i_batch,
+                item,
+                height=height,
+                width=width,
+                controlnet_processor_params=controlnet_processor_params,
+                condition_images=condition_images,
+                video_is_middle=video_is_middle,
+                video_has_condition=video_has_condition,
+                profiler=profiler,
             )
 
-            batch = batch[np.newaxis, ...]
-            batch_size, channel, video_length, video_height, video_width = batch.shape
-            # extract controlnet middle
-            if self.pipeline.controlnet is not None:
-                batch = rearrange(batch, "b c t h w-> (b t) h w c")
-                controlnet_processor_params = update_controlnet_processor_params(
-                    src=self.controlnet_processor_params,
-                    dst=controlnet_processor_params,
-                )
-                if not video_is_middle:
-                    batch_condition = self.controlnet_processor(
-                        data=batch,
-                        data_channel_order="b h w c",
-                        target_height=height,
-                        target_width=width,
-                        return_type="np",
-                        return_data_channel_order="b c h w",
-                        input_rgb_order="rgb",
-                        processor_params=controlnet_processor_params,
-                    )
-                else:
-                    # TODO: 临时用于可视化输入的 controlnet middle 序列，后续待拆到 middl2video中，也可以增加参数支持
-                    # TODO: only use video_path is controlnet middle output, to improved
-                    batch_condition = rearrange(
-                        copy.deepcopy(batch), " b h w c-> b c h w"
-                    )
-
-                # 当前仅当 输入是 middle、condition_image的pose在middle首帧之前，需要重新生成condition_images的pose并绑定到middle_batch上
-                # when video_path is middle seq and condition_image is not aligned with middle seq,
-                # regenerate codntion_images pose, and then concat into middle_batch,
-                if (
-                    i_batch == 0
-                    and not video_has_condition
-                    and video_is_middle
-                    and condition_images is not None
-                ):
-                    condition_images_reshape = rearrange(
-                        condition_images, "b c t h w-> (b t) h w c"
-                    )
-                    condition_images_condition = self.controlnet_processor(
-                        data=condition_images_reshape,
-                        data_channel_order="b h w c",
-                        target_height=height,
-                        target_width=width,
-                        return_type="np",
-                        return_data_channel_order="b c h w",
-                        input_rgb_order="rgb",
-                        processor_params=controlnet_processor_params,
-                    )
-                    condition_images_condition = rearrange(
-                        condition_images_condition,
-                        "(b t) c h w-> b c t h w",
-                        b=batch_size,
-                    )
-                else:
-                    condition_images_condition = None
-                if not isinstance(batch_condition, list):
-                    batch_condition = rearrange(
-                        batch_condition, "(b t) c h w-> b c t h w", b=batch_size
-                    )
-                    if condition_images_condition is not None:
-                        batch_condition = np.concatenate(
-                            [
-                                condition_images_condition,
-                                batch_condition,
-                            ],
-                            axis=2,
-                        )
-                        # 此时 batch_condition 比 batch 多了一帧，为了最终视频能 concat 存储，替换下
-                        # 当前仅适用于  condition_images_condition 不为None
-                        # when condition_images_condition is not None,  batch_condition has more frames than batch
-                        batch = rearrange(batch_condition, "b c t h w ->(b t) h w c")
-                else:
-                    batch_condition = [
-                        rearrange(x, "(b t) c h w-> b c t h w", b=batch_size)
-                        for x in batch_condition
-                    ]
-                    if condition_images_condition is not None:
-                        batch_condition = [
-                            np.concatenate(
-                                [condition_images_condition, batch_condition_tmp],
-                                axis=2,
-                            )
-                            for batch_condition_tmp in batch_condition
-                        ]
-                batch = rearrange(batch, "(b t) h w c -> b c t h w", b=batch_size)
-            else:
-                batch_condition = None
+        # 后台线程读取并预处理下一个窗口，与当前窗口的去噪重叠
+        # background thread reads and preprocesses next window, overlapping with denoising of current window
+        if max_batch_num is not None:
+            video_reader_iter = itertools.islice(video_reader, max_batch_num)
+        else:
+            video_reader_iter = video_reader
+        prefetcher = BackgroundPrefetcher(
+            video_reader_iter,
+            fn=prepare_batch,
+            max_prefetch=prefetch_batches,
+            name="musev_video2video_prefetch",
+        )
+        for i_batch, (batch, batch_condition, video_length) in enumerate(prefetcher):
+            logger.debug(f"\n sd_pipeline_predictor, run_pipe_video2video: {i_batch}")
             # condition [0,255]
             # latent: [0,1]
             # 按需求生成多个片段，
@@ -1113,6 +1709,7 @@ class DiffusersPipelinePredictor(object):
                             if redraw_condition_image_with_ip_adapter_face
                             else None,
                             prompt_only_use_image_prompt=prompt_only_use_image_prompt,
+                            profiler=profiler,
                         )
                         if refer_image is not None:
                             refer_image = first_image * 255.0
@@ -1233,6 +1830,9 @@ class DiffusersPipelinePredictor(object):
                 guidance_scale=video_guidance_scale,
                 guidance_scale_end=video_guidance_scale_end,
                 guidance_scale_method=video_guidance_scale_method,
+                guidance_execution_method=video_guidance_execution_method,
+                guidance_truncate_ratio=video_guidance_truncate_ratio,
+                guidance_uncond_reuse_steps=video_guidance_uncond_reuse_steps,
                 strength=video_strength,
                 refer_image=refer_image,
                 ip_adapter_image=ip_adapter_image,
@@ -1258,6 +1858,14 @@ class DiffusersPipelinePredictor(object):
                 context_batch_size=context_batch_size,
                 interpolation_factor=interpolation_factor,
                 # parallel_denoise parameter end
+                decoder_t_segment=decoder_t_segment,
+                deep_cache_interval=deep_cache_interval,
+                deep_cache_n_shallow_blocks=deep_cache_n_shallow_blocks,
+                refer_token_pool_method=refer_token_pool_method,
+                refer_token_pool_ratio=refer_token_pool_ratio,
+                temporal_attn_window=temporal_attn_window,
+                temporal_attn_chunk_size=temporal_attn_chunk_size,
+                profiler=profiler,
             )
             last_batch = batch
             last_batch_condition = batch_condition
@@ -1284,7 +1892,16 @@ class DiffusersPipelinePredictor(object):
                 ]
                 out_condition = [np.concatenate(x, axis=2) for x in out_condition]
         if need_hist_match:
-            videos[:, :, 1:, :, :] = hist_match_video_bcthw(
-                videos[:, :, 1:, :, :], videos[:, :, :1, :, :], value=255.0
+            with profiler.record("hist_match"):
+                videos[:, :, 1:, :, :] = hist_match_video_bcthw(
+                    videos[:, :, 1:, :, :], videos[:, :, :1, :, :], value=255.0
+                )
+        if restore_original_size:
+            out_videos = self.restore_resolution(
+                out_videos, original_height, original_width
+            )
+            out_condition = self.restore_resolution(
+                out_condition, original_height, original_width
             )
+            videos = self.restore_resolution(videos, original_height, original_width)
         return out_videos, out_condition, videos
@@ -0,0 +1,215 @@
+"""分辨率分桶：将请求的宽高吸附到有限的桶中，使 cudnn autotune、torch.compile 缓存、批处理等可以在请求间复用。
+输入按桶中心裁剪或填充，输出可选还原到原始尺寸。
+
+resolution bucketing: snap requested height and width to a limited set of buckets, so that cudnn autotune,
+torch.compile cache and batching could be reused across requests.
+inputs are center cropped or padded to bucket, outputs could be restored to original size optionally.
+"""
+from collections import OrderedDict
+from typing import Dict, List, Literal, Sequence, Tuple, Union
+import math
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from diffusers.utils import logging
+
+from mmcm.vision.process.image_process import batch_dynamic_crop_resize_images_v2
+
+logger = logging.get_logger(__name__)  # pylint: disable=invalid-name
+
+# 宽高比 width / height
+DEFAULT_BUCKET_ASPECT_RATIOS = (9 / 16, 2 / 3, 3 / 4, 1.0, 4 / 3, 3 / 2, 16 / 9)
+DEFAULT_BUCKET_AREAS = (384 * 384, 512 * 512, 640 * 640, 768 * 768)
+
+
+def build_bucket_table(
+    aspect_ratios: Sequence[float] = DEFAULT_BUCKET_ASPECT_RATIOS,
+    areas: Sequence[int] = DEFAULT_BUCKET_AREAS,
+    multiple: int = 64,
+) -> List[Tuple[int, int]]:
+    """每个宽高比与面积组合成一个桶，宽高为 multiple 的整数倍
+    every combination of aspect ratio and area is a bucket, height and width are multiples of multiple.
+
+    Returns:
+        List[Tuple[int, int]]: sorted unique (height, width).
+    """
+    buckets = set()
+    for ratio in aspect_ratios:
+        for area in areas:
+            height = max(multiple, round(math.sqrt(area / ratio) / multiple) * multiple)
+            width = max(multiple, round(math.sqrt(area * ratio) / multiple) * multiple)
+            buckets.add((int(height), int(width)))
+    return sorted(buckets)
+
+
+class ResolutionBucketer(object):
+    """将请求宽高吸附到最近的桶，优先宽高比最接近，其次面积最接近，并统计每个桶的命中率
+    snap requested size to nearest bucket, closest aspect ratio first and then closest area, and count hit rate of every bucket.
+
+    Args:
+        aspect_ratios (Sequence[float], optional): width / height of buckets. Defaults to DEFAULT_BUCKET_ASPECT_RATIOS.
+        areas (Sequence[int], optional): height * width of buckets. Defaults to DEFAULT_BUCKET_AREAS.
+        multiple (int, optional): height and width of bucket are multiples of it. Defaults to 64.
+        mode (Literal["crop", "pad"], optional): center crop or pad inputs to bucket. Defaults to "crop".
+    """
+
+    def __init__(
+        self,
+        aspect_ratios: Sequence[float] = None,
+        areas: Sequence[int] = None,
+        multiple: int = 64,
+        mode: Literal["crop", "pad"] = "crop",
+    ) -> None:
+        if mode not in ["crop", "pad"]:
+            raise ValueError(f"mode should be crop or pad, but given {mode}")
+        self.aspect_ratios = (
+            aspect_ratios if aspect_ratios is not None else DEFAULT_BUCKET_ASPECT_RATIOS
+        )
+        self.areas = areas if areas is not None else DEFAULT_BUCKET_AREAS
+        self.multiple = multiple
+        self.mode = mode
+        self.buckets = build_bucket_table(self.aspect_ratios, self.areas, multiple)
+        self.hits = OrderedDict((bucket, 0) for bucket in self.buckets)
+        self.n_requests = 0
+        self.n_exact = 0
+
+    def snap(self, height: int, width: int, record: bool = True) -> Tuple[int, int]:
+        def key(bucket):
+            bucket_height, bucket_width = bucket
+            ratio_diff = abs(math.log((bucket_width / bucket_height) / (width / height)))
+            area_diff = abs(math.log((bucket_height * bucket_width) / (height * width)))
+            return (round(ratio_diff, 4), area_diff)
+
+        bucket = min(self.buckets, key=key)
+        if record:
+            self.hits[bucket] += 1
+            self.n_requests += 1
+            if bucket == (height, width):
+                self.n_exact += 1
+        logger.debug(
+            f"ResolutionBucketer, snap height={height}, width={width} to bucket={bucket}"
+        )
+        return bucket
+
+    def hit_rates(self) -> Dict[str, Dict[str, float]]:
+        """hxw: {count, rate}, 只包含命中过的桶. only buckets hit at least once."""
+        return OrderedDict(
+            (
+                f"{bucket[0]}x{bucket[1]}",
+                {"count": count, "rate": count / max(self.n_requests, 1)},
+            )
+            for bucket, count in self.hits.items()
+            if count > 0
+        )
+
+    def report(self) -> Dict:
+        return {
+            "n_requests": self.n_requests,
+            "n_buckets_hit": sum(count > 0 for count in self.hits.values()),
+            "exact_rate": self.n_exact / max(self.n_requests, 1),
+            "buckets": self.hit_rates(),
+        }
+
+    def fit_inputs(
+        self,
+        images: Union[np.ndarray, torch.Tensor],
+        height: int,
+        width: int,
+    ) -> Union[np.ndarray, torch.Tensor]:
+        """按 mode 将 (..., h, w) 的输入裁剪或填充到桶尺寸, crop or pad (..., h, w) inputs to bucket size by mode."""
+        if images is None:
+            return None
+        if self.mode == "pad" and isinstance(images, (np.ndarray, torch.Tensor)):
+            return pad_resize_images(images, target_height=height, target_width=width)
+        return batch_dynamic_crop_resize_images_v2(
+            images, target_height=height, target_width=width
+        )
+
+    def restore_outputs(
+        self,
+        videos: np.ndarray,
+        height: int,
+        width: int,
+    ) -> np.ndarray:
+        """将桶尺寸的输出还原到原始尺寸，pad 模式先去掉填充
+        restore outputs of bucket size to original size, padding is removed first in pad mode.
+
+        Args:
+            videos (np.ndarray): b c t h w, bucket size.
+            height (int): original height.
+            width (int): original width.
+        """
+        if videos is None:
+            return None
+        if self.mode == "pad":
+            top, left, content_height, content_width = get_pad_box(
+                height, width, videos.shape[-2], videos.shape[-1]
+            )
+            videos = videos[
+                ..., top : top + content_height, left : left + content_width
+            ]
+        return batch_dynamic_crop_resize_images_v2(
+            videos, target_height=height, target_width=width
+        )
+
+
+def get_pad_box(
+    height: int, width: int, target_height: int, target_width: int
+) -> Tuple[int, int, int, int]:
+    """保持宽高比缩放到目标尺寸内，返回居中内容区域 top, left, height, width
+    resize into target keeping aspect ratio, return centered content box top, left, height, width.
+    """
+    scale = min(target_height / height, target_width / width)
+    content_height = min(target_height, max(1, round(height * scale)))
+    content_width = min(target_width, max(1, round(width * scale)))
+    top = (target_height - content_height) // 2
+    left = (target_width - content_width) // 2
+    return top, left, content_height, content_width
+
+
+def pad_resize_images(
+    images: Union[np.ndarray, torch.Tensor],
+    target_height: int,
+    target_width: int,
+    pad_value: float = 0,
+) -> Union[np.ndarray, torch.Tensor]:
+    """保持宽高比缩放后居中填充到目标尺寸，输入输出均为通道在前的 (..., h, w)
+    resize keeping aspect ratio and pad to target size in center, inputs and outputs are channel first (..., h, w).
+    """
+    is_numpy = isinstance(images, np.ndarray)
+    tensor = torch.from_numpy(images) if is_numpy else images
+    dtype = tensor.dtype
+    shape = tensor.shape
+    height, width = shape[-2:]
+    top, left, content_height, content_width = get_pad_box(
+        height, width, target_height, target_width
+    )
+    tensor = tensor.reshape(-1, 1, height, width).float()
+    if (content_height, content_width) != (height, width):
+        tensor = F.interpolate(
+            tensor,
+            size=(content_height, content_width),
+            mode="bilinear",
+            align_corners=False,
+        )
+    tensor = F.pad(
+        tensor,
+        (
+            left,
+            target_width - content_width - left,
+            top,
+            target_height - content_height - top,
+        ),
+        value=pad_value,
+    )
+    tensor = tensor.reshape(*shape[:-2], target_height, target_width)
+    if not dtype.is_floating_point:
+        tensor = tensor.round().clamp(
+            torch.iinfo(dtype).min, torch.iinfo(dtype).max
+        )
+    tensor = tensor.to(dtype)
+    if is_numpy:
+        return tensor.numpy()
+    return tensor
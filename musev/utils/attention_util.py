@@ -1,4 +1,4 @@
-from typing import Tuple, Union, Literal
+from typing import List, Tuple, Union, Literal
 
 from einops import repeat
 import torch
@@ -72,3 +72,47 @@ def generate_sparse_causcal_attn_mask(
     if out_type == "torch":
         mask = torch.from_numpy(mask)
     return mask
+
+
+def generate_local_attn_chunks(
+    n: int,
+    window_size: int,
+    chunk_size: int = None,
+    condition_index: torch.LongTensor = None,
+    device: torch.device = None,
+) -> List[Tuple[int, int, torch.LongTensor, torch.BoolTensor]]:
+    """将 n 个 query 按 chunk_size 分块，每块只与 ±window_size 内的 key 及条件帧 key 计算 attn，
+        避免生成 n*n 的 dense mask，复杂度为 O(n * (chunk_size + 2 * window_size + n_cond))
+    split n queries into chunks of chunk_size, every chunk only attends keys within ±window_size and condition keys,
+        to avoid dense n*n mask, complexity is O(n * (chunk_size + 2 * window_size + n_cond)).
+
+    Args:
+        n (int): length of query and key.
+        window_size (int): query i attends key j if |i - j| <= window_size.
+        chunk_size (int, optional): num of queries in one chunk. Defaults to None, use max(1, window_size).
+        condition_index (torch.LongTensor, optional): N or b*N, keys attended by all queries. Defaults to None.
+        device (torch.device, optional): Defaults to None.
+
+    Returns:
+        List[Tuple[int, int, torch.LongTensor, torch.BoolTensor]]: q_start, q_end, key_index, mask of (q_end - q_start) * len(key_index)
+    """
+    if chunk_size is None:
+        chunk_size = max(1, window_size)
+    frames = torch.arange(n, device=device)
+    if condition_index is not None:
+        # 不同样本的条件帧取并集, union of condition frames of all samples
+        condition_index = torch.unique(condition_index.flatten().to(device))
+        condition_index = condition_index[condition_index < n]
+    else:
+        condition_index = frames[:0]
+    chunks = []
+    for q_start in range(0, n, chunk_size):
+        q_end = min(n, q_start + chunk_size)
+        k_start = max(0, q_start - window_size)
+        k_end = min(n, q_end + window_size)
+        key_index = torch.unique(torch.cat([frames[k_start:k_end], condition_index]))
+        query_index = frames[q_start:q_end]
+        mask = (query_index[:, None] - key_index[None, :]).abs() <= window_size
+        mask = mask | torch.isin(key_index, condition_index)[None, :]
+        chunks.append((q_start, q_end, key_index, mask))
+    return chunks
@@ -0,0 +1,165 @@
+"""视频帧图片的并行导出。
+save_images 时原先在主线程上逐帧串行调用 imageio.imsave，且在视频编码结束之后才开始。
+这里用线程池以 opencv 编码并写盘，opencv 编码时释放 GIL，可与 StreamingVideoWriter 的 ffmpeg 编码同时进行。
+提交中的帧数有上限，生产过快时 submit 阻塞，内存不会随视频长度增长。
+支持 png（压缩等级）、jpg（质量）、webp（质量或无损）。
+
+parallel export of video frames as images.
+save_images used to call imageio.imsave frame by frame on the main thread, only after video encoding finished.
+here a thread pool encodes and writes with opencv, which releases the GIL, so that it runs concurrently
+with ffmpeg encoding of StreamingVideoWriter. num of pending frames is bounded, submit blocks when producing too fast,
+memory does not grow with video length. supports png (compression level), jpg (quality), webp (quality or lossless).
+
+usage:
+    with FrameImageExporter("frames_dir", image_type="jpg", quality=90) as exporter:
+        for i, frame in enumerate(frames):  # h w c, uint8, rgb
+            exporter.submit(i, frame)
+"""
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import List, Literal
+import os
+import threading
+import logging
+
+import cv2
+import numpy as np
+
+
+logger = logging.getLogger(__name__)
+
+# 各格式 quality 为 None 时的默认值. default quality of every format when quality is None
+DEFAULT_QUALITY = {
+    "png": 3,
+    "jpg": 95,
+    "webp": None,
+}
+
+
+def get_imwrite_params(
+    image_type: Literal["png", "jpg", "webp"], quality: int = None
+) -> List[int]:
+    """
+    Args:
+        image_type (Literal["png", "jpg", "webp"]): image format.
+        quality (int, optional): png compression level 0-9, jpg quality 0-100, webp quality 1-100,
+            None means default of format, webp default is lossless. Defaults to None.
+
+    Returns:
+        List[int]: params of cv2.imwrite.
+    """
+    if image_type not in DEFAULT_QUALITY:
+        raise ValueError(
+            f"image_type should be one of {list(DEFAULT_QUALITY.keys())}, but given {image_type}"
+        )
+    if quality is None:
+        quality = DEFAULT_QUALITY[image_type]
+    if image_type == "png":
+        return [cv2.IMWRITE_PNG_COMPRESSION, int(quality)]
+    if image_type == "jpg":
+        return [cv2.IMWRITE_JPEG_QUALITY, int(quality)]
+    # opencv 中 webp 质量大于 100 表示无损. webp quality above 100 means lossless in opencv
+    return [cv2.IMWRITE_WEBP_QUALITY, 101 if quality is None else int(quality)]
+
+
+class FrameImageExporter(object):
+    def __init__(
+        self,
+        path: str,
+        image_type: Literal["png", "jpg", "webp"] = "png",
+        quality: int = None,
+        num_workers: int = 4,
+        max_pending: int = None,
+    ) -> None:
+        """
+        Args:
+            path (str): image directory path, images are named as {index:04d}.{image_type}.
+            image_type (Literal["png", "jpg", "webp"], optional): Defaults to "png".
+            quality (int, optional): see get_imwrite_params. Defaults to None.
+            num_workers (int, optional): num of threads, 0 means write synchronously in caller thread. Defaults to 4.
+            max_pending (int, optional): max num of frames submitted but not written, None means 2 * num_workers.
+                Defaults to None.
+        """
+        if num_workers < 0:
+            raise ValueError(f"num_workers should be >= 0, but given {num_workers}")
+        self.path = path
+        self.image_type = image_type
+        self.params = get_imwrite_params(image_type, quality)
+        self.num_workers = num_workers
+        if max_pending is None:
+            max_pending = 2 * max(num_workers, 1)
+        self.pending = threading.BoundedSemaphore(max_pending)
+        self.executor = (
+            ThreadPoolExecutor(
+                max_workers=num_workers, thread_name_prefix="musev_frame_exporter"
+            )
+            if num_workers > 0
+            else None
+        )
+        self.futures: List[Future] = []
+        self.n_frames = 0
+        os.makedirs(path, exist_ok=True)
+
+    def _write(self, index: int, frame: np.ndarray) -> None:
+        path = os.path.join(self.path, f"{index:04d}.{self.image_type}")
+        # opencv 使用 bgr. opencv uses bgr
+        if frame.ndim == 3 and frame.shape[-1] == 3:
+            frame = cv2.cvtColor(frame, cv2.COLOR_RGB2BGR)
+        if not cv2.imwrite(path, frame, self.params):
+            raise RuntimeError(f"failed to write {path}")
+
+    def _write_and_release(self, index: int, frame: np.ndarray) -> None:
+        try:
+            self._write(index, frame)
+        finally:
+            self.pending.release()
+
+    def submit(self, index: int, frame: np.ndarray) -> None:
+        """提交一帧，h w c，uint8，rgb，提交后不应再修改 frame
+        submit one frame, h w c, uint8, rgb, frame should not be modified after submitted.
+        """
+        if frame.dtype != np.uint8:
+            raise ValueError(f"frame should be uint8, but given {frame.dtype}")
+        self.n_frames += 1
+        if self.executor is None:
+            self._write(index, frame)
+            return
+        # 先检查已完成的失败任务，尽早报错. check finished failed tasks to raise early
+        if self.futures and self.futures[0].done():
+            self._collect(wait=False)
+        self.pending.acquire()
+        self.futures.append(
+            self.executor.submit(
+                self._write_and_release, index, np.ascontiguousarray(frame)
+            )
+        )
+
+    def _collect(self, wait: bool) -> None:
+        futures = []
+        for future in self.futures:
+            if wait or future.done():
+                future.result()
+            else:
+                futures.append(future)
+        self.futures = futures
+
+    def close(self) -> None:
+        if self.executor is None:
+            return
+        try:
+            self._collect(wait=True)
+        finally:
+            self.executor.shutdown(wait=True)
+            self.executor = None
+        logger.debug(f"FrameImageExporter, write {self.n_frames} frames to {self.path}")
+
+    def __enter__(self) -> "FrameImageExporter":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> bool:
+        if exc_type is None:
+            self.close()
+        elif self.executor is not None:
+            # 出错时取消未开始的任务，不覆盖原始异常. cancel pending tasks on error, do not shadow original exception
+            self.executor.shutdown(wait=True, cancel_futures=True)
+            self.executor = None
+        return False
@@ -16,6 +16,11 @@ from .convert_from_ckpt import (
     convert_ldm_clip_checkpoint,
 )
 from .convert_lora_safetensor_to_diffusers import convert_motion_lora_ckpt_to_diffusers
+from ..models.quantization import (
+    add_layer_weight_delta,
+    is_lora_factor_layer,
+    remove_layer_lora,
+)
 
 logger = logging.getLogger(__name__)
 
@@ -237,19 +242,34 @@ def update_pipeline_lora_model(
                 weight_scale = state_dict[alpha_key].item() / weight_up.shape[1]
             else:
                 weight_scale = 1.0
-            adding_weight = alpha * weight_scale * torch.mm(weight_up, weight_down)
-        adding_weight = adding_weight.to(torch.float16)
+            if is_lora_factor_layer(curr_layer):
+                # 量化层以低秩因子保存 lora，不构造稠密 delta
+                # quantized layer keeps lora as low-rank factors, no dense delta is built
+                adding_weight = None
+                weight_up = alpha * weight_scale * weight_up
+            else:
+                adding_weight = alpha * weight_scale * torch.mm(weight_up, weight_down)
+        block_weight = 1.0
         if lora_block_weight:
             if "text" in key:
-                adding_weight *= lora_block_weight[0]
+                block_weight = lora_block_weight[0]
             else:
                 for idx, layer in enumerate(lora_unet_layers):
                     if layer in key:
-                        adding_weight *= lora_block_weight[idx + 1]
+                        block_weight = lora_block_weight[idx + 1]
                         break
 
-        curr_layer_unload_data = {"layer": curr_layer, "added_weight": adding_weight}
-        curr_layer.weight.data += adding_weight
+        if adding_weight is None:
+            lora_key = curr_layer.add_lora(weight_up * block_weight, weight_down)
+            curr_layer_unload_data = {"layer": curr_layer, "lora_key": lora_key}
+        else:
+            adding_weight = adding_weight.to(torch.float16)
+            adding_weight *= block_weight
+            curr_layer_unload_data = {
+                "layer": curr_layer,
+                "added_weight": adding_weight,
+            }
+            add_layer_weight_delta(curr_layer, adding_weight)
 
         unload_dict.append(curr_layer_unload_data)
         # update visited list
@@ -386,7 +406,7 @@ def update_pipeline_lora_model_old(
                         break
 
         curr_layer_unload_data = {"layer": curr_layer, "added_weight": adding_weight}
-        curr_layer.weight.data += adding_weight
+        add_layer_weight_delta(curr_layer, adding_weight)
 
         unload_dict.append(curr_layer_unload_data)
         # update visited list
@@ -467,9 +487,7 @@ def update_pipeline_lora_models(
 
 def unload_lora(unload_dict: List[Dict[str, nn.Module]]):
     for layer_data in unload_dict:
-        layer = layer_data["layer"]
-        added_weight = layer_data["added_weight"]
-        layer.weight.data -= added_weight
+        remove_layer_lora(layer_data)
 
     gc.collect()
     torch.cuda.empty_cache()
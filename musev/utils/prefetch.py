@@ -0,0 +1,100 @@
+"""后台预取。在后台线程中读取并预处理下一批数据，与主线程的去噪计算重叠。
+队列有上限，消费者处理不过来时生产者阻塞（背压），结果按输入顺序交付。
+解码、opencv 缩放、controlnet 检测模型等主要开销都会释放 GIL，因此使用线程而不是进程，
+也避免了在进程间传递 controlnet processor 模型。
+
+background prefetch. read and preprocess next batches in a background thread, overlapping with denoising
+in the main thread. the queue is bounded, producer blocks when consumer falls behind (back-pressure),
+results are delivered in input order. decoding, opencv resizing and controlnet detector models release the GIL,
+so a thread is used instead of a process, which also avoids passing controlnet processor models across processes.
+"""
+from queue import Empty, Full, Queue
+from typing import Any, Callable, Iterable, Iterator
+import threading
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+_END = object()
+
+
+class BackgroundPrefetcher(object):
+    def __init__(
+        self,
+        iterable: Iterable,
+        fn: Callable[[int, Any], Any] = None,
+        max_prefetch: int = 1,
+        name: str = "musev_prefetch",
+    ) -> None:
+        """在后台线程中迭代 iterable 并对每个元素执行 fn(index, item)
+        iterate iterable and run fn(index, item) on every item in a background thread.
+
+        Args:
+            iterable (Iterable): input, such as DecordVideoDataset, iterated in background thread.
+            fn (Callable[[int, Any], Any], optional): preprocess function, None means yield items directly. Defaults to None.
+            max_prefetch (int, optional): max num of prepared items waiting in queue, 0 means run synchronously in caller thread. Defaults to 1.
+            name (str, optional): name of background thread. Defaults to "musev_prefetch".
+        """
+        if max_prefetch < 0:
+            raise ValueError(f"max_prefetch should be >= 0, but given {max_prefetch}")
+        self.iterable = iterable
+        self.fn = fn
+        self.max_prefetch = max_prefetch
+        self.name = name
+
+    def _process(self, index: int, item: Any) -> Any:
+        if self.fn is None:
+            return item
+        return self.fn(index, item)
+
+    def __iter__(self) -> Iterator:
+        if self.max_prefetch == 0:
+            for index, item in enumerate(self.iterable):
+                yield self._process(index, item)
+            return
+
+        queue = Queue(maxsize=self.max_prefetch)
+        stop = threading.Event()
+
+        def put(value) -> bool:
+            # 定时检查 stop，消费者提前退出时生产者不会永久阻塞
+            # check stop periodically, so that producer is not blocked forever when consumer exits early
+            while not stop.is_set():
+                try:
+                    queue.put(value, timeout=0.1)
+                    return True
+                except Full:
+                    continue
+            return False
+
+        def produce() -> None:
+            try:
+                for index, item in enumerate(self.iterable):
+                    if stop.is_set():
+                        return
+                    if not put((self._process(index, item), None)):
+                        return
+            except BaseException as e:
+                put((None, e))
+                return
+            put((_END, None))
+
+        thread = threading.Thread(target=produce, name=self.name, daemon=True)
+        thread.start()
+        try:
+            while True:
+                try:
+                    value, error = queue.get(timeout=1.0)
+                except Empty:
+                    if not thread.is_alive() and queue.empty():
+                        raise RuntimeError(f"{self.name} thread exited unexpectedly")
+                    continue
+                if error is not None:
+                    raise error
+                if value is _END:
+                    break
+                yield value
+        finally:
+            stop.set()
+            thread.join()
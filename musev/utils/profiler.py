@@ -0,0 +1,222 @@
+"""推理各阶段耗时与显存的结构化记录，输出 json 汇总与 chrome trace（chrome://tracing 或 perfetto 打开）。
+未启用时使用 NULL_PROFILER，record 返回共享的空上下文，开销接近 0。
+
+structured profiler of wall time and memory of inference stages, output json summary and chrome trace
+(open with chrome://tracing or perfetto). NULL_PROFILER is used when disabled, record returns a shared empty context,
+overhead is close to zero.
+"""
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Dict, List, Sequence
+import json
+import os
+import threading
+import time
+import logging
+
+import torch
+from torch import nn
+
+
+logger = logging.getLogger(__name__)
+
+
+class _NullContext(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+_NULL_CONTEXT = _NullContext()
+
+
+class NullProfiler(object):
+    """未启用时的 profiler，所有接口为空操作, profiler when disabled, all interfaces are no-op."""
+
+    enabled = False
+    unet_block_hooks = False
+
+    def record(self, name: str, category: str = "stage", **kwargs):
+        return _NULL_CONTEXT
+
+    def register_module_hooks(self, *args, **kwargs) -> None:
+        pass
+
+    def remove_hooks(self) -> None:
+        pass
+
+
+NULL_PROFILER = NullProfiler()
+
+
+class PipelineProfiler(object):
+    """记录每个阶段的开始时间、耗时与可选的显存峰值
+    record start time, duration and optional peak memory of every stage.
+
+    Args:
+        record_memory (bool, optional): record peak cuda memory of every stage, peak of nested stage is counted from start of outermost stage.
+            peak memory is process-wide, so it is only reset and recorded on the thread which creates the profiler,
+            stages of other threads such as background prefetch only record time. Defaults to False.
+        cuda_sync (bool, optional): synchronize cuda at the end of every stage, to get actual gpu time instead of launch time. Defaults to True.
+        unet_block_hooks (bool, optional): pipeline registers hooks to record every down/mid/up block of unet. Defaults to False.
+    """
+
+    enabled = True
+
+    def __init__(
+        self,
+        record_memory: bool = False,
+        cuda_sync: bool = True,
+        unet_block_hooks: bool = False,
+    ) -> None:
+        self.record_memory = record_memory and torch.cuda.is_available()
+        self.cuda_sync = cuda_sync and torch.cuda.is_available()
+        self.unet_block_hooks = unet_block_hooks
+        self.events = []
+        self._hooks = []
+        # 嵌套深度按线程记录，后台预取线程的阶段不影响主线程. nesting depth per thread, stages of prefetch thread do not affect main thread
+        self._local = threading.local()
+        self._owner_thread = threading.get_ident()
+        self._t0 = time.perf_counter()
+
+    def _now_us(self) -> float:
+        return (time.perf_counter() - self._t0) * 1e6
+
+    def _is_owner_thread(self) -> bool:
+        return threading.get_ident() == self._owner_thread
+
+    def _begin(self) -> float:
+        if self.cuda_sync:
+            torch.cuda.synchronize()
+        depth = getattr(self._local, "depth", 0)
+        # 嵌套阶段不重置峰值，内层阶段的峰值从最外层阶段开始统计；
+        # 峰值是进程级的，只在创建 profiler 的线程上重置，避免预取线程在主线程阶段中途重置
+        # nested stages do not reset peak, peak of inner stage is counted from start of outermost stage;
+        # peak is process-wide, only reset on the thread creating profiler, so that prefetch thread does not reset it
+        # in the middle of stages of main thread
+        if self.record_memory and depth == 0 and self._is_owner_thread():
+            torch.cuda.reset_peak_memory_stats()
+        self._local.depth = depth + 1
+        return self._now_us()
+
+    def _end(self, name: str, category: str, start: float, args: Dict) -> None:
+        if self.cuda_sync:
+            torch.cuda.synchronize()
+        end = self._now_us()
+        self._local.depth -= 1
+        event = {
+            "name": name,
+            "cat": category,
+            "ts": start,
+            "dur": end - start,
+            "tid": threading.get_ident(),
+            "args": args,
+        }
+        if self.record_memory and self._is_owner_thread():
+            event["args"]["peak_memory_mb"] = torch.cuda.max_memory_allocated() / 2**20
+        self.events.append(event)
+
+    @contextmanager
+    def record(self, name: str, category: str = "stage", **kwargs):
+        """记录一个阶段，kwargs 作为附加信息，如 step. record a stage, kwargs are extra info such as step."""
+        start = self._begin()
+        try:
+            yield self
+        finally:
+            self._end(name, category, start, kwargs)
+
+    def register_module_hooks(
+        self,
+        model: nn.Module,
+        prefixes: Sequence[str] = ("down_blocks.", "mid_block", "up_blocks."),
+        category: str = "unet_block",
+    ) -> None:
+        """给 model 中名字以 prefixes 开头的直接子 block 注册 hook，记录每个 block 的耗时
+        register hooks to direct sub blocks whose names start with prefixes, to record time of every block.
+        """
+
+        def is_block(name: str) -> bool:
+            # 只记录 down_blocks.0 这一级, only record level like down_blocks.0
+            for prefix in prefixes:
+                if name == prefix:
+                    return True
+                if (
+                    prefix.endswith(".")
+                    and name.startswith(prefix)
+                    and "." not in name[len(prefix) :]
+                ):
+                    return True
+            return False
+
+        for name, module in model.named_modules():
+            if not is_block(name):
+                continue
+            starts = []
+
+            def pre_hook(module, args, starts=starts):
+                starts.append(self._begin())
+
+            def hook(module, args, output, name=name, starts=starts):
+                self._end(name, category, starts.pop(), {})
+
+            self._hooks.append(module.register_forward_pre_hook(pre_hook))
+            self._hooks.append(module.register_forward_hook(hook))
+
+    def remove_hooks(self) -> None:
+        for hook in self._hooks:
+            hook.remove()
+        self._hooks = []
+
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        """按阶段名汇总 count、total_ms、mean_ms、max_ms 与 peak_memory_mb
+        summarize count, total_ms, mean_ms, max_ms and peak_memory_mb by stage name.
+        """
+        summary = OrderedDict()
+        for event in self.events:
+            item = summary.setdefault(
+                event["name"],
+                {"category": event["cat"], "count": 0, "total_ms": 0.0, "max_ms": 0.0},
+            )
+            dur_ms = event["dur"] / 1000
+            item["count"] += 1
+            item["total_ms"] += dur_ms
+            item["max_ms"] = max(item["max_ms"], dur_ms)
+            if "peak_memory_mb" in event["args"]:
+                item["peak_memory_mb"] = max(
+                    item.get("peak_memory_mb", 0.0), event["args"]["peak_memory_mb"]
+                )
+        for item in summary.values():
+            item["mean_ms"] = item["total_ms"] / item["count"]
+        return summary
+
+    def chrome_trace(self) -> Dict[str, List[Dict]]:
+        return {
+            "traceEvents": [
+                {
+                    "name": event["name"],
+                    "cat": event["cat"],
+                    "ph": "X",
+                    "ts": event["ts"],
+                    "dur": event["dur"],
+                    "pid": os.getpid(),
+                    "tid": event["tid"],
+                    "args": event["args"],
+                }
+                for event in self.events
+            ]
+        }
+
+    def save(self, path: str) -> None:
+        """保存 {path}.json 汇总与 {path}.trace.json chrome trace
+        save summary to {path}.json and chrome trace to {path}.trace.json.
+        """
+        dirname = os.path.dirname(path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        with open(f"{path}.json", "w") as f:
+            json.dump(self.summary(), f, indent=4)
+        with open(f"{path}.trace.json", "w") as f:
+            json.dump(self.chrome_trace(), f)
+        logger.info(f"save profile to {path}.json, {path}.trace.json")
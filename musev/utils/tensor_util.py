@@ -1,3 +1,5 @@
+from typing import Union
+
 import torch
 import numpy as np
 
@@ -11,24 +13,89 @@ def generate_meshgrid_2d(h: int, w: int, device) -> torch.tensor:
 
 
 def his_match(src, dst):
-    src = src * 255.0
-    dst = dst * 255.0
-    src = src.astype(np.uint8)
-    dst = dst.astype(np.uint8)
-    res = np.zeros_like(dst)
-
-    cdf_src = np.zeros((3, 256))
-    cdf_dst = np.zeros((3, 256))
-    cdf_res = np.zeros((3, 256))
-    kw = dict(bins=256, range=(0, 256), density=True)
-    for ch in range(3):
-        his_src, _ = np.histogram(src[:, :, ch], **kw)
-        hist_dst, _ = np.histogram(dst[:, :, ch], **kw)
-        cdf_src[ch] = np.cumsum(his_src)
-        cdf_dst[ch] = np.cumsum(hist_dst)
-        index = np.searchsorted(cdf_src[ch], cdf_dst[ch], side="left")
-        np.clip(index, 0, 255, out=index)
-        res[:, :, ch] = index[dst[:, :, ch]]
-        his_res, _ = np.histogram(res[:, :, ch], **kw)
-        cdf_res[ch] = np.cumsum(his_res)
-    return res / 255.0
+    """将 dst 的直方图匹配到 src，h w c，值范围[0-1]
+    match histogram of dst to src, h w c, value in [0, 1].
+    """
+    res = hist_match_video_bcthw(
+        dst.transpose(2, 0, 1)[None, :, None],
+        src.transpose(2, 0, 1)[None, :, None],
+        value=255.0,
+    )
+    return res[0, :, 0].transpose(1, 2, 0)
+
+
+def _quantize(x: torch.Tensor, value: float, n_bins: int) -> torch.Tensor:
+    # 与 astype(np.uint8) 一样向零截断. truncate toward zero like astype(np.uint8)
+    return (x * value).clamp_(0, n_bins - 1).to(torch.long)
+
+
+def channel_cdf(levels: torch.Tensor, n_bins: int = 256) -> torch.Tensor:
+    """用一次 bincount 计算所有前导维度的归一化累积直方图
+    compute normalized cumulative histograms of all leading dims with a single bincount.
+
+    Args:
+        levels (torch.Tensor): long, (..., n), values in [0, n_bins).
+        n_bins (int, optional): Defaults to 256.
+
+    Returns:
+        torch.Tensor: float, (..., n_bins).
+    """
+    lead_shape = levels.shape[:-1]
+    n_groups = int(np.prod(lead_shape))
+    offset = torch.arange(n_groups, device=levels.device).view(*lead_shape, 1) * n_bins
+    hist = torch.bincount(
+        (levels + offset).flatten(), minlength=n_groups * n_bins
+    ).view(*lead_shape, n_bins)
+    return hist.cumsum(dim=-1).to(torch.float32) / levels.shape[-1]
+
+
+def hist_match_video_bcthw(
+    video: Union[torch.Tensor, np.ndarray],
+    target: Union[torch.Tensor, np.ndarray],
+    value: float = 255.0,
+    n_bins: int = 256,
+    chunk_size: int = 32,
+) -> Union[torch.Tensor, np.ndarray]:
+    """在 video 所在设备上，将每一帧每个通道的直方图匹配到 target，所有帧的累积直方图用 bincount 批量计算，
+    得到每帧每通道 n_bins 项的查找表，再用 gather 映射，不需要逐帧逐通道的 numpy 直方图与拷回主机。
+    match histogram of every channel of every frame to target on the device of video. cdfs of all frames are
+    computed in batch with bincount into lookup tables of n_bins entries per frame and channel, then mapped with gather,
+    without numpy histogram per frame and channel, nor host round-trip.
+
+    Args:
+        video (Union[torch.Tensor, np.ndarray]): b c t1 h w, value in [0, n_bins / value).
+        target (Union[torch.Tensor, np.ndarray]): b c t2 h w, reference, all t2 frames are pooled, usually t2 = 1.
+        value (float, optional): scale from video to levels. Defaults to 255.0.
+        n_bins (int, optional): num of levels. Defaults to 256.
+        chunk_size (int, optional): num of frames processed at once, to bound memory of long index tensors. Defaults to 32.
+
+    Returns:
+        Union[torch.Tensor, np.ndarray]: matched video, same type, dtype and device as video.
+    """
+    is_numpy = isinstance(video, np.ndarray)
+    if is_numpy:
+        video = torch.from_numpy(video)
+    if isinstance(target, np.ndarray):
+        target = torch.from_numpy(target)
+    b, c, t, h, w = video.shape
+    target_levels = _quantize(target.to(video.device), value, n_bins)
+    # b c n_bins
+    target_cdf = channel_cdf(target_levels.flatten(2), n_bins)
+
+    output = torch.empty_like(video)
+    for start in range(0, t, chunk_size):
+        end = min(start + chunk_size, t)
+        # b c t (h w)
+        levels = _quantize(video[:, :, start:end], value, n_bins).flatten(3)
+        cdf = channel_cdf(levels, n_bins)
+        # 每帧每通道的查找表 b c t n_bins. lookup table of every frame and channel
+        lut = torch.searchsorted(
+            target_cdf[:, :, None].expand_as(cdf).contiguous(), cdf
+        ).clamp_(max=n_bins - 1)
+        matched = torch.gather(lut, -1, levels)
+        output[:, :, start:end] = (matched.to(video.dtype) / value).view(
+            b, c, end - start, h, w
+        )
+    if is_numpy:
+        output = output.numpy()
+    return output
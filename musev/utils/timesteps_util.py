@@ -59,3 +59,54 @@ def generate_three_stages_parameters(start, stop, num):
     num_end = num - num_start - num_middle
     parames = [start] * num_start + [middle] * num_middle + [stop] * num_end
     return parames
+
+
+def generate_guidance_execution_with_timesteps(
+    num: int,
+    method: Literal["always", "truncate", "reuse_uncond"] = "always",
+    truncate_ratio: float = 1.0,
+    uncond_reuse_steps: int = 0,
+) -> List[Literal["full", "cond", "reuse"]]:
+    """为每个timestep生成 classifier-free guidance 的执行方式，用于减少 uncond 分支的unet计算量。
+    generate how to run classifier-free guidance for every timestep, to reduce unet compute of uncond branch.
+
+    full: 计算 uncond 与 cond，compute both uncond and cond.
+    cond: 仅计算 cond，不做guidance，compute only cond, and skip guidance.
+    reuse: 仅计算 cond，复用最近一次 full step 的 uncond，compute only cond, and reuse uncond of last full step.
+
+    Args:
+        num (int): num of timesteps.
+        method (Literal["always", "truncate", "reuse_uncond"], optional):
+            always: every step is full.
+            truncate: the first `truncate_ratio` steps are full, the rest are cond.
+            reuse_uncond: every full step is followed by `uncond_reuse_steps` reuse steps.
+            Defaults to "always".
+        truncate_ratio (float, optional): ratio of full steps in truncate. Defaults to 1.0.
+        uncond_reuse_steps (int, optional): num of reuse steps after full step in reuse_uncond. Defaults to 0.
+
+    Returns:
+        List[Literal["full", "cond", "reuse"]]: execution mode of every timestep.
+    """
+    if method == "always":
+        modes = ["full"] * num
+    elif method == "truncate":
+        if not 0 <= truncate_ratio <= 1:
+            raise ValueError(
+                f"truncate_ratio should be in [0, 1], but given {truncate_ratio}"
+            )
+        num_full = int(np.ceil(num * truncate_ratio))
+        modes = ["full"] * num_full + ["cond"] * (num - num_full)
+    elif method == "reuse_uncond":
+        if uncond_reuse_steps < 0:
+            raise ValueError(
+                f"uncond_reuse_steps should be >= 0, but given {uncond_reuse_steps}"
+            )
+        modes = [
+            "full" if i % (uncond_reuse_steps + 1) == 0 else "reuse"
+            for i in range(num)
+        ]
+    else:
+        raise ValueError(
+            f"now only support always, truncate, reuse_uncond, but given {method}"
+        )
+    return modes
@@ -1,4 +1,6 @@
 import os
+import contextlib
+import functools
 import imageio
 import numpy as np
 from typing import Literal, Union, List, Dict, Tuple
@@ -9,23 +11,35 @@ import cv2
 from PIL import Image
 
 from tqdm import tqdm
-from einops import rearrange
+from einops import parse_shape, rearrange
 import webp
-import subprocess
 
 from .. import logger
+from .frame_exporter import FrameImageExporter
+from .video_writer import StreamingVideoWriter
 
 
-def save_videos_to_images(videos: np.array, path: str, image_type="png") -> None:
-    """save video batch to images into image_type
+def save_videos_to_images(
+    videos: np.array,
+    path: str,
+    image_type="png",
+    quality: int = None,
+    num_workers: int = 4,
+) -> None:
+    """save video batch to images into image_type with a thread pool
 
     Args:
         videos (np.array): [h w c]
         path (str): image directory path
+        image_type (str, optional): png, jpg or webp. Defaults to "png".
+        quality (int, optional): png compression level, jpg or webp quality, None means default, webp default is lossless. Defaults to None.
+        num_workers (int, optional): num of export threads, 0 means synchronously. Defaults to 4.
     """
-    os.makedirs(path, exist_ok=True)
-    for i, video in enumerate(videos):
-        imageio.imsave(os.path.join(path, f"{i:04d}.{image_type}"), video)
+    with FrameImageExporter(
+        path, image_type=image_type, quality=quality, num_workers=num_workers
+    ) as exporter:
+        for i, video in enumerate(videos):
+            exporter.submit(i, video)
 
 
 def save_videos_grid(
@@ -75,6 +89,159 @@ def save_videos_grid(
         imageio.mimsave(path, outputs, **params)
 
 
+@functools.lru_cache(maxsize=256)
+def get_text_sprite(
+    text: str,
+    org: Tuple[int, int],
+    height: int,
+    width: int,
+    font_size: float,
+    font_thickness: int,
+) -> Tuple[np.ndarray, int, int]:
+    """将文字用 opencv 渲染一次，缓存为掩码精灵图，之后对所有帧、所有子视频直接混合，不再逐帧 putText
+    render text once with opencv and cache it as mask sprite, then blend it into all frames and sub videos
+    instead of calling putText per frame.
+
+    Args:
+        text (str): text.
+        org (Tuple[int, int]): bottom-left corner of text in tile, same as cv2.putText.
+        height (int): tile height, text is clipped by tile like cv2.putText.
+        width (int): tile width.
+        font_size (float): font scale of cv2.FONT_HERSHEY_SIMPLEX.
+        font_thickness (int): font thickness.
+
+    Returns:
+        Tuple[np.ndarray, int, int]: bool mask of text pixels, top and left of mask in tile. mask is shared by cache,
+            should not be modified.
+    """
+    canvas = np.zeros((height, width), dtype=np.uint8)
+    cv2.putText(
+        canvas,
+        text,
+        org,
+        cv2.FONT_HERSHEY_SIMPLEX,
+        fontScale=font_size,
+        color=255,
+        thickness=font_thickness,
+    )
+    ys, xs = np.nonzero(canvas)
+    if len(ys) == 0:
+        return np.zeros((0, 0), dtype=bool), 0, 0
+    top, bottom, left, right = ys.min(), ys.max() + 1, xs.min(), xs.max() + 1
+    return canvas[top:bottom, left:right] > 0, int(top), int(left)
+
+
+def blend_text_sprite(
+    frames: Union[torch.Tensor, np.ndarray],
+    text: str,
+    org: Tuple[int, int],
+    font_size: float,
+    font_thickness: int,
+    font_color: Tuple[int],
+    y: int = 0,
+    x: int = 0,
+    height: int = None,
+    width: int = None,
+) -> None:
+    """将缓存的文字精灵图原地混合进 frames 中以 (y, x) 为左上角的 tile
+    blend cached text sprite into tile of frames with top-left (y, x) in place.
+
+    Args:
+        frames (Union[torch.Tensor, np.ndarray]): uint8, t h w c or h w c.
+        text (str): text.
+        org (Tuple[int, int]): bottom-left corner of text in tile, same as cv2.putText.
+        font_size (float): font scale.
+        font_thickness (int): font thickness.
+        font_color (Tuple[int]): text color.
+        y (int, optional): top of tile in frames. Defaults to 0.
+        x (int, optional): left of tile in frames. Defaults to 0.
+        height (int, optional): tile height, None means frame height. Defaults to None.
+        width (int, optional): tile width, None means frame width. Defaults to None.
+    """
+    frame_h, frame_w, c = frames.shape[-3:]
+    height = frame_h if height is None else height
+    width = frame_w if width is None else width
+    mask, top, left = get_text_sprite(
+        text, tuple(org), height, width, font_size, font_thickness
+    )
+    if mask.size == 0:
+        return
+    mask_h, mask_w = mask.shape
+    region = frames[
+        ..., y + top : y + top + mask_h, x + left : x + left + mask_w, :
+    ]
+    color = font_color[:c] if c < len(font_color) else font_color
+    if isinstance(frames, torch.Tensor):
+        mask = torch.from_numpy(mask).to(frames.device)
+        color = torch.tensor(color, dtype=frames.dtype, device=frames.device)
+    region[..., mask, :] = color
+
+
+def make_video_grid(
+    videos: Union[torch.Tensor, np.ndarray],
+    nrows: int,
+    texts: List[str] = None,
+    rescale: bool = False,
+    font_size: float = 0.05,
+    font_thickness: int = 1,
+    font_color: Tuple[int] = (255, 0, 0),
+    tensor_order: str = "t b c h w",
+    write_info: bool = False,
+) -> torch.Tensor:
+    """在输入所在设备上用 torch 一次性生成所有帧的 grid，只有一次 reshape 与 transpose，文字以缓存的精灵图混合
+    make grids of all frames at once with torch on source device, with a single reshape and transpose,
+    texts are blended as cached sprites.
+
+    Args:
+        videos (Union[torch.Tensor, np.ndarray]): 5 dim tensor, like t b c h w, value in [0, 1], or uint8.
+        nrows (int): how many rows in the grid.
+        texts (List[str], optional): text of every b, written at top left of its tile. Defaults to None.
+        rescale (bool, optional): whether rescale [0,1] from [-1, 1]. Defaults to False.
+        font_size (float, optional): font size. Defaults to 0.05.
+        font_thickness (int, optional): font_thickness. Defaults to 1.
+        font_color (Tuple[int], optional): text color. Defaults to (255, 0, 0).
+        tensor_order (str, optional): videos channel order. Defaults to "t b c h w".
+        write_info (bool, optional): whether write text into video. Defaults to False.
+
+    Returns:
+        torch.Tensor: uint8, t h w c, on the same device as videos.
+    """
+    if isinstance(videos, np.ndarray):
+        videos = torch.from_numpy(videos)
+    videos = rearrange(videos, f"{tensor_order} -> t b h w c")
+    t, b, h, w, c = videos.shape
+    ncols = int(np.ceil(b / nrows))
+    if videos.dtype != torch.uint8:
+        if rescale:
+            videos = (videos + 1.0) / 2.0  # -1,1 -> 0,1
+        videos = (videos * 255).clamp_(0, 255).to(torch.uint8)
+    n_pad = nrows * ncols - b
+    if n_pad > 0:
+        videos = torch.cat([videos, videos.new_zeros((t, n_pad, h, w, c))], dim=1)
+    # t (nrows ncols) h w c -> t (nrows h) (ncols w) c
+    grid = (
+        videos.reshape(t, nrows, ncols, h, w, c)
+        .permute(0, 1, 3, 2, 4, 5)
+        .reshape(t, nrows * h, ncols * w, c)
+    )
+    if texts is not None and write_info:
+        for i, text in enumerate(texts[:b]):
+            i_row, i_col = i // ncols, i % ncols
+            blend_text_sprite(
+                grid,
+                text,
+                (5, 20),
+                font_size,
+                font_thickness,
+                font_color,
+                y=i_row * h,
+                x=i_col * w,
+                height=h,
+                width=w,
+            )
+    return grid
+
+
 def make_grid_with_opencv(
     batch: Union[torch.Tensor, np.ndarray],
     nrows: int,
@@ -86,7 +253,7 @@ def make_grid_with_opencv(
     tensor_order: str = "b c h w",
     write_info: bool = False,
 ) -> np.ndarray:
-    """read tensor batch and make a grid with opencv
+    """read tensor batch and make a grid, single frame version of make_video_grid
 
     Args:
         batch (Union[torch.Tensor, np.ndarray]): 4 dim tensor, like b c h w
@@ -102,34 +269,18 @@ def make_grid_with_opencv(
     Returns:
         np.ndarray: h w c
     """
-    if isinstance(batch, torch.Tensor):
-        batch = batch.cpu().numpy()
-    # batch: (B, C, H, W)
-    batch = rearrange(batch, f"{tensor_order} -> b h w c")
-    b, h, w, c = batch.shape
-    ncols = int(np.ceil(b / nrows))
-    grid = np.zeros((h * nrows, w * ncols, c), dtype=np.uint8)
-    font = cv2.FONT_HERSHEY_SIMPLEX
-    for i, x in enumerate(batch):
-        i_row, i_col = i // ncols, i % ncols
-        if rescale:
-            x = (x + 1.0) / 2.0  # -1,1 -> 0,1
-        x = (x * 255).astype(np.uint8)
-        # 没有这行会报错
-        # ref: https://stackoverflow.com/questions/72327137/opencv4-5-5-error-5bad-argument-in-function-puttext
-        x = x.copy()
-        if texts is not None and write_info:
-            x = cv2.putText(
-                x,
-                texts[i],
-                (5, 20),
-                font,
-                fontScale=font_size,
-                color=font_color,
-                thickness=font_thickness,
-            )
-        grid[i_row * h : (i_row + 1) * h, i_col * w : (i_col + 1) * w, :] = x
-    return grid
+    grid = make_video_grid(
+        batch[None],
+        nrows,
+        texts=texts,
+        rescale=rescale,
+        font_size=font_size,
+        font_thickness=font_thickness,
+        font_color=font_color,
+        tensor_order=f"t {tensor_order}",
+        write_info=write_info,
+    )
+    return grid[0].cpu().numpy()
 
 
 def save_videos_grid_with_opencv(
@@ -148,6 +299,14 @@ def save_videos_grid_with_opencv(
     write_info: bool = False,
     save_filetype: Literal["gif", "mp4", "webp"] = "mp4",
     save_images: bool = False,
+    save_images_type: Literal["png", "jpg", "webp"] = "png",
+    save_images_quality: int = None,
+    save_images_num_workers: int = 4,
+    codec: str = None,
+    crf: int = 18,
+    preset: str = "medium",
+    threads: int = 0,
+    grid_chunk_size: int = 16,
 ) -> None:
     """存储tensor视频为gif、mp4等
 
@@ -165,14 +324,24 @@ def save_videos_grid_with_opencv(
         batch_dim (int, optional): 有时候b特别大，这时候一个视频就太大了，就可以分成几个视频存储. Defaults to 0.
         split_size_or_sections (int, optional): 不为None时，与batch_dim配套，一个存储视频最多支持几个子视频。会按照n_cols截断向上取整数. Defaults to None.
         write_info (bool, False): 是否也些提示信息在视频上
+        save_images (bool, optional): 是否同时将每帧存为图片，与视频编码并行. Defaults to False.
+        save_images_type (Literal["png", "jpg", "webp"], optional): 图片格式. Defaults to "png".
+        save_images_quality (int, optional): png 压缩等级，jpg、webp 质量，None 表示格式默认值，webp 默认无损. Defaults to None.
+        save_images_num_workers (int, optional): 图片导出线程数，0 表示同步写入. Defaults to 4.
+        codec (str, optional): ffmpeg 编码器，如 libx264、libx265，None 表示格式默认值. Defaults to None.
+        crf (int, optional): x264/x265/vp9 的 crf. Defaults to 18.
+        preset (str, optional): x264/x265 的 preset. Defaults to "medium".
+        threads (int, optional): 编码线程数，0 表示自动. Defaults to 0.
+        grid_chunk_size (int, optional): 每次生成 grid 的帧数，限制峰值内存. Defaults to 16.
     """
+    if grid_chunk_size < 1:
+        raise ValueError(f"grid_chunk_size should be >= 1, but given {grid_chunk_size}")
     if split_size_or_sections is not None:
         split_size_or_sections = int(np.ceil(split_size_or_sections / n_cols)) * n_cols
         if isinstance(videos, np.ndarray):
             videos = torch.from_numpy(videos)
         # 比np.array_split更适合
         videos_split = torch.split(videos, split_size_or_sections, dim=batch_dim)
-        videos_split = [videos.cpu().numpy() for videos in videos_split]
     else:
         videos_split = [videos]
     n_videos_split = len(videos_split)
@@ -181,82 +350,93 @@ def save_videos_grid_with_opencv(
     os.makedirs(dirname, exist_ok=True)
 
     for i_video, videos in enumerate(videos_split):
-        videos = rearrange(videos, f"{tensor_order} -> t b c h w")
-        outputs = []
-        font = cv2.FONT_HERSHEY_SIMPLEX
-        batch_size = videos.shape[1]
+        batch_size = parse_shape(videos, tensor_order)["b"]
         n_rows = int(np.ceil(batch_size / n_cols))
-        for t, x in enumerate(videos):
-            x = make_grid_with_opencv(
-                x,
-                n_rows,
-                texts,
-                rescale,
-                font_size,
-                font_thickness,
-                font_color,
-                write_info=write_info,
-            )
-            h, w, c = x.shape
-            x = x.copy()
-            if write_info:
-                x = cv2.putText(
-                    x,
-                    str(t),
-                    (5, h - 20),
-                    font,
-                    fontScale=2,
-                    color=font_color,
-                    thickness=font_thickness,
-                )
-            outputs.append(x)
-        logger.debug(f"outputs[0].shape: {outputs[0].shape}")
         # TODO: 有待更新实现方式
         if i_video == 0 and n_videos_split == 1:
             pass
         else:
             path = os.path.join(dirname, "{}_{}{}".format(filename, i_video, ext))
-        if save_filetype == "gif":
-            params = {
-                "duration": int(1000 * 1.0 / fps),
-                "loop": 0,
-            }
-            imageio.mimsave(path, outputs, **params)
-        elif save_filetype == "mp4":
-            params = {
-                "quality": 9,
-                "fps": fps,
-            }
-            imageio.mimsave(path, outputs, **params)
-        elif save_filetype == "webp":
-            outputs = [Image.fromarray(x_tmp) for x_tmp in outputs]
-            webp.save_images(outputs, path, fps=fps, lossless=True)
-        else:
+        if save_filetype not in ["gif", "mp4", "webp"]:
             raise ValueError(f"Unsupported file type: {save_filetype}")
-        if save_images:
-            images_path = os.path.join(dirname, filename)
-            os.makedirs(images_path, exist_ok=True)
-            save_videos_to_images(outputs, images_path)
+        if isinstance(videos, np.ndarray):
+            videos = torch.from_numpy(videos)
+        # 只做维度重排的视图，不拷贝. a view with permuted dims, no copy
+        videos = rearrange(videos, f"{tensor_order} -> t b c h w")
+        n_frames = videos.shape[0]
+        # 在输入设备上按时间分块生成 grid，每块拷回 uint8 结果后流式写出，内存不随视频长度增长
+        # make grids chunk by chunk along time on source device, copy uint8 result back and stream every chunk,
+        # memory does not grow with video length
+        with contextlib.ExitStack() as stack:
+            writer = stack.enter_context(
+                StreamingVideoWriter(
+                    path,
+                    fps=fps,
+                    save_filetype=save_filetype,
+                    codec=codec,
+                    crf=crf,
+                    preset=preset,
+                    threads=threads,
+                )
+            )
+            if save_images:
+                exporter = stack.enter_context(
+                    FrameImageExporter(
+                        os.path.join(dirname, filename),
+                        image_type=save_images_type,
+                        quality=save_images_quality,
+                        num_workers=save_images_num_workers,
+                    )
+                )
+            for start in range(0, n_frames, grid_chunk_size):
+                frames = (
+                    make_video_grid(
+                        videos[start : start + grid_chunk_size],
+                        n_rows,
+                        texts,
+                        rescale,
+                        font_size,
+                        font_thickness,
+                        font_color,
+                        tensor_order="t b c h w",
+                        write_info=write_info,
+                    )
+                    .cpu()
+                    .numpy()
+                )
+                if start == 0:
+                    logger.debug(f"outputs[0].shape: {frames.shape[1:]}")
+                # 逐帧流式写给 ffmpeg，同时由线程池导出图片
+                # stream to ffmpeg frame by frame, images are exported by thread pool concurrently
+                for t, x in enumerate(frames, start=start):
+                    if write_info:
+                        # 帧序号每帧不同，精灵图缓存无法命中，直接 putText
+                        # frame index differs every frame and would miss sprite cache, putText directly
+                        h = x.shape[0]
+                        cv2.putText(
+                            x,
+                            str(t),
+                            (5, h - 20),
+                            cv2.FONT_HERSHEY_SIMPLEX,
+                            fontScale=2,
+                            color=font_color,
+                            thickness=font_thickness,
+                        )
+                    writer.write(x)
+                    if save_images:
+                        exporter.submit(t, x)
 
 
 def export_to_video(videos: torch.Tensor, output_video_path: str, fps=8):
-    tmp_path = output_video_path.replace(".mp4", "_tmp.mp4")
-
     videos = rearrange(videos, "b c t h w -> b t h w c")
     videos = videos.squeeze()
-    videos = (videos * 255).cpu().detach().numpy().astype(np.uint8)  # tensor -> numpy
-    fourcc = cv2.VideoWriter_fourcc(*"mp4v")
-    h, w, _ = videos[0].shape
-    video_writer = cv2.VideoWriter(
-        tmp_path, fourcc, fps=fps, frameSize=(w, h), isColor=True
-    )
-    for i in range(len(videos)):
-        img = cv2.cvtColor(videos[i], cv2.COLOR_RGB2BGR)
-        video_writer.write(img)
-    video_writer.release()  # 要释放video writer，否则无法播放
-    cmd = f"ffmpeg -y -i {tmp_path} -c:v libx264 -c:a aac -strict -2 {output_video_path} -loglevel quiet"
-    subprocess.run(cmd, shell=True)
-    os.remove(tmp_path)
+    # 逐帧转换并直接以 x264 编码，不再先写 mp4v 临时文件再转码
+    # convert and encode with x264 frame by frame, without mp4v temp file and second encode
+    with StreamingVideoWriter(output_video_path, fps=fps, codec="libx264") as writer:
+        for i in range(len(videos)):
+            writer.write(
+                (videos[i] * 255).cpu().detach().numpy().astype(np.uint8)
+            )
 
 
 # DDIM Inversion
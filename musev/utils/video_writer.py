@@ -0,0 +1,300 @@
+"""流式视频写入。逐帧接收 rgb 帧，由后台线程通过管道写给 ffmpeg 子进程编码，
+python 侧只缓存队列中的少量帧，编码与生成帧重叠，内存与单帧大小相关而不是与视频长度相关。
+mp4 支持 x264/x265，webm 支持 vp9，gif、webp 使用同一接口。
+gif 的调色板由 ffmpeg palettegen 生成，需要在 ffmpeg 进程内缓存整个视频，内存随视频长度增长。
+ffmpeg 未编译 libwebp 时，webp 回退到 python webp 包，在 python 侧缓存全部帧后一次写出。
+
+streaming video writer. rgb frames are accepted one by one, a background thread pipes them to an ffmpeg subprocess,
+python side only buffers a few frames in queue, encoding overlaps with producing frames,
+memory depends on frame size instead of video length.
+mp4 supports x264/x265, webm supports vp9, gif and webp share the same interface.
+gif palette is made by ffmpeg palettegen, which buffers the whole clip inside ffmpeg process,
+so its memory grows with video length.
+when ffmpeg is built without libwebp, webp falls back to python webp package, which buffers all frames in python
+and writes them at close.
+
+usage:
+    with StreamingVideoWriter("out.mp4", fps=25, crf=18) as writer:
+        for frame in frames:  # h w c, uint8, rgb
+            writer.write(frame)
+"""
+from functools import lru_cache
+from queue import Queue
+from typing import List, Literal
+import os
+import shutil
+import subprocess
+import threading
+import logging
+
+import numpy as np
+from PIL import Image
+
+
+logger = logging.getLogger(__name__)
+
+_END = object()
+
+# 各格式默认编码器. default codec of every format
+DEFAULT_CODECS = {
+    "mp4": "libx264",
+    "webm": "libvpx-vp9",
+    "gif": "gif",
+    "webp": "libwebp",
+}
+
+
+def get_ffmpeg_exe() -> str:
+    ffmpeg = shutil.which("ffmpeg")
+    if ffmpeg is not None:
+        return ffmpeg
+    try:
+        import imageio_ffmpeg
+
+        return imageio_ffmpeg.get_ffmpeg_exe()
+    except (ImportError, RuntimeError):
+        raise ValueError(
+            "ffmpeg is not found, install ffmpeg or imageio-ffmpeg to use StreamingVideoWriter"
+        )
+
+
+@lru_cache(maxsize=None)
+def ffmpeg_has_encoder(encoder: str) -> bool:
+    """检查 ffmpeg 是否编译了该编码器. check whether ffmpeg is built with the encoder.
+
+    Args:
+        encoder (str): encoder name, such as libwebp, libx265.
+
+    Returns:
+        bool: True if encoder is listed in `ffmpeg -encoders`.
+    """
+    try:
+        output = subprocess.run(
+            [get_ffmpeg_exe(), "-hide_banner", "-encoders"],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            check=True,
+        ).stdout.decode("utf-8", errors="ignore")
+    except (OSError, subprocess.CalledProcessError) as e:
+        logger.warning(f"failed to list ffmpeg encoders, {e}")
+        return False
+    # 每行格式为 " V....D libx264  description". every line is like " V....D libx264  description"
+    return any(
+        len(line.split()) > 1 and line.split()[1] == encoder
+        for line in output.splitlines()
+    )
+
+
+class StreamingVideoWriter(object):
+    def __init__(
+        self,
+        path: str,
+        fps: float = 8,
+        save_filetype: Literal["mp4", "webm", "gif", "webp"] = None,
+        codec: str = None,
+        crf: int = 18,
+        preset: str = "medium",
+        threads: int = 0,
+        pix_fmt: str = "yuv420p",
+        lossless: bool = True,
+        queue_size: int = 2,
+    ) -> None:
+        """
+        Args:
+            path (str): output path.
+            fps (float, optional): Defaults to 8.
+            save_filetype (Literal["mp4", "webm", "gif", "webp"], optional): None means from extension of path. Defaults to None.
+            codec (str, optional): libx264, libx265 for mp4, libvpx-vp9 for webm, None means default of filetype. Defaults to None.
+            crf (int, optional): constant rate factor of x264/x265/vp9, lower is better. Defaults to 18.
+            preset (str, optional): speed preset of x264/x265. Defaults to "medium".
+            threads (int, optional): encoder threads, 0 means auto. Defaults to 0.
+            pix_fmt (str, optional): pixel format of mp4/webm. Defaults to "yuv420p".
+            lossless (bool, optional): lossless webp. Defaults to True.
+            queue_size (int, optional): max num of frames buffered before blocking write. Defaults to 2.
+        """
+        if save_filetype is None:
+            save_filetype = os.path.splitext(path)[1].lstrip(".").lower()
+        if save_filetype not in DEFAULT_CODECS:
+            raise ValueError(
+                f"save_filetype should be one of {list(DEFAULT_CODECS.keys())}, but given {save_filetype}"
+            )
+        self.path = path
+        self.fps = fps
+        self.save_filetype = save_filetype
+        self.codec = codec if codec is not None else DEFAULT_CODECS[save_filetype]
+        self.crf = crf
+        self.preset = preset
+        self.threads = threads
+        self.pix_fmt = pix_fmt
+        self.lossless = lossless
+        self.queue = Queue(maxsize=queue_size)
+        self.process = None
+        self.thread = None
+        self.error = None
+        self.frame_shape = None
+        self.n_frames = 0
+        # ffmpeg 无 libwebp 时回退到 webp 包所缓存的帧. frames buffered for webp package fallback
+        self.webp_frames = None
+
+    def _output_args(self) -> List[str]:
+        if self.save_filetype == "gif":
+            # 调色板在 ffmpeg 内生成，python 侧不缓存全部帧，但 palettegen 会在 ffmpeg 内缓存整个视频
+            # palette is generated inside ffmpeg, python side does not buffer all frames,
+            # but palettegen buffers the whole clip inside ffmpeg
+            return [
+                "-filter_complex",
+                "split[a][b];[a]palettegen[p];[b][p]paletteuse",
+                "-loop",
+                "0",
+            ]
+        if self.save_filetype == "webp":
+            return [
+                "-c:v",
+                self.codec,
+                "-lossless",
+                str(int(self.lossless)),
+                "-loop",
+                "0",
+            ]
+        args = [
+            # yuv420p 需要偶数宽高，奇数时在右下补一行/列
+            # yuv420p needs even size, pad one row/column at bottom right when odd
+            "-vf",
+            "pad=ceil(iw/2)*2:ceil(ih/2)*2",
+            "-c:v",
+            self.codec,
+            "-pix_fmt",
+            self.pix_fmt,
+            "-crf",
+            str(self.crf),
+        ]
+        if self.codec in ["libx264", "libx265"]:
+            args += ["-preset", self.preset]
+        elif self.codec == "libvpx-vp9":
+            # vp9 的 crf 模式需要 b:v 0. crf mode of vp9 needs b:v 0
+            args += ["-b:v", "0", "-row-mt", "1"]
+        if self.save_filetype == "mp4":
+            args += ["-movflags", "+faststart"]
+        return args
+
+    def _start(self, frame: np.ndarray) -> None:
+        h, w, c = frame.shape
+        if c != 3:
+            raise ValueError(f"frame should be h w 3 rgb, but given {frame.shape}")
+        dirname = os.path.dirname(self.path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        self.frame_shape = frame.shape
+        if (
+            self.save_filetype == "webp"
+            and self.codec == "libwebp"
+            and not ffmpeg_has_encoder("libwebp")
+        ):
+            logger.warning(
+                "ffmpeg is built without libwebp, fall back to webp package, all frames are buffered in memory"
+            )
+            self.webp_frames = []
+            return
+        cmd = [
+            get_ffmpeg_exe(),
+            "-y",
+            "-loglevel",
+            "error",
+            "-f",
+            "rawvideo",
+            "-pix_fmt",
+            "rgb24",
+            "-s",
+            f"{w}x{h}",
+            "-r",
+            str(self.fps),
+            "-i",
+            "-",
+            "-threads",
+            str(self.threads),
+            *self._output_args(),
+            self.path,
+        ]
+        logger.debug(f"StreamingVideoWriter, cmd={' '.join(cmd)}")
+        self.process = subprocess.Popen(
+            cmd, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE
+        )
+        self.thread = threading.Thread(
+            target=self._pipe, name="musev_video_writer", daemon=True
+        )
+        self.thread.start()
+
+    def _pipe(self) -> None:
+        try:
+            while True:
+                frame = self.queue.get()
+                if frame is _END:
+                    break
+                self.process.stdin.write(frame.tobytes())
+        except BaseException as e:
+            self.error = e
+            # 继续取走剩余帧，避免 write 永久阻塞. drain remaining frames so that write is not blocked forever
+            while self.queue.get() is not _END:
+                pass
+
+    def write(self, frame: np.ndarray) -> None:
+        """写入一帧，h w c，uint8，rgb. write one frame, h w c, uint8, rgb."""
+        if self.error is not None:
+            raise RuntimeError(f"StreamingVideoWriter failed, {self.error}")
+        if frame.dtype != np.uint8:
+            raise ValueError(f"frame should be uint8, but given {frame.dtype}")
+        if self.frame_shape is None:
+            self._start(frame)
+        elif frame.shape != self.frame_shape:
+            raise ValueError(
+                f"all frames should have shape {self.frame_shape}, but given {frame.shape}"
+            )
+        if self.webp_frames is not None:
+            # 调用方可能复用 frame 的内存，需要拷贝. caller may reuse memory of frame, copy it
+            self.webp_frames.append(Image.fromarray(np.array(frame)))
+        else:
+            self.queue.put(np.ascontiguousarray(frame))
+        self.n_frames += 1
+
+    def close(self) -> None:
+        if self.webp_frames is not None:
+            import webp
+
+            webp.save_images(
+                self.webp_frames, self.path, fps=self.fps, lossless=self.lossless
+            )
+            self.webp_frames = None
+            logger.debug(
+                f"StreamingVideoWriter, write {self.n_frames} frames to {self.path} with webp package"
+            )
+            return
+        if self.process is None:
+            return
+        self.queue.put(_END)
+        self.thread.join()
+        self.process.stdin.close()
+        stderr = self.process.stderr.read().decode("utf-8", errors="ignore")
+        returncode = self.process.wait()
+        self.process = None
+        if self.error is not None or returncode != 0:
+            raise RuntimeError(
+                f"ffmpeg failed to write {self.path}, returncode={returncode}, error={self.error}, stderr={stderr}"
+            )
+        logger.debug(f"StreamingVideoWriter, write {self.n_frames} frames to {self.path}")
+
+    def __enter__(self) -> "StreamingVideoWriter":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> bool:
+        if exc_type is None:
+            self.close()
+        elif self.webp_frames is not None:
+            self.webp_frames = None
+        elif self.process is not None:
+            # 出错时终止 ffmpeg，不覆盖原始异常. kill ffmpeg on error, do not shadow original exception
+            self.queue.put(_END)
+            self.thread.join()
+            self.process.kill()
+            self.process.wait()
+            self.process = None
+        return False
@@ -33,6 +33,7 @@ def download_model():
 download_model()  # for huggingface deployment.
 if not ignore_video2video:
     from gradio_video2video import online_v2v_inference
+    from gradio_video2video import sd_predictor as v2v_sd_predictor
 from gradio_text2video import online_t2v_inference
 
 
@@ -46,6 +47,7 @@ def hf_online_t2v_inference(
     h,
     video_len,
     img_edge_ratio,
+    profile=False,
 ):
     img_edge_ratio, _, _ = limit_shape(
         image_np, w, h, img_edge_ratio, max_image_edge=max_image_edge
@@ -53,7 +55,7 @@ def hf_online_t2v_inference(
     if not isinstance(image_np, np.ndarray):  # None
         raise gr.Error("Need input reference image")
     return online_t2v_inference(
-        prompt, image_np, seed, fps, w, h, video_len, img_edge_ratio
+        prompt, image_np, seed, fps, w, h, video_len, img_edge_ratio, profile=profile
     )
 
 
@@ -69,6 +71,7 @@ def hg_online_v2v_inference(
     h,
     video_length,
     img_edge_ratio,
+    profile=False,
 ):
     img_edge_ratio, _, _ = limit_shape(
         image_np, w, h, img_edge_ratio, max_image_edge=max_image_edge
@@ -86,6 +89,7 @@ def hg_online_v2v_inference(
         h,
         video_length,
         img_edge_ratio,
+        profile=profile,
     )
 
 
@@ -239,6 +243,10 @@ with gr.Blocks(css=css) as demo:
                         value=1.0,
                         interactive=False,
                     )
+                profile = gr.Checkbox(
+                    label="Profile (save stage timing to output_dir/profile)",
+                    value=False,
+                )
                 btn1 = gr.Button("Generate")
             out = gr.Video()
             # pdb.set_trace()
@@ -281,6 +289,7 @@ with gr.Blocks(css=css) as demo:
                 h,
                 video_length,
                 img_edge_ratio_infact,
+                profile,
             ],
             outputs=out,
         )
@@ -340,6 +349,10 @@ with gr.Blocks(css=css) as demo:
                             value=1.0,
                             interactive=False,
                         )
+                    profile = gr.Checkbox(
+                        label="Profile (save stage timing to output_dir/profile)",
+                        value=False,
+                    )
                     btn2 = gr.Button("Generate")
                 out1 = gr.Video()
 
@@ -380,6 +393,7 @@ with gr.Blocks(css=css) as demo:
                     h,
                     video_length,
                     img_edge_ratio_infact,
+                    profile,
                 ],
                 outputs=out1,
             )
@@ -390,6 +404,12 @@ ip_address = "0.0.0.0"  # Replace with your desired IP address
 port_number = 7860  # Replace with your desired port number
 
 
-demo.queue().launch(
-    share=True, debug=True, server_name=ip_address, server_port=port_number
-)
+try:
+    demo.queue().launch(
+        share=True, debug=True, server_name=ip_address, server_port=port_number
+    )
+finally:
+    # gradio 退出时回收 controlnet processor 的 worker 进程，不等到解释器退出
+    # shutdown worker processes of controlnet processor when gradio exits, instead of waiting for interpreter exit
+    if not ignore_video2video:
+        v2v_sd_predictor.close()
@@ -35,6 +35,7 @@ def download_model():
 download_model()  # for huggingface deployment.
 if not ignore_video2video:
     from gradio_video2video import online_v2v_inference
+    from gradio_video2video import sd_predictor as v2v_sd_predictor
 from gradio_text2video import online_t2v_inference
 
 
@@ -392,6 +393,12 @@ ip_address = "0.0.0.0"  # Replace with your desired IP address
 port_number = 7860  # Replace with your desired port number
 
 
-demo.queue().launch(
-    share=True, debug=True, server_name=ip_address, server_port=port_number
-)
+try:
+    demo.queue().launch(
+        share=True, debug=True, server_name=ip_address, server_port=port_number
+    )
+finally:
+    # gradio 退出时回收 controlnet processor 的 worker 进程，不等到解释器退出
+    # shutdown worker processes of controlnet processor when gradio exits, instead of waiting for interpreter exit
+    if not ignore_video2video:
+        v2v_sd_predictor.close()
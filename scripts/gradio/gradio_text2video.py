@@ -43,6 +43,7 @@ from musev.pipelines.pipeline_controlnet_predictor import (
 from musev.models.referencenet import ReferenceNet2D
 from musev.models.unet_loader import load_unet_by_name
 from musev.utils.util import save_videos_grid_with_opencv
+from musev.utils.profiler import NULL_PROFILER, PipelineProfiler
 from musev import logger
 
 use_v2v_predictor = False
@@ -82,6 +83,27 @@ args_dict = {
     "img_length_ratio": 1.0,
     "img_weight": 0.001,
     "interpolation_factor": 1,
+    "deep_cache_interval": 1,
+    "deep_cache_n_shallow_blocks": 1,
+    "refer_token_pool_method": None,
+    "refer_token_pool_ratio": 1.0,
+    "temporal_attn_window": None,
+    "temporal_attn_chunk_size": None,
+    "decoder_t_segment": 200,
+    "memory_budget": None,
+    "enable_phase_offload": False,
+    "weight_quant_bits": None,
+    "compile_unet": False,
+    "resolution_bucket_mode": None,
+    "latent_paging": None,
+    "latent_paging_dir": None,
+    "latent_paging_page_size": 16,
+    "restore_original_size": False,
+    "profile_dir": None,
+    "profile_memory": False,
+    "profile_unet_blocks": False,
+    "token_merge_ratio": 0.0,
+    "token_merge_max_downsample": 1,
     "ip_adapter_face_model_cfg_path": "../../configs/model/ip_adapter.py",
     "ip_adapter_face_model_name": None,
     "ip_adapter_face_scale": 1.0,
@@ -119,6 +141,9 @@ args_dict = {
     "referencenet_model_name": "musev_referencenet",
     "save_filetype": "mp4",
     "save_images": False,
+    "save_images_type": "png",
+    "save_images_quality": None,
+    "save_images_num_workers": 4,
     "sd_model_cfg_path": "../../configs/model/T2I_all_model.py",
     "sd_model_name": "majicmixRealv6Fp16",
     "seed": None,
@@ -134,6 +159,9 @@ args_dict = {
     "video_guidance_scale": 3.5,
     "video_guidance_scale_end": None,
     "video_guidance_scale_method": "linear",
+    "video_guidance_execution_method": "always",
+    "video_guidance_truncate_ratio": 1.0,
+    "video_guidance_uncond_reuse_steps": 0,
     "video_negative_prompt": "V2",
     "video_num_inference_steps": 10,
     "video_overlap": 1,
@@ -176,6 +204,9 @@ num_inference_steps = args.num_inference_steps  # 时序条件帧 重绘参数
 seed = args.seed
 save_filetype = args.save_filetype
 save_images = args.save_images
+save_images_type = args.save_images_type
+save_images_quality = args.save_images_quality
+save_images_num_workers = args.save_images_num_workers
 sd_model_cfg_path = args.sd_model_cfg_path
 sd_model_name = (
     args.sd_model_name
@@ -197,6 +228,9 @@ motion_speed = args.motion_speed
 need_hist_match = args.need_hist_match
 video_guidance_scale_end = args.video_guidance_scale_end
 video_guidance_scale_method = args.video_guidance_scale_method
+video_guidance_execution_method = args.video_guidance_execution_method
+video_guidance_truncate_ratio = args.video_guidance_truncate_ratio
+video_guidance_uncond_reuse_steps = args.video_guidance_uncond_reuse_steps
 add_static_video_prompt = args.add_static_video_prompt
 n_vision_condition = args.n_vision_condition
 lcm_model_cfg_path = args.lcm_model_cfg_path
@@ -242,6 +276,27 @@ context_stride = args.context_stride
 context_overlap = args.context_overlap
 context_batch_size = args.context_batch_size
 interpolation_factor = args.interpolation_factor
+deep_cache_interval = args.deep_cache_interval
+deep_cache_n_shallow_blocks = args.deep_cache_n_shallow_blocks
+refer_token_pool_method = args.refer_token_pool_method
+refer_token_pool_ratio = args.refer_token_pool_ratio
+temporal_attn_window = args.temporal_attn_window
+temporal_attn_chunk_size = args.temporal_attn_chunk_size
+decoder_t_segment = args.decoder_t_segment
+memory_budget = args.memory_budget
+enable_phase_offload = args.enable_phase_offload
+weight_quant_bits = args.weight_quant_bits
+compile_unet = args.compile_unet
+resolution_bucket_mode = args.resolution_bucket_mode
+latent_paging = args.latent_paging
+latent_paging_dir = args.latent_paging_dir
+latent_paging_page_size = args.latent_paging_page_size
+restore_original_size = args.restore_original_size
+profile_dir = args.profile_dir
+profile_memory = args.profile_memory
+profile_unet_blocks = args.profile_unet_blocks
+token_merge_ratio = args.token_merge_ratio
+token_merge_max_downsample = args.token_merge_max_downsample
 n_repeat = args.n_repeat
 
 # parallel_denoise parameter end
@@ -592,6 +647,16 @@ for model_name, sd_model_params in sd_model_params_dict.items():
             vae_model=test_model_vae_model_path,
             ip_adapter_face_emb_extractor=ip_adapter_face_emb_extractor,
             ip_adapter_face_image_proj=ip_adapter_face_image_proj,
+            token_merge_ratio=token_merge_ratio,
+            token_merge_max_downsample=token_merge_max_downsample,
+            memory_budget=memory_budget,
+            enable_phase_offload=enable_phase_offload,
+            weight_quant_bits=weight_quant_bits,
+            compile_unet=compile_unet,
+            resolution_bucket_mode=resolution_bucket_mode,
+            latent_paging=latent_paging,
+            latent_paging_dir=latent_paging_dir,
+            latent_paging_page_size=latent_paging_page_size,
         )
         if not use_v2v_predictor
         else video_sd_predictor
@@ -620,9 +685,15 @@ def online_t2v_inference(
     h,
     video_len,
     img_edge_ratio: float = 1.0,
+    profile: bool = False,
     progress=gr.Progress(track_tqdm=True),
 ):
     progress(0, desc="Starting...")
+    # 单次请求开启 profile 时，未配置 profile_dir 则存到 output_dir/profile
+    # when profile is enabled per request and profile_dir is not set, save to output_dir/profile
+    request_profile_dir = profile_dir
+    if profile and request_profile_dir is None:
+        request_profile_dir = os.path.join(output_dir, "profile")
     # Save the uploaded image to a specified path
     if not os.path.exists(CACHE_PATH):
         os.makedirs(CACHE_PATH)
@@ -862,6 +933,14 @@ def online_t2v_inference(
             continue
 
         print("output_path", output_path)
+        profiler = (
+            PipelineProfiler(
+                record_memory=profile_memory,
+                unet_block_hooks=profile_unet_blocks,
+            )
+            if request_profile_dir is not None
+            else NULL_PROFILER
+        )
         out_videos = sd_predictor.run_pipe_text2video(
             video_length=time_size,
             prompt=prompt,
@@ -888,6 +967,9 @@ def online_t2v_inference(
             need_hist_match=need_hist_match,
             video_guidance_scale_end=video_guidance_scale_end,
             video_guidance_scale_method=video_guidance_scale_method,
+            video_guidance_execution_method=video_guidance_execution_method,
+            video_guidance_truncate_ratio=video_guidance_truncate_ratio,
+            video_guidance_uncond_reuse_steps=video_guidance_uncond_reuse_steps,
             vision_condition_latent_index=test_data_condition_images_index,
             refer_image=test_data_refer_image,
             fixed_refer_image=fixed_refer_image,
@@ -917,21 +999,36 @@ def online_t2v_inference(
             context_overlap=context_overlap,
             context_batch_size=context_batch_size,
             interpolation_factor=interpolation_factor,
+            deep_cache_interval=deep_cache_interval,
+            deep_cache_n_shallow_blocks=deep_cache_n_shallow_blocks,
+            refer_token_pool_method=refer_token_pool_method,
+            refer_token_pool_ratio=refer_token_pool_ratio,
+            temporal_attn_window=temporal_attn_window,
+            temporal_attn_chunk_size=temporal_attn_chunk_size,
+            decoder_t_segment=decoder_t_segment,
+            restore_original_size=restore_original_size,
+            profiler=profiler,
             # parallel_denoise parameter end
         )
         out = np.concatenate([out_videos], axis=0)
         texts = ["out"]
-        save_videos_grid_with_opencv(
-            out,
-            output_path,
-            texts=texts,
-            fps=fps,
-            tensor_order="b c t h w",
-            n_cols=n_cols,
-            write_info=args.write_info,
-            save_filetype=save_filetype,
-            save_images=save_images,
-        )
+        with profiler.record("save_video"):
+            save_videos_grid_with_opencv(
+                out,
+                output_path,
+                texts=texts,
+                fps=fps,
+                tensor_order="b c t h w",
+                n_cols=n_cols,
+                write_info=args.write_info,
+                save_filetype=save_filetype,
+                save_images=save_images,
+                save_images_type=save_images_type,
+                save_images_quality=save_images_quality,
+                save_images_num_workers=save_images_num_workers,
+            )
+        if request_profile_dir is not None:
+            profiler.save(os.path.join(request_profile_dir, save_file_name))
         print("Save to", output_path)
         print("\n" * 2)
         return output_path
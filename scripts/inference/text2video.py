@@ -38,6 +38,9 @@ from musev.models.ip_adapter_face_loader import (
 from musev.pipelines.pipeline_controlnet_predictor import (
     DiffusersPipelinePredictor,
 )
+from musev.pipelines.memory_planner import int_or_auto
+from musev.utils.profiler import NULL_PROFILER, PipelineProfiler
+from musev.pipelines.context_parallel import init_context_parallel, is_main_process
 from musev.models.referencenet import ReferenceNet2D
 from musev.models.unet_loader import load_unet_by_name
 from musev.utils.util import save_videos_grid_with_opencv
@@ -191,6 +194,25 @@ def parse_args():
         default=False,
         help="more than video, whether save generated video into images, default=`False`",
     )
+    parser.add_argument(
+        "--save_images_type",
+        type=str,
+        default="png",
+        help="image format of --save_images, default=`png`",
+        choices=["png", "jpg", "webp"],
+    )
+    parser.add_argument(
+        "--save_images_quality",
+        type=int,
+        default=None,
+        help="png compression level 0-9, jpg or webp quality 0-100 of --save_images, None means default of format, webp default is lossless, default=`None`",
+    )
+    parser.add_argument(
+        "--save_images_num_workers",
+        type=int,
+        default=4,
+        help="num of threads exporting images of --save_images concurrently with video encoding, 0 means synchronously, default=`4`",
+    )
     parser.add_argument(
         "--overwrite",
         action="store_true",
@@ -317,6 +339,25 @@ def parse_args():
         help="generate  changed video_guidance_scale with timesteps, default=`linear`",
         choices=["linear", "two_stage", "three_stage", "fix_two_stage"],
     ),
+    parser.add_argument(
+        "--video_guidance_execution_method",
+        type=str,
+        default="always",
+        help="how to run uncond branch of video cfg to reduce unet compute, `truncate` stops uncond after video_guidance_truncate_ratio of steps, `reuse_uncond` reuses uncond for video_guidance_uncond_reuse_steps steps, default=`always`",
+        choices=["always", "truncate", "reuse_uncond"],
+    ),
+    parser.add_argument(
+        "--video_guidance_truncate_ratio",
+        type=float,
+        default=1.0,
+        help="ratio of steps running uncond branch when video_guidance_execution_method=truncate, default=`1.0`",
+    ),
+    parser.add_argument(
+        "--video_guidance_uncond_reuse_steps",
+        type=int,
+        default=0,
+        help="num of steps reusing last uncond prediction when video_guidance_execution_method=reuse_uncond, default=`0`",
+    ),
     parser.add_argument(
         "--num_inference_steps",
         type=int,
@@ -524,8 +565,8 @@ def parse_args():
     parser.add_argument(
         "--context_batch_size",
         default=1,
-        type=int,
-        help="num of subshot in parallel denoise, change in batch_size, need more gpu memory, default=`1`",
+        type=int_or_auto,
+        help="num of subshot in parallel denoise, change in batch_size, need more gpu memory, `auto` means planned with memory budget, default=`1`",
     )
     parser.add_argument(
         "--interpolation_factor",
@@ -533,6 +574,136 @@ def parse_args():
         type=int,
         help="whether do super resolution to latents, `1` means do nothing, default=`1`",
     )
+    parser.add_argument(
+        "--deep_cache_interval",
+        type=int,
+        default=1,
+        help="the first step of every deep_cache_interval steps runs the full unet, the others reuse cached deep features, `1` means no deep cache, default=`1`",
+    )
+    parser.add_argument(
+        "--deep_cache_n_shallow_blocks",
+        type=int,
+        default=1,
+        help="num of shallow down_blocks/up_blocks run in deep cache cheap step, default=`1`",
+    )
+    parser.add_argument(
+        "--refer_token_pool_method",
+        type=str,
+        default=None,
+        help="method to reduce reference tokens of referencenet and vision condition frames in referenceonly attn, `None` means no reduction, default=`None`",
+        choices=["stride", "topk_norm", "cluster"],
+    )
+    parser.add_argument(
+        "--refer_token_pool_ratio",
+        type=float,
+        default=1.0,
+        help="ratio of reference tokens to keep in referenceonly attn, default=`1.0`",
+    )
+    parser.add_argument(
+        "--temporal_attn_window",
+        type=int_or_auto,
+        default=None,
+        help="every frame only attends frames within ±temporal_attn_window and condition frames in temporal attn, computed chunk by chunk, `None` means full attn, `auto` means planned with memory budget, default=`None`",
+    )
+    parser.add_argument(
+        "--temporal_attn_chunk_size",
+        type=int,
+        default=None,
+        help="num of frames in one query chunk of local temporal attn, `None` means temporal_attn_window, default=`None`",
+    )
+    parser.add_argument(
+        "--decoder_t_segment",
+        type=int_or_auto,
+        default=200,
+        help="num of frames decoded by vae at once, `auto` means planned with memory budget, default=`200`",
+    )
+    parser.add_argument(
+        "--memory_budget",
+        type=float,
+        default=None,
+        help="gpu memory budget in GB for `auto` parameters, `None` means 90%% of free gpu memory, default=`None`",
+    )
+    parser.add_argument(
+        "--enable_phase_offload",
+        action="store_true",
+        help="keep text_encoder, image encoders, referencenet, vae and unet on gpu only in the inference phase which needs them, with pinned memory and prefetch, for low-vram gpu",
+    )
+    parser.add_argument(
+        "--weight_quant_bits",
+        type=int,
+        default=None,
+        help="weight-only quantization bits of attn and ff linears in unet, referencenet and controlnet, `None` means no quantization. saves weight memory; only 8 bits on cpu is faster, 4 bits and all gpu layers dequantize weights every forward and are slower, default=`None`",
+        choices=[4, 8],
+    )
+    parser.add_argument(
+        "--compile_unet",
+        action="store_true",
+        help="compile unet with torch.compile, once with static shapes for every resolution bucket",
+    )
+    parser.add_argument(
+        "--resolution_bucket_mode",
+        type=str,
+        default=None,
+        help="snap requested height and width to resolution buckets, and center crop or pad inputs to bucket, `None` means no bucketing, default=`None`",
+        choices=["crop", "pad"],
+    )
+    parser.add_argument(
+        "--restore_original_size",
+        action="store_true",
+        help="crop or resize outputs of resolution bucket back to original height and width",
+    )
+    parser.add_argument(
+        "--profile_dir",
+        type=str,
+        default=None,
+        help="save per request profile of stages, json summary and chrome trace, to this dir, `None` means no profiling, default=`None`",
+    )
+    parser.add_argument(
+        "--profile_memory",
+        action="store_true",
+        help="record peak cuda memory of every stage in profile",
+    )
+    parser.add_argument(
+        "--profile_unet_blocks",
+        action="store_true",
+        help="record time of every down/mid/up block of unet in profile",
+    )
+    parser.add_argument(
+        "--context_parallel",
+        action="store_true",
+        help="spread context windows of every step across processes launched by torchrun, gloo on cpu, nccl on gpu. only rank 0 saves videos",
+    )
+    parser.add_argument(
+        "--latent_paging",
+        type=str,
+        default=None,
+        help="keep full-length latents, noise_pred and control images in pinned host memory or memory-mapped file, only move frames of current window to device, for single-call very long video, `None` means no paging, default=`None`",
+        choices=["pinned", "memmap"],
+    )
+    parser.add_argument(
+        "--latent_paging_dir",
+        type=str,
+        default=None,
+        help="dir of memory-mapped files of latent paging, `None` means system temp dir, default=`None`",
+    )
+    parser.add_argument(
+        "--latent_paging_page_size",
+        type=int,
+        default=16,
+        help="number of frames per page of scheduler step in latent paging, default=`16`",
+    )
+    parser.add_argument(
+        "--token_merge_ratio",
+        type=float,
+        default=0.0,
+        help="ratio of tokens merged in spatial self-attn of unet and referencenet, `0` means no token merging, default=`0.0`",
+    )
+    parser.add_argument(
+        "--token_merge_max_downsample",
+        type=int,
+        default=1,
+        help="only merge tokens in blocks whose downsample <= token_merge_max_downsample, one of 1,2,4,8, default=`1`",
+    )
     parser.add_argument(
         "--n_repeat",
         default=1,
@@ -574,6 +745,9 @@ num_inference_steps = args.num_inference_steps  # 时序条件帧 重绘参数
 seed = args.seed
 save_filetype = args.save_filetype
 save_images = args.save_images
+save_images_type = args.save_images_type
+save_images_quality = args.save_images_quality
+save_images_num_workers = args.save_images_num_workers
 sd_model_cfg_path = args.sd_model_cfg_path
 sd_model_name = (
     args.sd_model_name
@@ -595,6 +769,9 @@ motion_speed = args.motion_speed
 need_hist_match = args.need_hist_match
 video_guidance_scale_end = args.video_guidance_scale_end
 video_guidance_scale_method = args.video_guidance_scale_method
+video_guidance_execution_method = args.video_guidance_execution_method
+video_guidance_truncate_ratio = args.video_guidance_truncate_ratio
+video_guidance_uncond_reuse_steps = args.video_guidance_uncond_reuse_steps
 add_static_video_prompt = args.add_static_video_prompt
 n_vision_condition = args.n_vision_condition
 lcm_model_cfg_path = args.lcm_model_cfg_path
@@ -640,6 +817,32 @@ context_stride = args.context_stride
 context_overlap = args.context_overlap
 context_batch_size = args.context_batch_size
 interpolation_factor = args.interpolation_factor
+deep_cache_interval = args.deep_cache_interval
+deep_cache_n_shallow_blocks = args.deep_cache_n_shallow_blocks
+refer_token_pool_method = args.refer_token_pool_method
+refer_token_pool_ratio = args.refer_token_pool_ratio
+temporal_attn_window = args.temporal_attn_window
+temporal_attn_chunk_size = args.temporal_attn_chunk_size
+decoder_t_segment = args.decoder_t_segment
+memory_budget = args.memory_budget
+enable_phase_offload = args.enable_phase_offload
+weight_quant_bits = args.weight_quant_bits
+compile_unet = args.compile_unet
+resolution_bucket_mode = args.resolution_bucket_mode
+restore_original_size = args.restore_original_size
+profile_dir = args.profile_dir
+profile_memory = args.profile_memory
+profile_unet_blocks = args.profile_unet_blocks
+context_parallel = args.context_parallel
+latent_paging = args.latent_paging
+latent_paging_dir = args.latent_paging_dir
+latent_paging_page_size = args.latent_paging_page_size
+if context_parallel:
+    # 每个进程使用自己的 device，随机种子需相同
+    # every process uses its own device, random seed should be the same
+    _, _, device = init_context_parallel()
+token_merge_ratio = args.token_merge_ratio
+token_merge_max_downsample = args.token_merge_max_downsample
 n_repeat = args.n_repeat
 
 # parallel_denoise parameter end
@@ -990,6 +1193,17 @@ for model_name, sd_model_params in sd_model_params_dict.items():
         vae_model=test_model_vae_model_path,
         ip_adapter_face_emb_extractor=ip_adapter_face_emb_extractor,
         ip_adapter_face_image_proj=ip_adapter_face_image_proj,
+        token_merge_ratio=token_merge_ratio,
+        token_merge_max_downsample=token_merge_max_downsample,
+        memory_budget=memory_budget,
+        enable_phase_offload=enable_phase_offload,
+        weight_quant_bits=weight_quant_bits,
+        compile_unet=compile_unet,
+        resolution_bucket_mode=resolution_bucket_mode,
+        context_parallel=context_parallel,
+        latent_paging=latent_paging,
+        latent_paging_dir=latent_paging_dir,
+        latent_paging_page_size=latent_paging_page_size,
     )
     logger.debug(f"load referencenet"),
 
@@ -1224,6 +1438,14 @@ for model_name, sd_model_params in sd_model_params_dict.items():
             if os.path.exists(output_path) and not overwrite:
                 print("existed", output_path)
                 continue
+            profiler = (
+                PipelineProfiler(
+                    record_memory=profile_memory,
+                    unet_block_hooks=profile_unet_blocks,
+                )
+                if profile_dir is not None
+                else NULL_PROFILER
+            )
 
             print("output_path", output_path)
             out_videos = sd_predictor.run_pipe_text2video(
@@ -1252,6 +1474,9 @@ for model_name, sd_model_params in sd_model_params_dict.items():
                 need_hist_match=need_hist_match,
                 video_guidance_scale_end=video_guidance_scale_end,
                 video_guidance_scale_method=video_guidance_scale_method,
+                video_guidance_execution_method=video_guidance_execution_method,
+                video_guidance_truncate_ratio=video_guidance_truncate_ratio,
+                video_guidance_uncond_reuse_steps=video_guidance_uncond_reuse_steps,
                 vision_condition_latent_index=test_data_condition_images_index,
                 refer_image=test_data_refer_image,
                 fixed_refer_image=fixed_refer_image,
@@ -1279,20 +1504,41 @@ for model_name, sd_model_params in sd_model_params_dict.items():
                 context_overlap=context_overlap,
                 context_batch_size=context_batch_size,
                 interpolation_factor=interpolation_factor,
+                deep_cache_interval=deep_cache_interval,
+                deep_cache_n_shallow_blocks=deep_cache_n_shallow_blocks,
+                refer_token_pool_method=refer_token_pool_method,
+                refer_token_pool_ratio=refer_token_pool_ratio,
+                temporal_attn_window=temporal_attn_window,
+                temporal_attn_chunk_size=temporal_attn_chunk_size,
+                decoder_t_segment=decoder_t_segment,
+                restore_original_size=restore_original_size,
+                profiler=profiler,
                 # parallel_denoise parameter end
             )
+            # context window 并行时只有 rank 0 保存结果
+            # only rank 0 saves results in context parallel
+            if not is_main_process():
+                continue
             out = np.concatenate([out_videos], axis=0)
             texts = ["out"]
-            save_videos_grid_with_opencv(
-                out,
-                output_path,
-                texts=texts,
-                fps=fps,
-                tensor_order="b c t h w",
-                n_cols=n_cols,
-                write_info=args.write_info,
-                save_filetype=save_filetype,
-                save_images=save_images,
-            )
+            with profiler.record("save_video"):
+                save_videos_grid_with_opencv(
+                    out,
+                    output_path,
+                    texts=texts,
+                    fps=fps,
+                    tensor_order="b c t h w",
+                    n_cols=n_cols,
+                    write_info=args.write_info,
+                    save_filetype=save_filetype,
+                    save_images=save_images,
+                    save_images_type=save_images_type,
+                    save_images_quality=save_images_quality,
+                    save_images_num_workers=save_images_num_workers,
+                )
             print("Save to", output_path)
+            if profile_dir is not None:
+                profiler.save(os.path.join(profile_dir, save_file_name))
             print("\n" * 2)
+    if resolution_bucket_mode is not None:
+        print("resolution bucket report", sd_predictor.resolution_bucket_report())